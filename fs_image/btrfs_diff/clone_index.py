@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+`CloneIndex` is an online answer to "what clones what?".  Without it,
+finding the `ChunkClone`s of even one file means running
+`extents_to_chunks_with_clones` over every inode of a `SubvolumeSet`,
+which is what `freeze` used to do each time it was called.
+
+Cloned storage is always represented by a single leaf `Extent` object,
+shared by all of its clones (see `extent.py`).  Therefore, the
+`ChunkClone`s of an inode depend only on the extents of its "neighbors",
+i.e. the inodes that reference at least one of the same leaves.  We keep
+a map from each leaf to the inodes referencing it, and to compute the
+`Chunk`s of one inode, we run `extents_to_chunks_with_clones` on just
+that inode and its neighbors.  The result is identical to the one from a
+whole-filesystem pass, since the `ChunkClone`s of an inode never mention
+inodes outside of its neighborhood.
+
+Computed `Chunk`s are cached.  When an inode's extent changes, we evict
+the cached `Chunk`s of the inode, and of its old & new neighbors -- no
+other inode can have a `ChunkClone` that changed.  Thus, querying again
+after applying a few more send-stream items costs time proportional to
+what those items changed, not to the size of the filesystem.
+
+`update()` only records the new extent.  The leaves are enumerated
+lazily, on the next query, since e.g. a file built up from many `write`s
+would otherwise get re-scanned once per `write`.  Likewise,
+`update_subvolume()` defers the pass over the files of a new snapshot,
+keeping snapshots cheap, see `Subvolume.snapshot`.
+
+`copy.deepcopy` alert: like `extents_to_chunks.py`, we key leaves by
+`id()`.  This stays correct under `deepcopy` because `Extent`s are not
+copied, and because we store the indexed `Extent`s, ensuring that no leaf
+we track is garbage-collected, and has its `id()` reused.  `InodeID`s
+must only be `deepcopy`d together with their `InodeIDMap`, as usual.
+'''
+from typing import (
+    Dict, Iterable, List, Mapping, Optional, Sequence, Set,
+)
+
+from .extent import Extent
+from .extents_to_chunks import extents_to_chunks_with_clones
+from .inode import Chunk
+from .inode_id import InodeID
+from .subvolume import Subvolume
+
+
+class CloneIndex:
+
+    def __init__(self):
+        # The `Extent` of each inode, as of the last `_flush()`.
+        self._id_to_extent: Dict[InodeID, Extent] = {}
+        # `None` marks inodes that were deleted, or are no longer files.
+        self._id_to_pending_extent: Dict[InodeID, Optional[Extent]] = {}
+        self._id_to_leaf_ids: Dict[InodeID, Set[int]] = {}
+        self._leaf_id_to_ids: Dict[int, Set[InodeID]] = {}
+        self._id_to_chunks: Dict[InodeID, Sequence[Chunk]] = {}
+        # Subvolumes whose files we have yet to `update`
+        self._pending_subvols: List[Subvolume] = []
+
+    def update(self, ino_id: InodeID, extent: Optional[Extent]) -> None:
+        'Call this whenever the `Extent` of `ino_id` changes, or it is gone.'
+        self._id_to_pending_extent[ino_id] = extent
+
+    def update_subvolume(self, subvol: Subvolume) -> None:
+        '''
+        Like calling `update` on each file of `subvol`, which is e.g. a
+        new snapshot.  The pass over its inodes waits for the next query.
+        '''
+        self._pending_subvols.append(subvol)
+
+    def _flush(self) -> None:
+        for subvol in self._pending_subvols:
+            for ino_id, extent in subvol._inode_ids_and_extents():
+                # Any pending extent is already the current one.
+                self._id_to_pending_extent.setdefault(ino_id, extent)
+        self._pending_subvols.clear()
+        for ino_id, extent in self._id_to_pending_extent.items():
+            if extent is not self._id_to_extent.get(ino_id):
+                self._reindex(ino_id, extent)
+        self._id_to_pending_extent.clear()
+
+    def _evict(self, ino_ids: Iterable[InodeID]) -> None:
+        for ino_id in ino_ids:
+            self._id_to_chunks.pop(ino_id, None)
+
+    def _reindex(self, ino_id: InodeID, extent: Optional[Extent]) -> None:
+        self._id_to_chunks.pop(ino_id, None)
+        for leaf_id in self._id_to_leaf_ids.pop(ino_id, ()):
+            ids = self._leaf_id_to_ids[leaf_id]
+            ids.remove(ino_id)
+            self._evict(ids)  # Old neighbors lost their clones of `ino_id`
+            if not ids:
+                del self._leaf_id_to_ids[leaf_id]
+        # Only now that we no longer track them may the old leaves be freed.
+        if extent is None:
+            self._id_to_extent.pop(ino_id, None)
+            return
+        self._id_to_extent[ino_id] = extent
+        leaf_ids = {id(leaf) for _, _, leaf in extent.gen_trimmed_leaves()}
+        self._id_to_leaf_ids[ino_id] = leaf_ids
+        for leaf_id in leaf_ids:
+            ids = self._leaf_id_to_ids.setdefault(leaf_id, set())
+            self._evict(ids)  # New neighbors gained clones of `ino_id`
+            ids.add(ino_id)
+
+    def _neighbors(self, ino_id: InodeID) -> Set[InodeID]:
+        'Returns the inodes sharing leaves with `ino_id`, including itself.'
+        neighbors = {ino_id}
+        for leaf_id in self._id_to_leaf_ids[ino_id]:
+            neighbors.update(self._leaf_id_to_ids[leaf_id])
+        return neighbors
+
+    def chunks(self, ino_id: InodeID) -> Sequence[Chunk]:
+        '''
+        Returns the same `Chunk`s for the file `ino_id` as a
+        whole-filesystem `extents_to_chunks_with_clones` would.
+        Raises `KeyError` if `ino_id` is not a file.
+        '''
+        self._flush()
+        chunks = self._id_to_chunks.get(ino_id)
+        if chunks is not None:
+            return chunks
+        neighbors = self._neighbors(ino_id)
+        for other_id, other_chunks in extents_to_chunks_with_clones([
+            (i, self._id_to_extent[i]) for i in neighbors
+        ]):
+            # The `Chunk`s of other inodes are also exact if they have no
+            # neighbors outside of this set.  This is the common case for
+            # a group of clones, so it makes sense to cache them.
+            if other_id == ino_id or self._neighbors(other_id) <= neighbors:
+                self._id_to_chunks[other_id] = other_chunks
+        return self._id_to_chunks[ino_id]
+
+    def id_to_chunks(self) -> Mapping[InodeID, Sequence[Chunk]]:
+        'The `Chunk`s of all files, suitable for `Subvolume.freeze`.'
+        self._flush()
+        return {ino_id: self.chunks(ino_id) for ino_id in self._id_to_extent}
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+`CompactInodeIDMap` is a drop-in alternative to `InodeIDMap`, meant for
+images with millions of inodes, where the path map dominates our memory.
+
+`InodeIDMap` spends a `_PathEntry`, a `set` of `_ReversePathEntry`s, and
+a `defaultdict` slot on every inode, and it finds the reverse entry for a
+path by re-walking the paths of each hardlink.  Instead, we keep:
+  - one `dict` of `name -> child inode number` per directory,
+  - per inode number, in flat lists: the parent inode number, the name in
+    the parent, the children `dict` (or `None` for non-directories), and
+    the rare extra hardlinks of a file,
+  - one copy of each distinct name, since file names repeat a lot across
+    directories (`__init__.py`, `README`, ...).
+
+All the path operations are O(path depth), and hardlink checks are O(1).
+
+The API is that of `InodeIDMap`, including `freeze` and `deepcopy`
+support, and `InodeID`s work the same way.  On a synthetic 1M-path tree,
+this map needs ~150MB instead of ~530MB, and adds, finds, and removes
+paths ~1.7-2.3x faster, see `tests/benchmark_inode_id.py`.
+
+Additionally, `snapshot` and `freeze` take O(1) time, since the flat
+lists are `CowList`s.
+'''
+import itertools
+
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from .cow_list import CowList
+from .freeze import freeze
+from .inode_id import InodeID, _norm_split_path
+
+_NO_PARENT = -1  # For the root, and for inodes that have no paths
+_ROOT = 0  # The inode number of the root directory
+
+
+class _CompactInnerInodeIDMap:
+    '''
+    Plays the role of `_InnerInodeIDMap`: it is what `InodeID`s refer to,
+    so it holds all the state, except for the ID counter.
+    '''
+
+    def __init__(self, *, description: Any):
+        self.description = description  # repr()able, for repr()ing InodeIDs
+        self.frozen = False
+        # These are indexed by inode number.  `id_to_name[i]` is the name
+        # of `i` in the directory `id_to_parent[i]`, if it has a path.
+        self.id_to_parent = CowList()
+        self.id_to_name = CowList()
+        # `None` for files & other non-directories.  Use `get_mutable` to
+        # change these `dict`s, since snapshots share them.
+        self.id_to_children = CowList(copy_item=dict.copy)
+        # Any links beyond the first one, as a tuple of (parent, name).
+        self.id_to_extra_links = CowList()
+        # The `InodeID` objects that we handed out, so that we keep
+        # returning the same ones.  Not shared with snapshots.
+        self.id_to_inode_id: List[Optional[InodeID]] = []
+        # Only grows, so snapshots share it.
+        self.interned_names: Dict[bytes, bytes] = {}
+
+    def snapshot(self, *, description: Any) -> '_CompactInnerInodeIDMap':
+        'Returns a copy of `self`, which initially shares our storage.'
+        snapshot = _CompactInnerInodeIDMap(description=description)
+        snapshot.id_to_parent = self.id_to_parent.snapshot()
+        snapshot.id_to_name = self.id_to_name.snapshot()
+        snapshot.id_to_children = self.id_to_children.snapshot()
+        snapshot.id_to_extra_links = self.id_to_extra_links.snapshot()
+        snapshot.interned_names = self.interned_names
+        return snapshot
+
+    def freeze(self, *, _memo) -> '_CompactInnerInodeIDMap':
+        frozen = self.snapshot(
+            description=freeze(self.description, _memo=_memo),
+        )
+        frozen.frozen = True
+        return frozen
+
+    def _assert_mine(self, inode_id: InodeID) -> InodeID:
+        if inode_id.inner_id_map is not self:
+            # Avoid InodeID.__repr__ since that would recurse infinitely.
+            raise RuntimeError(f'Wrong map for InodeID #{inode_id.id}')
+        return inode_id
+
+    def _set_inode_id(self, inode_id: InodeID) -> None:
+        ino = inode_id.id
+        missing = ino + 1 - len(self.id_to_inode_id)
+        if missing > 0:
+            self.id_to_inode_id.extend([None] * missing)
+        self.id_to_inode_id[ino] = inode_id
+
+    def _inode_id(self, ino: int) -> InodeID:
+        if ino < len(self.id_to_inode_id):
+            inode_id = self.id_to_inode_id[ino]
+            if inode_id is not None:
+                return inode_id
+        inode_id = InodeID(id=ino, inner_id_map=self)
+        self._set_inode_id(inode_id)
+        return inode_id
+
+    def _gen_links(self, ino: int) -> Iterator[Tuple[int, bytes]]:
+        if ino < len(self.id_to_parent):
+            parent = self.id_to_parent.items[ino]
+            if parent != _NO_PARENT:
+                yield parent, self.id_to_name.items[ino]
+            yield from self.id_to_extra_links.items[ino] or ()
+
+    def _path(self, parent: int, name: bytes) -> bytes:
+        id_to_name = self.id_to_name.items
+        id_to_parent = self.id_to_parent.items
+        parts = [name]
+        while parent != _ROOT:
+            parts.append(id_to_name[parent])
+            parent = id_to_parent[parent]
+        return b'/'.join(reversed(parts))
+
+    def gen_paths(self, inode_id: InodeID) -> Iterator[bytes]:
+        ino = self._assert_mine(inode_id).id
+        if ino == _ROOT:
+            yield b'.'
+            return
+        for parent, name in self._gen_links(ino):
+            yield self._path(parent, name)
+
+
+class CompactInodeIDMap:
+    'Has the same API as `InodeIDMap`, read its docblock.'
+
+    def __init__(self, *, inode_id_counter, inner: _CompactInnerInodeIDMap):
+        self.inode_id_counter = inode_id_counter
+        self.inner = inner
+
+    @classmethod
+    def new(cls, *, description: Any = '') -> 'CompactInodeIDMap':
+        self = cls(
+            inode_id_counter=itertools.count(),
+            inner=_CompactInnerInodeIDMap(description=description),
+        )
+        root_id = self.next()
+        assert root_id.id == _ROOT
+        self._set_inode(root_id, children={})
+        return self
+
+    def freeze(self, *, _memo) -> 'CompactInodeIDMap':
+        'Returns a recursively immutable copy of `self`.'
+        return type(self)(
+            inode_id_counter=None,  # can't add IDs once frozen
+            inner=freeze(self.inner, _memo=_memo),
+        )
+
+    def snapshot(self, *, description: Any) -> 'CompactInodeIDMap':
+        '''
+        Returns a copy of `self` with a new `description`, which shares no
+        mutable state with `self`.  The copy issues the same inode numbers
+        as `self` would, but its `InodeID`s refer to the copy.
+        '''
+        next_id = next(self.inode_id_counter)
+        self.inode_id_counter = itertools.count(next_id)
+        return type(self)(
+            inode_id_counter=itertools.count(next_id),
+            inner=self.inner.snapshot(description=description),
+        )
+
+    def next(self) -> InodeID:
+        return InodeID(
+            id=next(self.inode_id_counter), inner_id_map=self.inner,
+        )
+
+    def _check_mutable(self):
+        if self.inner.frozen:
+            raise TypeError(f'Cannot change a frozen {type(self).__name__}')
+
+    def _set_inode(
+        self, ino_id: InodeID, *, children: Optional[Dict[bytes, int]],
+    ) -> None:
+        'Makes room for `ino_id` in the lists, and sets its children.'
+        inner = self.inner
+        ino = ino_id.id
+        if ino >= len(inner.id_to_parent):
+            # Over-allocate a bit, so that adding a path is amortized O(1).
+            length = ino + 1 + len(inner.id_to_parent) // 8
+            inner.id_to_parent.grow(length, _NO_PARENT)
+            inner.id_to_name.grow(length, None)
+            inner.id_to_children.grow(length, None)
+            inner.id_to_extra_links.grow(length, None)
+        inner.id_to_children.set(ino, children)
+        inner._set_inode_id(ino_id)
+
+    def _walk(self, parts, num_parts=None) -> Optional[int]:
+        '''
+        Returns the inode number at the first `num_parts` of `parts`
+        (default: all), or None if it is missing.
+        '''
+        id_to_children = self.inner.id_to_children.items
+        ino = _ROOT
+        for name in itertools.islice(parts, num_parts):
+            children = id_to_children[ino]
+            if children is None:
+                raise RuntimeError(f"{name}'s parent in {parts} is a file")
+            ino = children.get(name)
+            if ino is None:
+                return None
+        return ino
+
+    def _get_parts_parent_and_ino(
+        self, path: bytes,
+    ) -> Tuple[List[bytes], int, int]:
+        'Contract: never call this on the root, aka empty `parts`'
+        parts = _norm_split_path(path)
+        if not parts:
+            raise RuntimeError('Cannot remove the root path')
+        parent = self._walk(parts, len(parts) - 1)
+        ino = None
+        if parent is not None:
+            siblings = self.inner.id_to_children.items[parent]
+            if siblings is None:
+                raise RuntimeError(
+                    f"{parts[-1]}'s parent in {parts} is a file"
+                )
+            ino = siblings.get(parts[-1])
+        if ino is None:
+            raise RuntimeError(f'Cannot remove non-existent {path}')
+        return parts, parent, ino
+
+    # We must differentiate between files and directories because hardlinks
+    # to directories would cause a combinatorial explosion of possible paths
+    # to a file, which would unnecessarily complicate our implementation.
+
+    def add_file(self, ino_id: InodeID, path: bytes) -> InodeID:
+        self._add_path(ino_id, path, is_dir=False)
+        return ino_id
+
+    def add_dir(self, ino_id: InodeID, path: bytes) -> InodeID:
+        self._add_path(ino_id, path, is_dir=True)
+        return ino_id
+
+    def _add_path(self, ino_id: InodeID, path: bytes, *, is_dir) -> None:
+        inner = self.inner
+        inner._assert_mine(ino_id)
+        ino = ino_id.id
+
+        # Block an ID from being added as both a file and a directory, ban
+        # directory hardlinks.
+        has_links = next(inner._gen_links(ino), None) is not None
+        if has_links and (
+            is_dir or inner.id_to_children.items[ino] is not None
+        ):
+            raise RuntimeError(f'Tried to add non-file hardlink for {ino_id}')
+
+        parts = _norm_split_path(path)
+        parent = self._walk(parts[:-1])
+        if parent is None:
+            raise RuntimeError(f'Missing ancestor for {path}')
+        if inner.id_to_children.items[parent] is None:
+            raise RuntimeError(f"The parent of {path} is a file")
+
+        name = parts[-1]
+        old = inner.id_to_children.items[parent].get(name)
+        if old is not None:
+            raise RuntimeError(f'Adding #{ino} to {path} which has #{old}')
+
+        self._check_mutable()
+        name = inner.interned_names.setdefault(name, name)
+        if not has_links:
+            # A renamed directory keeps its children, see `rename_path`.
+            if not is_dir or ino >= len(inner.id_to_children) \
+                    or inner.id_to_children.items[ino] is None:
+                self._set_inode(ino_id, children={} if is_dir else None)
+            else:
+                inner._set_inode_id(ino_id)
+        inner.id_to_children.get_mutable(parent)[name] = ino
+        if inner.id_to_parent.items[ino] == _NO_PARENT:
+            inner.id_to_parent.set(ino, parent)
+            inner.id_to_name.set(ino, name)
+        else:
+            inner.id_to_extra_links.set(ino, (
+                *(inner.id_to_extra_links.items[ino] or ()), (parent, name),
+            ))
+
+    def remove_path(self, path: bytes) -> InodeID:
+        _parts, _parent, ino = self._get_parts_parent_and_ino(path)
+        if self.inner.id_to_children.items[ino]:
+            raise RuntimeError(f'Cannot remove {path} since it has children')
+        return self._remove_path_unsafe(path)
+
+    def _remove_path_unsafe(self, path: bytes) -> InodeID:
+        'Does not check if path has children, used by `rename_path`.'
+        parts, parent, ino = self._get_parts_parent_and_ino(path)
+        self._check_mutable()
+        inner = self.inner
+        name = parts[-1]
+        del inner.id_to_children.get_mutable(parent)[name]
+        extra_links = inner.id_to_extra_links.items[ino] or ()
+        if (parent, name) == (
+            inner.id_to_parent.items[ino], inner.id_to_name.items[ino],
+        ):
+            # Promote another link to be the first one, if we have any.
+            new_parent, new_name = extra_links[-1] if extra_links \
+                else (_NO_PARENT, None)
+            inner.id_to_parent.set(ino, new_parent)
+            inner.id_to_name.set(ino, new_name)
+            extra_links = extra_links[:-1]
+        else:
+            extra_links = tuple(
+                link for link in extra_links if link != (parent, name)
+            )
+        inner.id_to_extra_links.set(ino, extra_links or None)
+        return inner._inode_id(ino)
+
+    def rename_path(self, src: bytes, dest: bytes):
+        '''
+        It may be tempting to `add_*(remove_*(src), dest)`. However,
+        that idiom:
+         - would break on nonempty directories,
+         - is not exception-safe, since the add can fail after the remove
+           succeeded.
+        '''
+        ino_id = self._remove_path_unsafe(src)
+        is_dir = self.inner.id_to_children.items[ino_id.id] is not None
+        try:
+            self._add_path(ino_id, dest, is_dir=is_dir)
+        except Exception:
+            self._add_path(ino_id, src, is_dir=is_dir)
+            raise
+
+    def get_id(self, path: bytes) -> Optional[InodeID]:
+        '''
+        Returns None if the path does not exist, raises if the path
+        contains a file as a non-final component.
+        '''
+        ino = self._walk(_norm_split_path(path))
+        return None if ino is None else self.inner._inode_id(ino)
+
+    def get_paths(self, inode_id: InodeID) -> Set[bytes]:
+        return set(self.inner.gen_paths(inode_id))
+
+    def get_children(self, inode_id: InodeID) -> Optional[Set[bytes]]:
+        'Returns None if the inode is not a directory.'
+        inner = self.inner
+        ino = inner._assert_mine(inode_id).id
+        # Without this check, `_path` would never reach the root.
+        if ino != _ROOT and next(inner._gen_links(ino), None) is None:
+            raise ValueError(f'{inode_id} has no paths')
+        children = inner.id_to_children.items[ino]
+        if children is None:
+            return None
+        if ino == _ROOT:
+            return set(children)
+        path = inner._path(
+            inner.id_to_parent.items[ino], inner.id_to_name.items[ino],
+        )
+        return {path + b'/' + name for name in children}
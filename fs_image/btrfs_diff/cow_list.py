@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+`CowList` is a list whose `snapshot`s share storage with the original until
+either one is changed.  This is what makes snapshotting a `Subvolume`
+cheap, see `CompactInodeIDMap.snapshot` and `InodeTable.snapshot`.
+
+A snapshot takes O(1) time.  Afterwards, the first write to either list
+copies the underlying `list`.  That is O(n), but it is a single C-level
+copy of pointers, which costs ~1000x less than `deepcopy`ing the items.
+We do not split the list into copy-on-write pages, since then every read
+would need a Python-level `__getitem__`, and our readers are hot loops,
+like the path walks of `CompactInodeIDMap`.  Instead, read `.items`
+directly, but do not hold on to it across writes.
+
+The items may be mutable, like the `IncompleteInode`s of `InodeTable`.
+Pass `copy_item` to share them copy-on-write, too.  Then, `get_mutable`
+copies an item before returning it, unless this list already made, or
+was given, that item since the last snapshot.  So, snapshots only copy
+the items that get changed.
+
+`CowDict` does the same for a `dict` with immutable values, like the
+digest cache of `Subvolume`.
+'''
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+
+
+class CowList:
+    __slots__ = ('items', '_shared', '_copy_item', '_owned')
+
+    def __init__(self, *, copy_item: Optional[Callable[[Any], Any]] = None):
+        self.items: List[Any] = []
+        self._shared = False  # Is `items` shared with a snapshot?
+        self._copy_item = copy_item
+        # The indexes whose items we may mutate.  `None` means "all", so
+        # that we do not track anything until the first snapshot.
+        self._owned: Optional[Set[int]] = None
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def _writable_items(self) -> List[Any]:
+        if self._shared:
+            self.items = self.items.copy()
+            self._shared = False
+        return self.items
+
+    def set(self, i: int, value: Any) -> None:
+        '''
+        `value` must not be shared with any other `CowList`, since `self`
+        now owns it.
+        '''
+        self._writable_items()[i] = value
+        if self._owned is not None:
+            self._owned.add(i)
+
+    def grow(self, length: int, fill: Any) -> None:
+        'Appends `fill` until `self` has at least `length` items.'
+        missing = length - len(self.items)
+        if missing > 0:
+            # New items are owned, but `fill` is immutable in practice.
+            self._writable_items().extend([fill] * missing)
+
+    def get_mutable(self, i: int) -> Any:
+        'Returns `self.items[i]`, copying it first if it may be shared.'
+        if self._owned is None or i in self._owned:
+            return self.items[i]
+        value = self._copy_item(self.items[i])
+        self.set(i, value)
+        return value
+
+    def snapshot(self) -> 'CowList':
+        'Returns an equal `CowList`, which initially shares our storage.'
+        copy = CowList(copy_item=self._copy_item)
+        copy.items = self.items
+        # Neither list may write to the shared list or items anymore.
+        copy._shared = self._shared = True
+        if self._copy_item is not None:
+            copy._owned = set()
+            self._owned = set()
+        return copy
+
+
+class CowDict(MutableMapping):
+    'A `dict` whose `snapshot`s share storage, like `CowList`.'
+    __slots__ = ('_dict', '_shared')
+
+    def __init__(self, *args, **kwargs):
+        self._dict: Dict[Any, Any] = dict(*args, **kwargs)
+        self._shared = False  # Is `_dict` shared with a snapshot?
+
+    def _writable_dict(self) -> Dict[Any, Any]:
+        if self._shared:
+            self._dict = self._dict.copy()
+            self._shared = False
+        return self._dict
+
+    def __getitem__(self, key: Any) -> Any:
+        return self._dict[key]
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        return self._dict.get(key, default)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._dict
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        self._writable_dict()[key] = value
+
+    def __delitem__(self, key: Any) -> None:
+        del self._writable_dict()[key]
+
+    def pop(self, key: Any, *default: Any) -> Any:
+        # Unlike `MutableMapping.pop`, a missing key does not un-share.
+        if key not in self._dict:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return self._writable_dict().pop(key)
+
+    def clear(self) -> None:
+        self._dict = {}
+        self._shared = False
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self._dict)
+
+    def __len__(self) -> int:
+        return len(self._dict)
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self._dict!r})'
+
+    def snapshot(self) -> 'CowDict':
+        'Returns an equal `CowDict`, which initially shares our storage.'
+        copy = CowDict()
+        copy._dict = self._dict
+        copy._shared = self._shared = True
+        return copy
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+CRC32C (Castagnoli), as used for the per-command checksums of btrfs
+send-streams.
+
+Like the kernel's `crc32c()`, this does NOT invert the CRC before and
+after the update, so `crc32c(b'')` is 0, and the CRCs of consecutive
+buffers can be chained via the `crc` argument:
+
+    crc32c(b + c) == crc32c(c, crc32c(b))
+
+The standard (iSCSI) CRC32C of `s` is `crc32c(s, 0xffffffff) ^ 0xffffffff`.
+
+This is a pure-Python slice-by-8 implementation.  That is about 1.5x
+faster than the classic byte-at-a-time table lookup, but still only
+manages ~10MB/s, so it is only practical for metadata -- see
+`tests/benchmark_parse_send_stream.py` for the numbers.
+'''
+import struct
+
+from typing import List
+
+_POLYNOMIAL = 0x82f63b78  # Reversed representation of 0x1edc6f41
+
+
+def _make_tables() -> List[List[int]]:
+    '`tables[k][b]` is the CRC of byte `b` followed by `k` zero bytes.'
+    table = []
+    for b in range(256):
+        crc = b
+        for _ in range(8):
+            crc = (crc >> 1) ^ (_POLYNOMIAL if crc & 1 else 0)
+        table.append(crc)
+    tables = [table]
+    for _ in range(7):
+        prev = tables[-1]
+        tables.append([(c >> 8) ^ table[c & 0xff] for c in prev])
+    return tables
+
+
+_TABLES = _make_tables()
+_T0, _T1, _T2, _T3, _T4, _T5, _T6, _T7 = _TABLES
+_WORDS_STRUCT = struct.Struct('<II')
+
+
+def _crc32c_bytewise(data, crc: int) -> int:
+    for b in data:
+        crc = _T0[(crc ^ b) & 0xff] ^ (crc >> 8)
+    return crc
+
+
+def crc32c(data, crc: int = 0) -> int:
+    '''
+    Pure-Python slice-by-8: each step consumes 8 bytes via 8 table lookups,
+    instead of 8 dependent steps of 1 lookup each.
+    '''
+    if len(data) < 32:  # Setting up the `memoryview` would dominate.
+        return _crc32c_bytewise(data, crc)
+    view = memoryview(data).cast('B')
+    tail = len(view) % 8
+    for lo, hi in _WORDS_STRUCT.iter_unpack(view[:len(view) - tail]):
+        lo ^= crc
+        crc = (
+            _T7[lo & 0xff] ^ _T6[(lo >> 8) & 0xff]
+            ^ _T5[(lo >> 16) & 0xff] ^ _T4[lo >> 24]
+            ^ _T3[hi & 0xff] ^ _T2[(hi >> 8) & 0xff]
+            ^ _T1[(hi >> 16) & 0xff] ^ _T0[hi >> 24]
+        )
+    return _crc32c_bytewise(view[len(view) - tail:], crc)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+Usage:
+
+  python3 -m btrfs_diff.examples.diff_sendstreams OLD NEW > diff.jsonl
+
+Prints one JSON object per line for each path that was added, removed,
+or modified between the subvolumes of the send-streams OLD and NEW.  NEW
+may be a full send-stream, or an incremental one on top of OLD.  Read
+the docblock of `sendstream_diff.py` for the output format.
+
+To see which files grew the most:
+
+  jq -c 'select(.data_bytes_delta > 0)' diff.jsonl |
+    jq -s -c 'sort_by(-.data_bytes_delta) | .[]' | head
+
+Try it on the "demo send-streams" from our tests:
+
+  alias demo_sendstream='python3 -m btrfs_diff.tests.gold_demo_sendstreams'
+
+  python3 -m btrfs_diff.examples.diff_sendstreams \
+    <(demo_sendstream create_ops) <(demo_sendstream mutate_ops)
+
+When diffing the same send-streams repeatedly, pass `--cache-dir` to keep
+the replayed subvolumes on disk.  The cache key is a hash of the inputs,
+so they must be regular files, not pipes as in the example above.
+'''
+import argparse
+import json
+import sys
+
+from ..sendstream_diff import diff_sendstreams
+from ..subvolume_cache import SubvolumeSetCache
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        '--parent', type=argparse.FileType('br'), action='append',
+        default=[],
+        help='If OLD is an incremental send-stream, repeat this option to '
+            'pass the send-streams that it builds on, oldest first.',
+    )
+    parser.add_argument(
+        'old', type=argparse.FileType('br'),
+        help='A file containing the output of `btrfs send`.',
+    )
+    parser.add_argument(
+        'new', type=argparse.FileType('br'),
+        help='A file containing the output of `btrfs send`, or of '
+            '`btrfs send -p` with the subvolume of OLD as the parent.',
+    )
+    parser.add_argument(
+        '--cache-dir',
+        help='Store the replayed send-streams in this directory, and reuse '
+            'them on later runs with the same inputs.',
+    )
+    parser.add_argument(
+        '--cache-max-bytes', type=int, default=2 ** 30,
+        help='Evict the least recently used entries of --cache-dir to keep '
+            'it under this size. Default: %(default)s',
+    )
+    args = parser.parse_args(argv[1:])
+
+    cache = None if args.cache_dir is None else SubvolumeSetCache(
+        args.cache_dir, max_bytes=args.cache_max_bytes,
+    )
+    for d in diff_sendstreams(
+        args.old, args.new, parent_infiles=args.parent, cache=cache,
+    ):
+        print(json.dumps(d, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
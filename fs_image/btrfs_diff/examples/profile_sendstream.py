@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+Usage:
+
+  python3 -m btrfs_diff.examples.profile_sendstream --top 20 LAYER
+
+Prints a tab-separated table of the paths whose subtrees take up the most
+bytes of the send-stream LAYER, broken down by category.  Read the
+docblock of `sendstream_profile.py` for what the categories mean.
+
+To see the same data as a flame graph:
+
+  python3 -m btrfs_diff.examples.profile_sendstream \
+    --folded layer.folded LAYER > /dev/null
+  flamegraph.pl layer.folded > layer.svg
+
+Try it on the "demo send-streams" from our tests:
+
+  alias demo_sendstream='python3 -m btrfs_diff.tests.gold_demo_sendstreams'
+
+  python3 -m btrfs_diff.examples.profile_sendstream \
+    --parent <(demo_sendstream create_ops) <(demo_sendstream mutate_ops)
+'''
+import argparse
+import sys
+
+from ..sendstream_profile import (
+    CATEGORIES, gen_folded_stacks, gen_report_lines, profile_sendstream,
+)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        '--parent', type=argparse.FileType('br'), action='append',
+        default=[],
+        help='If LAYER is an incremental send-stream, repeat this option to '
+            'pass the send-streams that it builds on, oldest first.',
+    )
+    parser.add_argument(
+        'layer', type=argparse.FileType('br'),
+        help='A file containing the output of `btrfs send`.',
+    )
+    parser.add_argument(
+        '--top', type=int,
+        help='Only print this many of the largest subtrees.',
+    )
+    parser.add_argument(
+        '--folded', type=argparse.FileType('w'),
+        help='Also write the "folded stacks" input of `flamegraph.pl` to '
+            'this file.',
+    )
+    parser.add_argument(
+        '--category', choices=CATEGORIES,
+        help='Make --folded count just this category, instead of all the '
+            'bytes of the send-stream.',
+    )
+    args = parser.parse_args(argv[1:])
+
+    path_to_counts = profile_sendstream(
+        args.layer, parent_infiles=args.parent,
+    )
+    for line in gen_report_lines(path_to_counts, top=args.top):
+        print(line)
+    if args.folded:
+        with args.folded:
+            for line in gen_folded_stacks(
+                path_to_counts, category=args.category,
+            ):
+                print(line, file=args.folded)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -26,7 +26,7 @@ def main(argv):
     if len(argv) != 1:
         print(__doc__, file=sys.stderr)
         return 1
-    for item in parse_send_stream(sys.stdin.buffer):
+    for item in parse_send_stream(sys.stdin.buffer, no_data=True):
         if isinstance(item, SendStreamItems.mknod) and (
             os.major(item.dev) == 7 or item.dev == os.makedev(10, 237)
         ):
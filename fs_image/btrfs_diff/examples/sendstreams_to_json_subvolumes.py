@@ -46,6 +46,7 @@ from ..inode_utils import (
     erase_mode_and_owner, erase_selinux_xattr, erase_utimes_in_range,
     SELinuxXAttrStats,
 )
+from ..parallel_replay import replay_sections, split_sections
 from ..parse_send_stream import parse_send_stream
 from ..rendered_tree import emit_non_unique_traversal_ids
 from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
@@ -104,6 +105,12 @@ def main(argv):
             'if necessary: "@minimally-unambuguous-uuid-prefix". If in '
             'doubt, first look at the output without `--show-only`.'
     )
+    parser.add_argument(
+        '--jobs', type=int, default=1,
+        help='Replay the send-streams in up to this many processes. Only '
+            'send-streams that do not snapshot or clone from one another '
+            'can run in parallel, e.g. the layer stacks of different images.',
+    )
     parser.add_argument(
         'sendstream', type=argparse.FileType('br'), nargs='+',
         help='A file containing the output of `btrfs send`. Note that '
@@ -113,11 +120,22 @@ def main(argv):
     args = parser.parse_args(argv[1:])
 
     subvols = SubvolumeSet.new()
-    for sendstream_in in args.sendstream:
-        parsed = parse_send_stream(sendstream_in)
-        mutator = SubvolumeSetMutator.new(subvols, next(parsed))
-        for i in parsed:
-            mutator.apply_item(i)
+    if args.jobs > 1:
+        replay_sections(subvols, (
+            section
+                for sendstream_in in args.sendstream
+                    for section in split_sections(
+                        # Skip the file data, as below.
+                        parse_send_stream(sendstream_in, no_data=True),
+                    )
+        ), max_workers=args.jobs)
+    else:
+        for sendstream_in in args.sendstream:
+            # `Subvolume` only tracks extent lengths, so skip the file data.
+            parsed = parse_send_stream(sendstream_in, no_data=True)
+            mutator = SubvolumeSetMutator.new(subvols, next(parsed))
+            for i in parsed:
+                mutator.apply_item(i)
 
     # Check that our send-streams completely specified the subvolumes.
     if not args.no_check_complete:
@@ -57,7 +57,7 @@ class Extent(NamedTuple):
     An Extent represents a contiguous sequence of bytes, which were either:
      - written (`write`)
      - cloned from another extent (btrfs clone `ioctl`)
-     - deliberately left as holes (`truncate`)
+     - deliberately left as holes (`truncate`, `punch_hole`)
 
     A file always has one Extent object, and it is placed at file offset 0.
     Holes are modeled explicitly via subextents.
@@ -76,8 +76,8 @@ class Extent(NamedTuple):
     Users should NOT directly create extents. Also, the fields of `offset`
     and `content` cannot be usefully introspected.
      - Start each file with `empty()`
-     - Use the `btrfs send` workalikes of `truncate()`, `write()`, `clone()`
-       to change files.
+     - Use the `btrfs send` workalikes of `truncate()`, `write()`, `clone()`,
+       `punch_hole()` to change files.
      - Use `.length`, and `gen_trimmed_leaves()` to inspect the objects.
 
     ## KEY INTERNAL INVARIANT
@@ -204,6 +204,21 @@ class Extent(NamedTuple):
     def empty():
         return Extent.__new(())
 
+    @staticmethod
+    def from_trimmed_leaves(
+        leaves: Iterable[Tuple[int, int, 'Extent']],
+    ) -> 'Extent':
+        '''
+        Returns an extent whose `gen_trimmed_leaves` yields `leaves`, e.g.
+        to restore a file from `subvolume_cache.py`.  Since the leaves are
+        reused as-is, the result shares bytes with the same extents that
+        the original file did.
+        '''
+        return Extent.__new(tuple(
+            Extent.__new(leaf, offset=offset, length=length)
+                for offset, length, leaf in leaves
+        ))
+
     def truncate(self, length: int):
         return Extent.__new((
             self,
@@ -227,6 +242,12 @@ class Extent(NamedTuple):
             offset, Extent.__new(Extent.Kind.DATA, length=length)
         )
 
+    def punch_hole(self, *, offset: int, length: int):
+        'Like `write`, but the bytes become a hole.'
+        return self.__put(
+            offset, Extent.__new(Extent.Kind.HOLE, length=length)
+        )
+
     def clone(
         self,
         *,
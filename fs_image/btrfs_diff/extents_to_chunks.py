@@ -100,6 +100,20 @@ the structures of the write forks, respecting `truncate`, `write`, and
       by which the N-1 spanning tree edges are selected.  It's easy to make
       such a process deterministic, but it still adds cognitive load.
 
+      When the copy number is high -- e.g. many snapshots of a deduplicated
+      base layer -- use `extents_to_chunks_with_shared_extents` instead.
+      Rather than linking every pair of clones, it gives each cloned part
+      of a `Chunk` one `SharedExtent`, which names the underlying leaf
+      extent, and the range of it that the `Chunk` uses.  This is linear in
+      the number of clones, and it is still symmetric & unique, since the
+      extent names are assigned at render time, in traversal order, the
+      same way that `Subvolume.render` numbers hardlinked inodes.  The
+      above example becomes (`#0` is the extent):
+
+        {'A': ['#0:0+3@0', '#0:6+3@3'],  # `A` is contiguous -> 1 `Chunk`
+         'B': ['#0:1+5@0'],
+         'C': ['#0:3+5@0']}
+
 [1] The current code tracks clones of HOLEs, because it makes no effort to
     ignore them.  I would guess that btrfs lacks this tracking, since such
     clones would save no space.  Once this is confirmed, it would be very
@@ -116,16 +130,22 @@ the structures of the write forks, respecting `truncate`, `write`, and
 
 '''
 # Future: frozentypes instead of NamedTuples can permit some cleanups below.
-import functools
+import itertools
 
 from collections import defaultdict
-from typing import Dict, Iterable, NamedTuple, Sequence, Tuple
+from typing import (
+    Dict, Hashable, Iterable, Iterator, List, NamedTuple, Sequence, Tuple,
+)
 
 from .extent import Extent
-from .inode import Clone, Chunk, ChunkClone
+from .inode import Clone, Chunk, ChunkClone, SharedExtent
 from .inode_id import InodeID
 
 
+# `(offset, length, leaf extent)`, as yielded by `gen_trimmed_leaves`
+_TrimmedLeaf = Tuple[int, int, Extent]
+
+
 class _CloneExtentRef(NamedTuple):
     '''
     Connects a part of a HOLE/DATA leaf Extent to a location in an Inode.
@@ -136,19 +156,17 @@ class _CloneExtentRef(NamedTuple):
 
     We initially create a _CloneExtentRef for every piece of every inode,
     but later we only retain those have some inter-inode overlap within
-    their `.extent`, thus identifying cloned chunks of inodes.
+    their leaf extent, thus identifying cloned chunks of inodes.
 
     Aside: Unlike the simplified data model in `inode.py`, the Extent's
     object identity captures the original reason that parts of some inodes
-    became identified via a clone relationship.  We mostly use this for
-    assertions.
-
-    Future: With `frozentype`, __new__ could assert that `offset` and
-    `clone.length` are sane with respect to `extent`.
+    became identified via a clone relationship.  We group the refs by
+    `id(leaf_extent)`, so the extent itself need not be stored.
     '''
-    clone: Clone  # `clone.length` trims `extent`
-    extent: Extent
-    offset: int  # Trims `extent`
+    inode_id: InodeID
+    inode_offset: int  # Where the trimmed leaf starts in the inode
+    offset: int  # Trims the leaf extent
+    length: int  # Trims the leaf extent
     # The position in `gen_trimmed_leaves` of the specific trimmed leaf that
     # is being connected to another inode.
     #
@@ -164,191 +182,137 @@ class _CloneExtentRef(NamedTuple):
     # the first, but not to itself.
     #
     # We could avoid this denormalization by keying `CloneChunk`s on
-    # `(inode_offset, offset, length, extent)`, which is unique.  And
-    # `extents_to_chunks_with_clones` does already track `inode_offset`.
-    # However, the denormalized approach seemed cleaner.
+    # `(inode_offset, offset, length, extent)`, which is unique.  However,
+    # the denormalized approach seemed cleaner.
     leaf_idx: int
 
-    def __repr__(self):  # pragma: no cover
-        return (
-            f'{self.clone.inode_id}:{self.clone.offset}'
-            f'+{self.clone.length}:{id(self.extent)}'  # Extent is too noisy
-        )
-
-
-# If these change, we have to update `_clone_op_compare_key`
-assert Clone._fields.index('inode_id') == 0
-assert _CloneExtentRef._fields.index('clone') == 0
 
-
-# Our _CloneOp ordering obeys the following invariants:
-#  - sort by position first
-#  - sort by action second, putting POPs before PUSHes (see their def'ns)
-# We do not need finer-grained ordering because:
-#  (1) we only do work on POPs,
-#  (2) the work done on all the POPs at one position does not depend on the
-#      order of the _CloneOps -- we symmetrically record the relationship in
-#      both directions:
-#        (just-popped op, each unpopped op)
-#        (each unpopped op, just-popped op)
-#
-# We could get the desired ordering implicitly by:
-#  - relying on the order of field declaration in `_CloneOp` (not bad)
-#  - making `Inode`s comparable (a bit ugly, comparing Extents is pricy,
-#    comparing InodeIDs would require some comparator boilerplate)
-# Luckily, being explicit is not *that* painful.
-def _clone_op_compare_key(c: '_CloneOp'):
-    return (
-        # The preceding asserts make these [1:] hacks tolerable.
-        c.pos, c.action, c.ref[1:], c.ref.clone[1:],
-        c.ref.clone.inode_id.id,
-    )
-
-
-def _clone_op_compare(fn):
-    @functools.wraps(fn)
-    def cmp(self: '_CloneOp', other: '_CloneOp'):
-        assert isinstance(other, _CloneOp)
-        # We only compare ops within one extent. The tests assume this to
-        # justify focusing on single-extent examples, so check it.
-        assert self.ref.extent is other.ref.extent
-        # All our items are distinct, since `clone.offset` is `inode_offset`,
-        # which is strictly increasing in each inode.  We have no business
-        # comparing a _CloneOp with itself.
-        assert tuple.__ne__(self, other)
-        return fn(_clone_op_compare_key(self), _clone_op_compare_key(other))
-    return cmp
-
-
-class _CloneOp(NamedTuple):
-    PUSH = 'push'
-    POP = 'pop'
-    assert POP < PUSH  # We want to sort all POPs before any PUSHes
-
-    pos: int
-    action: str
-    ref: _CloneExtentRef
-
-    # NamedTuple confuses functools.total_ordering, so define all 6 comparators
-    __eq__ = _clone_op_compare(tuple.__eq__)
-    __ne__ = _clone_op_compare(tuple.__ne__)
-    __lt__ = _clone_op_compare(tuple.__lt__)
-    __le__ = _clone_op_compare(tuple.__le__)
-    __gt__ = _clone_op_compare(tuple.__gt__)
-    __ge__ = _clone_op_compare(tuple.__ge__)
-
-
-def _leaf_extent_id_to_clone_ops(
-    ids_and_extents: Iterable[Tuple[InodeID, Extent]]
-):
+def _leaf_extent_id_to_clone_refs(
+    ids_and_leaves: Iterable[Tuple[InodeID, Sequence[_TrimmedLeaf]]],
+) -> Dict[int, List[_CloneExtentRef]]:
     '''
     To collect the parts of a Chunk that are cloned, we will run a variation
     on the standard interval-overlap algorithm.  We first sort the starts &
     ends of each interval, and then do a sequential scan that uses starts to
-    add, and ends to remove, a tracking object from a "current intervals"
+    add, and ends to remove, an interval from a "current intervals"
     structure.
 
-    This function simply prepares the set of interval starts & ends for each
-    InodeID, the computation is in `_leaf_ref_to_chunk_clones_from_clone_ops`.
+    This function simply groups the intervals by their leaf extent, the
+    computation is in `_ref_idx_to_chunk_clones`.
     '''
-    leaf_extent_id_to_clone_ops = defaultdict(list)
-    for ino_id, extent in ids_and_extents:
+    leaf_extent_id_to_refs = defaultdict(list)
+    for ino_id, leaves in ids_and_leaves:
         file_offset = 0
-        for leaf_idx, (offset, length, leaf_extent) in enumerate(
-            extent.gen_trimmed_leaves()
-        ):
-            ref = _CloneExtentRef(
-                clone=Clone(
-                    inode_id=ino_id, offset=file_offset, length=length,
-                ),
-                extent=leaf_extent,
+        for leaf_idx, (offset, length, leaf_extent) in enumerate(leaves):
+            leaf_extent_id_to_refs[id(leaf_extent)].append(_CloneExtentRef(
+                inode_id=ino_id,
+                inode_offset=file_offset,
                 offset=offset,
+                length=length,
                 leaf_idx=leaf_idx,
-            )
-            leaf_extent_id_to_clone_ops[id(leaf_extent)].extend([
-                _CloneOp(pos=offset, action=_CloneOp.PUSH, ref=ref),
-                _CloneOp(pos=offset + length, action=_CloneOp.POP, ref=ref),
-            ])
+            ))
             file_offset += length
-    return leaf_extent_id_to_clone_ops
+    return leaf_extent_id_to_refs
 
 
-def _leaf_ref_to_chunk_clones_from_clone_ops(
-    extent_id: int, clone_ops: Iterable[_CloneOp]
-):
-    'As per `_leaf_extent_id_to_clone_ops`, this computes interval overlaps'
-    active_ops: Dict[_CloneExtentRef, _CloneOp] = {}  # Tracks open intervals
-    leaf_ref_to_chunk_clones = defaultdict(list)
-    for op in sorted(clone_ops):
+def _ref_idx_to_chunk_clones(
+    refs: Sequence[_CloneExtentRef],
+) -> Dict[int, List[ChunkClone]]:
+    '''
+    As per `_leaf_extent_id_to_clone_refs`, this computes the overlaps of
+    `refs`, all of which trim the same leaf extent.  The result is keyed by
+    the index into `refs`.
+
+    With heavy reflinking, this sweep is the hot spot, so rather than make
+    an object per interval start & end, and sort those via a Python-level
+    comparator, we encode each boundary as a single `int`:
+
+        (2 * position + (1 if start else 0)) * len(refs) + index in `refs`
+
+    The built-in sort orders plain `int`s without calling back into Python,
+    and this order is exactly what the sweep needs: by position, with ends
+    before starts.  The order among the ends at one position does not
+    matter, since we symmetrically record each overlap in both directions:
+        (just-ended interval, each open interval)
+        (each open interval, just-ended interval)
+    '''
+    num_refs = len(refs)
+    boundaries = [
+        (2 * offset + 1) * num_refs + idx
+            for idx, (_, _, offset, _, _) in enumerate(refs)
+    ]
+    boundaries.extend(
+        2 * (offset + length) * num_refs + idx
+            for idx, (_, _, offset, length, _) in enumerate(refs)
+    )
+    boundaries.sort()
+
+    open_idxs: Dict[int, None] = {}  # An insertion-ordered set
+    ref_idx_to_chunk_clones = defaultdict(list)
+    for boundary in boundaries:
+        pos_and_is_start, idx = divmod(boundary, num_refs)
+        if pos_and_is_start & 1:
+            assert idx not in open_idxs
+            open_idxs[idx] = None
+            continue
         # Whenever an interval (aka an Inode's Extent's "trimmed leaf")
         # ends, we create `ChunkClone` objects **to** and **from** all the
         # concurrently open intervals.
-        if op.action is _CloneOp.POP:
-            pushed_op = active_ops.pop(op.ref)
-            assert pushed_op.ref is op.ref
-            assert id(op.ref.extent) == extent_id
-            assert pushed_op.pos == op.ref.offset
-            assert pushed_op.pos + op.ref.clone.length == op.pos
-
-            for clone_op in active_ops.values():
-                assert op.ref.extent is clone_op.ref.extent
-
-                # The cloned portion's extent offset is the larger of the 2
-                bigger_offset = max(clone_op.ref.offset, op.ref.offset)
-
-                # Record that `clone_op` clones part of `op`'s inode.
-                leaf_ref_to_chunk_clones[op.ref].append(ChunkClone(
-                    offset=bigger_offset,
-                    clone=Clone(
-                        inode_id=clone_op.ref.clone.inode_id,
-                        offset=clone_op.ref.clone.offset + (
-                            bigger_offset - clone_op.ref.offset
-                        ),
-                        length=op.pos - bigger_offset,
-                    ),
-                ))
+        del open_idxs[idx]
+        end = pos_and_is_start >> 1
+        ino_id, inode_offset, offset, _, _ = refs[idx]
+        chunk_clones = ref_idx_to_chunk_clones[idx]
+        for other_idx in open_idxs:
+            other_ino_id, other_inode_offset, other_offset, _, _ = \
+                refs[other_idx]
+
+            # The cloned portion's extent offset is the larger of the 2
+            bigger_offset = max(other_offset, offset)
+            length = end - bigger_offset
+
+            # Record that `other_idx` clones part of `idx`'s inode.
+            chunk_clones.append(ChunkClone(
+                offset=bigger_offset,
+                clone=Clone(
+                    inode_id=other_ino_id,
+                    offset=other_inode_offset + bigger_offset - other_offset,
+                    length=length,
+                ),
+            ))
 
-                # Record that `op` clones part of `clone_op`'s inode.
-                leaf_ref_to_chunk_clones[clone_op.ref].append(ChunkClone(
-                    offset=bigger_offset,
-                    clone=Clone(
-                        inode_id=op.ref.clone.inode_id,
-                        offset=op.ref.clone.offset + (
-                            bigger_offset - op.ref.offset
-                        ),
-                        length=op.pos - bigger_offset,  # Same length
-                    ),
-                ))
-        # Sorting guarantees all POPs for `pos` are handled before PUSHes
-        elif op.action == _CloneOp.PUSH:
-            assert op.ref not in active_ops
-            active_ops[op.ref] = op
-        else:
-            raise AssertionError(op)  # pragma: no cover
-    return leaf_ref_to_chunk_clones
+            # Record that `idx` clones part of `other_idx`'s inode.
+            ref_idx_to_chunk_clones[other_idx].append(ChunkClone(
+                offset=bigger_offset,
+                clone=Clone(
+                    inode_id=ino_id,
+                    offset=inode_offset + bigger_offset - offset,
+                    length=length,  # Same length
+                ),
+            ))
+    assert not open_idxs, open_idxs
+    return ref_idx_to_chunk_clones
 
 
 def _id_to_leaf_idx_to_chunk_clones(
-    ids_and_extents: Iterable[Tuple[InodeID, Extent]],
+    ids_and_leaves: Iterable[Tuple[InodeID, Sequence[_TrimmedLeaf]]],
 ):
     'Aggregates newly created ChunkClones per InodeID, and per "trimmed leaf"'
     id_to_leaf_idx_to_chunk_clones = defaultdict(dict)
-    for extent_id, clone_ops in _leaf_extent_id_to_clone_ops(
-        ids_and_extents
-    ).items():
-        leaf_ref_to_chunk_clones = _leaf_ref_to_chunk_clones_from_clone_ops(
-            extent_id, clone_ops
-        )
-        for leaf_ref, offsets_clones in leaf_ref_to_chunk_clones.items():
-            d = id_to_leaf_idx_to_chunk_clones[leaf_ref.clone.inode_id]
+    for refs in _leaf_extent_id_to_clone_refs(ids_and_leaves).values():
+        # Most leaf extents occur just once, and so have no clones.
+        if len(refs) < 2:
+            continue
+        for idx, chunk_clones in _ref_idx_to_chunk_clones(refs).items():
+            ref = refs[idx]
+            d = id_to_leaf_idx_to_chunk_clones[ref.inode_id]
             # A `leaf_idx` from a specific inode ID refers to one extent,
             # and each extent is handled in one iteration, so it cannot be
             # that two iterations contribute to the same `leaf_idx` key.
-            assert leaf_ref.leaf_idx not in d
+            assert ref.leaf_idx not in d
             # `leaf_idx` is the position in `gen_trimmed_leaves` of the
             # chunk, whose clones we computed.  That fully specifies where
             #  `extents_to_chunks_with_clones` should put the clones.
-            d[leaf_ref.leaf_idx] = offsets_clones
+            d[ref.leaf_idx] = chunk_clones
 
     return id_to_leaf_idx_to_chunk_clones
 
@@ -362,15 +326,18 @@ def extents_to_chunks_with_clones(
     described in this file's docblock.  The `InodeID`s are needed to ensure
     that the `Chunk`s' `Clone` objects refer to the appropriate files.
     '''
+    # Both passes below need the leaves, which are costly to compute.
+    ids_and_leaves = [
+        (ino_id, list(extent.gen_trimmed_leaves()))
+            for ino_id, extent in ids_and_extents
+    ]
     id_to_leaf_idx_to_chunk_clones = _id_to_leaf_idx_to_chunk_clones(
-        ids_and_extents
+        ids_and_leaves
     )
-    for ino_id, extent in ids_and_extents:
+    for ino_id, leaves in ids_and_leaves:
         leaf_to_chunk_clones = id_to_leaf_idx_to_chunk_clones.get(ino_id, {})
         new_chunks = []
-        for leaf_idx, (offset, length, extent) in enumerate(
-            extent.gen_trimmed_leaves()
-        ):
+        for leaf_idx, (offset, length, extent) in enumerate(leaves):
             chunk_clones = leaf_to_chunk_clones.get(leaf_idx, [])
             assert isinstance(extent.content, Extent.Kind)
 
@@ -408,3 +375,102 @@ def extents_to_chunks_with_clones(
                 chunk_clones=frozenset(c.chunk_clones),
             ) for c in new_chunks
         )
+
+
+def _shared_extent_offsets(
+    refs: Iterable[Tuple[int, int, Hashable]],
+) -> Iterator[Tuple[Hashable, int]]:
+    '''
+    Takes `(offset, length, key)` for each trimmed occurrence of one leaf
+    extent.  Yields `(key, extent_offset)` for those occurrences that
+    overlap some other occurrence, i.e. those that are actually cloned.
+
+    `extent_offset` skips the parts of the leaf extent that are not shared.
+    This way, it does not depend on e.g. the length of the original `write`
+    that made the leaf extent, but we still preserve which occurrences
+    overlap, since two overlapping ranges are never separated by a gap.
+    '''
+    refs = sorted(r for r in refs if r[1] > 0)
+    overlapping = []
+    max_end = 0  # The largest end among `refs[:i]`
+    for i, (offset, length, key) in enumerate(refs):
+        end = offset + length
+        # Since `refs` is sorted, this range overlaps some other iff it
+        # overlaps either the next one, or the furthest-reaching previous one.
+        if (i and offset < max_end) or (
+            i + 1 < len(refs) and refs[i + 1][0] < end
+        ):
+            overlapping.append((offset, end, key))
+        max_end = max(max_end, end)
+
+    shift = 0  # The number of unshared bytes to the left of `offset`
+    segment_end = 0
+    for offset, end, key in overlapping:
+        if offset > segment_end:
+            shift += offset - segment_end
+        segment_end = max(segment_end, end)
+        yield key, offset - shift
+
+
+def extents_to_chunks_with_shared_extents(
+    ids_and_extents: Sequence[Tuple[InodeID, Extent]],
+) -> Iterable[Tuple[InodeID, Sequence[Chunk]]]:
+    '''
+    Like `extents_to_chunks_with_clones`, but annotates cloned parts with
+    `SharedExtent`s instead of `ChunkClone`s, see the file docblock.  Time
+    & memory are linear in the number of trimmed leaves (up to sorting the
+    occurrences of each leaf extent), no matter how many times each leaf
+    extent is cloned.
+
+    The `extent_nonce`s are numbered from 0 in the order of
+    `ids_and_extents`.  Since they are only unique within one call, clones
+    are only detected among the `ids_and_extents` passed together.
+    '''
+    ids_and_leaves = [
+        (ino_id, list(extent.gen_trimmed_leaves()))
+            for ino_id, extent in ids_and_extents
+    ]
+    # Our keys are `(index in ids_and_leaves, leaf_idx)`.  As explained in
+    # `_CloneExtentRef`, one inode can contain identical trimmed leaves.
+    leaf_extent_id_to_refs = defaultdict(list)
+    for ino_idx, (_, leaves) in enumerate(ids_and_leaves):
+        for leaf_idx, (offset, length, leaf_extent) in enumerate(leaves):
+            leaf_extent_id_to_refs[id(leaf_extent)].append(
+                (offset, length, (ino_idx, leaf_idx)),
+            )
+    key_to_nonce_and_offset = {}
+    nonces = itertools.count()
+    for refs in leaf_extent_id_to_refs.values():
+        nonce = None
+        for key, extent_offset in _shared_extent_offsets(refs):
+            if nonce is None:
+                nonce = next(nonces)
+            key_to_nonce_and_offset[key] = (nonce, extent_offset)
+
+    for ino_idx, (ino_id, leaves) in enumerate(ids_and_leaves):
+        # Mutable `[kind, length, shared_extents]`, frozen into `Chunk`s below
+        new_chunks = []
+        for leaf_idx, (_, length, extent) in enumerate(leaves):
+            assert isinstance(extent.content, Extent.Kind)
+            # If the chunk kind matches, merge into the previous chunk.
+            if not new_chunks or new_chunks[-1][0] != extent.content:
+                new_chunks.append([extent.content, 0, []])
+            chunk = new_chunks[-1]
+            nonce_and_offset = key_to_nonce_and_offset.get((ino_idx, leaf_idx))
+            if nonce_and_offset is not None:
+                nonce, extent_offset = nonce_and_offset
+                chunk[2].append(SharedExtent(
+                    offset=chunk[1],
+                    length=length,
+                    extent_nonce=nonce,
+                    extent_offset=extent_offset,
+                ))
+            chunk[1] += length
+        yield ino_id, tuple(
+            Chunk(
+                kind=kind,
+                length=length,
+                chunk_clones=frozenset(),
+                shared_extents=tuple(shared_extents),
+            ) for kind, length, shared_extents in new_chunks
+        )
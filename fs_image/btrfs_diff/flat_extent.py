@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+`FlatExtent` is a drop-in alternative to `Extent` for files that receive
+many small `write`s or `clone`s, like logs or databases in images.
+
+`Extent` records the full history of mutations as a tree, so mutations are
+O(1), but `gen_trimmed_leaves` must re-walk all of that history on every
+call.  When writes land out of order, each one makes the tree reference
+its predecessor twice (once before, once after the written range), and the
+walk gets super-linear -- 10k random `write`s take minutes to enumerate.
+
+`FlatExtent` instead stores only what `gen_trimmed_leaves` yields: the
+`(offset, length, leaf)` triples, sorted by their position in the file.
+The KEY INTERNAL INVARIANT of `Extent` still holds: the leaves are the
+very same `Extent` objects with `Extent.Kind` content, and they are never
+replaced.  When a mutation cuts a trimmed leaf, both pieces refer to the
+original leaf object.  Therefore, `extents_to_chunks.py` and `CloneIndex`
+work unchanged, and a `FlatExtent` can clone from an `Extent`.
+
+Like `Extent`, `FlatExtent` is immutable, since snapshots and clone
+sources share it.  A flat array cannot be both immutable and cheap to
+update, so the sorted sequence lives in a treap (a binary search tree that
+is balanced with high probability by random heap priorities), and each
+mutation copies just the nodes on the path to the change:
+  - `write`, `punch_hole`, and `truncate` take O(log n) expected time,
+  - `clone` takes O(log n + number of leaves cloned),
+  - `gen_trimmed_leaves` takes O(log n + number of leaves yielded).
+
+For 100k random 4KiB `write`s, this lists the leaves in ~0.1s, while
+`Extent` already needs ~5s for 2k such writes.  The mutations themselves
+are at most ~2x slower than `Extent`'s.  See `tests/benchmark_extent.py`.
+'''
+import random
+
+from typing import Iterable, Iterator, Optional, Tuple
+
+from .extent import Extent
+
+_random_priority = random.Random(0).random  # Deterministic tree shapes
+
+
+# A treap node is a plain tuple of
+#   (start, length, leaf, leaf_offset, priority, left, right)
+# describing one trimmed leaf at file offset `start`, and its subtrees.  We
+# do not use `NamedTuple`, since node copies dominate the cost of mutations,
+# and making a `NamedTuple` takes several times longer than a `tuple`.
+_Node = tuple
+
+
+def _split(
+    node: Optional[_Node], at: int,
+) -> Tuple[Optional[_Node], Optional[_Node]]:
+    'Splits the tree into the parts before & after the file offset `at`.'
+    if node is None:
+        return None, None
+    start, length, leaf, leaf_offset, priority, left, right = node
+    if at <= start:
+        left, mid = _split(left, at)
+        return left, (start, length, leaf, leaf_offset, priority, mid, right)
+    cut = at - start
+    if cut >= length:
+        mid, right = _split(right, at)
+        return (start, length, leaf, leaf_offset, priority, left, mid), right
+    # `at` is inside this node, so cut it into two pieces of the same leaf.
+    # Both pieces may keep the priority, since each keeps one subtree.
+    return (start, cut, leaf, leaf_offset, priority, left, None), (
+        at, length - cut, leaf, leaf_offset + cut, priority, None, right,
+    )
+
+
+def _merge(left: Optional[_Node], right: Optional[_Node]) -> Optional[_Node]:
+    'Every node of `left` must precede every node of `right`.'
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left[4] > right[4]:  # Compare priorities
+        return (*left[:6], _merge(left[6], right))
+    return (*right[:5], _merge(left, right[5]), right[6])
+
+
+def _new_node(start: int, length: int, leaf: Extent, leaf_offset: int):
+    return (start, length, leaf, leaf_offset, _random_priority(), None, None)
+
+
+def _new_leaf(kind: Extent.Kind, length: int) -> Extent:
+    # Same as `Extent.__new(kind, length=length)`
+    return Extent(content=kind, offset=0, length=length)
+
+
+class FlatExtent:
+    '''
+    Has the same API as `Extent`, read its docblock.  Do not mix the two
+    backends in one `SubvolumeSet`, since `Extent.clone` cannot take a
+    `FlatExtent`.
+    '''
+    __slots__ = ('_root', 'length')
+
+    def __init__(self, root: Optional[_Node], length: int):
+        self._root = root
+        self.length = length
+
+    @staticmethod
+    def empty() -> 'FlatExtent':
+        return FlatExtent(None, 0)
+
+    @staticmethod
+    def from_trimmed_leaves(
+        leaves: Iterable[Tuple[int, int, Extent]],
+    ) -> 'FlatExtent':
+        'Same as `Extent.from_trimmed_leaves`.'
+        root = None
+        start = 0
+        for leaf_offset, length, leaf in leaves:
+            root = _merge(root, _new_node(start, length, leaf, leaf_offset))
+            start += length
+        return FlatExtent(root, start)
+
+    def truncate(self, length: int) -> 'FlatExtent':
+        if length <= self.length:
+            return FlatExtent(_split(self._root, length)[0], length)
+        return FlatExtent(_merge(self._root, _new_node(
+            self.length, length - self.length,
+            _new_leaf(Extent.Kind.HOLE, length - self.length), 0,
+        )), length)
+
+    def __put(
+        self, offset: int, length: int,
+        pieces: Iterator[Tuple[int, int, Extent]],
+    ) -> 'FlatExtent':
+        'Overwrites `length` bytes at `offset` with the trimmed `pieces`.'
+        assert length > 0, 'Future: not sure how to hangle length = 0'
+        before, rest = _split(self._root, offset)
+        after = _split(rest, offset + length)[1]
+        if offset > self.length:
+            before = _merge(before, _new_node(
+                self.length, offset - self.length,
+                _new_leaf(Extent.Kind.HOLE, offset - self.length), 0,
+            ))
+        start = offset
+        for leaf_offset, piece_length, leaf in pieces:
+            before = _merge(before, _new_node(
+                start, piece_length, leaf, leaf_offset,
+            ))
+            start += piece_length
+        assert start == offset + length, f'{start} != {offset} + {length}'
+        return FlatExtent(_merge(before, after), max(self.length, start))
+
+    def write(self, *, offset: int, length: int) -> 'FlatExtent':
+        return self.__put(offset, length, [
+            (0, length, _new_leaf(Extent.Kind.DATA, length)),
+        ])
+
+    def punch_hole(self, *, offset: int, length: int) -> 'FlatExtent':
+        return self.__put(offset, length, [
+            (0, length, _new_leaf(Extent.Kind.HOLE, length)),
+        ])
+
+    def clone(
+        self,
+        *,
+        to_offset: int, from_extent: 'FlatExtent', from_offset: int,
+        length: int,
+    ) -> 'FlatExtent':
+        return self.__put(to_offset, length, from_extent.gen_trimmed_leaves(
+            offset=from_offset, length=length,
+        ))
+
+    def gen_trimmed_leaves(
+        self, *, offset: int = 0, length: Optional[int] = None,
+    ) -> Iterator[Tuple[int, int, Extent]]:
+        'Same as `Extent.gen_trimmed_leaves`.'
+        if length is None:
+            length = self.length - offset
+        assert offset >= 0 and length >= 0, f'offset {offset}, len {length}'
+        assert offset + length <= self.length, f'{offset} + {length}'
+        end = offset + length
+        # An in-order traversal, skipping the nodes that end before `offset`.
+        stack = []
+        node = self._root
+        while True:
+            while node is not None:
+                start, node_length, _, _, _, left, right = node
+                if start + node_length <= offset:
+                    node = right
+                else:
+                    stack.append(node)
+                    node = left
+            if not stack:
+                return
+            start, node_length, leaf, leaf_offset, _, _, node = stack.pop()
+            if start >= end:
+                return
+            lo = max(offset, start)
+            hi = min(end, start + node_length)
+            yield leaf_offset + lo - start, hi - lo, leaf
+
+    # `Extent`'s implementations only use `gen_trimmed_leaves`.
+    _gen_leaf_reprs = Extent._gen_leaf_reprs
+    __repr__ = Extent.__repr__
+
+    def __copy__(self):
+        return self  # Immutable, just like `Extent`
+
+    def __deepcopy__(self, memo):
+        return self  # Immutable, just like `Extent`
@@ -18,16 +18,127 @@ provisions for `freeze`ing self-referential structures, because it is
 impossible to construct a recursively immutable structure that references
 itself.
 
+Freezing a large `SubvolumeSet` visits millions of objects, so we look up
+how to freeze each type just once, in `_TYPE_TO_FREEZER`.  Modules may add
+faster freezers for their own types via `register_freezer`, or declare
+that a type is already recursively immutable via `register_immutable`.  A
+tuple, `frozenset`, or `NamedTuple`, all of whose items freeze to
+themselves, is also returned as-is, instead of being copied.
+
 Future: Once `deepfrozen` is landed, this sort of thing should get nicer.
 '''
+import operator
+
 from enum import Enum
 from types import MappingProxyType
+from typing import Any, Callable, Dict
+
+_IMMUTABLE_BASES = (bytes, Enum, float, int, str, type(None))
+
+
+def _freeze_as_is(obj, *, _memo):
+    # `freeze` checks for this freezer, instead of calling it.
+    return obj  # pragma: no cover
+
+
+def _freeze_via_method(obj, *, _memo, **kwargs):
+    return obj.freeze(_memo=_memo, **kwargs)
+
+
+def _freeze_items(obj, _memo):
+    frozen = [freeze(i, _memo=_memo) for i in obj]
+    return frozen, all(map(operator.is_, frozen, obj))
+
+
+def _freeze_namedtuple(obj, *, _memo):
+    frozen, unchanged = _freeze_items(obj, _memo)
+    return obj if unchanged else obj._make(frozen)
+
+
+def _freeze_tuple(obj, *, _memo):
+    frozen, unchanged = _freeze_items(obj, _memo)
+    return obj if unchanged else tuple(frozen)
+
+
+def _freeze_list(obj, *, _memo):
+    return tuple(freeze(i, _memo=_memo) for i in obj)
+
+
+def _freeze_dict(obj, *, _memo):
+    return MappingProxyType({
+        freeze(k, _memo=_memo): freeze(v, _memo=_memo)
+            for k, v in obj.items()
+    })
+
+
+def _freeze_set(obj, *, _memo):
+    return frozenset(freeze(i, _memo=_memo) for i in obj)
+
+
+def _freeze_frozenset(obj, *, _memo):
+    frozen, unchanged = _freeze_items(obj, _memo)
+    return obj if unchanged else frozenset(frozen)
+
+
+# Maps exact types to functions of `(obj, *, _memo, **kwargs)`.  Other
+# types get added on first use, e.g. subclasses of `_IMMUTABLE_BASES`.
+_TYPE_TO_FREEZER: Dict[type, Callable[..., Any]] = {
+    **{
+        cls: _freeze_as_is
+            for cls in (bool, bytes, float, int, str, type(None))
+    },
+    dict: _freeze_dict,
+    frozenset: _freeze_frozenset,
+    list: _freeze_list,
+    set: _freeze_set,
+    tuple: _freeze_tuple,
+}
+
+
+def register_freezer(cls: type, freezer: Callable[..., Any]) -> None:
+    '''
+    `freeze` will use `freezer(obj, *, _memo)` for objects whose type is
+    exactly `cls`.  This is a faster alternative to a `freeze` method.
+    '''
+    _TYPE_TO_FREEZER[cls] = freezer
+
+
+def register_immutable(cls: type) -> None:
+    'Instances of exactly `cls` MUST be recursively immutable.'
+    register_freezer(cls, _freeze_as_is)
+
+
+def _freezer_for_type(cls: type) -> Callable[..., Any]:
+    if hasattr(cls, 'freeze'):
+        freezer = _freeze_via_method
+    # This is a lame-o way of identifying `NamedTuple`s. Using
+    # `deepfrozen` would avoid this kludge.
+    elif issubclass(cls, tuple) and hasattr(cls, '_replace') and (
+        hasattr(cls, '_fields') and hasattr(cls, '_make')
+    ):
+        freezer = _freeze_namedtuple
+    elif issubclass(cls, (list, tuple)):
+        freezer = _freeze_list
+    elif issubclass(cls, dict):
+        freezer = _freeze_dict
+    elif issubclass(cls, (set, frozenset)):
+        freezer = _freeze_set
+    else:
+        raise NotImplementedError(cls)
+    _TYPE_TO_FREEZER[cls] = freezer
+    return freezer
 
 
 def freeze(obj, *, _memo=None, **kwargs):
+    freezer = _TYPE_TO_FREEZER.get(type(obj))
     # Don't bother memoizing primitive types
-    if isinstance(obj, (bytes, Enum, float, int, str, type(None))):
+    if freezer is _freeze_as_is:
         return obj
+    if freezer is None:
+        if isinstance(obj, _IMMUTABLE_BASES):
+            register_immutable(type(obj))
+            return obj
+        freezer = _freezer_for_type(type(obj))
 
     if _memo is None:
         _memo = {}
@@ -35,31 +146,12 @@ def freeze(obj, *, _memo=None, **kwargs):
     if id(obj) in _memo:  # Already frozen?
         return _memo[id(obj)]
 
-    if hasattr(obj, 'freeze'):
-        frozen = obj.freeze(_memo=_memo, **kwargs)
-    else:
+    if freezer is not _freeze_via_method:
         # At the moment, I don't have a need for passing extra data into
         # items that live inside containers.  If we're relaxing this, just
-        # be sure to add `**kwargs` to each `freeze()` call below.
+        # be sure to add `**kwargs` to each `freeze()` call in the freezers.
         assert kwargs == {}, kwargs
-        # This is a lame-o way of identifying `NamedTuple`s. Using
-        # `deepfrozen` would avoid this kludge.
-        if (
-            isinstance(obj, tuple) and hasattr(obj, '_replace') and
-            hasattr(obj, '_fields') and hasattr(obj, '_make')
-        ):
-            frozen = obj._make(freeze(i, _memo=_memo) for i in obj)
-        elif isinstance(obj, (list, tuple)):
-            frozen = tuple(freeze(i, _memo=_memo) for i in obj)
-        elif isinstance(obj, dict):
-            frozen = MappingProxyType({
-                freeze(k, _memo=_memo): freeze(v, _memo=_memo)
-                    for k, v in obj.items()
-            })
-        elif isinstance(obj, (set, frozenset)):
-            frozen = frozenset(freeze(i, _memo=_memo) for i in obj)
-        else:
-            raise NotImplementedError(type(obj))
+    frozen = freezer(obj, _memo=_memo, **kwargs)
 
     _memo[id(obj)] = frozen
     return frozen
@@ -34,13 +34,21 @@ import itertools
 import stat
 
 from abc import ABC
-from typing import Dict, Optional, Sequence, Type
+from typing import Any, Dict, Optional, Sequence, Tuple, Type
 
 from .extent import Extent
 from .freeze import freeze
 from .inode import Chunk, Inode, InodeOwner, InodeUtimes
 from .parse_dump import SendStreamItem, SendStreamItems
 
+# The `fallocate(2)` flags that `btrfs receive` can be asked to apply.
+_FALLOC_FL_KEEP_SIZE = 0x01
+_FALLOC_FL_PUNCH_HOLE = 0x02
+_FALLOC_FL_ZERO_RANGE = 0x10
+_KNOWN_FALLOC_FLAGS = (
+    _FALLOC_FL_KEEP_SIZE | _FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_ZERO_RANGE
+)
+
 
 class IncompleteInode(ABC):
     '''
@@ -60,6 +68,10 @@ class IncompleteInode(ABC):
     # If any of these are None, the filesystem was created badly.
     # Exception: symlinks don't have permissions.
 
+    # `(_freeze_key(), Inode)` of the last `freeze`, for reuse while the
+    # key stays the same.  Not copied, see `__getstate__`.
+    _frozen: Optional[Tuple[Any, Inode]] = None
+
     def __init__(self, *, item: SendStreamItem):
         assert isinstance(item, self.INITIAL_ITEM)
         self.file_type = self.FILE_TYPE
@@ -69,14 +81,46 @@ class IncompleteInode(ABC):
         self.xattrs = {}
 
     def freeze(self, *, _memo, chunks: Sequence[Chunk]) -> Inode:
-        'Returns a recursively immutable `Inode` based on `self`.'
+        '''
+        Returns a recursively immutable `Inode` based on `self`.  Freezing
+        the same subvolume repeatedly, e.g. to validate it after each
+        send-stream, reuses the `Inode`s of the unchanged inodes.
+        '''
+        key = self._freeze_key(chunks)
+        if key is not None and self._frozen is not None \
+                and self._frozen[0] == key:
+            return self._frozen[1]
         # NB: If any freezing bugs turn up in this implementation, consider
         # wrapping a single `freeze` around the `freeze_kwargs` call to
         # ensure that everything gets processed.
         ino = Inode(**self._freeze_kwargs(_memo=_memo, chunks=chunks))
         assert (ino.chunks is not None) ^ (chunks is None)
+        if key is not None:
+            self._frozen = (key, ino)
         return ino
 
+    def _freeze_key(self, chunks: Sequence[Chunk]) -> Optional[Tuple]:
+        '''
+        Captures all the inputs of `_freeze_kwargs`, or returns `None` if
+        the `Inode` must not be reused.  Clones refer to other inodes via
+        the `InodeID`s of the frozen `InodeIDMap`, which differs between
+        `freeze` calls.  We do not hook the mutators, since some callers
+        (e.g. `inode_utils.py`) set the fields directly.
+        '''
+        if chunks is not None and any(c.chunk_clones for c in chunks):
+            return None
+        return (
+            chunks, self.mode, self.owner, self.utimes,
+            tuple(self.xattrs.items()),
+        )
+
+    def __getstate__(self):
+        # The cached `Inode` is cheap to rebuild, and cannot be copied,
+        # since `MappingProxyType` does not support `deepcopy` or `pickle`.
+        state = self.__dict__.copy()
+        state.pop('_frozen', None)
+        return state
+
     def _freeze_kwargs(self, *, _memo, chunks: Sequence[Chunk]):
         return {
             'file_type': self.file_type,
@@ -107,6 +151,8 @@ class IncompleteInode(ABC):
                 mtime=item.mtime,
                 atime=item.atime,
             )
+        elif isinstance(item, SendStreamItems.fileattr):
+            pass  # Like `btrfs receive`, we do not track inode flags yet.
         else:
             raise RuntimeError(f'{self} cannot apply {item}')
 
@@ -125,14 +171,14 @@ class IncompleteDir(IncompleteInode):
 
 
 class IncompleteFile(IncompleteInode):
-    extent: Extent
+    extent: Extent  # Or `FlatExtent`, per `extent_class`
 
     FILE_TYPE = stat.S_IFREG
     INITIAL_ITEM = SendStreamItems.mkfile
 
-    def __init__(self, *, item: SendStreamItem):
+    def __init__(self, *, item: SendStreamItem, extent_class=Extent):
         super().__init__(item=item)
-        self.extent = Extent.empty()
+        self.extent = extent_class.empty()
 
     def _freeze_kwargs(self, *, _memo, chunks: Sequence[Chunk]):
         assert (chunks is None) ^ (self.extent is not None)
@@ -154,9 +200,36 @@ class IncompleteFile(IncompleteInode):
             self.extent = self.extent.write(
                 offset=item.offset, length=item.len,
             )
+        elif isinstance(item, SendStreamItems.encoded_write):
+            # Only the lengths matter, so we never decode `item.data`.
+            if item.unencoded_offset + item.unencoded_file_len > \
+                    item.unencoded_len:
+                raise RuntimeError(f'{item} reads past its decoded data')
+            self.extent = self.extent.write(
+                offset=item.offset, length=item.unencoded_file_len,
+            )
+        elif isinstance(item, SendStreamItems.fallocate):
+            self._fallocate(item)
         else:
             super().apply_item(item=item)
 
+    def _fallocate(self, item: SendStreamItems.fallocate) -> None:
+        '''
+        Preallocated and zeroed ranges read as zeros, and `btrfs send`
+        would not send data for them, so we model them as holes.
+        '''
+        if item.mode & ~_KNOWN_FALLOC_FLAGS:
+            raise RuntimeError(f'{self} cannot apply the mode of {item}')
+        end = item.offset + item.len
+        if not item.mode & _FALLOC_FL_KEEP_SIZE and end > self.extent.length:
+            self.extent = self.extent.truncate(length=end)
+        if item.mode & (_FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_ZERO_RANGE):
+            end = min(end, self.extent.length)
+            if end > item.offset:
+                self.extent = self.extent.punch_hole(
+                    offset=item.offset, length=end - item.offset,
+                )
+
     def apply_clone(
         self, item: SendStreamItems.clone, from_ino: IncompleteInode,
     ) -> None:
@@ -221,6 +294,9 @@ class IncompleteDevice(IncompleteInode):
         self.mode = item.mode & ~self.FILE_TYPE
         self.dev = item.dev
 
+    def _freeze_key(self, chunks: Sequence[Chunk]) -> Optional[Tuple]:
+        return (self.dev, *super()._freeze_key(chunks))
+
     def _freeze_kwargs(self, *, _memo, chunks: Sequence[Chunk]):
         return {
             'dev': self.dev,
@@ -242,6 +318,9 @@ class IncompleteSymlink(IncompleteInode):
         super().__init__(item=item)
         self.dest = item.dest
 
+    def _freeze_key(self, chunks: Sequence[Chunk]) -> Optional[Tuple]:
+        return (self.dest, *super()._freeze_key(chunks))
+
     def _freeze_kwargs(self, *, _memo, chunks: Sequence[Chunk]):
         return {
             'dest': self.dest,
@@ -17,9 +17,12 @@ Avoid whitespace when possible, since IncompleteInode uses space separators.
 import stat
 
 from datetime import datetime
-from typing import NamedTuple, Mapping, Optional, Set, Sequence, Tuple
+from typing import (
+    Callable, NamedTuple, Mapping, Optional, Set, Sequence, Tuple,
+)
 
 from .extent import Extent
+from .freeze import register_immutable
 from .inode_id import InodeID
 
 
@@ -31,6 +34,9 @@ class InodeOwner(NamedTuple):
         return f'{self.uid}:{self.gid}'
 
 
+register_immutable(InodeOwner)
+
+
 MSEC_TO_NSEC = 10 ** 6
 SEC_TO_NSEC = 1000 * MSEC_TO_NSEC
 MIN_TO_SEC = 60
@@ -85,6 +91,9 @@ class InodeUtimes(NamedTuple):
         return f'{_repr_time(*self.ctime)}{c_to_m}{m_to_a}'
 
 
+register_immutable(InodeUtimes)
+
+
 S_IFMT_TO_FILE_TYPE_NAME = {
     stat.S_IFBLK: 'Block',
     stat.S_IFCHR: 'Char',
@@ -150,7 +159,7 @@ class Inode(NamedTuple):
         if (self.dest is not None) ^ stat.S_ISLNK(self.file_type):
             raise RuntimeError(f'{self} must have .dest iff it is a symlink')
 
-    def _repr_fields(self):
+    def _repr_fields(self, extent_id: Callable[[int], int]):
         yield S_IFMT_TO_FILE_TYPE_NAME.get(self.file_type, str(self.file_type))
         if self.mode is not None:
             yield f'm{self.mode:o}'
@@ -173,6 +182,13 @@ class Inode(NamedTuple):
                         repr(cc) for cc in c.chunk_clones
                     )) + ')')
                         if c.chunk_clones else ''
+                ) + (
+                    ('[' + '/'.join(
+                        f'#{extent_id(se.extent_nonce)}:{se.extent_offset}'
+                        f'+{se.length}@{se.offset}'
+                            for se in c.shared_extents
+                    ) + ']')
+                        if c.shared_extents else ''
                 ) for c in self.chunks
             )
         if self.dev is not None:
@@ -180,8 +196,16 @@ class Inode(NamedTuple):
         if self.dest is not None:
             yield f'{_repr_decode(self.dest)}'
 
+    def repr_with_extent_ids(self, extent_id: Callable[[int], int]) -> str:
+        '''
+        `SharedExtent.extent_nonce` depends on how the filesystem was built,
+        so `Subvolume.render` passes an `extent_id` that renumbers nonces
+        in traversal order, just as it does for hardlinked inodes.
+        '''
+        return '(' + ' '.join(self._repr_fields(extent_id)) + ')'
+
     def __repr__(self):
-        return '(' + ' '.join(self._repr_fields()) + ')'
+        return self.repr_with_extent_ids(lambda nonce: nonce)
 
 
 class Clone(NamedTuple):
@@ -208,13 +232,47 @@ class ChunkClone(NamedTuple):
         return f'{repr(self.clone)}@{self.offset}'
 
 
+class SharedExtent(NamedTuple):
+    '''
+    The linear-size alternative to `ChunkClone`, emitted by
+    `extents_to_chunks_with_shared_extents`.  Bytes `[offset, offset +
+    length)` of this `Chunk` share storage with the bytes of any other
+    `SharedExtent` that has the same `extent_nonce`, and whose
+    `[extent_offset, extent_offset + length)` range overlaps this one.
+    '''
+    offset: int  # Offset into the `Chunk`
+    length: int
+    # Identifies the underlying leaf `Extent`.  This is only unique within
+    # one call to `extents_to_chunks_with_shared_extents`, so it must be
+    # renumbered for rendering, see `Inode.repr_with_extent_ids`.
+    extent_nonce: int
+    # Offset into the leaf `Extent`, after removing the byte ranges that
+    # are not shared, so that it does not depend on the build history.
+    extent_offset: int
+
+    def __repr__(self):
+        return (
+            f'#{self.extent_nonce}:{self.extent_offset}+{self.length}'
+            f'@{self.offset}'
+        )
+
+
+register_immutable(SharedExtent)
+
+
 class Chunk(NamedTuple):
     kind: Extent.Kind
     length: int
     chunk_clones: Set[ChunkClone]
+    # Only populated by `extents_to_chunks_with_shared_extents`, which
+    # leaves `chunk_clones` empty.
+    shared_extents: Sequence[SharedExtent] = ()
 
     def __repr__(self):
         return f'({self.kind.name}/{self.length}' + (
             (': ' + ', '.join(repr(c) for c in self.chunk_clones))
                 if self.chunk_clones else ''
+        ) + (
+            (' ' + ', '.join(repr(s) for s in self.shared_extents))
+                if self.shared_extents else ''
         ) + ')'
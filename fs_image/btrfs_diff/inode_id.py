@@ -21,7 +21,7 @@ from typing import (
     Tuple,
 )
 
-from .freeze import freeze
+from .freeze import freeze, register_freezer, register_immutable
 
 
 def tail(n: int, iterable):
@@ -80,6 +80,17 @@ class InodeID(NamedTuple):
         )
 
 
+def _freeze_inode_id(inode_id: InodeID, *, _memo) -> InodeID:
+    # Skips the generic `NamedTuple` walk, since only the map needs work.
+    return InodeID(
+        id=inode_id.id,
+        inner_id_map=freeze(inode_id.inner_id_map, _memo=_memo),
+    )
+
+
+register_freezer(InodeID, _freeze_inode_id)
+
+
 def _norm_split_path(p: bytes) -> Sequence[bytes]:
     # Check explicitly since the downstream errors are incomprehensible.
     if not isinstance(p, bytes):
@@ -113,6 +124,7 @@ class _ReversePathEntry(NamedTuple):
 
 
 _ROOT_REVERSE_ENTRY = _ReversePathEntry(name=b'', parent_int_id=None)
+register_immutable(_ReversePathEntry)
 
 
 class _InnerInodeIDMap(NamedTuple):
@@ -383,7 +395,9 @@ class InodeIDMap(NamedTuple):
         a non-final component.
         '''
         paths = list(self.inner.gen_paths(inode_id))
-        if len(paths) > 1:  # Directories have 1 path, 0 paths is an error
+        if not paths:
+            raise ValueError(f'{inode_id} has no paths')
+        if len(paths) > 1:  # Directories have 1 path
             return None  # A file
         path, = paths
         entry = self._get_entry(path)  # Not None since we started from InodeID
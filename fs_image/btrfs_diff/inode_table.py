@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+`InodeTable` is the `Subvolume.id_to_inode` of subvolumes that use a
+`CompactInodeIDMap`.  It is a mapping from `InodeID`s to
+`IncompleteInode`s, which can be snapshotted in O(1) time.
+
+To snapshot a subvolume, we used to `deepcopy` it, copying every
+`IncompleteInode`.  Replaying a chain of N incremental send-streams thus
+cost N full copies of the base filesystem.  Instead, `snapshot` shares
+the `IncompleteInode`s between the two tables, and either table only
+copies an inode the first time that `get_mutable` returns it.  The
+`Subvolume` mutates inodes only via `get_mutable`.
+
+We key the inodes by their inode numbers, since a snapshot's `InodeID`s
+refer to a different `CompactInodeIDMap` than its parent's.
+'''
+import copy
+
+from typing import Any, Iterator, MutableMapping
+
+from .cow_list import CowList
+from .incomplete_inode import IncompleteInode
+from .inode_id import InodeID
+
+
+class InodeTable(MutableMapping):
+
+    def __init__(self, inner_id_map: Any):
+        # The `.inner` of the `CompactInodeIDMap` issuing our `InodeID`s
+        self._inner_id_map = inner_id_map
+        # Indexed by inode number, `None` marks a missing inode.  Each
+        # `IncompleteInode` is `deepcopy`able, see `incomplete_inode.py`.
+        self._inodes = CowList(copy_item=copy.deepcopy)
+        self._len = 0
+
+    def _index(self, ino_id: InodeID) -> int:
+        if (
+            not isinstance(ino_id, InodeID)
+            or ino_id.inner_id_map is not self._inner_id_map
+            or ino_id.id >= len(self._inodes)
+            or self._inodes.items[ino_id.id] is None
+        ):
+            raise KeyError(ino_id)
+        return ino_id.id
+
+    def __getitem__(self, ino_id: InodeID) -> IncompleteInode:
+        return self._inodes.items[self._index(ino_id)]
+
+    def get_mutable(self, ino_id: InodeID) -> IncompleteInode:
+        'Returns `self[ino_id]`, copying it first if it may be shared.'
+        return self._inodes.get_mutable(self._index(ino_id))
+
+    def __setitem__(self, ino_id: InodeID, ino: IncompleteInode) -> None:
+        'Do not store the same `IncompleteInode` in two tables.'
+        if ino_id not in self:
+            self._inner_id_map._assert_mine(ino_id)
+            self._inodes.grow(ino_id.id + 1, None)
+            self._len += 1
+        self._inodes.set(ino_id.id, ino)
+
+    def __delitem__(self, ino_id: InodeID) -> None:
+        self._inodes.set(self._index(ino_id), None)
+        self._len -= 1
+
+    def __iter__(self) -> Iterator[InodeID]:
+        for ino, inode in enumerate(self._inodes.items):
+            if inode is not None:
+                # Not a new `InodeID`, since `freeze` memoizes by `id()`,
+                # and would mistake new objects that reuse an `id()`.
+                yield self._inner_id_map._inode_id(ino)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def snapshot(self, inner_id_map: Any) -> 'InodeTable':
+        '''
+        Returns a copy of `self`, keyed by the `InodeID`s of
+        `inner_id_map`, which initially shares our `IncompleteInode`s.
+        '''
+        snapshot = InodeTable(inner_id_map)
+        snapshot._inodes = self._inodes.snapshot()
+        snapshot._len = self._len
+        return snapshot
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+`replay_sections` applies send-streams to a `SubvolumeSet` using all
+cores, producing the same `SubvolumeSet` as feeding each section to a
+`SubvolumeSetMutator` in order.
+
+A "section" is a `subvol` or `snapshot` item, plus the items that follow
+it up to the next such item -- in other words, one send-stream, see
+`split_sections`.  A section depends on the subvolume that it snapshots,
+and on those that it clones from.  Sections that are not connected by
+such dependencies are independent, e.g. the layer stacks of unrelated
+images, so we group them into "components", and replay each component
+in a worker process, which ships the resulting `Subvolume`s back via
+`pickle`.
+
+This is deterministic: each `Subvolume` numbers its inodes
+independently of the others, so a worker assigns the same `InodeID`s as
+a sequential replay, and we insert the subvolumes in the same order.
+
+Three details of the merge:
+  - Each worker's `SubvolumeDescription`s share its own
+    `name_uuid_prefix_counts`, which we replace with the one of the
+    target `SubvolumeSet` while unpickling.
+  - The `CloneIndex` is keyed by `id()`s, which do not survive `pickle`,
+    so we re-index the subvolumes of each component.  Components never
+    clone from each other, so their `Extent`s need not be shared.
+  - A component that depends on a subvolume that is already in the
+    target `SubvolumeSet` is replayed in this process.  So is everything
+    when there is just one component, or one core.
+
+As with `SubvolumeSetMutator`, an error may leave the `SubvolumeSet`
+partially updated.
+'''
+import io
+import os
+import pickle
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Sequence
+
+from .send_stream import SendStreamItem, SendStreamItems
+from .subvolume import Subvolume
+from .subvolume_set import SubvolumeSet, SubvolumeSetMutator
+
+_Section = Sequence[SendStreamItem]
+_SUBVOL_ITEMS = (SendStreamItems.subvol, SendStreamItems.snapshot)
+# Stands in for a worker's `name_uuid_prefix_counts` in the pickle.
+_PREFIX_COUNTS_ID = 'name_uuid_prefix_counts'
+
+
+def split_sections(
+    items: Iterable[SendStreamItem],
+) -> Iterator[List[SendStreamItem]]:
+    'Splits `items` before each `subvol` or `snapshot` item.'
+    section = None
+    for item in items:
+        if isinstance(item, _SUBVOL_ITEMS):
+            if section is not None:
+                yield section
+            section = [item]
+        elif section is None:
+            raise RuntimeError(f'{item} must specify subvolume')
+        else:
+            section.append(item)
+    if section is not None:
+        yield section
+
+
+def _section_uuids(section: _Section) -> Iterator[str]:
+    'The UUID of the section, and of the subvolumes that it depends on.'
+    first = section[0]
+    yield first.uuid.decode()
+    if isinstance(first, SendStreamItems.snapshot):
+        yield first.parent_uuid.decode()
+    for item in section:
+        if isinstance(item, SendStreamItems.clone):
+            yield item.from_uuid.decode()
+
+
+def _components(sections: Sequence[_Section]) -> List[List[int]]:
+    '''
+    Groups the indexes of `sections` by the subvolumes that they share.
+    Components, and the sections in each, are in order of first appearance.
+    '''
+    # Union-find over section indexes, where each root is the smallest
+    # index in its component.
+    parents = list(range(len(sections)))
+
+    def find(idx):
+        while parents[idx] != idx:
+            parents[idx] = parents[parents[idx]]
+            idx = parents[idx]
+        return idx
+
+    uuid_to_idx = {}
+    for idx, section in enumerate(sections):
+        for uuid in _section_uuids(section):
+            a, b = find(idx), find(uuid_to_idx.setdefault(uuid, idx))
+            parents[max(a, b)] = min(a, b)
+    root_to_component = {}
+    for idx in range(len(sections)):
+        root_to_component.setdefault(find(idx), []).append(idx)
+    return list(root_to_component.values())
+
+
+def _replay(subvols: SubvolumeSet, sections: Iterable[_Section]) -> None:
+    for section in sections:
+        mutator = SubvolumeSetMutator.new(subvols, section[0])
+        for item in section[1:]:
+            mutator.apply_item(item)
+
+
+def _replay_component(
+    sections: Sequence[_Section], extent_class: type, id_map_class: type,
+) -> bytes:
+    'Runs in a worker.  Returns the pickled `Subvolume`s, in order.'
+    subvols = SubvolumeSet.new(
+        extent_class=extent_class, id_map_class=id_map_class,
+    )
+    _replay(subvols, sections)
+    prefix_counts = subvols.name_uuid_prefix_counts
+
+    class Pickler(pickle.Pickler):
+        def persistent_id(self, obj):
+            return _PREFIX_COUNTS_ID if obj is prefix_counts else None
+
+    out = io.BytesIO()
+    Pickler(out, pickle.HIGHEST_PROTOCOL).dump(
+        list(subvols.uuid_to_subvolume.values()),
+    )
+    return out.getvalue()
+
+
+def _unpickle_subvols(
+    subvols: SubvolumeSet, data: bytes,
+) -> List[Subvolume]:
+
+    class Unpickler(pickle.Unpickler):
+        def persistent_load(self, pid):
+            assert pid == _PREFIX_COUNTS_ID, pid
+            return subvols.name_uuid_prefix_counts
+
+    return Unpickler(io.BytesIO(data)).load()
+
+
+def replay_sections(
+    subvols: SubvolumeSet,
+    sections: Iterable[_Section],
+    *,
+    max_workers: Optional[int] = None,
+) -> None:
+    '''
+    Applies `sections`, as from `split_sections`, to `subvols`.  Runs up
+    to `max_workers` processes, by default one per core.
+    '''
+    sections = list(sections)
+    existing_uuids = set(subvols.uuid_to_subvolume)
+    local_idxs = set()
+    remote_components = []
+    for component in _components(sections):
+        if existing_uuids.isdisjoint(
+            uuid
+                for idx in component
+                    for uuid in _section_uuids(sections[idx])
+        ):
+            remote_components.append(component)
+        else:
+            local_idxs.update(component)
+    # Pickling costs about as much as replaying, so only use workers if
+    # they can run concurrently.
+    if len(remote_components) < 2 or (max_workers or os.cpu_count()) < 2:
+        for component in remote_components:
+            local_idxs.update(component)
+        remote_components = []
+
+    _replay(subvols, (sections[idx] for idx in sorted(local_idxs)))
+    idx_to_new_subvol = {
+        idx: subvols.uuid_to_subvolume.pop(sections[idx][0].uuid.decode())
+            for idx in local_idxs
+    }
+    if remote_components:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for component, data in zip(remote_components, executor.map(
+                _replay_component,
+                [[sections[idx] for idx in c] for c in remote_components],
+                [subvols.extent_class] * len(remote_components),
+                [subvols.id_map_class] * len(remote_components),
+            )):
+                # A component makes one subvolume per section, in order.
+                for idx, subvol in zip(
+                    component, _unpickle_subvols(subvols, data),
+                ):
+                    idx_to_new_subvol[idx] = subvol
+                    subvols.clone_index.update_subvolume(subvol)
+                    # pyre-fixme[16]: This is supposed to be frozen!!!
+                    subvols.name_uuid_prefix_counts.update(
+                        subvol.id_map.inner.description.name_uuid_prefixes()
+                    )
+    # Insert the new subvolumes in the same order as a sequential replay.
+    for idx in sorted(idx_to_new_subvol):
+        # pyre-fixme[16]: This is supposed to be frozen!!!
+        subvols.uuid_to_subvolume[
+            sections[idx][0].uuid.decode()
+        ] = idx_to_new_subvol[idx]
@@ -58,11 +58,14 @@ Limitations of `btrfs receive --dump` (filed as T25376790):
    unravel the source of a clone when more than one source is in use.
 '''
 import datetime
+import functools
 import os
 import re
 
 from collections import OrderedDict
-from typing import Any, BinaryIO, Dict, Iterable, Optional, Pattern, Tuple
+from typing import (
+    Any, BinaryIO, Callable, Dict, Iterable, Optional, Pattern, Tuple,
+)
 
 from .send_stream import SendStreamItem, SendStreamItems
 
@@ -107,6 +110,8 @@ def unquote_btrfs_progs_path(s):
     custom un-quoting function.  Future: fix `btrfs-progs` so that other
     fields (paths & data) are quoted too.
     '''
+    if b'\\' not in s:  # Most paths have no escapes
+        return s
     return _ESCAPED_REGEX.sub(lambda m: _ESCAPED_TO_UNESCAPED[m.group(0)], s)
 
 
@@ -138,6 +143,22 @@ class RegexItemParser:
 
 
 def _normalize_subvolume_path(s: bytes, *, subvol_name: bytes) -> bytes:
+    # Fast path: `relpath` is slow, but most paths look like
+    # `./SUBVOL/a/b`, which is already normalized if no component is
+    # empty or starts with a dot.
+    start = 2 if s.startswith(b'./') else 0
+    if s.startswith(subvol_name, start):
+        start += len(subvol_name)
+        stripped = s[start + 1:]
+        if s[start:start + 1] == b'/' and (
+            stripped and not stripped.endswith(b'/')
+            and b'//' not in stripped and b'/.' not in stripped
+            and stripped[:1] not in (b'/', b'.')
+        ):
+            return stripped
+        # The subvolume itself, as in `utimes ./SUBVOL/`
+        if s[start:] in (b'', b'/') and len(s) > 1:
+            return b'.'
     # `normpath` is needed since `btrfs receive --dump` is inconsistent
     # about trailing slashes on directory paths.
     stripped = os.path.relpath(s, subvol_name)
@@ -312,6 +333,8 @@ class SendStreamItemParsers:
         )
 
         @classmethod
+        # `strptime` is slow, and the timestamps of an image mostly repeat.
+        @functools.lru_cache(maxsize=1024)
         def conv_atime(cls, t: bytes) -> Tuple[int, int]:
             return (int(datetime.datetime.strptime(
                 t.decode(), '%Y-%m-%dT%H:%M:%S%z'
@@ -326,6 +349,45 @@ class SendStreamItemParsers:
         conv_offset = staticmethod(int)
         conv_len = staticmethod(int)
 
+    # NB: `encoded_write` is not here, see `_EncodedWriteParser`.
+
+    class fallocate(RegexItemParser):
+        regex = re.compile(
+            br'mode=(?P<mode>[0-9]+) '
+            br'offset=(?P<offset>[0-9]+) '
+            br'len=(?P<len>[0-9]+)'
+        )
+        conv_mode = staticmethod(int)
+        conv_offset = staticmethod(int)
+        conv_len = staticmethod(int)
+
+    class fileattr(RegexItemParser):
+        regex = re.compile(br'fileattr=0x(?P<attr>[0-9a-fA-F]+)')
+
+        @staticmethod
+        def conv_attr(attr: bytes) -> int:
+            return int(attr, 16)
+
+
+class _EncodedWriteParser(RegexItemParser):
+    '''
+    Like `write`, `encoded_write` becomes an `update_extent`, since
+    `--dump` does not show the data.  Its `len` is the length of the
+    encoded data, while the file gets `unencoded_file_len` bytes.
+    '''
+    # Some versions of `btrfs-progs` separate these fields with commas.
+    regex = re.compile(
+        br'offset=(?P<offset>[0-9]+),? '
+        br'len=[0-9]+,? '
+        br'unencoded_file_len=(?P<len>[0-9]+),? '
+        br'unencoded_len=[0-9]+,? '
+        br'unencoded_offset=[0-9]+,? '
+        br'compression=[0-9]+,? '
+        br'encryption=[0-9]+'
+    )
+    conv_offset = staticmethod(int)
+    conv_len = staticmethod(int)
+
 
 # The inner classes of SendStreamItems, omitting internals like __doc__.
 # The keys must be bytes because `btrfs` does not give us unicode.
@@ -336,31 +398,101 @@ NAME_TO_PARSER_TYPE = {
 NAME_TO_ITEM_TYPE = {
     k.encode(): v
         for k, v in SendStreamItems.__dict__.items()
-            if k[0] != '_' and k != 'write'
+            if k[0] != '_' and k not in ('write', 'encoded_write')
 }
 assert set(NAME_TO_PARSER_TYPE.keys()) == set(NAME_TO_ITEM_TYPE.keys())
 
 
+DetailsParser = Callable[[bytes, bytes], Optional[Dict[str, Any]]]
+
+
+def _compile_details_parser(parser_type) -> DetailsParser:
+    '''
+    Returns the equivalent of `parser_type.parse_details`, minus the
+    per-field `getattr`s of `RegexItemParser`, which dominate its runtime.
+    '''
+    if not issubclass(parser_type, RegexItemParser):
+        return parser_type.parse_details
+    regex = parser_type.regex
+    assert 'path' not in regex.groupindex, f'{parser_type} defined <path>'
+    if not regex.groupindex:
+        return lambda subvol_name, details: None \
+            if regex.fullmatch(details) is None else {}
+    names = sorted(regex.groupindex, key=regex.groupindex.get)
+    assert regex.groups == len(names), f'{parser_type} has unnamed groups'
+    fields_and_convs = [
+        (
+            name,
+            getattr(parser_type, f'conv_{name}', None),
+            getattr(parser_type, f'context_conv_{name}', None),
+        ) for name in names
+    ]
+
+    def parse_details(
+        subvol_name: bytes, details: bytes,
+    ) -> Optional[Dict[str, Any]]:
+        m = regex.fullmatch(details)
+        if m is None:
+            return None
+        fields = {}
+        for (name, conv, context_conv), value in zip(
+            fields_and_convs, m.groups(),
+        ):
+            if conv is not None:
+                value = conv(value)
+            if context_conv is not None:
+                value = context_conv(value, subvol_name=subvol_name)
+            fields[name] = value
+        return fields
+
+    return parse_details
+
+
+# `btrfs receive --dump` prints the item name, the quoted path of the item,
+# and the item-specific details.
+_LINE_REGEX = re.compile(br'([^ ]+) +((?:\\ |[^ ])+) *(.*)\n')
+# Maps each item name to its type & compiled details parser.
+#
+# This parser maps `write` and `encoded_write` to `update_extent` regardless
+# of whether the send-stream used `--no-data` or not.  The reason is that
+# `btrfs receive --dump` never displays the `data` field (because it can be
+# huge, and not very illuminating to the user).
+_NAME_TO_ITEM_TYPE_AND_PARSER: Dict[bytes, Tuple[type, DetailsParser]] = {
+    **{
+        name: (
+            NAME_TO_ITEM_TYPE[parser_name],
+            _compile_details_parser(NAME_TO_PARSER_TYPE[parser_name]),
+        ) for name, parser_name in [
+            *((n, n) for n in NAME_TO_PARSER_TYPE),
+            (b'write', b'update_extent'),
+        ]
+    },
+    b'encoded_write': (
+        SendStreamItems.update_extent,
+        _compile_details_parser(_EncodedWriteParser),
+    ),
+}
+
+
 def parse_btrfs_dump(binary_infile: BinaryIO) -> Iterable[SendStreamItem]:
-    reg = re.compile(br'([^ ]+) +((\\ |[^ ])+) *(.*)\n')
+    '''
+    A single pass over the lines of `binary_infile`, which tokenizes each
+    line with one regex, and dispatches on the item name to a details
+    parser compiled from `SendStreamItemParsers`.
+    '''
+    line_fullmatch = _LINE_REGEX.fullmatch
+    name_to_item_type_and_parser = _NAME_TO_ITEM_TYPE_AND_PARSER
     subvol_name = None
     for l in binary_infile:
-        m = reg.fullmatch(l)
+        m = line_fullmatch(l)
         if not m:
             raise RuntimeError(f'line has unexpected format: {repr(l)}')
-        item_name, path, _, details = m.groups()
-
-        # This parser maps `write` to `update_extent` regardless of whether
-        # the send-stream used `--no-data` or not.  The reason is that
-        # `btrfs receive --dump` never displays the `data` field (because it
-        # can be huge, and not very illuminating to the user).
-        if item_name == b'write':
-            item_name = b'update_extent'
+        item_name, path, details = m.groups()
 
-        item_class = NAME_TO_ITEM_TYPE.get(item_name)
-        if not item_class:
+        item_class_and_parser = name_to_item_type_and_parser.get(item_name)
+        if not item_class_and_parser:
             raise RuntimeError(f'unknown item type {item_name} in {repr(l)}')
-        item_parser = NAME_TO_PARSER_TYPE[item_name]
+        item_class, parse_details = item_class_and_parser
 
         # We MUST unquote here, or paths in field 1 will not be comparable
         # with as-of-now unquoted paths in the other fields.  For example,
@@ -385,13 +517,11 @@ def parse_btrfs_dump(binary_infile: BinaryIO) -> Iterable[SendStreamItem]:
                 unnormalized_path, subvol_name=subvol_name,
             )
 
-        fields = item_parser.parse_details(subvol_name, details)
+        fields = parse_details(subvol_name, details)
         if fields is None:
             raise RuntimeError(f'unexpected format in line details: {repr(l)}')
 
-        assert 'path' not in fields, f'{item_name}.regex defined <path>'
         fields['path'] = path
-
         yield item_class(**fields)
 
 
@@ -4,38 +4,112 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-'Parses the btrfs send-stream binary format. Only version 1 is supported.'
+'''
+Parses the btrfs send-stream binary format, versions 1 and 2.
+
+Version 2 adds the ENCODED_WRITE, FALLOCATE, and FILEATTR commands, and
+lets the DATA attribute exceed 64KiB, by omitting its length -- DATA is
+then the last attribute, and extends to the end of its command.  We pass
+the compressed DATA of an ENCODED_WRITE through undecoded.  `Subvolume`
+only needs its `unencoded_file_len`.
+
+There are two entry points, which produce identical `SendStreamItem`s:
+
+ - `parse_send_stream` reads a file object one command at a time, never
+   consuming bytes past the END command.  Use it for pipes.
+
+ - `parse_send_stream_buffer` parses a send-stream that is already in
+   memory, or `mmap`ed (see `parse_send_stream_mmap`).  It avoids copying
+   command bodies, and only materializes `bytes` for the attribute values
+   that end up in the resulting items.  This is considerably faster on
+   large send-streams -- try `tests/benchmark_parse_send_stream.py`.
+
+Both share the precompiled `struct.Struct`s and the kind-to-converter
+dispatch tables below.
+
+Both also accept `no_data=True`, which is for consumers that only care
+about metadata, like `Subvolume`.  In this mode, we never read the DATA
+payloads of WRITE commands, and emit `update_extent` items in place of
+`write`s and `encoded_write`s, exactly as if the stream had been made by
+`btrfs send --no-data`.
+The cost of the parse is then proportional to the size of the metadata.
+
+To normalize a large send-stream in one pass, without a list of all of
+its items, gather statistics like the default SELinux context via
+`get_frequency_of_selinux_xattrs_in_send_stream` first, and then feed
+`parse_send_stream` into an `ItemFilterPipeline` from `send_stream.py`.
+
+Finally, `check_crc=True` verifies the CRC32C of every command, which
+catches send-streams corrupted in storage or in transit.  With `no_data`,
+WRITE and ENCODED_WRITE commands are not checked, since we never read
+their payloads.  The CRC32C is computed in pure Python at ~10MB/s (see
+`crc32c.py`), so on data-heavy send-streams, only combine `check_crc`
+with `no_data` -- checking the data would dominate the parse.
+'''
 import enum
+import mmap
 import os
 import struct
 import uuid
 
-from io import BytesIO
-from typing import NamedTuple, Iterator, Tuple
+from collections import Counter
+from typing import (
+    Any, Callable, Dict, Iterator, Mapping, NamedTuple, Optional, Tuple,
+    Union,
+)
 
-from .send_stream import SendStreamItem, SendStreamItems
+from .crc32c import crc32c
+from .send_stream import (
+    get_frequency_of_selinux_xattrs, SendStreamItem, SendStreamItems,
+)
 
 BTRFS_SEND_STREAM_MAGIC = b'btrfs-stream\0'
+# Not to be confused with the send-stream format version.  Bump this when
+# a change to the parser can change the resulting items, since it is part
+# of the key of `subvolume_cache.py`.
+PARSER_VERSION = 1
 
+SUPPORTED_VERSIONS = (1, 2)
 
-def file_unpack(fmt, infile):
-    size = struct.calcsize(fmt)
-    b = infile.read(size)
-    if len(b) != size:
-        raise RuntimeError(f'Not enough bytes {b} for format {fmt}')
-    return struct.unpack(fmt, b)
+VERSION_STRUCT = struct.Struct('<I')
+COMMAND_HEADER_STRUCT = struct.Struct('<IHI')
+ATTRIBUTE_HEADER_STRUCT = struct.Struct('<HH')
+# Since version 2, the header of the DATA attribute is just its kind.
+UINT16_STRUCT = struct.Struct('<H')
+UINT32_STRUCT = struct.Struct('<I')
+UINT64_STRUCT = struct.Struct('<Q')
+TIME_STRUCT = struct.Struct('<QI')
 
 
-def check_magic(infile) -> None:
-    magic = infile.read(len(BTRFS_SEND_STREAM_MAGIC))
+def file_unpack(fmt: Union[str, struct.Struct], infile):
+    if not isinstance(fmt, struct.Struct):
+        fmt = struct.Struct(fmt)
+    b = infile.read(fmt.size)
+    if len(b) != fmt.size:
+        raise RuntimeError(f'Not enough bytes {b} for format {fmt.format}')
+    return fmt.unpack(b)
+
+
+def _check_magic_bytes(magic: bytes) -> None:
     if magic != BTRFS_SEND_STREAM_MAGIC:
         raise RuntimeError(f'Magic {magic}, not "{BTRFS_SEND_STREAM_MAGIC}"')
 
 
-def check_version(infile) -> None:
-    version, = file_unpack('<I', infile)
-    if version != 1:
-        raise RuntimeError(f'Got version {version}, but we require version 1')
+def _check_version_number(version: int) -> None:
+    if version not in SUPPORTED_VERSIONS:
+        raise RuntimeError(
+            f'Got version {version}, but we require version 1 or 2'
+        )
+
+
+def check_magic(infile) -> None:
+    _check_magic_bytes(infile.read(len(BTRFS_SEND_STREAM_MAGIC)))
+
+
+def check_version(infile) -> int:
+    version, = file_unpack(VERSION_STRUCT, infile)
+    _check_version_number(version)
+    return version
 
 
 class CommandKind(enum.Enum):
@@ -70,6 +144,11 @@ class CommandKind(enum.Enum):
     END = 21
     UPDATE_EXTENT = 22
 
+    # Version 2
+    FALLOCATE = 23
+    FILEATTR = 24
+    ENCODED_WRITE = 25
+
 
 class CommandHeader(NamedTuple):
     kind: CommandKind
@@ -78,7 +157,7 @@ class CommandHeader(NamedTuple):
 
     @staticmethod
     def from_file(infile) -> 'CommandHeader':
-        length, kind, crc = file_unpack('<IHI', infile)
+        length, kind, crc = file_unpack(COMMAND_HEADER_STRUCT, infile)
         return CommandHeader(kind=CommandKind(kind), length=length, crc=crc)
 
 
@@ -117,6 +196,16 @@ class AttributeKind(enum.Enum):
     CLONE_OFFSET = 23
     CLONE_LEN = 24
 
+    # Version 2
+    FALLOCATE_MODE = 25
+    FILEATTR = 26
+    UNENCODED_FILE_LEN = 27
+    UNENCODED_LEN = 28
+    UNENCODED_OFFSET = 29
+    # An ENCODED_WRITE may omit these if they are 0, i.e. "none".
+    COMPRESSION = 30
+    ENCRYPTION = 31
+
 
 class AttributeHeader(NamedTuple):
     kind: AttributeKind
@@ -124,214 +213,506 @@ class AttributeHeader(NamedTuple):
 
     @staticmethod
     def from_file(infile) -> 'AttributeHeader':
-        kind, length = file_unpack('<HH', infile)
+        kind, length = file_unpack(ATTRIBUTE_HEADER_STRUCT, infile)
         return AttributeHeader(kind=AttributeKind(kind), length=length)
 
 
 def conv_uuid(s: bytes) -> bytes:
-    return str(uuid.UUID(bytes=s)).encode()  # All our other strings are bytes
+    # `bytes()` since `s` may be a `memoryview` of a bigger buffer.  We
+    # `.encode()` because all our other strings are bytes.
+    return str(uuid.UUID(bytes=bytes(s))).encode()
+
+
+def conv_uint32(s: bytes) -> int:
+    i, = UINT32_STRUCT.unpack(s)
+    return i
 
 
 def conv_uint64(s: bytes) -> int:
-    i, = struct.unpack('<Q', s)
+    i, = UINT64_STRUCT.unpack(s)
     return i
 
 
 def conv_time(s: bytes) -> Tuple[int, int]:
-    s, us = struct.unpack('<QI', s)
+    s, us = TIME_STRUCT.unpack(s)
     # pyre wants an explicit check even though struct.unpack will raise
     assert isinstance(s, int) and isinstance(us, int), 'struct.unpack() failed'
     return s, us
 
 
+def conv_path(s: bytes) -> bytes:
+    return os.path.normpath(bytes(s))
+
+
+# Converters must return objects that do not reference their input, since
+# the input may be a `memoryview` into an `mmap` that is about to be closed.
+_ATTRIBUTE_KIND_TO_CONV: Mapping[AttributeKind, Callable[[bytes], Any]] = {
+    AttributeKind.UUID: conv_uuid,
+    AttributeKind.CTRANSID: conv_uint64,
+    AttributeKind.INO: conv_uint64,
+    AttributeKind.SIZE: conv_uint64,
+    AttributeKind.MODE: conv_uint64,
+    AttributeKind.UID: conv_uint64,
+    AttributeKind.GID: conv_uint64,
+    AttributeKind.RDEV: conv_uint64,
+    AttributeKind.CTIME: conv_time,
+    AttributeKind.MTIME: conv_time,
+    AttributeKind.ATIME: conv_time,
+    AttributeKind.XATTR_NAME: bytes,
+    AttributeKind.XATTR_DATA: bytes,
+    AttributeKind.PATH: conv_path,
+    AttributeKind.PATH_TO: conv_path,
+    # NB This is NOT normalized since we don't want to normalize symlinks
+    AttributeKind.PATH_LINK: bytes,
+    AttributeKind.FILE_OFFSET: conv_uint64,
+    AttributeKind.DATA: bytes,
+    AttributeKind.CLONE_UUID: conv_uuid,
+    AttributeKind.CLONE_CTRANSID: conv_uint64,
+    AttributeKind.CLONE_PATH: conv_path,
+    AttributeKind.CLONE_OFFSET: conv_uint64,
+    AttributeKind.CLONE_LEN: conv_uint64,
+    AttributeKind.FALLOCATE_MODE: conv_uint32,
+    AttributeKind.FILEATTR: conv_uint64,
+    AttributeKind.UNENCODED_FILE_LEN: conv_uint64,
+    AttributeKind.UNENCODED_LEN: conv_uint64,
+    AttributeKind.UNENCODED_OFFSET: conv_uint64,
+    AttributeKind.COMPRESSION: conv_uint32,
+    AttributeKind.ENCRYPTION: conv_uint32,
+}
+assert set(_ATTRIBUTE_KIND_TO_CONV) == set(AttributeKind)
+# With `no_data`, we only keep the length of DATA, see the module docblock.
+_NO_DATA_ATTRIBUTE_KIND_TO_CONV = {
+    **_ATTRIBUTE_KIND_TO_CONV, AttributeKind.DATA: len,
+}
+# Looking up the raw integer avoids the relatively slow `Enum.__call__`.
+_ATTRIBUTE_VALUE_TO_KIND = {k.value: k for k in AttributeKind}
+_DATA_KIND_BYTES = UINT16_STRUCT.pack(AttributeKind.DATA.value)
+
+
+def _read_attribute_header(
+    infile, version: int, remaining: int,
+) -> AttributeHeader:
+    '''
+    `remaining` counts the bytes left in the command, since, from version
+    2 on, DATA has no length, and extends to the end of the command.
+    '''
+    if version == 1:
+        return AttributeHeader.from_file(infile)
+    kind, = file_unpack(UINT16_STRUCT, infile)
+    if kind == AttributeKind.DATA.value:
+        return AttributeHeader(
+            kind=AttributeKind.DATA,
+            # If DATA has too few bytes, our caller reports the overflow.
+            length=max(0, remaining - UINT16_STRUCT.size),
+        )
+    length, = file_unpack(UINT16_STRUCT, infile)
+    return AttributeHeader(kind=AttributeKind(kind), length=length)
+
+
+def _attribute_header_size(attr_header: AttributeHeader, version: int):
+    if version != 1 and attr_header.kind == AttributeKind.DATA:
+        return UINT16_STRUCT.size
+    return ATTRIBUTE_HEADER_STRUCT.size
+
+
 def read_attribute(infile):
+    'Reads a version 1 attribute.'
     attr_header = AttributeHeader.from_file(infile)
     attr_data = infile.read(attr_header.length)
     if len(attr_data) != attr_header.length:
         raise RuntimeError(f'{attr_header} got {len(attr_data)} bytes')
-
-    if attr_header.kind == AttributeKind.UUID:
-        return attr_header.kind, conv_uuid(attr_data)
-    elif attr_header.kind == AttributeKind.CTRANSID:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.INO:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.SIZE:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.MODE:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.UID:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.GID:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.RDEV:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.CTIME:
-        return attr_header.kind, conv_time(attr_data)
-    elif attr_header.kind == AttributeKind.MTIME:
-        return attr_header.kind, conv_time(attr_data)
-    elif attr_header.kind == AttributeKind.ATIME:
-        return attr_header.kind, conv_time(attr_data)
-    elif attr_header.kind == AttributeKind.XATTR_NAME:
-        return attr_header.kind, attr_data
-    elif attr_header.kind == AttributeKind.XATTR_DATA:
-        return attr_header.kind, attr_data
-    elif attr_header.kind == AttributeKind.PATH:
-        return attr_header.kind, os.path.normpath(attr_data)
-    elif attr_header.kind == AttributeKind.PATH_TO:
-        return attr_header.kind, os.path.normpath(attr_data)
-    elif attr_header.kind == AttributeKind.PATH_LINK:
-        # NB This is NOT normalized since we don't want to normalize symlinks
-        return attr_header.kind, attr_data
-    elif attr_header.kind == AttributeKind.FILE_OFFSET:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.DATA:
-        return attr_header.kind, attr_data
-    elif attr_header.kind == AttributeKind.CLONE_UUID:
-        return attr_header.kind, conv_uuid(attr_data)
-    elif attr_header.kind == AttributeKind.CLONE_CTRANSID:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.CLONE_PATH:
-        return attr_header.kind, os.path.normpath(attr_data)
-    elif attr_header.kind == AttributeKind.CLONE_OFFSET:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.CLONE_LEN:
-        return attr_header.kind, conv_uint64(attr_data)
-
-    raise RuntimeError(f'Fix me: unhandled {attr_header}')  # pragma: no cover
-
-
-def read_command(infile):
+    return (
+        attr_header.kind, _ATTRIBUTE_KIND_TO_CONV[attr_header.kind](attr_data),
+    )
+
+
+def _parse_attributes(
+    cmd_header: CommandHeader,
+    view: memoryview,
+    kind_to_conv: Mapping[AttributeKind, Callable[[bytes], Any]],
+    version: int = 1,
+) -> Dict[AttributeKind, Any]:
+    '''
+    The zero-copy equivalent of calling `read_attribute` until the command
+    body `view` is exhausted.  Each attribute is sliced out of `view`, and
+    is only copied by its converter.
+    '''
+    kind_to_attr = {}
+    pos = 0
+    end = len(view)
+    implicit_data_length = version != 1
+    while pos != end:
+        if implicit_data_length and (
+            view[pos:pos + UINT16_STRUCT.size] == _DATA_KIND_BYTES
+        ):
+            raw_kind = AttributeKind.DATA.value
+            pos += UINT16_STRUCT.size
+            length = end - pos
+        else:
+            if end - pos < ATTRIBUTE_HEADER_STRUCT.size:
+                raise RuntimeError(
+                    f'Not enough bytes {bytes(view[pos:])} for format '
+                    f'{ATTRIBUTE_HEADER_STRUCT.format}'
+                )
+            raw_kind, length = ATTRIBUTE_HEADER_STRUCT.unpack_from(view, pos)
+            pos += ATTRIBUTE_HEADER_STRUCT.size
+        kind = _ATTRIBUTE_VALUE_TO_KIND.get(raw_kind)
+        if kind is None:
+            kind = AttributeKind(raw_kind)  # Raises a helpful `ValueError`
+        attr_data = view[pos:pos + length]
+        if len(attr_data) != length:
+            attr_header = AttributeHeader(kind=kind, length=length)
+            raise RuntimeError(f'{attr_header} got {len(attr_data)} bytes')
+        pos += length
+        if kind in kind_to_attr:
+            raise RuntimeError(f'{kind} occurred twice in {cmd_header}')
+        kind_to_attr[kind] = kind_to_conv[kind](attr_data)
+    return kind_to_attr
+
+
+_COMMAND_KIND_TO_ITEM_MAKER: Mapping[
+    CommandKind,
+    Callable[[Mapping[AttributeKind, Any]], Optional[SendStreamItem]],
+] = {
+    CommandKind.SUBVOL: lambda a: SendStreamItems.subvol(
+        path=a[AttributeKind.PATH],
+        uuid=a[AttributeKind.UUID],
+        transid=a[AttributeKind.CTRANSID],
+    ),
+    CommandKind.SNAPSHOT: lambda a: SendStreamItems.snapshot(
+        path=a[AttributeKind.PATH],
+        uuid=a[AttributeKind.UUID],
+        transid=a[AttributeKind.CTRANSID],
+        parent_uuid=a[AttributeKind.CLONE_UUID],
+        parent_transid=a[AttributeKind.CLONE_CTRANSID],
+    ),
+    CommandKind.MKFILE: lambda a: SendStreamItems.mkfile(
+        path=a[AttributeKind.PATH],
+    ),
+    CommandKind.MKDIR: lambda a: SendStreamItems.mkdir(
+        path=a[AttributeKind.PATH],
+    ),
+    CommandKind.MKNOD: lambda a: SendStreamItems.mknod(
+        path=a[AttributeKind.PATH],
+        mode=a[AttributeKind.MODE],
+        dev=a[AttributeKind.RDEV],
+    ),
+    CommandKind.MKFIFO: lambda a: SendStreamItems.mkfifo(
+        path=a[AttributeKind.PATH],
+    ),
+    CommandKind.MKSOCK: lambda a: SendStreamItems.mksock(
+        path=a[AttributeKind.PATH],
+    ),
+    CommandKind.SYMLINK: lambda a: SendStreamItems.symlink(
+        path=a[AttributeKind.PATH],
+        # NB Unlike the other `dest` attributes, we don't normalize this.
+        dest=os.path.normpath(a[AttributeKind.PATH_LINK]),
+    ),
+    CommandKind.RENAME: lambda a: SendStreamItems.rename(
+        path=a[AttributeKind.PATH],
+        dest=a[AttributeKind.PATH_TO],
+    ),
+    CommandKind.LINK: lambda a: SendStreamItems.link(
+        path=a[AttributeKind.PATH],
+        dest=os.path.normpath(a[AttributeKind.PATH_LINK]),
+    ),
+    CommandKind.UNLINK: lambda a: SendStreamItems.unlink(
+        path=a[AttributeKind.PATH],
+    ),
+    CommandKind.RMDIR: lambda a: SendStreamItems.rmdir(
+        path=a[AttributeKind.PATH],
+    ),
+    CommandKind.WRITE: lambda a: SendStreamItems.write(
+        path=a[AttributeKind.PATH],
+        offset=a[AttributeKind.FILE_OFFSET],
+        data=a[AttributeKind.DATA],
+    ),
+    CommandKind.CLONE: lambda a: SendStreamItems.clone(
+        path=a[AttributeKind.PATH],
+        offset=a[AttributeKind.FILE_OFFSET],
+        len=a[AttributeKind.CLONE_LEN],
+        from_uuid=a[AttributeKind.CLONE_UUID],
+        from_transid=a[AttributeKind.CLONE_CTRANSID],
+        from_path=a[AttributeKind.CLONE_PATH],
+        clone_offset=a[AttributeKind.CLONE_OFFSET],
+    ),
+    CommandKind.SET_XATTR: lambda a: SendStreamItems.set_xattr(
+        path=a[AttributeKind.PATH],
+        name=a[AttributeKind.XATTR_NAME],
+        data=a[AttributeKind.XATTR_DATA],
+    ),
+    CommandKind.REMOVE_XATTR: lambda a: SendStreamItems.remove_xattr(
+        path=a[AttributeKind.PATH],
+        name=a[AttributeKind.XATTR_NAME],
+    ),
+    CommandKind.TRUNCATE: lambda a: SendStreamItems.truncate(
+        path=a[AttributeKind.PATH],
+        size=a[AttributeKind.SIZE],
+    ),
+    CommandKind.CHMOD: lambda a: SendStreamItems.chmod(
+        path=a[AttributeKind.PATH],
+        mode=a[AttributeKind.MODE],
+    ),
+    CommandKind.CHOWN: lambda a: SendStreamItems.chown(
+        path=a[AttributeKind.PATH],
+        uid=a[AttributeKind.UID],
+        gid=a[AttributeKind.GID],
+    ),
+    CommandKind.UTIMES: lambda a: SendStreamItems.utimes(
+        path=a[AttributeKind.PATH],
+        ctime=a[AttributeKind.CTIME],
+        mtime=a[AttributeKind.MTIME],
+        atime=a[AttributeKind.ATIME],
+    ),
+    CommandKind.END: lambda a: None,
+    CommandKind.UPDATE_EXTENT: lambda a: SendStreamItems.update_extent(
+        path=a[AttributeKind.PATH],
+        offset=a[AttributeKind.FILE_OFFSET],
+        len=a[AttributeKind.SIZE],
+    ),
+    CommandKind.FALLOCATE: lambda a: SendStreamItems.fallocate(
+        path=a[AttributeKind.PATH],
+        mode=a[AttributeKind.FALLOCATE_MODE],
+        offset=a[AttributeKind.FILE_OFFSET],
+        len=a[AttributeKind.SIZE],
+    ),
+    CommandKind.FILEATTR: lambda a: SendStreamItems.fileattr(
+        path=a[AttributeKind.PATH],
+        attr=a[AttributeKind.FILEATTR],
+    ),
+    CommandKind.ENCODED_WRITE: lambda a: SendStreamItems.encoded_write(
+        path=a[AttributeKind.PATH],
+        offset=a[AttributeKind.FILE_OFFSET],
+        unencoded_file_len=a[AttributeKind.UNENCODED_FILE_LEN],
+        unencoded_len=a[AttributeKind.UNENCODED_LEN],
+        unencoded_offset=a[AttributeKind.UNENCODED_OFFSET],
+        compression=a.get(AttributeKind.COMPRESSION, 0),
+        encryption=a.get(AttributeKind.ENCRYPTION, 0),
+        data=a[AttributeKind.DATA],
+    ),
+}
+assert set(_COMMAND_KIND_TO_ITEM_MAKER) == set(CommandKind)
+_COMMAND_VALUE_TO_KIND = {k.value: k for k in CommandKind}
+# With `no_data`, DATA is a length, see `_NO_DATA_ATTRIBUTE_KIND_TO_CONV`.
+_NO_DATA_COMMAND_KIND_TO_ITEM_MAKER = {
+    **_COMMAND_KIND_TO_ITEM_MAKER,
+    CommandKind.WRITE: lambda a: SendStreamItems.update_extent(
+        path=a[AttributeKind.PATH],
+        offset=a[AttributeKind.FILE_OFFSET],
+        len=a[AttributeKind.DATA],
+    ),
+    # Like `btrfs send --no-data`, which never sends ENCODED_WRITE.
+    CommandKind.ENCODED_WRITE: lambda a: SendStreamItems.update_extent(
+        path=a[AttributeKind.PATH],
+        offset=a[AttributeKind.FILE_OFFSET],
+        len=a[AttributeKind.UNENCODED_FILE_LEN],
+    ),
+}
+# With `no_data`, we skip the DATA payloads of these commands.
+_DATA_COMMAND_KINDS = frozenset([CommandKind.WRITE, CommandKind.ENCODED_WRITE])
+
+# Pipes cannot `seek`, so we discard skipped bytes in chunks of this size.
+_SKIP_CHUNK_SIZE = 2 ** 20
+
+
+def _skip_bytes(infile, n: int) -> int:
+    'Advances `infile` by up to `n` bytes, returns how many were skipped.'
+    if n and infile.seekable():
+        # Reading the last byte detects truncated input.  With buffered
+        # files, this costs no extra I/O, since the buffer fill will also
+        # pick up the header of the next command.
+        infile.seek(n - 1, os.SEEK_CUR)
+        return n - 1 + len(infile.read(1))
+    skipped = 0
+    while skipped < n:
+        chunk = infile.read(min(n - skipped, _SKIP_CHUNK_SIZE))
+        if not chunk:
+            break
+        skipped += len(chunk)
+    return skipped
+
+
+def _read_command_without_data(
+    infile, cmd_header: CommandHeader, version: int = 1,
+):
+    '''
+    Reads the attributes of a WRITE or ENCODED_WRITE command one at a
+    time, so that we can skip over the DATA payload instead of reading it
+    into memory.
+    '''
+    kind_to_attr = {}
+    remaining = cmd_header.length
+    while remaining:
+        attr_header = _read_attribute_header(infile, version, remaining)
+        remaining -= _attribute_header_size(attr_header, version) + \
+            attr_header.length
+        if remaining < 0:
+            raise RuntimeError(f'{attr_header} overflows {cmd_header}')
+        if attr_header.kind == AttributeKind.DATA:
+            attr_data = None
+            got_length = _skip_bytes(infile, attr_header.length)
+        else:
+            attr_data = infile.read(attr_header.length)
+            got_length = len(attr_data)
+        if got_length != attr_header.length:
+            raise RuntimeError(f'{attr_header} got {got_length} bytes')
+        if attr_header.kind in kind_to_attr:
+            raise RuntimeError(
+                f'{attr_header.kind} occurred twice in {cmd_header}'
+            )
+        kind_to_attr[attr_header.kind] = got_length if attr_data is None \
+            else _ATTRIBUTE_KIND_TO_CONV[attr_header.kind](attr_data)
+    return _NO_DATA_COMMAND_KIND_TO_ITEM_MAKER[cmd_header.kind](kind_to_attr)
+
+
+# The CRC covers the command header with its `crc` field set to 0.  Most
+# commands have one of a few lengths, so we cache the CRCs of their headers.
+_HEADER_CRC_CACHE: Dict[Tuple[int, CommandKind], int] = {}
+_MAX_HEADER_CRC_CACHE_SIZE = 4096
+
+
+def _check_crc(cmd_header: CommandHeader, cmd_body) -> None:
+    key = (cmd_header.length, cmd_header.kind)
+    header_crc = _HEADER_CRC_CACHE.get(key)
+    if header_crc is None:
+        header_crc = crc32c(COMMAND_HEADER_STRUCT.pack(
+            cmd_header.length, cmd_header.kind.value, 0,
+        ))
+        if len(_HEADER_CRC_CACHE) < _MAX_HEADER_CRC_CACHE_SIZE:
+            _HEADER_CRC_CACHE[key] = header_crc
+    crc = crc32c(cmd_body, header_crc)
+    if crc != cmd_header.crc:
+        raise RuntimeError(f'{cmd_header} has the wrong CRC32C {crc:#x}')
+
+
+def read_command(
+    infile, *, no_data: bool = False, check_crc: bool = False,
+    version: int = 1,
+):
     cmd_header = CommandHeader.from_file(infile)
+    if no_data and cmd_header.kind in _DATA_COMMAND_KINDS:
+        return _read_command_without_data(infile, cmd_header, version)
 
     s = infile.read(cmd_header.length)
     if len(s) != cmd_header.length:
         raise RuntimeError(f'{cmd_header} got {len(s)} bytes')
-    # Future: pull in the `crc32c` module and check the CRC.
+    if check_crc:
+        _check_crc(cmd_header, s)
 
-    attr_bytes = BytesIO(s)
-    kind_to_attr = {}
-    while attr_bytes.tell() != len(s):
-        kind, attr = read_attribute(attr_bytes)
-        if kind in kind_to_attr:
-            raise RuntimeError(f'{kind} occurred twice in {cmd_header}')
-        kind_to_attr[kind] = attr
-
-    if cmd_header.kind == CommandKind.SUBVOL:
-        return SendStreamItems.subvol(
-            path=kind_to_attr[AttributeKind.PATH],
-            uuid=kind_to_attr[AttributeKind.UUID],
-            transid=kind_to_attr[AttributeKind.CTRANSID],
-        )
-    elif cmd_header.kind == CommandKind.SNAPSHOT:
-        return SendStreamItems.snapshot(
-            path=kind_to_attr[AttributeKind.PATH],
-            uuid=kind_to_attr[AttributeKind.UUID],
-            transid=kind_to_attr[AttributeKind.CTRANSID],
-            parent_uuid=kind_to_attr[AttributeKind.CLONE_UUID],
-            parent_transid=kind_to_attr[AttributeKind.CLONE_CTRANSID],
-        )
-    elif cmd_header.kind == CommandKind.MKFILE:
-        return SendStreamItems.mkfile(path=kind_to_attr[AttributeKind.PATH])
-    elif cmd_header.kind == CommandKind.MKDIR:
-        return SendStreamItems.mkdir(path=kind_to_attr[AttributeKind.PATH])
-    elif cmd_header.kind == CommandKind.MKNOD:
-        return SendStreamItems.mknod(
-            path=kind_to_attr[AttributeKind.PATH],
-            mode=kind_to_attr[AttributeKind.MODE],
-            dev=kind_to_attr[AttributeKind.RDEV],
-        )
-    elif cmd_header.kind == CommandKind.MKFIFO:
-        return SendStreamItems.mkfifo(path=kind_to_attr[AttributeKind.PATH])
-    elif cmd_header.kind == CommandKind.MKSOCK:
-        return SendStreamItems.mksock(path=kind_to_attr[AttributeKind.PATH])
-    elif cmd_header.kind == CommandKind.SYMLINK:
-        return SendStreamItems.symlink(
-            path=kind_to_attr[AttributeKind.PATH],
-            # NB Unlike the other `dest` attributes, we don't normalize this.
-            dest=os.path.normpath(kind_to_attr[AttributeKind.PATH_LINK]),
-        )
-    elif cmd_header.kind == CommandKind.RENAME:
-        return SendStreamItems.rename(
-            path=kind_to_attr[AttributeKind.PATH],
-            dest=kind_to_attr[AttributeKind.PATH_TO],
-        )
-    elif cmd_header.kind == CommandKind.LINK:
-        return SendStreamItems.link(
-            path=kind_to_attr[AttributeKind.PATH],
-            dest=os.path.normpath(kind_to_attr[AttributeKind.PATH_LINK]),
-        )
-    elif cmd_header.kind == CommandKind.UNLINK:
-        return SendStreamItems.unlink(path=kind_to_attr[AttributeKind.PATH])
-    elif cmd_header.kind == CommandKind.RMDIR:
-        return SendStreamItems.rmdir(path=kind_to_attr[AttributeKind.PATH])
-    elif cmd_header.kind == CommandKind.WRITE:
-        return SendStreamItems.write(
-            path=kind_to_attr[AttributeKind.PATH],
-            offset=kind_to_attr[AttributeKind.FILE_OFFSET],
-            data=kind_to_attr[AttributeKind.DATA],
-        )
-    elif cmd_header.kind == CommandKind.CLONE:
-        return SendStreamItems.clone(
-            path=kind_to_attr[AttributeKind.PATH],
-            offset=kind_to_attr[AttributeKind.FILE_OFFSET],
-            len=kind_to_attr[AttributeKind.CLONE_LEN],
-            from_uuid=kind_to_attr[AttributeKind.CLONE_UUID],
-            from_transid=kind_to_attr[AttributeKind.CLONE_CTRANSID],
-            from_path=kind_to_attr[AttributeKind.CLONE_PATH],
-            clone_offset=kind_to_attr[AttributeKind.CLONE_OFFSET],
-        )
-    elif cmd_header.kind == CommandKind.SET_XATTR:
-        return SendStreamItems.set_xattr(
-            path=kind_to_attr[AttributeKind.PATH],
-            name=kind_to_attr[AttributeKind.XATTR_NAME],
-            data=kind_to_attr[AttributeKind.XATTR_DATA],
-        )
-    elif cmd_header.kind == CommandKind.REMOVE_XATTR:
-        return SendStreamItems.remove_xattr(
-            path=kind_to_attr[AttributeKind.PATH],
-            name=kind_to_attr[AttributeKind.XATTR_NAME],
-        )
-    elif cmd_header.kind == CommandKind.TRUNCATE:
-        return SendStreamItems.truncate(
-            path=kind_to_attr[AttributeKind.PATH],
-            size=kind_to_attr[AttributeKind.SIZE],
-        )
-    elif cmd_header.kind == CommandKind.CHMOD:
-        return SendStreamItems.chmod(
-            path=kind_to_attr[AttributeKind.PATH],
-            mode=kind_to_attr[AttributeKind.MODE],
-        )
-    elif cmd_header.kind == CommandKind.CHOWN:
-        return SendStreamItems.chown(
-            path=kind_to_attr[AttributeKind.PATH],
-            uid=kind_to_attr[AttributeKind.UID],
-            gid=kind_to_attr[AttributeKind.GID],
-        )
-    elif cmd_header.kind == CommandKind.UTIMES:
-        return SendStreamItems.utimes(
-            path=kind_to_attr[AttributeKind.PATH],
-            ctime=kind_to_attr[AttributeKind.CTIME],
-            mtime=kind_to_attr[AttributeKind.MTIME],
-            atime=kind_to_attr[AttributeKind.ATIME],
-        )
-    elif cmd_header.kind == CommandKind.END:
-        return None
-    elif cmd_header.kind == CommandKind.UPDATE_EXTENT:
-        return SendStreamItems.update_extent(
-            path=kind_to_attr[AttributeKind.PATH],
-            offset=kind_to_attr[AttributeKind.FILE_OFFSET],
-            len=kind_to_attr[AttributeKind.SIZE],
-        )
+    return _COMMAND_KIND_TO_ITEM_MAKER[cmd_header.kind](_parse_attributes(
+        cmd_header, memoryview(s), _ATTRIBUTE_KIND_TO_CONV, version,
+    ))
 
-    raise AssertionError(f'Fix me: unhandled {cmd_header}')  # pragma: no cover
 
-
-def parse_send_stream(infile) -> Iterator[SendStreamItem]:
+def parse_send_stream(
+    infile, *, no_data: bool = False, check_crc: bool = False,
+) -> Iterator[SendStreamItem]:
     check_magic(infile)
-    check_version(infile)
+    version = check_version(infile)
     while True:
-        cmd = read_command(infile)
+        cmd = read_command(
+            infile, no_data=no_data, check_crc=check_crc, version=version,
+        )
         if cmd is None:
             return
         yield cmd
+
+
+def parse_send_stream_buffer(
+    buf, *, no_data: bool = False, check_crc: bool = False,
+) -> Iterator[SendStreamItem]:
+    '''
+    Like `parse_send_stream`, but takes a bytes-like object (`bytes`,
+    `bytearray`, `mmap`, ...) containing the send-stream.  Command bodies
+    are parsed as `memoryview` slices of `buf`, so no copies are made
+    besides the attribute values stored in the resulting items.
+    '''
+    if no_data:
+        kind_to_conv = _NO_DATA_ATTRIBUTE_KIND_TO_CONV
+        kind_to_item_maker = _NO_DATA_COMMAND_KIND_TO_ITEM_MAKER
+    else:
+        kind_to_conv = _ATTRIBUTE_KIND_TO_CONV
+        kind_to_item_maker = _COMMAND_KIND_TO_ITEM_MAKER
+    with memoryview(buf) as view:
+        pos = len(BTRFS_SEND_STREAM_MAGIC)
+        _check_magic_bytes(bytes(view[:pos]))
+        if len(view) - pos < VERSION_STRUCT.size:
+            raise RuntimeError(
+                f'Not enough bytes {bytes(view[pos:])} for format '
+                f'{VERSION_STRUCT.format}'
+            )
+        version, = VERSION_STRUCT.unpack_from(view, pos)
+        _check_version_number(version)
+        pos += VERSION_STRUCT.size
+        end = len(view)
+        while True:
+            if end - pos < COMMAND_HEADER_STRUCT.size:
+                raise RuntimeError(
+                    f'Not enough bytes {bytes(view[pos:])} for format '
+                    f'{COMMAND_HEADER_STRUCT.format}'
+                )
+            length, raw_kind, crc = COMMAND_HEADER_STRUCT.unpack_from(
+                view, pos,
+            )
+            pos += COMMAND_HEADER_STRUCT.size
+            kind = _COMMAND_VALUE_TO_KIND.get(raw_kind)
+            if kind is None:
+                kind = CommandKind(raw_kind)  # Raises a helpful `ValueError`
+            cmd_header = CommandHeader(kind=kind, length=length, crc=crc)
+            cmd_body = view[pos:pos + length]
+            if len(cmd_body) != length:
+                raise RuntimeError(f'{cmd_header} got {len(cmd_body)} bytes')
+            pos += length
+            if check_crc and not (no_data and kind in _DATA_COMMAND_KINDS):
+                _check_crc(cmd_header, cmd_body)
+            cmd = kind_to_item_maker[kind](_parse_attributes(
+                cmd_header, cmd_body, kind_to_conv, version,
+            ))
+            # Drop our slice before yielding, since an `mmap` refuses to
+            # close while any slices of it are alive.
+            cmd_body.release()
+            if cmd is None:
+                return
+            yield cmd
+
+
+def parse_send_stream_mmap(
+    infile, *, no_data: bool = False, check_crc: bool = False,
+) -> Iterator[SendStreamItem]:
+    '''
+    `mmap`s the regular file `infile` and parses it via
+    `parse_send_stream_buffer`.  The kernel pages the data in on demand, so
+    memory use does not grow with the size of the send-stream.
+    '''
+    m = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    if no_data:
+        # We will not touch most pages, so readahead would just waste I/O.
+        m.madvise(mmap.MADV_RANDOM)
+    try:
+        yield from parse_send_stream_buffer(
+            m, no_data=no_data, check_crc=check_crc,
+        )
+    finally:
+        try:
+            m.close()
+        except BufferError:
+            # A parse error's traceback can still reference slices of `m`.
+            # Don't mask the original exception, the GC will unmap `m`.
+            pass
+
+
+def get_frequency_of_selinux_xattrs_in_send_stream(infile) -> Counter:
+    '''
+    Pre-scans the send-stream in the seekable `infile` for the statistics
+    that `ItemFilterPipeline.selinux_xattr` needs, and seeks back, so the
+    caller can then parse and filter the items in a single streaming pass,
+    without keeping them all in memory.  The scan is metadata-only, so it
+    skips the DATA payloads, which are most of a typical send-stream.
+    '''
+    start = infile.tell()
+    try:
+        return get_frequency_of_selinux_xattrs(
+            parse_send_stream(infile, no_data=True),
+        )
+    finally:
+        infile.seek(start)
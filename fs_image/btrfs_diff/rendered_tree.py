@@ -27,6 +27,9 @@ This offers some flexibility in how you express references to one object
 Since `RenderedTree` is plain-old-data (not a class), this module instead
 offers helpers for operating on the data structure: `map_bottom_up` for
 rewriting `RenderedTrees`, and the underlying traversal `gather_bottom_up`.
+Both this and `Subvolume.gather_bottom_up` run on `traverse_bottom_up`,
+which uses an explicit stack, so deep trees cannot exceed the recursion
+limit.
 
 There are two aspects to rendering a `Subvolume`:
 
@@ -73,7 +76,8 @@ wraps only objects that occur more than once. For example, (ii) becomes:
 import os
 
 from typing import (
-    Any, Coroutine, Hashable, Mapping, NamedTuple, Optional, Tuple, Union,
+    Any, Callable, Coroutine, Hashable, Iterable, Mapping, NamedTuple,
+    Optional, Tuple, Union,
 )
 from itertools import count
 
@@ -85,14 +89,69 @@ from .coroutine_utils import while_not_exited
 RenderedTree = Union[Tuple[Any], Tuple[Any, Mapping[bytes, Any]]]
 
 
-def gather_bottom_up(
-    ser: RenderedTree,
-    *,
-    # Private, and NOT like the public `top_path` arg of `gather_bottom_up`.
-    # Not `bytes` since we `surrogateescape` everything at render time to
-    # let us produce JSON-friendly `utf-8`.
-    _path: str='.',
-) -> Coroutine[
+class KnownResult(NamedTuple):
+    'See `traverse_bottom_up`.'
+    result: Any
+
+
+_NO_RESULT = object()
+# What `traverse_bottom_up` gets from `expand`.
+_Expanded = Union[
+    KnownResult,
+    Tuple[
+        Tuple[Any, ...],  # `info`
+        Optional[Iterable[Tuple[Any, Any]]],  # `(child_name, child_node)`
+    ],
+]
+
+
+def traverse_bottom_up(
+    top_node: Any, expand: Callable[[Any], _Expanded],
+) -> Coroutine[Tuple[Any, ...], Any, Any]:
+    '''
+    The traversal engine of the `gather_bottom_up` coroutines.  It keeps
+    an explicit stack, instead of recursing with a generator per level.
+
+    `expand(node)` returns `(info, children)`, where `children` is `None`
+    for a file, or else an iterable of `(child_name, child_node)` in
+    traversal order.  Once all children have been visited, we yield
+    `(*info, child_results)`, where `child_results` is `None` for files,
+    or maps each `child_name` to the result that was sent for its child.
+    `expand` may instead return `KnownResult(result)` to skip the node.
+
+    Returns the result for `top_node`.
+    '''
+    # Frames of `[info, children iterator, child_results, child_name]`
+    stack = []
+    node = top_node
+    while True:
+        expanded = expand(node)
+        if isinstance(expanded, KnownResult):
+            result = expanded.result
+        else:
+            info, children = expanded
+            if children is None:
+                result = yield (*info, None)
+            else:
+                stack.append([info, iter(children), {}, None])
+                result = _NO_RESULT
+        # Record `result`, and finish the directories that have no more
+        # children to visit.
+        while stack:
+            frame = stack[-1]
+            if result is not _NO_RESULT:
+                frame[2][frame[3]] = result
+            next_child = next(frame[1], None)
+            if next_child is not None:
+                frame[3], node = next_child
+                break
+            stack.pop()
+            result = yield (*frame[0], frame[2])
+        else:
+            return result
+
+
+def gather_bottom_up(ser: RenderedTree) -> Coroutine[
     Tuple[
         bytes,  # full path to current inode
         Any,  # the current inode
@@ -109,30 +168,31 @@ def gather_bottom_up(
     `Subvolume.gather_bottom_up`.  See that docblock for a discussion of the
     merits of traversal coroutines.
     '''
+    # Not `bytes` since we `surrogateescape` everything at render time to
+    # let us produce JSON-friendly `utf-8`.
+    return traverse_bottom_up(('.', ser), _expand_rendered_tree)
+
+
+def _expand_rendered_tree(path_and_ser: Tuple[str, RenderedTree]):
+    path, ser = path_and_ser
     if not isinstance(ser, list):
         raise RuntimeError(f'Unknown type in rendered subvolume: {ser}')
     elif len(ser) == 1:
-        # pyre-fixme[7]: Generator vs Coroutine?!
-        return (yield _path, ser[0], None)
+        return (path, ser[0]), None
     elif len(ser) != 2:
         raise RuntimeError(f'Rendered inode list length != 1, 2: {ser}')
 
     ino, children = ser
     # Normally, we'd just get a 1-element list, but this is OK too.
     if children is None:
-        child_results = None
-    else:
-        child_results = {}
-        # Traverse children in the same order as `gather_bottom_up`,
-        # ensuring that in tests actual & expected traversal IDs agree.
-        for name, child_ser in sorted(children.items()):
-            child_results[name] = (yield from gather_bottom_up(
-                child_ser,
-                # normpath to remove the leading ./
-                _path=os.path.normpath(os.path.join(_path, name)),
-            ))
-    # pyre-fixme[7]: Generator vs Coroutine?!
-    return (yield (_path, ino, child_results))  # noqa: B901
+        return (path, ino), None
+    # Traverse children in the same order as `Subvolume.gather_bottom_up`,
+    # ensuring that in tests actual & expected traversal IDs agree.
+    return (path, ino), (
+        # normpath to remove the leading ./
+        (name, (os.path.normpath(os.path.join(path, name)), child_ser))
+            for name, child_ser in sorted(children.items())
+    )
 
 
 def map_bottom_up(ser: RenderedTree, fn) -> RenderedTree:
@@ -15,7 +15,9 @@ number of limitations, but we find it useful for testing -- refer to the
 import re
 from collections import Counter
 from dataclasses import dataclass
-from typing import Callable, ClassVar, Iterable, Tuple
+from typing import (
+    Callable, ClassVar, Dict, Iterable, Iterator, List, Optional, Tuple,
+)
 
 _SELINUX_XATTR = b'security.selinux'
 
@@ -184,9 +186,45 @@ class SendStreamItems:
         offset: int
         len: int
 
+    #
+    # operations added in version 2 of the send-stream format
+    #
+
+    # Writes `unencoded_file_len` bytes at `offset`.  The `data` is still
+    # compressed (or encrypted), and we never decode it.  Once decoded, it
+    # has `unencoded_len` bytes, of which the file gets the ones starting
+    # at `unencoded_offset`.
+    @dataclass(frozen=True)
+    class encoded_write(SendStreamItem):
+        offset: int
+        unencoded_file_len: int
+        unencoded_len: int
+        unencoded_offset: int
+        compression: int
+        encryption: int
+        data: bytes
+
+    # `mode` takes the `FALLOC_FL_*` flags of `fallocate(2)`.
+    @dataclass(frozen=True)
+    class fallocate(SendStreamItem):
+        mode: int
+        offset: int
+        len: int
+
+    # The inode flags, as in `chattr(1)`, in their `BTRFS_INODE_*` encoding.
+    @dataclass(frozen=True)
+    class fileattr(SendStreamItem):
+        attr: int
+
 
 def get_frequency_of_selinux_xattrs(items):
-    'Returns {"xattr_value": <count>}. Useful for ItemFilters.selinux_xattr.'
+    '''
+    Returns {"xattr_value": <count>}. Useful for `ItemFilters.selinux_xattr`.
+
+    To avoid keeping a large send-stream in memory just for this count,
+    pass the items of a metadata-only parse, see
+    `get_frequency_of_selinux_xattrs_in_send_stream`.
+    '''
     counter = Counter()
     for item in items:
         if isinstance(item, SendStreamItems.set_xattr):
@@ -195,37 +233,57 @@ def get_frequency_of_selinux_xattrs(items):
     return counter
 
 
-class ItemFilters:
+class ItemFilterPipeline:
     '''
-    A namespace of filters for taking a just-parsed Iterable[SendStreamItems],
-    and making it useful for filesystem testing.
+    Applies a sequence of per-item filters to an Iterable[SendStreamItems]
+    in a single pass:
+
+        items = ItemFilterPipeline().selinux_xattr(
+            discard_fn=lambda _path, ctx: ctx == default_ctx,
+        ).normalize_utimes(
+            start_time=build_start_time, end_time=build_end_time,
+        ).filter(items)
+
+    Each filter is a function of one item, returning the item to pass on,
+    or `None` to discard it.  Filters only apply to items of the type they
+    were added for, so the many items that no filter cares about cost a
+    single dictionary lookup.  Filters for one type run in the order they
+    were added.
     '''
 
-    @staticmethod
+    def __init__(self):
+        self._type_to_filters: Dict[
+            type, List[Callable[[SendStreamItem], Optional[SendStreamItem]]]
+        ] = {}
+
+    def add(
+        self,
+        item_type: type,
+        filter_fn: Callable[[SendStreamItem], Optional[SendStreamItem]],
+    ) -> 'ItemFilterPipeline':
+        self._type_to_filters.setdefault(item_type, []).append(filter_fn)
+        return self
+
     def selinux_xattr(
-        items: Iterable[SendStreamItem],
-        discard_fn: Callable[[bytes, bytes], bool],
-    ) -> Iterable[SendStreamItem]:
+        self, discard_fn: Callable[[bytes, bytes], bool],
+    ) -> 'ItemFilterPipeline':
         '''
-        SELinux always sets a security context on filesystem objects, but most
-        images will not ship data with non-default contexts, so it is easiest to
-        just filter out these `set_xattr`s
+        SELinux always sets a security context on filesystem objects, but
+        most images will not ship data with non-default contexts, so it is
+        easiest to just filter out these `set_xattr`s
         '''
-        for item in items:
-            if isinstance(item, SendStreamItems.set_xattr):
-                if (
-                    item.name == _SELINUX_XATTR and
-                    discard_fn(item.path, item.data)
-                ):
-                    continue
-            yield item
+        def filter_fn(item):
+            if item.name == _SELINUX_XATTR and discard_fn(
+                item.path, item.data,
+            ):
+                return None
+            return item
+
+        return self.add(SendStreamItems.set_xattr, filter_fn)
 
-    @staticmethod
     def normalize_utimes(
-        items: Iterable[SendStreamItem],
-        start_time: float,
-        end_time: float,
-    ) -> Iterable[SendStreamItem]:
+        self, start_time: float, end_time: float,
+    ) -> 'ItemFilterPipeline':
         '''
         Build-time timestamps will vary, since the build takes some time.
         We can make them predictable by replacing any timestamp within the
@@ -234,13 +292,57 @@ class ItemFilters:
         def normalize_time(t):
             return start_time if start_time <= t <= end_time else t
 
+        def filter_fn(item):
+            return type(item)(
+                path=item.path,
+                atime=normalize_time(item.atime),
+                mtime=normalize_time(item.mtime),
+                ctime=normalize_time(item.ctime),
+            )
+
+        return self.add(SendStreamItems.utimes, filter_fn)
+
+    def filter(
+        self, items: Iterable[SendStreamItem],
+    ) -> Iterator[SendStreamItem]:
+        # Snapshot the filters, so that `add`ing more does not affect
+        # this pass.
+        type_to_filters = {
+            t: tuple(fns) for t, fns in self._type_to_filters.items()
+        }
         for item in items:
-            if isinstance(item, SendStreamItems.utimes):
-                yield type(item)(
-                    path=item.path,
-                    atime=normalize_time(item.atime),
-                    mtime=normalize_time(item.mtime),
-                    ctime=normalize_time(item.ctime),
-                )
+            for filter_fn in type_to_filters.get(type(item), ()):
+                item = filter_fn(item)
+                if item is None:
+                    break
             else:
                 yield item
+
+
+class ItemFilters:
+    '''
+    A namespace of filters for taking a just-parsed Iterable[SendStreamItems],
+    and making it useful for filesystem testing.
+
+    Each of these is a one-filter `ItemFilterPipeline`.  To apply several,
+    chain them on one pipeline instead, which only makes one pass.
+    '''
+
+    @staticmethod
+    def selinux_xattr(
+        items: Iterable[SendStreamItem],
+        discard_fn: Callable[[bytes, bytes], bool],
+    ) -> Iterable[SendStreamItem]:
+        'See `ItemFilterPipeline.selinux_xattr`'
+        return ItemFilterPipeline().selinux_xattr(discard_fn).filter(items)
+
+    @staticmethod
+    def normalize_utimes(
+        items: Iterable[SendStreamItem],
+        start_time: float,
+        end_time: float,
+    ) -> Iterable[SendStreamItem]:
+        'See `ItemFilterPipeline.normalize_utimes`'
+        return ItemFilterPipeline().normalize_utimes(
+            start_time, end_time,
+        ).filter(items)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+Explains what changed between two layers, given as send-streams.  This
+is meant to answer questions like "why did this layer grow by 100MB?":
+
+    for d in diff_sendstreams(old_infile, new_infile):
+        print(json.dumps(d, sort_keys=True))
+
+See `examples/diff_sendstreams.py` for a CLI.  The new send-stream may be
+a full one, or an incremental `btrfs send -p` on top of the old one.  If
+the old send-stream is itself incremental, also pass the ones that it
+builds on.
+
+Each changed path yields a JSON-friendly dict with the keys:
+  - `path`: decoded with `surrogateescape`, just like `Subvolume.render`.
+  - `change`: `added`, `removed`, or `modified`.  An inode that changes
+    file type is `removed`, and then `added`.  A directory is `added` or
+    `removed` together with its descendants, which come right after it.
+  - `old`, `new`: the `repr` of the inode on either side, or `None`.
+  - `size_delta`, `data_bytes_delta`: how the length of the file, and
+    the number of its bytes that are not holes, changed.
+  - `changed_fields`: only for `modified`, the keys of `inode_fields` that
+    differ, e.g. `mode` or `extents`.
+
+We parse the send-streams without file data, and the comparison uses
+`Subvolume.changed_paths`, so it only visits the changed parts of the
+filesystem.  With the default `CompactInodeIDMap`, an incremental
+send-stream also only copies the inodes that it changes, see
+`inode_table.py`.  Of course, the old layer must still be modeled in
+full -- unless you pass a `SubvolumeSetCache`, in which case repeated
+diffs of the same send-streams load the replayed subvolumes from disk,
+see `subvolume_cache.py`.
+'''
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, Optional, Union
+
+from .compact_inode_id import CompactInodeIDMap
+from .coroutine_utils import while_not_exited
+from .extent import Extent
+from .incomplete_inode import IncompleteInode
+from .inode import Inode
+from .parse_send_stream import parse_send_stream
+from .subvolume import inode_fields, Subvolume
+from .subvolume_cache import cache_key, SubvolumeSetCache
+from .subvolume_set import SubvolumeSet, SubvolumeSetMutator
+
+_Ino = Union[IncompleteInode, Inode]
+
+
+def _sizes(fields: Optional[Dict[str, Any]]):
+    'Returns the file size, and the bytes of it that are not holes.'
+    if fields is None:
+        return 0, 0
+    return (
+        sum(length for _, length in fields['extents']),
+        sum(
+            length for kind, length in fields['extents']
+                if kind == Extent.Kind.DATA.name
+        ),
+    )
+
+
+def _record(
+    path: bytes,
+    change: str,
+    old_ino: Optional[_Ino],
+    new_ino: Optional[_Ino],
+) -> Dict[str, Any]:
+    old_fields = None if old_ino is None else inode_fields(old_ino)
+    new_fields = None if new_ino is None else inode_fields(new_ino)
+    old_size, old_data_bytes = _sizes(old_fields)
+    new_size, new_data_bytes = _sizes(new_fields)
+    record = {
+        'path': path.decode(errors='surrogateescape'),
+        'change': change,
+        'old': None if old_ino is None else repr(old_ino),
+        'new': None if new_ino is None else repr(new_ino),
+        'size_delta': new_size - old_size,
+        'data_bytes_delta': new_data_bytes - old_data_bytes,
+    }
+    if old_fields is not None and new_fields is not None:
+        record['changed_fields'] = [
+            k for k, v in old_fields.items() if v != new_fields[k]
+        ]
+    return record
+
+
+def _path_sort_key(path: bytes):
+    'Sorts parents before children, and siblings by name.'
+    return () if path == b'.' else tuple(path.split(b'/'))
+
+
+def _subtree_records(
+    subvol: Subvolume, top_path: bytes, change: str,
+) -> Iterator[Dict[str, Any]]:
+    paths_and_inodes = []
+    with while_not_exited(subvol.gather_bottom_up(top_path)) as ctx:
+        while True:
+            path, ino, _ = ctx.send(None)
+            paths_and_inodes.append((path, ino))
+    for path, ino in sorted(
+        paths_and_inodes, key=lambda p_i: _path_sort_key(p_i[0]),
+    ):
+        yield _record(
+            path, change,
+            ino if change == 'removed' else None,
+            ino if change == 'added' else None,
+        )
+
+
+def diff_subvolumes(
+    old: Subvolume, new: Subvolume, top_path: bytes = b'.',
+) -> Iterator[Dict[str, Any]]:
+    'Yields the changes under `top_path`, see the module docblock.'
+    for path in old.changed_paths(new, top_path):
+        old_ino = old.inode_at_path(path)
+        new_ino = new.inode_at_path(path)
+        if old_ino is None or new_ino is None or (
+            old_ino.file_type != new_ino.file_type
+        ):
+            if old_ino is not None:
+                yield from _subtree_records(old, path, 'removed')
+            if new_ino is not None:
+                yield from _subtree_records(new, path, 'added')
+        else:
+            yield _record(path, 'modified', old_ino, new_ino)
+
+
+def _replay(subvols: SubvolumeSet, infile: BinaryIO) -> Subvolume:
+    # `Subvolume` only tracks extent lengths, so skip the file data.
+    items = parse_send_stream(infile, no_data=True)
+    mutator = SubvolumeSetMutator.new(subvols, next(items))
+    for item in items:
+        mutator.apply_item(item)
+    return mutator.subvolume
+
+
+def diff_sendstreams(
+    old_infile: BinaryIO,
+    new_infile: BinaryIO,
+    *,
+    parent_infiles: Iterable[BinaryIO] = (),
+    id_map_class: type = CompactInodeIDMap,
+    cache: Optional[SubvolumeSetCache] = None,
+) -> Iterator[Dict[str, Any]]:
+    '''
+    Yields the changes from the subvolume of `old_infile` to that of
+    `new_infile`, see the module docblock.  `parent_infiles` are replayed
+    first, in order, for when `old_infile` is incremental.
+
+    With a `cache`, all the input files must be seekable, since they are
+    hashed to compute the cache key.
+    '''
+    parent_infiles = list(parent_infiles)
+    if cache is not None:
+        key = cache_key(
+            [*parent_infiles, old_infile, new_infile],
+            id_map_class=id_map_class,
+        )
+        cached = cache.get(key)
+        if cached is not None:
+            try:
+                with cached:
+                    # Only decode the two subvolumes that we compare.
+                    old, new = (
+                        cached.subvolume(u) for u in cached.uuids[-2:]
+                    )
+            except RuntimeError:
+                pass  # A corrupt record, so replay, and replace the entry.
+            else:
+                yield from diff_subvolumes(old, new)
+                return
+    subvols = SubvolumeSet.new(id_map_class=id_map_class)
+    for infile in parent_infiles:
+        _replay(subvols, infile)
+    old = _replay(subvols, old_infile)
+    new = _replay(subvols, new_infile)
+    if cache is not None:
+        cache.put(key, subvols)
+    yield from diff_subvolumes(old, new)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+Explains where the bytes of a send-stream go, to answer questions like
+"why did this layer grow by 3GB?" without mounting it:
+
+    path_to_counts = profile_sendstream(infile)
+    for line in gen_report_lines(path_to_counts, top=20):
+        print(line)
+
+See `examples/profile_sendstream.py` for a CLI.  If the send-stream is
+incremental, also pass the ones that it builds on as `parent_infiles`.
+
+We parse the send-stream one command at a time, and count the bytes that
+each command occupies in the stream.  The data of a command is dropped as
+soon as it is counted, so memory use is that of the `Subvolume` metadata.
+The bytes of each command go to the inode that it acts on, in these
+`CATEGORIES`:
+  - `data`: the DATA payloads of `write` & `encoded_write`.  The latter
+    is still compressed, so this is what it costs in the stream.
+  - `xattr`: whole `set_xattr` & `remove_xattr` commands.
+  - `metadata`: the rest of the commands, including the command and
+    attribute headers of `write`s.  The stream header, the `subvol` or
+    `snapshot` command, and the END command count towards the root.
+  - `clone_saved`: NOT in the stream -- the bytes that `clone` commands
+    reused, instead of sending them as data.
+The sum of the `STREAM_CATEGORIES` over all paths is the size of the
+send-stream.
+
+Once the send-stream ends, each inode's bytes are attributed to its path.
+Hardlinked inodes use their lexicographically first path, and deleted
+inodes use the last path that a command used for them.  Since `btrfs
+send` creates inodes under temporary names, and then renames them, this
+is much more useful than accounting by the paths in the commands.
+
+The results are per path, excluding descendants, so use `subtree_totals`
+to aggregate directories.  `gen_folded_stacks` makes input for
+`flamegraph.pl`, which also aggregates the subtrees.
+'''
+import os
+
+from collections import Counter, defaultdict
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional
+
+from .compact_inode_id import CompactInodeIDMap
+from .parse_send_stream import parse_send_stream
+from .send_stream import SendStreamItems
+from .subvolume_set import SubvolumeSet, SubvolumeSetMutator
+
+STREAM_CATEGORIES = ('data', 'xattr', 'metadata')
+CATEGORIES = (*STREAM_CATEGORIES, 'clone_saved')
+
+_DATA_ITEMS = (SendStreamItems.write, SendStreamItems.encoded_write)
+_XATTR_ITEMS = (SendStreamItems.set_xattr, SendStreamItems.remove_xattr)
+
+
+class _CountingReader:
+    'Counts the bytes that `parse_send_stream` reads from `infile`.'
+
+    def __init__(self, infile: BinaryIO):
+        self._infile = infile
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        b = self._infile.read(size)
+        self.bytes_read += len(b)
+        return b
+
+
+def stream_bytes(counts: Counter) -> int:
+    'How many bytes of the send-stream `counts` account for.'
+    return sum(counts[c] for c in STREAM_CATEGORIES)
+
+
+def profile_sendstream(
+    infile: BinaryIO,
+    *,
+    parent_infiles: Iterable[BinaryIO] = (),
+    id_map_class: type = CompactInodeIDMap,
+) -> Dict[bytes, Counter]:
+    '''
+    Returns `{path: Counter of CATEGORIES}` for the bytes of `infile`,
+    see the module docblock.  `parent_infiles` are replayed first, in
+    order, for when `infile` is incremental.
+    '''
+    subvols = SubvolumeSet.new(id_map_class=id_map_class)
+    for parent_infile in parent_infiles:
+        # We don't profile these, so skip the file data.
+        items = parse_send_stream(parent_infile, no_data=True)
+        mutator = SubvolumeSetMutator.new(subvols, next(items))
+        for item in items:
+            mutator.apply_item(item)
+
+    # Our `Subvolume` only needs the lengths of the data, but we must read
+    # it anyway to count the bytes of each command.
+    reader = _CountingReader(infile)
+    items = parse_send_stream(reader)
+    mutator = SubvolumeSetMutator.new(subvols, next(items))
+    id_map = mutator.subvolume.id_map
+    root_id = id_map.get_id(b'.')
+    ino_to_counts = defaultdict(Counter)
+    ino_to_last_path = {root_id: b'.'}
+
+    ino_to_counts[root_id]['metadata'] += reader.bytes_read
+    pos = reader.bytes_read
+    for item in items:
+        cmd_bytes = reader.bytes_read - pos
+        pos = reader.bytes_read
+        # Most commands act on an existing path, the rest create it.
+        ino_id = id_map.get_id(item.path)
+        mutator.apply_item(item)
+        if ino_id is None:
+            ino_id = id_map.get_id(item.path)
+        ino_to_last_path[ino_id] = item.dest \
+            if isinstance(item, SendStreamItems.rename) else item.path
+
+        counts = ino_to_counts[ino_id]
+        if isinstance(item, _DATA_ITEMS):
+            counts['data'] += len(item.data)
+            counts['metadata'] += cmd_bytes - len(item.data)
+        elif isinstance(item, _XATTR_ITEMS):
+            counts['xattr'] += cmd_bytes
+        else:
+            counts['metadata'] += cmd_bytes
+            if isinstance(item, SendStreamItems.clone):
+                counts['clone_saved'] += item.len
+    ino_to_counts[root_id]['metadata'] += reader.bytes_read - pos  # END
+
+    path_to_counts = defaultdict(Counter)
+    for ino_id, counts in ino_to_counts.items():
+        paths = id_map.get_paths(ino_id)
+        path_to_counts[
+            min(paths) if paths else ino_to_last_path[ino_id]
+        ].update(counts)
+    return dict(path_to_counts)
+
+
+def _ancestors_and_self(path: bytes) -> Iterator[bytes]:
+    while path != b'.':
+        yield path
+        path = os.path.dirname(path) or b'.'
+    yield path
+
+
+def subtree_totals(
+    path_to_counts: Dict[bytes, Counter],
+) -> Dict[bytes, Counter]:
+    '''
+    Adds the counts of each path to all of its ancestors.  The result also
+    has directories without counts of their own, e.g. when the bytes of a
+    file were attributed to a path under a deleted directory.
+    '''
+    totals = defaultdict(Counter)
+    for path, counts in path_to_counts.items():
+        for p in _ancestors_and_self(path):
+            totals[p].update(counts)
+    return dict(totals)
+
+
+def gen_report_lines(
+    path_to_counts: Dict[bytes, Counter], *, top: Optional[int] = None,
+) -> Iterator[str]:
+    '''
+    Yields a header, and tab-separated rows for the `top` paths whose
+    subtrees take up the most bytes of the send-stream.  Each row has the
+    bytes of the subtree, the bytes of just the path, the `CATEGORIES` of
+    the subtree, and the path, decoded with `surrogateescape`.
+    '''
+    totals = subtree_totals(path_to_counts)
+    yield '\t'.join(['subtree', 'own', *CATEGORIES, 'path'])
+    rows = sorted(
+        totals.items(), key=lambda p_c: (-stream_bytes(p_c[1]), p_c[0]),
+    )
+    for path, counts in rows if top is None else rows[:top]:
+        yield '\t'.join([
+            str(stream_bytes(counts)),
+            str(stream_bytes(path_to_counts.get(path, Counter()))),
+            *(str(counts[c]) for c in CATEGORIES),
+            path.decode(errors='surrogateescape'),
+        ])
+
+
+def _frame(name: bytes) -> str:
+    # `;` separates the frames, and each stack takes one line.
+    return name.decode(errors='surrogateescape').replace(
+        ';', '?',
+    ).replace('\n', '?')
+
+
+def gen_folded_stacks(
+    path_to_counts: Dict[bytes, Counter], *, category: Optional[str] = None,
+) -> Iterator[str]:
+    '''
+    Yields the "folded stacks" of `flamegraph.pl`, one line per path with
+    a nonzero count, e.g. `.;dir;file 1234`.  The count is that of
+    `category`, or the stream bytes if it is `None`.  We replace `;` and
+    newlines in file names by `?`.
+    '''
+    for path, counts in sorted(path_to_counts.items()):
+        value = stream_bytes(counts) if category is None else counts[category]
+        if value:
+            yield ';'.join(
+                _frame(p) for p in reversed([
+                    os.path.basename(a) or a
+                        for a in _ancestors_and_self(path)
+                ])
+            ) + f' {value}'
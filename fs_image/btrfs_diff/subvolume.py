@@ -27,16 +27,25 @@ mutate its state.
 
 - Maximum path lengths are not checked.
 '''
+import copy
+import hashlib
+import itertools
+import json
 import os
 
 from types import MappingProxyType
 from typing import (
-    Any, Coroutine, Mapping, NamedTuple, Optional, Sequence,
-    Tuple, Union, ValuesView
+    Any, Coroutine, Dict, Iterator, Mapping, MutableMapping, NamedTuple,
+    Optional, Sequence, TextIO, Tuple, Union, ValuesView
 )
 
+from .compact_inode_id import CompactInodeIDMap
 from .coroutine_utils import while_not_exited
-from .extents_to_chunks import extents_to_chunks_with_clones
+from .cow_list import CowDict
+from .extent import Extent
+from .extents_to_chunks import (
+    extents_to_chunks_with_clones, extents_to_chunks_with_shared_extents,
+)
 from .freeze import freeze
 from .inode import Chunk, Inode
 from .inode_id import InodeID, InodeIDMap
@@ -44,8 +53,11 @@ from .incomplete_inode import (
     IncompleteDevice, IncompleteDir, IncompleteFifo, IncompleteFile,
     IncompleteInode, IncompleteSocket, IncompleteSymlink,
 )
+from .inode_table import InodeTable
 from .send_stream import SendStreamItem, SendStreamItems
-from .rendered_tree import RenderedTree, TraversalIDMaker
+from .rendered_tree import (
+    KnownResult, RenderedTree, traverse_bottom_up, TraversalIDMaker,
+)
 
 _DUMP_ITEM_TO_INCOMPLETE_INODE = {
     SendStreamItems.mkdir: IncompleteDir,
@@ -57,6 +69,51 @@ _DUMP_ITEM_TO_INCOMPLETE_INODE = {
 }
 
 
+def inode_fields(ino: Union[IncompleteInode, Inode]) -> Dict[str, Any]:
+    '''
+    The parts of `ino` covered by `Subvolume.digest`, as plain data.  The
+    data layout is under `extents`, as runs of `(Extent.Kind.name,
+    length)`.  Like `render`, this ignores how the filesystem was built,
+    including clones, so an `Inode` has the same fields as the
+    `IncompleteInode` that it was frozen from.
+    '''
+    if isinstance(ino, Inode):
+        leaves = ((c.kind, c.length) for c in ino.chunks or ())
+    elif isinstance(ino, IncompleteFile):
+        leaves = (
+            (leaf.content, length)
+                for _, length, leaf in ino.extent.gen_trimmed_leaves()
+        )
+    else:
+        leaves = ()
+    return {
+        'file_type': ino.file_type,
+        'mode': ino.mode,
+        'owner': None if ino.owner is None else tuple(ino.owner),
+        'utimes': None if ino.utimes is None else tuple(ino.utimes),
+        'xattrs': sorted(ino.xattrs.items()),
+        'extents': [
+            (kind.name, sum(length for _, length in kind_leaves))
+                for kind, kind_leaves in itertools.groupby(
+                    (kl for kl in leaves if kl[1]), lambda kl: kl[0],
+                )
+        ],
+        'dev': getattr(ino, 'dev', None),
+        'dest': getattr(ino, 'dest', None),
+    }
+
+
+def _inode_digest(
+    ino: Union[IncompleteInode, Inode],
+    child_digests: Optional[Mapping[bytes, bytes]],
+) -> bytes:
+    'Hashes `inode_fields`, and the names & digests of any children.'
+    h = hashlib.sha256(repr(tuple(inode_fields(ino).values())).encode())
+    for name, digest in sorted((child_digests or {}).items()):
+        h.update(b'%d:%s%s' % (len(name), name, digest))
+    return h.digest()
+
+
 # Future: `deepfrozen` would let us lose the `new` methods on NamedTuples,
 # and avoid `deepcopy`.
 class Subvolume(NamedTuple):
@@ -83,6 +140,15 @@ class Subvolume(NamedTuple):
       - `IncompleteInode` descendants are correctly deepcopy-able despite
         the fact that `Extent` relies on object identity for clone-tracking.
         This is explained in the submodule docblock.
+
+    With a `CompactInodeIDMap`, `id_to_inode` is an `InodeTable`, and
+    `snapshot` does not `deepcopy`, see `inode_table.py`.
+
+    `digests` caches the Merkle digests of `digest`, and `apply_item`
+    drops those of the changed inode and its ancestor directories.  If
+    you mutate inodes directly, e.g. via `inode_utils.py`, call
+    `digests.clear()`.  Being a cache, `digests` does not affect `==`,
+    and it is a `CowDict`, so snapshots share it until they change.
     '''
     # Inodes & inode maps are per-subvolume because btrfs treats subvolumes
     # as independent entities -- we cannot `rename` or hard-link data across
@@ -94,15 +160,62 @@ class Subvolume(NamedTuple):
     # require us to share inodes across subvolumes.
     id_map: InodeIDMap
     id_to_inode: Mapping[Optional[InodeID], Union[IncompleteInode, Inode]]
+    # New files start with `extent_class.empty()`.  Pass `FlatExtent` for
+    # subvolumes whose files get many small writes, see `flat_extent.py`.
+    extent_class: type = Extent
+    # Maps `InodeID.id` to the digest of the inode, see `digest`.  A
+    # directory only has a digest here if all of its children do.  Keep
+    # this field last, since `__eq__` ignores it.
+    digests: Optional[MutableMapping[int, bytes]] = None
 
     @classmethod
     def new(cls, *, id_map, **kwargs) -> 'Subvolume':
-        kwargs.setdefault('id_to_inode', {})
+        kwargs.setdefault('id_to_inode', InodeTable(id_map.inner)
+            if isinstance(id_map, CompactInodeIDMap) else {})
+        kwargs.setdefault('digests', CowDict())
         kwargs['id_to_inode'][id_map.get_id(b'.')] = IncompleteDir(
             item=SendStreamItems.mkdir(path=b'.'),
         )
         return cls(id_map=id_map, **kwargs)
 
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, Subvolume):
+            return NotImplemented
+        return self[:-1] == other[:-1]  # All fields but `digests`
+
+    def __ne__(self, other: Any) -> bool:
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def _snapshot_digests(self) -> Optional[CowDict]:
+        if self.digests is None:
+            return None
+        if isinstance(self.digests, CowDict):
+            return self.digests.snapshot()
+        return CowDict(self.digests)
+
+    def snapshot(self, *, description: Any) -> 'Subvolume':
+        '''
+        Returns a copy of `self`, which shares no mutable state with
+        `self`, and whose `id_map` has `description`.  With an
+        `InodeTable`, this takes O(1) time, and afterwards, each copy only
+        copies the inodes & directories that it changes.
+        '''
+        if isinstance(self.id_to_inode, InodeTable):
+            id_map = self.id_map.snapshot(description=description)
+            return self._replace(
+                id_map=id_map,
+                id_to_inode=self.id_to_inode.snapshot(id_map.inner),
+                digests=self._snapshot_digests(),
+            )
+        # The old description is replaced rather than copied, see the
+        # docblock of `SubvolumeSetMutator.new`.  The digests are keyed
+        # by inode number, so the copy can share them.
+        return copy.deepcopy(self, memo={
+            id(self.id_map.inner.description): description,
+            id(self.digests): self._snapshot_digests(),
+        })
+
     def inode_at_path(
         self, path: bytes,
     ) -> Optional[Union[IncompleteInode, Inode]]:
@@ -119,10 +232,41 @@ class Subvolume(NamedTuple):
             raise RuntimeError(f'Cannot apply {item}, {path} does not exist')
         return ino
 
+    def _require_mutable_inode_at_path(
+        self, item: SendStreamItem, path: bytes,
+    ) -> Union[IncompleteInode, Inode]:
+        'Call this, and not `_require_inode_at_path`, to mutate the inode.'
+        ino = self._require_inode_at_path(item, path)
+        ino_id = self.id_map.get_id(path)
+        if self.digests:
+            self.digests.pop(ino_id.id, None)
+            for ino_path in self.id_map.get_paths(ino_id):
+                self._invalidate_parent_digests(ino_path)
+        if isinstance(self.id_to_inode, InodeTable):
+            # Snapshots share `IncompleteInode`s until they change.
+            return self.id_to_inode.get_mutable(ino_id)
+        return ino
+
+    def _invalidate_parent_digests(self, path: bytes) -> None:
+        '''
+        Call after adding or removing `path`.  Drops the digests of the
+        directories above `path`, bottom-up, stopping at the first one
+        without a digest, since its ancestors cannot have one either.
+        '''
+        while self.digests and path:
+            path = os.path.dirname(path)
+            if self.digests.pop(
+                self.id_map.get_id(path or b'.').id, None,
+            ) is None:
+                return
+
     def _delete(self, path):
         ino_id = self.id_map.remove_path(path)
         if not self.id_map.get_paths(ino_id):
             del self.id_to_inode[ino_id]
+            if self.digests:
+                self.digests.pop(ino_id.id, None)
+        self._invalidate_parent_digests(path)
 
     def apply_item(self, item: SendStreamItem) -> None:
         for item_type, inode_class in _DUMP_ITEM_TO_INCOMPLETE_INODE.items():
@@ -134,7 +278,10 @@ class Subvolume(NamedTuple):
                     self.id_map.add_file(ino_id, item.path)
                 assert ino_id not in self.id_to_inode
                 # pyre-fixme[16]: This is supposed to be frozen!!!
-                self.id_to_inode[ino_id] = inode_class(item=item)
+                self.id_to_inode[ino_id] = inode_class(
+                    item=item, extent_class=self.extent_class,
+                ) if inode_class is IncompleteFile else inode_class(item=item)
+                self._invalidate_parent_digests(item.path)
                 return  # Done applying item
 
         if isinstance(item, SendStreamItems.rename):
@@ -153,6 +300,8 @@ class Subvolume(NamedTuple):
             # No destination path? Easy.
             if new_id is None:
                 self.id_map.rename_path(item.path, item.dest)
+                self._invalidate_parent_digests(item.path)
+                self._invalidate_parent_digests(item.dest)
                 return
 
             # Overwrite an existing path.
@@ -170,6 +319,7 @@ class Subvolume(NamedTuple):
                 )
             self._delete(item.dest)
             self.id_map.rename_path(item.path, item.dest)
+            self._invalidate_parent_digests(item.path)
             # NB: Per `rename (2)`, if either the new or the old inode is a
             # symbolic link, they get treated just as regular files.
         elif isinstance(item, SendStreamItems.unlink):
@@ -189,19 +339,24 @@ class Subvolume(NamedTuple):
             if isinstance(self.id_to_inode[old_id], IncompleteDir):
                 raise RuntimeError(f'Cannot {item} a directory')
             self.id_map.add_file(old_id, item.path)
+            self._invalidate_parent_digests(item.path)
         else:  # Any other operation must be handled at inode scope.
             ino = self.inode_at_path(item.path)
             if ino is None:
                 raise RuntimeError(f'Cannot apply {item}, path does not exist')
             # pyre-fixme[16]: Inode doesn't have apply_item() ...
-            self._require_inode_at_path(item, item.path).apply_item(item=item)
+            self._require_mutable_inode_at_path(
+                item, item.path,
+            ).apply_item(item=item)
 
     def apply_clone(
         self, item: SendStreamItems.clone, from_subvol: 'Subvolume',
     ):
         assert isinstance(item, SendStreamItems.clone)
         # pyre-fixme[16]: Inode doesn't have apply_clone() ...
-        return self._require_inode_at_path(item, item.path).apply_clone(
+        return self._require_mutable_inode_at_path(
+            item, item.path,
+        ).apply_clone(
             item, from_subvol._require_inode_at_path(item, item.from_path),
         )
 
@@ -216,6 +371,7 @@ class Subvolume(NamedTuple):
         *,
         _memo,
         id_to_chunks: Optional[Mapping[InodeID, Sequence[Chunk]]] = None,
+        shared_extents: bool = False,
     ):
         '''
         Returns a recursively immutable copy of `self`, replacing
@@ -223,22 +379,36 @@ class Subvolume(NamedTuple):
         populate them with `Chunk`s instead of `Extent`s.
 
         If `id_to_chunks` is omitted, we'll detect clones only within `self`.
+        They are described by `ChunkClone`s, or with `shared_extents=True`,
+        by the linear-size `SharedExtent`s -- see `extents_to_chunks.py`.
 
         IMPORTANT: Our lookups assume that the `id_to_chunks` has the
         pre-`freeze` variants of the `InodeID`s.
         '''
         if id_to_chunks is None:
-            id_to_chunks = dict(extents_to_chunks_with_clones(
-                list(self._inode_ids_and_extents()),
-            ))
+            id_to_chunks = dict((
+                extents_to_chunks_with_shared_extents if shared_extents
+                    else extents_to_chunks_with_clones
+            )(list(self._inode_ids_and_extents())))
+        # The `IncompleteInode`s of an `InodeTable` may be shared with
+        # other snapshots, whose `Inode`s need different `chunks`, so they
+        # must bypass the `id()`-keyed memo.
+        freeze_inode = (
+            lambda ino, chunks: ino.freeze(_memo=_memo, chunks=chunks)
+        ) if isinstance(self.id_to_inode, InodeTable) else (
+            lambda ino, chunks: freeze(ino, _memo=_memo, chunks=chunks)
+        )
         return type(self)(
             id_map=freeze(self.id_map, _memo=_memo),
             id_to_inode=MappingProxyType({
                 freeze(id, _memo=_memo):
                         # pyre-fixme[6]: id is Optional[InodeID] not InodeID
-                        freeze(ino, _memo=_memo, chunks=id_to_chunks.get(id))
+                        freeze_inode(ino, id_to_chunks.get(id))
                     for id, ino in self.id_to_inode.items()
             }),
+            extent_class=self.extent_class,
+            # Digests ignore clones, so they are the same once frozen.
+            digests=self._snapshot_digests(),
         )
 
     def inodes(self) -> ValuesView[Union[Inode, IncompleteInode]]:
@@ -297,25 +467,123 @@ class Subvolume(NamedTuple):
 
         See also: `rendered_tree.gather_bottom_up()`
         '''
-        ino_id = self.id_map.get_id(top_path)
-        assert ino_id is not None, f'"{top_path}" does not exist!'
-        child_paths = self.id_map.get_children(ino_id)
-        # While I'd love the next code to be a single expression using a
-        # dictionary comprehension, Python does not allow `yield` inside
-        # comprehensions.  See https://stackoverflow.com/questions/32139885
-        if child_paths is None:
-            child_results = None
-        else:
-            child_results = {}
-            for child_path in sorted(child_paths):
-                child_results[os.path.relpath(child_path, top_path)] = (
-                    yield from self.gather_bottom_up(child_path)
+        return self._gather_bottom_up(top_path, {}, with_ino_id=False)
+
+    def _require_id(self, path: bytes) -> InodeID:
+        ino_id = self.id_map.get_id(path)
+        assert ino_id is not None, f'"{path}" does not exist!'
+        return ino_id
+
+    def _gather_bottom_up(
+        self,
+        top_path: bytes,
+        id_to_result: Mapping[int, Any],
+        *,
+        with_ino_id: bool,
+    ):
+        '''
+        Implements `gather_bottom_up`, optionally also yielding the
+        `InodeID` after the path.  Does not visit inodes whose `InodeID.id`
+        is in `id_to_result`, using that result instead.
+        '''
+        id_map = self.id_map
+
+        def expand(path_and_id):
+            path, ino_id = path_and_id
+            result = id_to_result.get(ino_id.id)
+            if result is not None:
+                return KnownResult(result)
+            ino = self.id_to_inode[ino_id]
+            child_paths = id_map.get_children(ino_id)
+            return (
+                (path, ino_id, ino) if with_ino_id else (path, ino)
+            ), None if child_paths is None else (
+                # Names cannot contain `/`, and `child_path` is normalized.
+                (os.path.basename(p), (p, id_map.get_id(p)))
+                    for p in sorted(child_paths)
+            )
+
+        return traverse_bottom_up(
+            (top_path, self._require_id(top_path)), expand,
+        )
+
+    def _digests(self, top_path: bytes) -> MutableMapping[int, bytes]:
+        'Returns `digests`, after adding those of `top_path` & below.'
+        digests = {} if self.digests is None else self.digests
+        with while_not_exited(self._gather_bottom_up(
+            top_path, digests, with_ino_id=True,
+        )) as ctx:
+            result = None
+            while True:
+                _path, ino_id, ino, child_digests = ctx.send(result)
+                result = digests[ino_id.id] = _inode_digest(
+                    ino, child_digests,
                 )
-        # pyre-fixme[7]: what even?!
-        return (  # noqa: B901
-            yield (top_path, self.id_to_inode[ino_id], child_results)
+        return digests
+
+    def digest(self, top_path=b'.') -> bytes:
+        '''
+        A Merkle digest of the inode at `top_path`, its metadata, data
+        layout, and for directories, the names & digests of its children.
+        Subvolumes that `render` the same have the same digests.
+
+        Digests are cached in `digests`, so after a few `apply_item`s,
+        this only rehashes the changed inodes and their ancestors.
+        '''
+        return self._digests(top_path)[self._require_id(top_path).id]
+
+    def changed_paths(
+        self, other: 'Subvolume', top_path=b'.',
+    ) -> Iterator[bytes]:
+        '''
+        Yields the paths at or under `top_path` whose inodes differ
+        between `self` and `other`, depth-first, in order of name.  A path
+        that exists on only one side is yielded without its descendants.
+        A directory is yielded if its own metadata differ, and is
+        descended into if any of its children differ.
+
+        Subtrees with equal `digest`s are skipped, so once the digests are
+        cached, this takes time proportional to the changes.
+        '''
+        yield from self._changed_paths(
+            other, top_path,
+            self._require_id(top_path), other._require_id(top_path),
+            self._digests(top_path), other._digests(top_path),
         )
 
+    def _changed_paths(
+        self, other: 'Subvolume', path: bytes,
+        ino_id: InodeID, other_ino_id: InodeID,
+        digests: Mapping[int, bytes], other_digests: Mapping[int, bytes],
+    ) -> Iterator[bytes]:
+        if digests[ino_id.id] == other_digests[other_ino_id.id]:
+            return
+        child_paths = self.id_map.get_children(ino_id)
+        other_child_paths = other.id_map.get_children(other_ino_id)
+        if child_paths is None or other_child_paths is None or (
+            _inode_digest(self.id_to_inode[ino_id], None)
+                != _inode_digest(other.id_to_inode[other_ino_id], None)
+        ):
+            yield path
+        if child_paths is None or other_child_paths is None:
+            return
+        child_paths = {os.path.basename(p): p for p in child_paths}
+        other_child_paths = {
+            os.path.basename(p): p for p in other_child_paths
+        }
+        for name in sorted(child_paths.keys() | other_child_paths.keys()):
+            child_path = child_paths.get(name)
+            other_child_path = other_child_paths.get(name)
+            if child_path is None or other_child_path is None:
+                yield child_path or other_child_path
+            else:
+                yield from self._changed_paths(
+                    other, child_path,
+                    self.id_map.get_id(child_path),
+                    other.id_map.get_id(other_child_path),
+                    digests, other_digests,
+                )
+
     def map_bottom_up(self, fn, top_path=b'.') -> RenderedTree:
         '''
         Applies `fn` to each inode from `top_path` down, in the
@@ -335,15 +603,124 @@ class Subvolume(NamedTuple):
                 }]
         return ctx.result
 
-    def render(self, top_path=b'.') -> RenderedTree:
+    def render(
+        self, top_path=b'.', *,
+        extent_id_maker: Optional[TraversalIDMaker] = None,
+    ) -> RenderedTree:
         '''
         Produces a JSON-friendly plain-old-data view of the Subvolume.
         Before this is actually JSON-ready, you will need to call one of the
         `emit_*_traversal_ids` functions.  Read the docblock of
         `rendered_tree.py` for more details.
+
+        If the `Subvolume` was frozen with `shared_extents=True`, its
+        `SharedExtent`s are numbered in traversal order by `extent_id_maker`.
+        When rendering several subvolumes from one frozen `SubvolumeSet`,
+        pass the same `extent_id_maker` to each, so that clones across
+        subvolumes get the same number.
         '''
         id_maker = TraversalIDMaker()
+        if extent_id_maker is None:
+            extent_id_maker = TraversalIDMaker()
+
+        def extent_id(nonce: int) -> int:
+            return extent_id_maker.next_with_nonce(nonce).id
+
         return self.map_bottom_up(
-            lambda ino: id_maker.next_with_nonce(id(ino)).wrap(repr(ino)),
+            lambda ino: id_maker.next_with_nonce(id(ino)).wrap(
+                ino.repr_with_extent_ids(extent_id)
+                    if isinstance(ino, Inode) else repr(ino)
+            ),
             top_path=top_path,
         )
+
+    def render_json(
+        self, outfile: TextIO, top_path=b'.', *,
+        all_traversal_ids: bool = False,
+        extent_id_maker: Optional[TraversalIDMaker] = None,
+    ) -> None:
+        '''
+        Writes the same JSON as `json.dump(emit_non_unique_traversal_ids(
+        self.render(top_path)), outfile)`, or with `all_traversal_ids`, as
+        `emit_all_traversal_ids`.  `extent_id_maker` is as in `render`.
+
+        `render` builds the whole `RenderedTree`, and `emit_*` then makes
+        a copy.  Instead, we write the JSON as we go, so we only keep the
+        traversal IDs of hardlinked inodes (or, with `all_traversal_ids`,
+        of all inodes), plus the children of the directories that we are
+        in.  Since the IDs are numbered bottom-up, but the JSON is written
+        top-down, we first make a pass to number the inodes.
+        '''
+        if extent_id_maker is None:
+            extent_id_maker = TraversalIDMaker()
+
+        def extent_id(nonce: int) -> int:
+            return extent_id_maker.next_with_nonce(nonce).id
+
+        def ino_repr(ino):
+            return (
+                ino.repr_with_extent_ids(extent_id)
+                    if isinstance(ino, Inode) else repr(ino)
+            )
+
+        # Count the inodes that may need IDs, in order of first appearance.
+        id_to_count = {}
+        with while_not_exited(self._gather_bottom_up(
+            top_path, {}, with_ino_id=True,
+        )) as ctx:
+            while True:
+                _path, ino_id, ino, child_results = ctx.send(None)
+                # `render` numbers shared extents in this order.
+                if isinstance(ino, Inode) and any(
+                    c.shared_extents for c in ino.chunks or ()
+                ):
+                    ino_repr(ino)
+                if all_traversal_ids or (
+                    child_results is None
+                    and len(self.id_map.get_paths(ino_id)) > 1
+                ):
+                    id_to_count[ino_id.id] = id_to_count.get(ino_id.id, 0) + 1
+        id_to_traversal_id = {
+            id: traversal_id
+                for traversal_id, id in enumerate(
+                    id for id, n in id_to_count.items()
+                        if all_traversal_ids or n > 1
+                )
+        }
+        del id_to_count
+
+        write = outfile.write
+        id_map = self.id_map
+        # Frames of `[iterator over child paths, whether to write a comma]`
+        stack = []
+        ino_id = self._require_id(top_path)
+        while True:
+            rendered = ino_repr(self.id_to_inode[ino_id])
+            traversal_id = id_to_traversal_id.get(ino_id.id)
+            write('[' + json.dumps(
+                rendered if traversal_id is None else [rendered, traversal_id]
+            ))
+            child_paths = id_map.get_children(ino_id)
+            if child_paths is None:
+                write(']')
+            else:
+                write(', {')
+                stack.append([iter(sorted(child_paths)), False])
+            # Write the name of the next child, closing the directories
+            # that have no more children.
+            while stack:
+                frame = stack[-1]
+                child_path = next(frame[0], None)
+                if child_path is not None:
+                    write((', ' if frame[1] else '') + json.dumps(
+                        os.path.basename(child_path).decode(
+                            errors='surrogateescape',
+                        ),
+                    ) + ': ')
+                    frame[1] = True
+                    ino_id = id_map.get_id(child_path)
+                    break
+                stack.pop()
+                write('}]')
+            else:
+                return
@@ -0,0 +1,574 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+`SubvolumeSetCache` is a content-addressed on-disk cache for the
+`SubvolumeSet`s made by replaying send-streams.  Tools that look at the
+same layers over and over can then skip parsing and replaying them:
+
+    key = cache_key(infiles, id_map_class=CompactInodeIDMap)
+    cached = cache.get(key)
+    if cached is None:
+        ...  # Replay `infiles` into `subvols`
+        cache.put(key, subvols)
+    else:
+        with cached:
+            subvols = cached.subvolume_set()
+
+The key hashes the send-streams, `PARSER_VERSION`, our `FORMAT_VERSION`,
+and the backends of the `SubvolumeSet`, so entries never go stale.  We
+cache the mutable sets that replay makes, and not frozen ones, since
+`freeze` is cheap by comparison, and its output can refer to `InodeID`s
+of the mutable set.
+
+Each entry is one file in a compact, versioned binary format, see
+`_encode_subvolume_set`:
+  - a header with the format version, and the backends of the set,
+  - a table of the leaf `Extent`s of all the files, so that the restored
+    files share bytes exactly like the original ones did,
+  - an index with the `SubvolumeDescription` of each subvolume, and the
+    position of its record,
+  - the records: the inodes of each subvolume, and its directory tree.
+
+`get` `mmap`s the entry, and reads just the header and the index.
+`CachedSubvolumeSet.subvolume` decodes a single subvolume on demand, so
+e.g. diffing the top two layers of a deep stack reads only their pages.
+
+`get` marks an entry as recently used by updating its mtime, and `put`
+evicts the least recently used entries until the cache fits in
+`max_bytes`.  Entries are written to a temporary file, and renamed into
+place, so concurrent processes can share a cache directory.  An entry
+with a bad header or index (unknown class codes, counts that do not fit
+the file, garbled names or UUIDs) is treated as a miss by `get`, and
+deleted.
+`get` does not read the records, so `subvolume` raises `RuntimeError` on
+a corrupt one -- the caller should then replay the send-streams, and
+`put` the result, which replaces the bad entry.
+
+The restored set behaves like a freshly replayed one, with two caveats:
+  - Snapshots that used a `CompactInodeIDMap` no longer share storage
+    with their parents, so they take more RAM.
+  - The `InodeID` counter of a subvolume resumes after its largest live
+    inode number, so further items may get different inode numbers than
+    they would have.  The numbers are invisible in renders & diffs.
+'''
+import hashlib
+import itertools
+import mmap
+import os
+import stat
+import struct
+import tempfile
+
+from collections import Counter
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .compact_inode_id import CompactInodeIDMap
+from .extent import Extent
+from .flat_extent import FlatExtent
+from .incomplete_inode import (
+    IncompleteDevice, IncompleteDir, IncompleteFifo, IncompleteFile,
+    IncompleteInode, IncompleteSocket, IncompleteSymlink,
+)
+from .inode import InodeOwner, InodeUtimes
+from .inode_id import InodeID, InodeIDMap
+from .parse_send_stream import PARSER_VERSION
+from .send_stream import SendStreamItems
+from .subvolume import Subvolume
+from .subvolume_set import SubvolumeDescription, SubvolumeID, SubvolumeSet
+
+# Bump this when the file format changes, or when a change to `Subvolume`
+# or to the `IncompleteInode`s alters what replaying a send-stream makes.
+FORMAT_VERSION = 1
+
+_MAGIC = b'BTRFSSVS'
+_SUFFIX = '.subvols'
+# The position of a class in these lists identifies it in the header.
+_ID_MAP_CLASSES = [InodeIDMap, CompactInodeIDMap]
+_EXTENT_CLASSES = [Extent, FlatExtent]
+
+# All integers are little-endian.  `bytes` are stored as a `_UINT32`
+# length, followed by the data.
+#
+# magic, FORMAT_VERSION, ID map class, extent class, number of leaves,
+# number of subvolumes, size of the whole file
+_HEADER = struct.Struct('<8sIBBIIQ')
+_LEAF = struct.Struct('<BQ')  # `Extent.Kind.value`, length
+# record offset, record size, transid, has parent, parent transid; then
+# the name, UUID & parent UUID, as `bytes`.  Offsets count from the end of
+# the index.
+_INDEX_ENTRY = struct.Struct('<QQQ?Q')
+_UINT32 = struct.Struct('<I')
+_SUBVOL = struct.Struct('<QII')  # next inode number, # inodes, # links
+# Followed by the present fields of `_MODE`, `_OWNER`, `_UTIMES`, then by
+# the xattrs, and the fields of the specific file type.
+_INODE = struct.Struct('<QIB')  # inode number, file type, `_HAS_*` flags
+_MODE = struct.Struct('<I')
+_OWNER = struct.Struct('<QQ')
+_UTIMES = struct.Struct('<qIqIqI')
+_PIECE = struct.Struct('<IQQ')  # leaf number, offset into leaf, length
+_DEV = struct.Struct('<Q')
+_LINK = struct.Struct('<QQ')  # parent, child inode numbers; then the name
+
+_HAS_MODE = 1
+_HAS_OWNER = 2
+_HAS_UTIMES = 4
+
+_READ_SIZE = 2 ** 20
+
+
+def cache_key(
+    infiles: Iterable[BinaryIO],
+    *,
+    id_map_class: type = InodeIDMap,
+    extent_class: type = Extent,
+) -> str:
+    '''
+    Returns the key of the `SubvolumeSet` made by replaying the
+    send-streams `infiles`, in order, with the given backends.  Reads the
+    files to the end, and then seeks them back, so they must be seekable.
+    '''
+    h = hashlib.sha256(repr((
+        FORMAT_VERSION, PARSER_VERSION,
+        id_map_class.__name__, extent_class.__name__,
+    )).encode())
+    for infile in infiles:
+        pos = infile.tell()
+        file_hash = hashlib.sha256()
+        for data in iter(lambda: infile.read(_READ_SIZE), b''):
+            file_hash.update(data)
+        infile.seek(pos)
+        h.update(file_hash.digest())
+    return h.hexdigest()
+
+
+def _class_code(classes: List[type], cls: type) -> int:
+    if cls not in classes:
+        raise RuntimeError(f'Cannot cache a SubvolumeSet that uses {cls}')
+    return classes.index(cls)
+
+
+def _pack_bytes(out: bytearray, b: bytes) -> None:
+    out += _UINT32.pack(len(b))
+    out += b
+
+
+def _gen_links(id_map) -> Iterator[Tuple[int, int, bytes]]:
+    '''
+    Yields `(parent, child, name)` for every path of `id_map`, where the
+    inode numbers of parents come first.  Hardlinked files appear once
+    per path.
+    '''
+    stack = [id_map.get_id(b'.')]
+    while stack:
+        dir_id = stack.pop()
+        for path in sorted(id_map.get_children(dir_id)):
+            ino_id = id_map.get_id(path)
+            yield dir_id.id, ino_id.id, os.path.basename(path)
+            if id_map.get_children(ino_id) is not None:
+                stack.append(ino_id)
+
+
+def _encode_subvolume(
+    subvol: Subvolume, leaf_to_number: Dict[int, int], leaves: List[Extent],
+) -> bytearray:
+    'Adds any new leaves to `leaves`, which keeps the `id()`s valid.'
+    out = bytearray()
+    inodes = sorted(subvol.id_to_inode.items(), key=lambda i: i[0].id)
+    links = list(_gen_links(subvol.id_map))
+    out += _SUBVOL.pack(inodes[-1][0].id + 1, len(inodes), len(links))
+    for ino_id, ino in inodes:
+        if not isinstance(ino, IncompleteInode):
+            raise RuntimeError(f'Can only cache IncompleteInodes, not {ino}')
+        out += _INODE.pack(ino_id.id, ino.file_type, (
+            (_HAS_MODE if ino.mode is not None else 0)
+            | (_HAS_OWNER if ino.owner is not None else 0)
+            | (_HAS_UTIMES if ino.utimes is not None else 0)
+        ))
+        if ino.mode is not None:
+            out += _MODE.pack(ino.mode)
+        if ino.owner is not None:
+            out += _OWNER.pack(*ino.owner)
+        if ino.utimes is not None:
+            out += _UTIMES.pack(*ino.utimes.ctime, *ino.utimes.mtime,
+                *ino.utimes.atime)
+        out += _UINT32.pack(len(ino.xattrs))
+        for name, value in ino.xattrs.items():
+            _pack_bytes(out, name)
+            _pack_bytes(out, value)
+        if isinstance(ino, IncompleteFile):
+            pieces = list(ino.extent.gen_trimmed_leaves())
+            out += _UINT32.pack(len(pieces))
+            for offset, length, leaf in pieces:
+                leaf_number = leaf_to_number.get(id(leaf))
+                if leaf_number is None:
+                    leaf_number = leaf_to_number[id(leaf)] = len(leaves)
+                    leaves.append(leaf)
+                out += _PIECE.pack(leaf_number, offset, length)
+        elif isinstance(ino, IncompleteDevice):
+            out += _DEV.pack(ino.dev)
+        elif isinstance(ino, IncompleteSymlink):
+            _pack_bytes(out, ino.dest)
+    for parent, child, name in links:
+        out += _LINK.pack(parent, child)
+        _pack_bytes(out, name)
+    return out
+
+
+def _encode_subvolume_set(subvols: SubvolumeSet) -> Iterator[bytes]:
+    'Yields the parts of the cache entry for `subvols`.'
+    if subvols.clone_index is None:
+        raise RuntimeError('Cannot cache a frozen SubvolumeSet')
+    id_map_code = _class_code(_ID_MAP_CLASSES, subvols.id_map_class)
+    extent_code = _class_code(_EXTENT_CLASSES, subvols.extent_class)
+    leaf_to_number = {}
+    leaves = []
+    index = bytearray()
+    records = []
+    offset = 0
+    for uuid, subvol in subvols.uuid_to_subvolume.items():
+        description = subvol.id_map.inner.description
+        if not isinstance(description, SubvolumeDescription):
+            raise RuntimeError(f'{uuid} lacks a SubvolumeDescription')
+        record = _encode_subvolume(subvol, leaf_to_number, leaves)
+        parent_id = description.parent_id
+        index += _INDEX_ENTRY.pack(
+            offset, len(record), description.id.transid,
+            parent_id is not None,
+            0 if parent_id is None else parent_id.transid,
+        )
+        _pack_bytes(index, description.name)
+        _pack_bytes(index, description.id.uuid.encode())
+        _pack_bytes(index, b'' if parent_id is None
+            else parent_id.uuid.encode())
+        records.append(record)
+        offset += len(record)
+    leaf_table = b''.join(
+        _LEAF.pack(leaf.content.value, leaf.length) for leaf in leaves
+    )
+    yield _HEADER.pack(
+        _MAGIC, FORMAT_VERSION, id_map_code, extent_code, len(leaves),
+        len(records), _HEADER.size + len(leaf_table) + len(index) + offset,
+    )
+    yield leaf_table
+    yield index
+    yield from records
+
+
+class _Reader:
+    'Decodes the fields of a cache entry, starting from `pos`.'
+
+    def __init__(self, buf, pos: int):
+        self.buf = buf
+        self.pos = pos
+
+    def unpack(self, st: struct.Struct) -> tuple:
+        values = st.unpack_from(self.buf, self.pos)
+        self.pos += st.size
+        return values
+
+    def bytes(self) -> bytes:
+        length, = self.unpack(_UINT32)
+        start = self.pos
+        self.pos += length
+        return bytes(self.buf[start:self.pos])
+
+
+def _set_next_id(id_map, next_id: int):
+    'Returns `id_map`, or a copy, whose next `InodeID` is `next_id`.'
+    if isinstance(id_map, CompactInodeIDMap):
+        id_map.inode_id_counter = itertools.count(next_id)
+        return id_map
+    return id_map._replace(inode_id_counter=itertools.count(next_id))
+
+
+class CachedSubvolumeSet:
+    '''
+    An entry of `SubvolumeSetCache`, as returned by `get`.  Close it, e.g.
+    via `with`, once you have loaded what you need.  The loaded objects
+    do not refer to the entry.
+    '''
+
+    def __init__(self, infile: BinaryIO):
+        'Raises `RuntimeError` if `infile` is not a valid entry.'
+        size = os.fstat(infile.fileno()).st_size
+        if size < _HEADER.size:
+            raise RuntimeError(f'Cache entry of {size} bytes is truncated')
+        self._buf = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._read_index(size)
+        except Exception:
+            self._buf.close()
+            raise
+
+    def _read_index(self, size: int) -> None:
+        reader = _Reader(self._buf, 0)
+        (
+            magic, version, id_map_code, extent_code, num_leaves,
+            num_subvols, expected_size,
+        ) = reader.unpack(_HEADER)
+        if (magic, version) != (_MAGIC, FORMAT_VERSION):
+            raise RuntimeError(f'Not a version {FORMAT_VERSION} cache entry')
+        if expected_size != size:
+            raise RuntimeError(f'Cache entry has {size} != {expected_size} B')
+        if id_map_code >= len(_ID_MAP_CLASSES) or \
+                extent_code >= len(_EXTENT_CLASSES):
+            raise RuntimeError(
+                f'Cache entry has unknown class codes {id_map_code}, '
+                f'{extent_code}'
+            )
+        self.id_map_class = _ID_MAP_CLASSES[id_map_code]
+        self.extent_class = _EXTENT_CLASSES[extent_code]
+        # The leaves are made on first use, and shared by all the
+        # subvolumes that we load, so that their clones are preserved.
+        self._leaves_pos = reader.pos
+        self._leaves = None
+        reader.pos += num_leaves * _LEAF.size
+        self._leaves_end = reader.pos
+        # Each index entry is followed by at least its 3 `bytes` lengths.
+        min_entry_size = _INDEX_ENTRY.size + 3 * _UINT32.size
+        if reader.pos + num_subvols * min_entry_size > size:
+            raise RuntimeError(
+                f'Cache entry of {size} bytes cannot fit {num_leaves} '
+                f'leaves and {num_subvols} subvolumes'
+            )
+
+        # Loaded subvolumes' descriptions share this, like in a real set.
+        self._prefix_counts = Counter()
+        self._uuid_to_record = {}
+        for _ in range(num_subvols):
+            try:
+                offset, record_size, transid, has_parent, parent_transid = \
+                    reader.unpack(_INDEX_ENTRY)
+                name = reader.bytes()
+                uuid = reader.bytes().decode()
+                parent_uuid = reader.bytes().decode()
+            except (IndexError, struct.error, UnicodeDecodeError) as ex:
+                raise RuntimeError('Cache entry has a corrupt index') from ex
+            description = SubvolumeDescription(
+                name=name,
+                id=SubvolumeID(uuid=uuid, transid=transid),
+                parent_id=SubvolumeID(
+                    uuid=parent_uuid, transid=parent_transid,
+                ) if has_parent else None,
+                name_uuid_prefix_counts=self._prefix_counts,
+            )
+            self._prefix_counts.update(description.name_uuid_prefixes())
+            self._uuid_to_record[uuid] = (description, offset, record_size)
+        for uuid, (description, offset, record_size) in \
+                self._uuid_to_record.items():
+            self._uuid_to_record[uuid] = (
+                description, reader.pos + offset, record_size,
+            )
+        # In the order of `SubvolumeSet.uuid_to_subvolume`
+        self.uuids = list(self._uuid_to_record)
+
+    def _get_leaves(self) -> List[Extent]:
+        if self._leaves is None:
+            self._leaves = [
+                Extent(content=Extent.Kind(kind), offset=0, length=length)
+                    for kind, length in _LEAF.iter_unpack(
+                        self._buf[self._leaves_pos:self._leaves_end],
+                    )
+            ]
+        return self._leaves
+
+    def subvolume(self, uuid: str) -> Subvolume:
+        '''
+        Decodes the `Subvolume` with `uuid`, each call makes a new one.
+        Raises `RuntimeError` if its record is corrupt.
+        '''
+        description, offset, record_size = self._uuid_to_record[uuid]
+        try:
+            return self._decode_subvolume(
+                uuid, description, offset, record_size,
+            )
+        except (IndexError, KeyError, ValueError, struct.error) as ex:
+            raise RuntimeError(f'Cache entry for {uuid} is corrupted') from ex
+
+    def _decode_subvolume(
+        self, uuid: str, description: SubvolumeDescription, offset: int,
+        record_size: int,
+    ) -> Subvolume:
+        leaves = self._get_leaves()
+        reader = _Reader(self._buf, offset)
+        next_id, num_inodes, num_links = reader.unpack(_SUBVOL)
+        id_map = self.id_map_class.new(description=description)
+        number_to_ino_id = {0: id_map.get_id(b'.')}
+        number_to_inode = {}
+        for _ in range(num_inodes):
+            number, file_type, flags = reader.unpack(_INODE)
+            mode, = reader.unpack(_MODE) if flags & _HAS_MODE else (None,)
+            owner = InodeOwner(*reader.unpack(_OWNER)) \
+                if flags & _HAS_OWNER else None
+            if flags & _HAS_UTIMES:
+                c_s, c_ns, m_s, m_ns, a_s, a_ns = reader.unpack(_UTIMES)
+                utimes = InodeUtimes(
+                    ctime=(c_s, c_ns), mtime=(m_s, m_ns), atime=(a_s, a_ns),
+                )
+            else:
+                utimes = None
+            num_xattrs, = reader.unpack(_UINT32)
+            xattrs = {}
+            for _ in range(num_xattrs):
+                name = reader.bytes()
+                xattrs[name] = reader.bytes()
+            ino = self._new_inode(reader, file_type, mode, leaves)
+            ino.mode = mode
+            ino.owner = owner
+            ino.utimes = utimes
+            ino.xattrs = xattrs
+            number_to_inode[number] = ino
+            if number not in number_to_ino_id:
+                number_to_ino_id[number] = InodeID(
+                    id=number, inner_id_map=id_map.inner,
+                )
+        number_to_path = {0: b''}
+        for _ in range(num_links):
+            parent, child = reader.unpack(_LINK)
+            name = reader.bytes()
+            path = number_to_path[parent] + name
+            ino_id = number_to_ino_id[child]
+            if stat.S_ISDIR(number_to_inode[child].file_type):
+                number_to_path[child] = path + b'/'
+                id_map.add_dir(ino_id, path)
+            else:
+                id_map.add_file(ino_id, path)
+        if reader.pos != offset + record_size:
+            raise RuntimeError(f'Cache entry for {uuid} is corrupted')
+        subvol = Subvolume.new(
+            id_map=_set_next_id(id_map, next_id),
+            extent_class=self.extent_class,
+        )
+        for number, ino in number_to_inode.items():
+            subvol.id_to_inode[number_to_ino_id[number]] = ino
+        return subvol
+
+    def _new_inode(
+        self, reader: _Reader, file_type: int, mode: Optional[int],
+        leaves: List[Extent],
+    ) -> IncompleteInode:
+        if file_type == stat.S_IFREG:
+            ino = IncompleteFile(
+                item=SendStreamItems.mkfile(path=b''),
+                extent_class=self.extent_class,
+            )
+            num_pieces, = reader.unpack(_UINT32)
+            ino.extent = self.extent_class.from_trimmed_leaves(
+                (offset, length, leaves[leaf_number])
+                    for leaf_number, offset, length in (
+                        reader.unpack(_PIECE) for _ in range(num_pieces)
+                    )
+            )
+            return ino
+        elif file_type == stat.S_IFDIR:
+            return IncompleteDir(item=SendStreamItems.mkdir(path=b''))
+        elif file_type in (stat.S_IFBLK, stat.S_IFCHR):
+            dev, = reader.unpack(_DEV)
+            return IncompleteDevice(item=SendStreamItems.mknod(
+                path=b'', mode=file_type | mode, dev=dev,
+            ))
+        elif file_type == stat.S_IFLNK:
+            return IncompleteSymlink(item=SendStreamItems.symlink(
+                path=b'', dest=reader.bytes(),
+            ))
+        elif file_type == stat.S_IFIFO:
+            return IncompleteFifo(item=SendStreamItems.mkfifo(path=b''))
+        elif file_type == stat.S_IFSOCK:
+            return IncompleteSocket(item=SendStreamItems.mksock(path=b''))
+        raise RuntimeError(f'Cache entry has unknown file type {file_type}')
+
+    def subvolume_set(self) -> SubvolumeSet:
+        'Decodes all the subvolumes into a new `SubvolumeSet`.'
+        subvols = SubvolumeSet.new(
+            name_uuid_prefix_counts=self._prefix_counts,
+            extent_class=self.extent_class,
+            id_map_class=self.id_map_class,
+        )
+        for uuid in self.uuids:
+            subvol = self.subvolume(uuid)
+            # pyre-fixme[16]: This is supposed to be frozen!!!
+            subvols.uuid_to_subvolume[uuid] = subvol
+            subvols.clone_index.update_subvolume(subvol)
+        return subvols
+
+    def close(self) -> None:
+        self._buf.close()
+
+    def __enter__(self) -> 'CachedSubvolumeSet':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+def _unlink_if_exists(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass  # Another process got to it first
+
+
+class SubvolumeSetCache:
+    'Read the module docblock.'
+
+    def __init__(self, path: str, *, max_bytes: int):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key + _SUFFIX)
+
+    def get(self, key: str) -> Optional[CachedSubvolumeSet]:
+        'Returns `None` if there is no usable entry for `key`.'
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as infile:
+                cached = CachedSubvolumeSet(infile)
+        except FileNotFoundError:
+            return None
+        except RuntimeError:
+            _unlink_if_exists(path)
+            return None
+        try:
+            os.utime(path)  # Now the most recently used
+        except FileNotFoundError:  # pragma: no cover
+            pass  # Evicted by another process, but our `mmap` is fine.
+        return cached
+
+    def put(self, key: str, subvols: SubvolumeSet) -> None:
+        '''
+        Stores the mutable `subvols` under `key`, and then evicts entries.
+        If the entry alone exceeds `max_bytes`, it is evicted right away.
+        '''
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                for part in _encode_subvolume_set(subvols):
+                    outfile.write(part)
+            os.rename(tmp_path, self._entry_path(key))
+        except BaseException:
+            _unlink_if_exists(tmp_path)
+            raise
+        self._evict()
+
+    def _evict(self) -> None:
+        'Deletes the least recently used entries, until we fit.'
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(_SUFFIX):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:  # pragma: no cover
+                    continue  # Evicted by another process
+                entries.append((st.st_mtime_ns, entry.name, st.st_size))
+        total_size = sum(size for _, _, size in entries)
+        for _, name, size in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            _unlink_if_exists(os.path.join(self.path, name))
+            total_size -= size
@@ -14,7 +14,6 @@ directory tree the way they would be in a real btrfs filesystem.  This is
 not done here simply because we don't have a need to model it, but you can
 easily imagine a path-aware `Volume` abstraction on top of this.
 '''
-import copy
 import itertools
 
 from collections import Counter
@@ -23,7 +22,9 @@ from types import MappingProxyType
 # and avoid `deepcopy`.
 from typing import Iterator, Mapping, NamedTuple, Optional, Union
 
-from .extents_to_chunks import extents_to_chunks_with_clones
+from .clone_index import CloneIndex
+from .extent import Extent
+from .extents_to_chunks import extents_to_chunks_with_shared_extents
 from .freeze import freeze
 from .incomplete_inode import IncompleteInode
 from .inode import Inode
@@ -102,11 +103,26 @@ class SubvolumeSet(NamedTuple):
     # each possible length of prefix (from 0 to `len(uuid)`).  When the name
     # is unique, `@uuid_prefix` is omitted (aka prefix length 0).
     name_uuid_prefix_counts: Mapping[str, int]
+    # Kept up-to-date by `SubvolumeSetMutator`, so that we can find the
+    # clones of mutable inodes without a pass over the whole set.  This is
+    # `None` once frozen, since the frozen `Inode`s already have `Chunk`s.
+    clone_index: Optional[CloneIndex]
+    # The `Subvolume.extent_class` of new subvolumes.  Clones may cross
+    # subvolumes, and `Extent.clone` cannot take a `FlatExtent`, so we
+    # pick the backend for the whole set.
+    extent_class: type
+    # The `Subvolume.id_map` class of new subvolumes.  Pass
+    # `CompactInodeIDMap` for huge images, see `compact_inode_id.py`, or
+    # for long chains of snapshots, see `inode_table.py`.
+    id_map_class: type
 
     @classmethod
     def new(cls, **kwargs) -> 'SubvolumeSet':
         kwargs.setdefault('uuid_to_subvolume', {})
         kwargs.setdefault('name_uuid_prefix_counts', Counter())
+        kwargs.setdefault('clone_index', CloneIndex())
+        kwargs.setdefault('extent_class', Extent)
+        kwargs.setdefault('id_map_class', InodeIDMap)
         return cls(**kwargs)
 
     def get_by_rendered_id(self, rendered_id: str) -> Optional[Subvolume]:
@@ -115,19 +131,30 @@ class SubvolumeSet(NamedTuple):
                 return subvol
         return None
 
-    def freeze(self, *, _memo) -> 'SubvolumeSet':
+    def freeze(
+        self, *, _memo, shared_extents: bool = False,
+    ) -> 'SubvolumeSet':
         '''
         Return a recursively immutable copy of `self`, replacing all
         `IncompleteInode`s by `Inode`s, and checking that all inode metadata
         are populated.  Correctly resolving cloned extents has to happen at
-        the level of the `SubvolumeSet`.
+        the level of the `SubvolumeSet`.  The `ChunkClone`s come from
+        `clone_index`, so freezing again after applying more items only
+        recomputes the `Chunk`s of the files that those items affected.
+
+        `shared_extents=True` describes clones via the linear-size
+        `SharedExtent`s, see `extents_to_chunks.py` and `Subvolume.render`.
+        Their numbering is global, so this needs a pass over all files.
         '''
-        id_to_chunks = dict(extents_to_chunks_with_clones(
-            list(itertools.chain.from_iterable(
-                subvol._inode_ids_and_extents()
-                    for subvol in self.uuid_to_subvolume.values()
+        if shared_extents:
+            id_to_chunks = dict(extents_to_chunks_with_shared_extents(
+                list(itertools.chain.from_iterable(
+                    subvol._inode_ids_and_extents()
+                        for subvol in self.uuid_to_subvolume.values()
+                ))
             ))
-        ))
+        else:
+            id_to_chunks = self.clone_index.id_to_chunks()
         return type(self)(
             uuid_to_subvolume=MappingProxyType({
                 uuid: freeze(subvol, _memo=_memo, id_to_chunks=id_to_chunks)
@@ -136,8 +163,35 @@ class SubvolumeSet(NamedTuple):
             name_uuid_prefix_counts=freeze(
                 self.name_uuid_prefix_counts, _memo=_memo,
             ),
+            clone_index=None,
+            extent_class=self.extent_class,
+            id_map_class=self.id_map_class,
         )
 
+    def freeze_inode_at_path(
+        self, subvol: Subvolume, path: bytes,
+    ) -> Optional[Inode]:
+        '''
+        Returns the `Inode` that `freeze()` would make for `path` in the
+        mutable `subvol`, without freezing anything else.  Thanks to
+        `clone_index`, this takes time proportional to the size of the
+        inode and its clones, so it is cheap to `assert_valid_and_complete`
+        or to `repr` just the inodes that a send-stream touched, even while
+        replaying a long chain of them.
+
+        Unlike with `freeze()`, the `ChunkClone`s refer to the live
+        `InodeID`s of the mutable set, whose `repr` may yet change.
+        '''
+        ino_id = subvol.id_map.get_id(path)
+        if ino_id is None:
+            return None
+        ino = subvol.id_to_inode[ino_id]
+        chunks = self.clone_index.chunks(ino_id) \
+            if hasattr(ino, 'extent') else None
+        # Seeding the memo stops `freeze` from copying the `InodeIDMap` of
+        # every `InodeID` in the `ChunkClone`s, which would cost O(set).
+        return freeze(ino, _memo={id(chunks): chunks}, chunks=chunks)
+
     def inodes(self) -> Iterator[Union[Inode, IncompleteInode]]:
         return itertools.chain.from_iterable(
             sv.inodes() for sv in self.uuid_to_subvolume.values()
@@ -198,19 +252,18 @@ class SubvolumeSetMutator(NamedTuple):
             # `SubvolumeDescription` references a part `SubvolumeSet`, so it
             # is not correctly `deepcopy`able as part of a `Subvolume`.  And
             # we want to modify the `InodeIDMap`'s `description` in any
-            # case, so let's just bulk-replace the old description instance.
-            # This would not be sane if the old instance were of a type that
-            # may be interned by the runtime, like `int`, hence the assert.
+            # case, so `Subvolume.snapshot` bulk-replaces the old
+            # description instance, if it has to `deepcopy`.  This would not
+            # be sane if the old instance were of a type that may be
+            # interned by the runtime, like `int`, hence the assert.
             assert isinstance(
                 parent_subvol.id_map.inner.description, SubvolumeDescription
             )
-            # pyre-fixme[6]: unsafe(?) deepcopy across different types!!!
-            subvol = copy.deepcopy(parent_subvol, memo={
-                id(parent_subvol.id_map.inner.description): description,
-            })
+            subvol = parent_subvol.snapshot(description=description)
         else:
             subvol = Subvolume.new(
-                id_map=InodeIDMap.new(description=description),
+                id_map=subvol_set.id_map_class.new(description=description),
+                extent_class=subvol_set.extent_class,
             )
 
         dup_subvol = subvol_set.uuid_to_subvolume.get(my_id.uuid)
@@ -218,6 +271,8 @@ class SubvolumeSetMutator(NamedTuple):
             raise RuntimeError(f'{my_id} is already in use: {dup_subvol}')
         # pyre-fixme[16]: This is supposed to be frozen!!!
         subvol_set.uuid_to_subvolume[my_id.uuid] = subvol
+        # A snapshot shares all of its file extents with its parent.
+        subvol_set.clone_index.update_subvolume(subvol)
 
         # insertion can fail, so update the description disambiguator last.
         # pyre-fixme[16]: This is supposed to be frozen!!!
@@ -229,11 +284,26 @@ class SubvolumeSetMutator(NamedTuple):
         return cls(subvolume=subvol, subvolume_set=subvol_set)
 
     def apply_item(self, item: SendStreamItem):
-        if isinstance(item, SendStreamItems.clone):
-            from_subvol = self.subvolume_set.uuid_to_subvolume.get(
-                item.from_uuid.decode()
-            )
-            if not from_subvol:
-                raise RuntimeError(f'Unknown from_uuid for {item}')
-            return self.subvolume.apply_clone(item, from_subvol)
-        return self.subvolume.apply_item(item)
+        # The only inodes whose `Extent`s an item can create, change, or
+        # delete are at its `path`, and at the `dest` of a `rename`.
+        paths = [item.path]
+        if isinstance(item, SendStreamItems.rename):
+            paths.append(item.dest)
+        id_map = self.subvolume.id_map
+        ino_ids = {id_map.get_id(p) for p in paths}
+        try:
+            if isinstance(item, SendStreamItems.clone):
+                from_subvol = self.subvolume_set.uuid_to_subvolume.get(
+                    item.from_uuid.decode()
+                )
+                if not from_subvol:
+                    raise RuntimeError(f'Unknown from_uuid for {item}')
+                return self.subvolume.apply_clone(item, from_subvol)
+            return self.subvolume.apply_item(item)
+        finally:
+            ino_ids.update(id_map.get_id(p) for p in paths)
+            ino_ids.discard(None)
+            for ino_id in ino_ids:
+                self.subvolume_set.clone_index.update(ino_id, getattr(
+                    self.subvolume.id_to_inode.get(ino_id), 'extent', None,
+                ))
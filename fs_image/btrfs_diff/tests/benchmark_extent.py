@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+Compares the `Extent` and `FlatExtent` backends on a file that receives
+many small `write`s, like a log or a database in an image:
+
+  buck run fs_image/btrfs_diff:benchmark-extent -- 1000 10000 100000
+
+For each backend, we time applying the writes, and then one pass of
+`gen_trimmed_leaves`, and we report the peak memory of doing both.  The
+writes are either appended, or land at random offsets.  `Extent` takes
+super-linear time to list the leaves of randomly-written files, so that
+case is skipped above `--max-extent-random-writes`.
+'''
+import argparse
+import random
+import time
+import tracemalloc
+
+from ..extent import Extent
+from ..flat_extent import FlatExtent
+
+_WRITE_SIZE = 4096
+
+
+def _gen_offsets(pattern: str, num_writes: int):
+    if pattern == 'append':
+        return (i * _WRITE_SIZE for i in range(num_writes))
+    assert pattern == 'random', pattern
+    rng = random.Random(0)
+    return (
+        rng.randrange(num_writes) * _WRITE_SIZE for _ in range(num_writes)
+    )
+
+
+def _write_and_list(extent_class, offsets):
+    start = time.perf_counter()
+    extent = extent_class.empty()
+    for offset in offsets:
+        extent = extent.write(offset=offset, length=_WRITE_SIZE)
+    write_time = time.perf_counter() - start
+    start = time.perf_counter()
+    num_leaves = sum(1 for _ in extent.gen_trimmed_leaves())
+    return write_time, time.perf_counter() - start, num_leaves
+
+
+def _measure(extent_class, pattern: str, num_writes: int) -> None:
+    offsets = list(_gen_offsets(pattern, num_writes))
+    write_time, leaves_time, num_leaves = _write_and_list(
+        extent_class, offsets,
+    )
+    # `tracemalloc` slows things down a lot, so it gets a separate run.
+    tracemalloc.start()
+    _write_and_list(extent_class, offsets)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f'  {extent_class.__name__:<10} {pattern:<6} '
+        f'write {write_time:8.3f}s  leaves {leaves_time:8.3f}s '
+        f'{peak / 2 ** 20:8.1f} MB peak {num_leaves:8} leaves'
+    )
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    p.add_argument(
+        'num_writes', type=int, nargs='*', default=[1000, 10000, 100000],
+        help='How many writes to apply to the file.',
+    )
+    p.add_argument(
+        '--max-extent-random-writes', type=int, default=2000,
+        help='Skip `Extent` with random writes for larger counts.',
+    )
+    args = p.parse_args(argv)
+
+    for num_writes in args.num_writes:
+        print(f'{num_writes} writes:')
+        for pattern in ['append', 'random']:
+            for extent_class in [Extent, FlatExtent]:
+                if (
+                    extent_class is Extent and pattern == 'random'
+                    and num_writes > args.max_extent_random_writes
+                ):
+                    continue
+                _measure(extent_class, pattern, num_writes)
+
+
+if __name__ == '__main__':
+    main()
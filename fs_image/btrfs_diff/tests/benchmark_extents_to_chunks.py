@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+Shows how the two clone representations of `extents_to_chunks.py` scale
+when one extent is cloned into N files, as happens with many snapshots of
+a deduplicated base layer:
+
+  buck run fs_image/btrfs_diff:benchmark-extents-to-chunks -- 100 1000 10000
+
+`ChunkClone`s grow as N^2, so that mode is skipped above
+`--max-quadratic-clones`.  `SharedExtent`s grow as N.
+
+Heavy reflinking, e.g. by `cp --reflink`, instead makes many small clones
+with few overlaps.  There, the cost is in sorting & sweeping the starts
+and ends of the clones -- aka clone ops -- of each leaf extent.  Measure
+that with `--clone-ops`, which clones random ranges of one large extent
+into `clone_ops / 2` files.
+'''
+import argparse
+import random
+import time
+import tracemalloc
+
+from ..extent import Extent
+from ..extents_to_chunks import (
+    extents_to_chunks_with_clones, extents_to_chunks_with_shared_extents,
+)
+from ..inode_id import InodeIDMap
+
+
+def _ids_and_extents(num_clones: int):
+    id_map = InodeIDMap.new()
+    source = Extent.empty().write(offset=0, length=2 ** 20)
+    return [
+        (
+            id_map.add_file(id_map.next(), b'f%d' % i),
+            # Vary the clone ranges a bit, so not all of them are identical.
+            Extent.empty().clone(
+                to_offset=0, from_extent=source, from_offset=i % 7,
+                length=2 ** 19,
+            ),
+        ) for i in range(num_clones)
+    ]
+
+
+def _sparse_ids_and_extents(num_clone_ops: int):
+    id_map = InodeIDMap.new()
+    rng = random.Random(0)
+    source = Extent.empty().write(offset=0, length=2 ** 40)
+    # Each file's clone is one trimmed leaf, with a start and an end op.
+    ids_and_extents = []
+    for i in range(num_clone_ops // 2):
+        length = rng.randrange(1, 2 ** 16)
+        ids_and_extents.append((
+            id_map.add_file(id_map.next(), b'f%d' % i),
+            Extent.empty().clone(
+                to_offset=0, from_extent=source,
+                from_offset=rng.randrange(2 ** 40 - length), length=length,
+            ),
+        ))
+    return ids_and_extents
+
+
+def _measure(name: str, ids_and_extents, fn, count_fn) -> None:
+    tracemalloc.start()
+    start = time.perf_counter()
+    ids_and_chunks = list(fn(ids_and_extents))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    num_refs = sum(
+        count_fn(c) for _, chunks in ids_and_chunks for c in chunks
+    )
+    print(
+        f'  {name:<13} {elapsed:9.4f}s {peak / 2 ** 20:9.1f} MB peak '
+        f'{num_refs:12} refs'
+    )
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    p.add_argument(
+        'num_clones', type=int, nargs='*', default=[10, 100, 1000, 10000],
+        help='How many files clone the same extent.',
+    )
+    p.add_argument(
+        '--max-quadratic-clones', type=int, default=1000,
+        help='Skip `extents_to_chunks_with_clones` for larger N.',
+    )
+    p.add_argument(
+        '--clone-ops', type=int, nargs='*', default=[10 ** 6],
+        help='How many clone ops to make for the sparse-reflink workload.',
+    )
+    args = p.parse_args(argv)
+
+    for num_clones in args.num_clones:
+        print(f'{num_clones} clones:')
+        ids_and_extents = _ids_and_extents(num_clones)
+        if num_clones <= args.max_quadratic_clones:
+            _measure(
+                'chunk-clones', ids_and_extents,
+                extents_to_chunks_with_clones, lambda c: len(c.chunk_clones),
+            )
+        _measure(
+            'shared-extent', ids_and_extents,
+            extents_to_chunks_with_shared_extents,
+            lambda c: len(c.shared_extents),
+        )
+
+    for num_clone_ops in args.clone_ops:
+        print(f'{num_clone_ops} sparse clone ops:')
+        ids_and_extents = _sparse_ids_and_extents(num_clone_ops)
+        _measure(
+            'chunk-clones', ids_and_extents,
+            extents_to_chunks_with_clones, lambda c: len(c.chunk_clones),
+        )
+        _measure(
+            'shared-extent', ids_and_extents,
+            extents_to_chunks_with_shared_extents,
+            lambda c: len(c.shared_extents),
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+Compares `InodeIDMap` and `CompactInodeIDMap` on a synthetic tree that
+looks like a big image -- every directory holds a few subdirectories and
+many files, and the same names recur in many directories:
+
+  buck run fs_image/btrfs_diff:benchmark-inode-id -- 100000 1000000
+
+For each map, we time adding all the paths, `get_id` and `get_paths` on
+each of them, renaming every top-level directory, and finally removing
+all the paths.  A separate run reports the memory held by the fully
+populated map.
+'''
+import argparse
+import time
+import tracemalloc
+
+from ..compact_inode_id import CompactInodeIDMap
+from ..inode_id import InodeIDMap
+
+_SUBDIRS_PER_DIR = 3
+_FILES_PER_DIR = 17
+
+
+def _gen_tree(num_paths: int):
+    'Yields `(path, is_dir)` in breadth-first order.'
+    dirs = [b'']
+    count = 0
+    for parent in dirs:
+        for i in range(_SUBDIRS_PER_DIR + _FILES_PER_DIR):
+            if count == num_paths:
+                return
+            count += 1
+            is_dir = i < _SUBDIRS_PER_DIR
+            path = parent + (b'dir%d' if is_dir else b'file%d.py') % i
+            if is_dir:
+                dirs.append(path + b'/')
+            yield path, is_dir
+
+
+def _build(id_map_class, tree):
+    id_map = id_map_class.new()
+    for path, is_dir in tree:
+        if is_dir:
+            id_map.add_dir(id_map.next(), path)
+        else:
+            id_map.add_file(id_map.next(), path)
+    return id_map
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def _measure(id_map_class, tree) -> None:
+    paths = [p for p, _ in tree]
+    id_map = None
+
+    def build():
+        nonlocal id_map
+        id_map = _build(id_map_class, tree)
+
+    times = {'add': _timed(build)}
+    times['get_id'] = _timed(lambda: [id_map.get_id(p) for p in paths])
+    ino_ids = [id_map.get_id(p) for p in paths]
+    times['get_paths'] = _timed(lambda: [id_map.get_paths(i) for i in ino_ids])
+
+    top_dirs = [p for p, is_dir in tree if is_dir and b'/' not in p]
+
+    def rename():
+        for d in top_dirs:
+            id_map.rename_path(d, d + b'.new')
+        for d in top_dirs:
+            id_map.rename_path(d + b'.new', d)
+
+    times['rename'] = _timed(rename)
+    times['remove'] = _timed(
+        lambda: [id_map.remove_path(p) for p in reversed(paths)]
+    )
+
+    # `tracemalloc` slows things down a lot, so it gets a separate run.
+    tracemalloc.start()
+    id_map = _build(id_map_class, tree)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'  {id_map_class.__name__:<18} ' + '  '.join(
+        f'{k} {v:6.2f}s' for k, v in times.items()
+    ) + f'  {size / 2 ** 20:7.1f} MB')
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    p.add_argument(
+        'num_paths', type=int, nargs='*', default=[100000, 1000000],
+        help='How many paths to put in the tree.',
+    )
+    args = p.parse_args(argv)
+
+    for num_paths in args.num_paths:
+        tree = list(_gen_tree(num_paths))
+        print(f'{num_paths} paths:')
+        for id_map_class in [InodeIDMap, CompactInodeIDMap]:
+            _measure(id_map_class, tree)
+
+
+if __name__ == '__main__':
+    main()
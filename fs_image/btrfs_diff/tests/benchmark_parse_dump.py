@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+Measures the throughput of `parse_btrfs_dump`, first on the `--dump`
+output of the gold `demo_sendstreams`, and then on a large dump that
+repeats their lines, which needs neither `btrfs` nor root:
+
+  buck run fs_image/btrfs_diff:benchmark-parse-dump -- --num-items 1000000
+
+Like real dumps, the repeated lines mostly have `./SUBVOL/`-prefixed
+paths and recurring timestamps.
+'''
+import argparse
+import io
+import itertools
+import time
+
+from typing import Sequence
+
+from ..parse_dump import parse_btrfs_dump
+
+from .demo_sendstreams import gold_demo_sendstreams
+
+
+def _synthetic_dump(num_items: int) -> bytes:
+    first, *rest = gold_demo_sendstreams()['create_ops']['dump']
+    return b'\n'.join([
+        first, *itertools.islice(itertools.cycle(rest), num_items - 1),
+    ]) + b'\n'
+
+
+def _time_parse(name: str, dump: bytes, *, repeat: int) -> None:
+    best = float('inf')
+    for _ in range(repeat):
+        num_items = 0
+        start = time.perf_counter()
+        for _item in parse_btrfs_dump(io.BytesIO(dump)):
+            num_items += 1
+        best = min(best, time.perf_counter() - start)
+    print(
+        f'  {name:<15} {best:9.4f}s {len(dump) / best / 2 ** 20:9.1f} MB/s '
+        f'{num_items / best:12.0f} items/s'
+    )
+
+
+def _join_lines(lines: Sequence[bytes]) -> bytes:
+    return b'\n'.join(lines) + b'\n'
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    p.add_argument(
+        '--num-items', type=int, default=1000000,
+        help='Number of items in the synthetic dump. Pass 0 to only '
+            'benchmark the demo dumps.',
+    )
+    p.add_argument(
+        '--repeat', type=int, default=3,
+        help='Report the best time out of this many parses.',
+    )
+    args = p.parse_args(argv)
+
+    for name, d in gold_demo_sendstreams().items():
+        # The gold dumps are tiny, so repeat more to reduce noise.
+        _time_parse(name, _join_lines(d['dump']), repeat=100 * args.repeat)
+    if args.num_items:
+        _time_parse(
+            'synthetic', _synthetic_dump(args.num_items), repeat=args.repeat,
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+Measures the throughput of the send-stream parse modes, first on the gold
+`demo_sendstreams` fixtures, and then on a synthetic send-stream, which
+`write_send_stream` makes without needing `btrfs` or root.
+
+  buck run fs_image/btrfs_diff:benchmark-parse-send-stream -- --size-mb 4096
+
+The synthetic stream is mostly 48KB `write`s, like `btrfs send` emits for
+data-heavy layers, interspersed with the per-inode metadata commands.
+
+The `-crc` rows show the overhead of `check_crc=True`.  Our pure-Python
+CRC32C makes checksumming the synthetic stream slow, so it only gets
+CRCs, and `-crc` rows, when `--check-crc` is passed.
+'''
+import argparse
+import io
+import os
+import tempfile
+import time
+
+from typing import Callable, Iterable, Iterator
+
+from ..parse_send_stream import (
+    parse_send_stream, parse_send_stream_buffer, parse_send_stream_mmap,
+)
+from ..send_stream import SendStreamItem, SendStreamItems
+from ..write_send_stream import write_send_stream
+
+from .demo_sendstreams import gold_demo_sendstreams
+
+_WRITE_SIZE = 48 * 1024
+_FILE_SIZE = 16 * _WRITE_SIZE
+_FILES_PER_DIR = 100
+
+
+def gen_synthetic_items(size: int) -> Iterator[SendStreamItem]:
+    'Yields a subvolume whose `write` payloads add up to about `size` bytes'
+    di = SendStreamItems
+    yield di.subvol(
+        path=b'synthetic', uuid=b'5f6b1e1c-0000-4000-8000-000000000000',
+        transid=1,
+    )
+    data = b'\xa5' * _WRITE_SIZE
+    for file_idx in range((size + _FILE_SIZE - 1) // _FILE_SIZE):
+        dir_path = b'd%d' % (file_idx // _FILES_PER_DIR)
+        if file_idx % _FILES_PER_DIR == 0:
+            yield di.mkdir(path=dir_path)
+        path = dir_path + b'/f%d' % file_idx
+        yield di.mkfile(path=path)
+        yield di.set_xattr(
+            path=path, name=b'security.selinux',
+            data=b'system_u:object_r:unlabeled_t:s0\0',
+        )
+        for offset in range(0, _FILE_SIZE, _WRITE_SIZE):
+            yield di.write(path=path, offset=offset, data=data)
+        yield di.chown(path=path, uid=0, gid=0)
+        yield di.chmod(path=path, mode=0o644)
+        yield di.utimes(
+            path=path, atime=(1, 0), mtime=(1, 0), ctime=(1, 0),
+        )
+
+
+def _time_parse(
+    name: str, size: int, parse: Callable[[], Iterable[SendStreamItem]],
+    *, repeat: int,
+) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        num_items = 0
+        start = time.perf_counter()
+        for _item in parse():
+            num_items += 1
+        best = min(best, time.perf_counter() - start)
+    print(
+        f'  {name:<15} {best:9.4f}s {size / best / 2 ** 20:9.1f} MB/s '
+        f'{num_items / best:12.0f} items/s'
+    )
+    return best
+
+
+def _parse_file(path: str, parse_fn) -> Iterable[SendStreamItem]:
+    with open(path, 'rb') as infile:
+        yield from parse_fn(infile)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    p.add_argument(
+        '--size-mb', type=int, default=2048,
+        help='Approximate size of the synthetic send-stream. Pass 0 to only '
+            'benchmark the demo send-streams.',
+    )
+    p.add_argument(
+        '--repeat', type=int, default=3,
+        help='Report the best time out of this many parses.',
+    )
+    p.add_argument(
+        '--tempdir', help='Where to put the synthetic send-stream.',
+    )
+    p.add_argument(
+        '--check-crc', action='store_true',
+        help='Also measure `check_crc=True` on the synthetic send-stream.',
+    )
+    args = p.parse_args(argv)
+
+    for name, d in gold_demo_sendstreams().items():
+        sendstream = d['sendstream']
+        print(f'{name}: {len(sendstream)} bytes')
+        _time_parse(
+            'stream', len(sendstream),
+            lambda: parse_send_stream(io.BytesIO(sendstream)),
+            # The gold streams are tiny, so repeat more to reduce noise.
+            repeat=100 * args.repeat,
+        )
+        _time_parse(
+            'buffer', len(sendstream),
+            lambda: parse_send_stream_buffer(sendstream),
+            repeat=100 * args.repeat,
+        )
+        _time_parse(
+            'stream-crc', len(sendstream),
+            lambda: parse_send_stream(
+                io.BytesIO(sendstream), check_crc=True,
+            ),
+            repeat=100 * args.repeat,
+        )
+        _time_parse(
+            'buffer-crc', len(sendstream),
+            lambda: parse_send_stream_buffer(sendstream, check_crc=True),
+            repeat=100 * args.repeat,
+        )
+
+    if not args.size_mb:
+        return
+    with tempfile.NamedTemporaryFile(dir=args.tempdir) as tf:
+        write_send_stream(
+            tf, gen_synthetic_items(args.size_mb * 2 ** 20),
+            with_crc=args.check_crc,
+        )
+        tf.flush()
+        size = os.path.getsize(tf.name)
+        print(f'synthetic: {size} bytes')
+        _time_parse(
+            'stream', size,
+            lambda: _parse_file(tf.name, parse_send_stream),
+            repeat=args.repeat,
+        )
+        _time_parse(
+            'mmap', size,
+            lambda: _parse_file(tf.name, parse_send_stream_mmap),
+            repeat=args.repeat,
+        )
+        # `no_data` is what metadata-only consumers like `Subvolume` need.
+        _time_parse(
+            'stream-nodata', size,
+            lambda: _parse_file(
+                tf.name, lambda f: parse_send_stream(f, no_data=True),
+            ),
+            repeat=args.repeat,
+        )
+        _time_parse(
+            'mmap-nodata', size,
+            lambda: _parse_file(
+                tf.name, lambda f: parse_send_stream_mmap(f, no_data=True),
+            ),
+            repeat=args.repeat,
+        )
+        if args.check_crc:
+            # Checks the CRCs of all commands besides WRITE.
+            _time_parse(
+                'mmap-nodata-crc', size,
+                lambda: _parse_file(tf.name, lambda f: parse_send_stream_mmap(
+                    f, no_data=True, check_crc=True,
+                )),
+                repeat=args.repeat,
+            )
+            _time_parse(
+                'mmap-crc', size,
+                lambda: _parse_file(
+                    tf.name,
+                    lambda f: parse_send_stream_mmap(f, check_crc=True),
+                ),
+                repeat=args.repeat,
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+Runs the whole `btrfs_diff` pipeline on synthetic send-streams of growing
+size, see `synthetic_sendstreams.py`, and reports the time and the peak
+RSS of each stage:
+
+  buck run fs_image/btrfs_diff:benchmark-scaling -- 1000 10000 100000
+
+The stages are:
+  - `write`: `write_send_stream` of the synthetic items to a temp file,
+  - `parse`: `parse_send_stream(no_data=True)` of that file into a list,
+  - `apply`: `SubvolumeSetMutator.apply_item` of those items,
+  - `extents_to_chunks`: `extents_to_chunks_with_clones` of all files,
+  - `freeze`: `freeze` of the `SubvolumeSet`, which gets the `Chunk`s
+    from its `CloneIndex` instead,
+  - `render`: `Subvolume.render` with `emit_all_traversal_ids`.
+The throughput of every stage is given relative to the send-stream, in MB
+and in items per second, so the rows of different stages and sizes are
+comparable.
+
+Each size runs in a forked process, which starts with a fresh RSS high-water
+mark.  As the stages run in order, and keep their outputs, the `peak RSS`
+of a stage is the high-water mark through its end -- the increase over the
+previous row is the memory that the stage added.
+
+Pass `--json FILE` to append one JSON object per stage, which makes it easy
+to compare runs, e.g. before and after a change.
+'''
+import argparse
+import itertools
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import traceback
+
+from ..compact_inode_id import CompactInodeIDMap
+from ..extent import Extent
+from ..extents_to_chunks import extents_to_chunks_with_clones
+from ..flat_extent import FlatExtent
+from ..freeze import freeze
+from ..inode_id import InodeIDMap
+from ..parse_send_stream import parse_send_stream
+from ..rendered_tree import emit_all_traversal_ids
+from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
+from ..write_send_stream import write_send_stream
+
+from .synthetic_sendstreams import (
+    SyntheticSendStreamSpec, gen_synthetic_sendstream_items,
+)
+
+_EXTENT_CLASSES = {c.__name__: c for c in [Extent, FlatExtent]}
+_ID_MAP_CLASSES = {c.__name__: c for c in [InodeIDMap, CompactInodeIDMap]}
+
+
+def _peak_rss() -> int:
+    # Linux reports kilobytes.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _report(
+    spec: SyntheticSendStreamSpec, args, stage: str, seconds: float,
+    num_items: int, num_bytes: int,
+) -> None:
+    peak_rss = _peak_rss()
+    print(
+        f'  {stage:<18} {seconds:9.4f}s '
+        f'{num_bytes / seconds / 2 ** 20:9.1f} MB/s '
+        f'{num_items / seconds:12.0f} items/s '
+        f'{peak_rss / 2 ** 20:9.1f} MB peak RSS'
+    )
+    sys.stdout.flush()
+    if args.json:
+        with open(args.json, 'a') as outfile:
+            print(json.dumps({
+                'spec': spec._asdict(),
+                'extent_class': args.extent_class,
+                'id_map_class': args.id_map_class,
+                'stage': stage,
+                'seconds': seconds,
+                'stream_bytes': num_bytes,
+                'stream_items': num_items,
+                'peak_rss_bytes': peak_rss,
+            }, sort_keys=True), file=outfile)
+
+
+def _measure(spec: SyntheticSendStreamSpec, args) -> None:
+    num_items = 0
+
+    def count_items(items):
+        nonlocal num_items
+        for item in items:
+            num_items += 1
+            yield item
+
+    with tempfile.TemporaryFile(dir=args.tempdir) as tf:
+        start = time.perf_counter()
+        # Pure-Python CRCs would dominate, and `parse` does not check them.
+        write_send_stream(tf, count_items(
+            gen_synthetic_sendstream_items(spec),
+        ), with_crc=False)
+        seconds = time.perf_counter() - start
+        num_bytes = tf.tell()
+        print(
+            f'{spec.num_inodes} inodes: {num_items} items, '
+            f'{num_bytes / 2 ** 20:.1f} MB'
+        )
+
+        def report(stage, seconds):
+            _report(spec, args, stage, seconds, num_items, num_bytes)
+
+        report('write', seconds)
+
+        tf.seek(0)
+        start = time.perf_counter()
+        items = list(parse_send_stream(tf, no_data=True))
+        report('parse', time.perf_counter() - start)
+
+    start = time.perf_counter()
+    subvols = SubvolumeSet.new(
+        extent_class=_EXTENT_CLASSES[args.extent_class],
+        id_map_class=_ID_MAP_CLASSES[args.id_map_class],
+    )
+    mutator = SubvolumeSetMutator.new(subvols, items[0])
+    for item in itertools.islice(items, 1, None):
+        mutator.apply_item(item)
+    report('apply', time.perf_counter() - start)
+
+    start = time.perf_counter()
+    id_to_chunks = dict(extents_to_chunks_with_clones(
+        list(mutator.subvolume._inode_ids_and_extents()),
+    ))
+    report('extents_to_chunks', time.perf_counter() - start)
+    del id_to_chunks
+
+    start = time.perf_counter()
+    frozen = freeze(subvols)
+    report('freeze', time.perf_counter() - start)
+
+    start = time.perf_counter()
+    frozen.map(lambda sv: emit_all_traversal_ids(sv.render()))
+    report('render', time.perf_counter() - start)
+
+
+def _measure_in_child(spec: SyntheticSendStreamSpec, args) -> None:
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _measure(spec, args)
+        except BaseException:
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+    _, status = os.waitpid(pid, 0)
+    if status != 0:
+        raise RuntimeError(f'Benchmarking {spec} failed: {status}')
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    defaults = SyntheticSendStreamSpec()
+    p.add_argument(
+        'num_inodes', type=int, nargs='*', default=[1000, 10000, 100000],
+        help='How many inodes each synthetic send-stream creates.',
+    )
+    for field, help in [
+        ('fanout', 'The most entries in one directory.'),
+        ('hardlink_fraction', 'The fraction of files with a 2nd hardlink.'),
+        ('clone_fraction', 'The fraction of files that clone their data.'),
+        ('writes_per_file', 'How many `write`s each other file gets.'),
+        ('write_size', 'The size of each `write`.'),
+        ('fragmentation', 'The fraction of `write`s at random offsets.'),
+        ('seed', 'Seeds the random choices of the generator.'),
+    ]:
+        default = getattr(defaults, field)
+        p.add_argument(
+            '--' + field.replace('_', '-'), type=type(default),
+            default=default, help=help + ' Default: %(default)s',
+        )
+    p.add_argument(
+        '--extent-class', choices=sorted(_EXTENT_CLASSES), default='Extent',
+        help='The `SubvolumeSet.extent_class`. Default: %(default)s',
+    )
+    p.add_argument(
+        '--id-map-class', choices=sorted(_ID_MAP_CLASSES),
+        default='InodeIDMap',
+        help='The `SubvolumeSet.id_map_class`. Default: %(default)s',
+    )
+    p.add_argument(
+        '--tempdir', help='Where to put the synthetic send-streams.',
+    )
+    p.add_argument(
+        '--json', help='Append one JSON object per stage to this file.',
+    )
+    args = p.parse_args(argv)
+
+    for num_inodes in args.num_inodes:
+        _measure_in_child(SyntheticSendStreamSpec(
+            num_inodes=num_inodes,
+            fanout=args.fanout,
+            hardlink_fraction=args.hardlink_fraction,
+            clone_fraction=args.clone_fraction,
+            writes_per_file=args.writes_per_file,
+            write_size=args.write_size,
+            fragmentation=args.fragmentation,
+            seed=args.seed,
+        ), args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+Replays a chain of incremental send-streams -- each a snapshot of the
+previous subvolume, which then changes a few files -- with either
+`Subvolume.id_map` class:
+
+  buck run fs_image/btrfs_diff:benchmark-snapshots -- 10000 100
+
+With `InodeIDMap`, each snapshot `deepcopy`s the whole parent, while
+`CompactInodeIDMap` makes them copy-on-write, see `inode_table.py`.  We
+time the replay, and a separate run reports the memory held by the
+resulting `SubvolumeSet`.
+'''
+import argparse
+import time
+import tracemalloc
+
+from ..compact_inode_id import CompactInodeIDMap
+from ..inode_id import InodeIDMap
+from ..parse_dump import SendStreamItems
+from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
+
+_FILES_PER_DIR = 20
+_CHANGES_PER_SNAPSHOT = 10
+
+
+def _gen_items(num_files: int, num_snapshots: int):
+    si = SendStreamItems
+    paths = [
+        b'd%d/f%d' % (i // _FILES_PER_DIR, i) for i in range(num_files)
+    ]
+    yield si.subvol(path=b'0', uuid=b'0', transid=0)
+    for i in range(0, num_files, _FILES_PER_DIR):
+        yield si.mkdir(path=b'd%d' % (i // _FILES_PER_DIR))
+    for path in paths:
+        yield si.mkfile(path=path)
+        yield si.write(path=path, offset=0, data=b'x' * 100)
+    for n in range(1, num_snapshots + 1):
+        uuid = b'%d' % n
+        yield si.snapshot(
+            path=uuid, uuid=uuid, transid=n,
+            parent_uuid=b'%d' % (n - 1), parent_transid=n - 1,
+        )
+        for c in range(_CHANGES_PER_SNAPSHOT):
+            path = paths[(n * _CHANGES_PER_SNAPSHOT + c) % num_files]
+            yield si.write(path=path, offset=50, data=b'y' * 100)
+            yield si.chmod(path=path, mode=0o644)
+
+
+def _replay(id_map_class, items) -> SubvolumeSet:
+    subvols = SubvolumeSet.new(id_map_class=id_map_class)
+    for item in items:
+        if isinstance(item, (
+            SendStreamItems.subvol, SendStreamItems.snapshot,
+        )):
+            mutator = SubvolumeSetMutator.new(subvols, item)
+        else:
+            mutator.apply_item(item)
+    return subvols
+
+
+def _measure(id_map_class, items) -> None:
+    start = time.perf_counter()
+    _replay(id_map_class, items)
+    replay_time = time.perf_counter() - start
+
+    # `tracemalloc` slows things down a lot, so it gets a separate run.
+    tracemalloc.start()
+    subvols = _replay(id_map_class, items)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del subvols
+    print(
+        f'  {id_map_class.__name__:<18} replay {replay_time:7.2f}s  '
+        f'{size / 2 ** 20:7.1f} MB'
+    )
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    p.add_argument(
+        'num_files', type=int, nargs='?', default=10000,
+        help='How many files the first subvolume has.',
+    )
+    p.add_argument(
+        'num_snapshots', type=int, nargs='?', default=100,
+        help='How many snapshots to chain onto the first subvolume.',
+    )
+    args = p.parse_args(argv)
+
+    items = list(_gen_items(args.num_files, args.num_snapshots))
+    print(f'{args.num_files} files, {args.num_snapshots} snapshots:')
+    for id_map_class in [InodeIDMap, CompactInodeIDMap]:
+        _measure(id_map_class, items)
+
+
+if __name__ == '__main__':
+    main()
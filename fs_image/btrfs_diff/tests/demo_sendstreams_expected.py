@@ -23,7 +23,7 @@ from . import render_subvols
 from .subvolume_utils import InodeRepr
 
 from ..send_stream import (
-    get_frequency_of_selinux_xattrs, ItemFilters, SendStreamItem,
+    get_frequency_of_selinux_xattrs, ItemFilterPipeline, SendStreamItem,
     SendStreamItems,
 )
 
@@ -63,15 +63,11 @@ def get_filtered_and_expected_items(
     assert len(selinux_freqs) > 0  # Our `gold` has SELinux attrs
     max_name, _count = max(selinux_freqs.items(), key=lambda p: p[1])
     logging.info(f'This test ignores SELinux xattrs set to {max_name}')
-    filtered_items = items
-    filtered_items = ItemFilters.selinux_xattr(
-        filtered_items,
+    filtered_items = list(ItemFilterPipeline().selinux_xattr(
         discard_fn=lambda _path, ctx: ctx == max_name,
-    )
-    filtered_items = ItemFilters.normalize_utimes(
-        filtered_items, start_time=build_start_time, end_time=build_end_time,
-    )
-    filtered_items = list(filtered_items)
+    ).normalize_utimes(
+        start_time=build_start_time, end_time=build_end_time,
+    ).filter(items))
 
     # In theory we never create more than ~10 temp paths but there's no
     # harm in letting this just grow forever.
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+'''
+`demo_sendstreams.py` makes real send-streams, but needs root and btrfs,
+and they are tiny.  To see how our code scales, this makes send-streams of
+any size in pure Python:
+
+    with open('synthetic.sendstream', 'wb') as outfile:
+        write_send_stream(outfile, gen_synthetic_sendstream_items(
+            SyntheticSendStreamSpec(num_inodes=10 ** 5),
+        ))
+
+The items follow the order of `btrfs send`: each inode is created under
+a temporary `o<ino>-<gen>-0` name, renamed into place, gets its data, and
+finally its metadata.  The shape of the subvolume is set by the fields of
+`SyntheticSendStreamSpec`.  The output only depends on the spec, since the
+random choices come from its `seed`.
+'''
+import random
+
+from typing import Iterator, List, NamedTuple
+
+from ..send_stream import SendStreamItem, SendStreamItems
+
+_UUID = b'5f6b1e1c-0000-4000-8000-00000000000'  # Append one hex digit
+_TRANSID = 7
+_SELINUX_LABEL = b'system_u:object_r:unlabeled_t:s0\0'
+
+
+class SyntheticSendStreamSpec(NamedTuple):
+    # Directories and files, excluding the root and extra hardlinks.
+    num_inodes: int = 1000
+    # Each directory holds up to this many entries, two of which are
+    # directories, so the tree has a depth of about `log2(num_inodes /
+    # fanout)`.
+    fanout: int = 20
+    # The fraction of files that get a second hardlink in another directory.
+    hardlink_fraction: float = 0.05
+    # The fraction of files that `clone` all of their data from an earlier
+    # file, instead of getting `write`s.
+    clone_fraction: float = 0.1
+    # The data of the other files comes in this many `write`s ...
+    writes_per_file: int = 4
+    # ... of this many bytes each.
+    write_size: int = 4096
+    # The fraction of `write`s that land at a random offset within twice
+    # the file size, instead of after the previous one.  These leave holes
+    # and overwrite earlier data, which makes for many small extents.
+    fragmentation: float = 0.0
+    seed: int = 0
+    # Distinguishes the UUIDs of streams that go in one `SubvolumeSet`.
+    subvol_idx: int = 0
+
+
+def _gen_metadata(path: bytes, mode: int) -> Iterator[SendStreamItem]:
+    si = SendStreamItems
+    yield si.chown(path=path, uid=0, gid=0)
+    yield si.chmod(path=path, mode=mode)
+    yield si.utimes(path=path, atime=(1, 0), mtime=(1, 0), ctime=(1, 0))
+
+
+def gen_synthetic_sendstream_items(
+    spec: SyntheticSendStreamSpec,
+) -> Iterator[SendStreamItem]:
+    'Yields the items of a version 1 send-stream, see the module docblock.'
+    if spec.fanout < 3:
+        raise RuntimeError(f'{spec} needs a fanout of at least 3')
+    si = SendStreamItems
+    rng = random.Random(spec.seed)
+    uuid = _UUID + b'%x' % spec.subvol_idx
+    yield si.subvol(
+        path=b'synthetic%d' % spec.subvol_idx, uuid=uuid, transid=_TRANSID,
+    )
+    dirs: List[bytes] = [b'']  # The path prefixes of the directories
+    data_files: List[bytes] = []  # The sources for `clone`
+    for idx in range(spec.num_inodes):
+        # Entry `idx` goes in `dirs[idx // fanout]`.  Making the first two
+        # entries of each directory into directories ensures that it
+        # exists by then.
+        temp_path = b'o%d-%d-0' % (257 + idx, _TRANSID)
+        path = dirs[idx // spec.fanout] + b'e%d' % idx
+        if idx % spec.fanout < 2:
+            yield si.mkdir(path=temp_path)
+            yield si.rename(path=temp_path, dest=path)
+            dirs.append(path + b'/')
+            yield from _gen_metadata(path, 0o755)
+            continue
+
+        yield si.mkfile(path=temp_path)
+        yield si.rename(path=temp_path, dest=path)
+        if rng.random() < spec.hardlink_fraction:
+            yield si.link(
+                path=rng.choice(dirs) + b'l%d' % idx, dest=path,
+            )
+        yield si.set_xattr(
+            path=path, name=b'security.selinux', data=_SELINUX_LABEL,
+        )
+        file_size = spec.writes_per_file * spec.write_size
+        if data_files and rng.random() < spec.clone_fraction:
+            yield si.clone(
+                path=path, offset=0, len=file_size, from_uuid=uuid,
+                from_transid=_TRANSID, from_path=rng.choice(data_files),
+                clone_offset=0,
+            )
+        elif file_size:
+            data = b'%d' % (idx % 10) * spec.write_size
+            offset = 0
+            for _ in range(spec.writes_per_file):
+                if rng.random() < spec.fragmentation:
+                    offset = rng.randrange(2 * file_size)
+                yield si.write(path=path, offset=offset, data=data)
+                offset += spec.write_size
+            # Random offsets may have written past the nominal size.
+            yield si.truncate(path=path, size=file_size)
+            data_files.append(path)
+        yield from _gen_metadata(path, 0o644)
+    yield from _gen_metadata(b'.', 0o755)
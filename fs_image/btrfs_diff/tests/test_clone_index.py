@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import copy
+import itertools
+import unittest
+
+from io import BytesIO
+
+from ..clone_index import CloneIndex
+from ..compact_inode_id import CompactInodeIDMap
+from ..extent import Extent
+from ..extents_to_chunks import extents_to_chunks_with_clones
+from ..inode_id import InodeIDMap
+from ..parse_send_stream import parse_send_stream
+from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
+
+from .demo_sendstreams import gold_demo_sendstreams
+
+
+def _all_chunks(subvols: SubvolumeSet):
+    'The whole-filesystem pass that `CloneIndex` replaces.'
+    return dict(extents_to_chunks_with_clones(list(
+        itertools.chain.from_iterable(
+            sv._inode_ids_and_extents()
+                for sv in subvols.uuid_to_subvolume.values()
+        )
+    )))
+
+
+class CloneIndexTestCase(unittest.TestCase):
+
+    def test_incremental_updates(self):
+        id_map = InodeIDMap.new()
+        a, b, c = (
+            id_map.add_file(id_map.next(), p) for p in [b'a', b'b', b'c']
+        )
+        index = CloneIndex()
+
+        def check(id_to_extent):
+            expected = dict(extents_to_chunks_with_clones(
+                list(id_to_extent.items())
+            ))
+            self.assertEqual(expected, index.id_to_chunks())
+            for ino_id, chunks in expected.items():
+                self.assertEqual(chunks, index.chunks(ino_id))
+
+        a_ext = Extent.empty().write(offset=0, length=10)
+        index.update(a, a_ext)
+        b_ext = Extent.empty().clone(
+            to_offset=0, from_extent=a_ext, from_offset=2, length=5,
+        )
+        index.update(b, b_ext)
+        c_ext = Extent.empty().write(offset=0, length=3)
+        index.update(c, c_ext)
+        check({a: a_ext, b: b_ext, c: c_ext})
+
+        # `c` has no clones, so changing it leaves the others' cache alone.
+        a_chunks = index.chunks(a)
+        c_ext = c_ext.clone(
+            to_offset=3, from_extent=c_ext, from_offset=0, length=3,
+        )
+        index.update(c, c_ext)
+        self.assertIs(a_chunks, index.chunks(a))
+        check({a: a_ext, b: b_ext, c: c_ext})
+
+        # Cloning into `c` adds it to the group of `a` & `b`.
+        c_ext = c_ext.clone(
+            to_offset=0, from_extent=b_ext, from_offset=0, length=2,
+        )
+        index.update(c, c_ext)
+        self.assertIsNot(a_chunks, index.chunks(a))
+        check({a: a_ext, b: b_ext, c: c_ext})
+
+        # Overwriting the shared part of `b` removes its clones of `a`.
+        b_ext = b_ext.write(offset=0, length=5)
+        index.update(b, b_ext)
+        check({a: a_ext, b: b_ext, c: c_ext})
+
+        # Several updates before a query are applied together.  Also, a
+        # copy made with updates pending applies them correctly, since the
+        # leaves are not copied.
+        index.update(a, None)
+        index.update(c, c_ext.truncate(length=1))
+        index.update(c, c_ext)
+        index_copy = copy.deepcopy(index)
+        check({b: b_ext, c: c_ext})
+        self.assertEqual(*[
+            {
+                repr(ino_id): [
+                    (c.kind, c.length, sorted(map(repr, c.chunk_clones)))
+                        for c in chunks
+                ] for ino_id, chunks in i.id_to_chunks().items()
+            } for i in [index, index_copy]
+        ])
+
+        with self.assertRaises(KeyError):
+            index.chunks(a)
+
+    def test_gold_sendstreams(self):
+        'After every item, the index must agree with a whole-set pass.'
+        for id_map_class in [InodeIDMap, CompactInodeIDMap]:
+            self._check_gold_sendstreams(SubvolumeSet.new(
+                id_map_class=id_map_class,
+            ))
+
+    def _check_gold_sendstreams(self, subvols):
+        for name in ['create_ops', 'mutate_ops']:
+            sendstream = gold_demo_sendstreams()[name]['sendstream']
+            parsed = parse_send_stream(BytesIO(sendstream))
+            mutator = SubvolumeSetMutator.new(subvols, next(parsed))
+            self.assertEqual(
+                _all_chunks(subvols), subvols.clone_index.id_to_chunks(),
+            )
+            for item in parsed:
+                mutator.apply_item(item)
+                self.assertEqual(
+                    _all_chunks(subvols), subvols.clone_index.id_to_chunks(),
+                    item,
+                )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import random
+import unittest
+
+from ..compact_inode_id import CompactInodeIDMap
+from ..freeze import freeze
+from ..inode_id import InodeIDMap
+from ..rendered_tree import emit_all_traversal_ids
+from ..subvolume_set import SubvolumeSet
+
+from .deepcopy_test import DeepCopyTestCase
+from .demo_sendstreams import gold_demo_sendstreams
+from .render_subvols import add_sendstream_to_subvol_set
+
+_PATHS = [
+    b'/'.join(p) for p in [
+        (a,) for a in [b'a', b'b', b'c']
+    ] + [
+        (a, b) for a in [b'a', b'b'] for b in [b'a', b'x']
+    ] + [(b'a', b'x', b'y')]
+] + [b'.']
+
+
+def _describe(id_map, ino_ids):
+    'Everything that the public API says about `id_map`.'
+    return (
+        [
+            (
+                ino_id.id, sorted(id_map.get_paths(ino_id)),
+                _result(lambda: id_map.get_children(ino_id)),
+                repr(ino_id),
+            ) for ino_id in ino_ids
+        ],
+        [_result(lambda: _id(id_map.get_id(p))) for p in _PATHS],
+    )
+
+
+def _apply(id_map, ino_ids, op, path, dest, idx):
+    if op == 'remove':
+        return id_map.remove_path(path).id
+    if op == 'rename':
+        return id_map.rename_path(path, dest)
+    if idx < 0 or not ino_ids:
+        ino_ids.append(id_map.next())
+    add = id_map.add_file if op == 'file' else id_map.add_dir
+    return add(ino_ids[idx % len(ino_ids)], path).id
+
+
+def _id(ino_id):
+    return None if ino_id is None else ino_id.id
+
+
+def _result(fn):
+    try:
+        return fn()
+    except Exception as ex:
+        return type(ex), str(ex)
+
+
+class CompactInodeIDMapTestCase(DeepCopyTestCase):
+
+    def test_matches_inode_id_map(self):
+        'Random ops must have the same results & errors with either map.'
+        rng = random.Random(5)
+        for _ in range(100):
+            maps_and_ids = [
+                (cls.new(description='d'), [])
+                    for cls in [InodeIDMap, CompactInodeIDMap]
+            ]
+            for _ in range(40):
+                op = rng.choice(['file', 'dir', 'remove', 'rename'])
+                path, dest = rng.choice(_PATHS), rng.choice(_PATHS)
+                # Sometimes, make a new inode, otherwise add a hardlink.
+                idx = rng.randrange(-1, 5)
+                self.assertEqual(*[
+                    (
+                        _result(lambda: _apply(
+                            id_map, ino_ids, op, path, dest, idx,
+                        )),
+                        _describe(id_map, ino_ids),
+                    ) for id_map, ino_ids in maps_and_ids
+                ])
+            self.assertEqual(*[
+                _describe(freeze(id_map, _memo=memo), [
+                    freeze(i, _memo=memo) for i in ino_ids
+                ]) for id_map, ino_ids in maps_and_ids for memo in [{}]
+            ])
+
+    def _check_compact_map(self):
+        'Also see `test_inode_id.py`, this checks the map-specific bits.'
+        id_map = yield 'empty', CompactInodeIDMap.new(description='desc')
+        root = id_map.get_id(b'.')
+        self.assertEqual('desc@.', repr(root))
+        self.assertEqual(set(), id_map.get_children(root))
+
+        a = id_map.add_dir(id_map.next(), b'a')
+        f = id_map.add_file(id_map.next(), b'a/f')
+        id_map.add_file(f, b'a/g')
+        id_map.add_file(f, b'h')
+        id_map = yield 'made a & f', id_map
+        root, a, f = (id_map.get_id(p) for p in [b'.', b'a', b'a/f'])
+        self.assertIs(f, id_map.get_id(b'h'))
+        self.assertEqual({b'a/f', b'a/g', b'h'}, id_map.get_paths(f))
+        self.assertEqual({b'a/f', b'a/g'}, id_map.get_children(a))
+        self.assertIsNone(id_map.get_children(f))
+        self.assertEqual({b'a', b'h'}, id_map.get_children(root))
+
+        # Remove the first link, then an extra one.
+        self.assertIs(f, id_map.remove_path(b'a/f'))
+        self.assertEqual({b'a/g', b'h'}, id_map.get_paths(f))
+        self.assertIs(f, id_map.remove_path(b'h'))
+        self.assertEqual({b'a/g'}, id_map.get_paths(f))
+        id_map = yield 'removed links', id_map
+        a, f = (id_map.get_id(p) for p in [b'a', b'a/g'])
+
+        id_map.add_dir(id_map.next(), b'a/d')
+        id_map.add_file(id_map.next(), b'a/d/e')
+        id_map.rename_path(b'a', b'b')
+        self.assertEqual({b'b/d/e'}, id_map.get_paths(id_map.get_id(b'b/d/e')))
+        self.assertEqual({b'b/d', b'b/g'}, id_map.get_children(a))
+        id_map = yield 'renamed a', id_map
+
+        with self.assertRaisesRegex(
+            RuntimeError, '^Tried to add non-file hardlink for desc@b/d$',
+        ):
+            id_map.add_dir(id_map.get_id(b'b/d'), b'c')
+        with self.assertRaisesRegex(
+            RuntimeError, '^Tried to add non-file hardlink for desc@b/g$',
+        ):
+            id_map.add_dir(id_map.get_id(b'b/g'), b'c')
+        with self.assertRaisesRegex(RuntimeError, 'Wrong map for InodeID #'):
+            id_map.add_file(InodeIDMap.new().next(), b'c')
+        self.assertEqual(
+            {b'b/d', b'b/g'}, id_map.get_children(id_map.get_id(b'b')),
+        )
+
+        frozen = freeze(id_map)
+        self.assertIsNone(frozen.inode_id_counter)
+        with self.assertRaisesRegex(TypeError, 'Cannot change a frozen '):
+            frozen.remove_path(b'b/g')
+        with self.assertRaisesRegex(TypeError, 'Cannot change a frozen '):
+            frozen.add_file(frozen.get_id(b'b/g'), b'c')
+        self.assertEqual({b'b/d', b'b/g'}, frozen.get_children(
+            frozen.get_id(b'b'),
+        ))
+        self.assertEqual({b'b/g'}, frozen.get_paths(frozen.get_id(b'b/g')))
+        id_map.remove_path(b'b/g')  # Does not affect `frozen`
+        self.assertEqual({b'b/g'}, frozen.get_paths(frozen.get_id(b'b/g')))
+        self.assertEqual('desc@b/d/e', repr(freeze(id_map.get_id(b'b/d/e'))))
+
+    def test_compact_map(self):
+        self.check_deepcopy_at_each_step(self._check_compact_map)
+
+    def test_get_children_without_paths(self):
+        for id_map_class in [InodeIDMap, CompactInodeIDMap]:
+            id_map = id_map_class.new(description='desc')
+            d = id_map.add_dir(id_map.next(), b'a')
+            f = id_map.add_file(id_map.next(), b'a/f')
+            id_map.remove_path(b'a/f')
+            id_map.remove_path(b'a')
+            for ino_id in [d, f, id_map.next()]:
+                with self.assertRaisesRegex(
+                    ValueError, f'^desc@ANON_INODE#{ino_id.id} has no paths$',
+                ):
+                    id_map.get_children(ino_id)
+
+    def test_snapshot(self):
+        id_map = CompactInodeIDMap.new(description='orig')
+        id_map.add_dir(id_map.next(), b'a')
+        id_map.add_file(id_map.next(), b'a/f')
+        snap = id_map.snapshot(description='snap')
+        self.assertEqual('snap@a/f', repr(snap.get_id(b'a/f')))
+        self.assertEqual('orig@a/f', repr(id_map.get_id(b'a/f')))
+        # Both maps issue the same inode numbers next.
+        self.assertEqual(3, snap.next().id)
+        self.assertEqual(3, id_map.next().id)
+
+        # Changes to one map do not affect the other.
+        snap.rename_path(b'a/f', b'g')
+        id_map.add_file(id_map.next(), b'a/h')
+        self.assertEqual({b'a/f', b'a/h'}, id_map.get_children(
+            id_map.get_id(b'a'),
+        ))
+        self.assertEqual(set(), snap.get_children(snap.get_id(b'a')))
+        self.assertEqual({b'a', b'g'}, snap.get_children(snap.get_id(b'.')))
+        self.assertEqual({b'a'}, id_map.get_children(id_map.get_id(b'.')))
+        with self.assertRaisesRegex(RuntimeError, 'Wrong map for InodeID #'):
+            snap.add_file(id_map.next(), b'c')
+
+    def test_interned_names(self):
+        id_map = CompactInodeIDMap.new()
+        for d in [b'a', b'b']:
+            id_map.add_dir(id_map.next(), d)
+            # Make a new `bytes` object for each path
+            id_map.add_file(id_map.next(), d + b'/' + b'name'.upper().lower())
+        (a_name,), (b_name,) = (
+            id_map.inner.id_to_children.items[id_map.get_id(d).id]
+                for d in [b'a', b'b']
+        )
+        self.assertIs(a_name, b_name)
+
+    def test_subvolume_set(self):
+        'The demo send-streams render the same with either map.'
+        renders = []
+        for id_map_class in [InodeIDMap, CompactInodeIDMap]:
+            subvols = SubvolumeSet.new(id_map_class=id_map_class)
+            for d in gold_demo_sendstreams().values():
+                subvol = add_sendstream_to_subvol_set(subvols, d['sendstream'])
+                self.assertIsInstance(subvol.id_map, id_map_class)
+            renders.append(freeze(subvols).map(
+                lambda sv: emit_all_traversal_ids(sv.render())
+            ))
+        self.assertEqual(*renders)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+
+from ..cow_list import CowDict, CowList
+
+
+class CowListTestCase(unittest.TestCase):
+
+    def test_snapshot(self):
+        orig = CowList()
+        orig.grow(3, 'x')
+        orig.grow(2, 'y')  # No-op, `orig` is already long enough
+        orig.set(1, 'a')
+        self.assertEqual(['x', 'a', 'x'], orig.items)
+        self.assertEqual(3, len(orig))
+
+        snap = orig.snapshot()
+        self.assertIs(orig.items, snap.items)
+
+        # The first write to either list un-shares the storage.
+        snap.set(0, 'b')
+        self.assertEqual(['x', 'a', 'x'], orig.items)
+        self.assertEqual(['b', 'a', 'x'], snap.items)
+        snap_items = snap.items
+        snap.set(2, 'c')  # No more copies
+        self.assertIs(snap_items, snap.items)
+
+        orig.grow(4, 'z')
+        self.assertEqual(['x', 'a', 'x', 'z'], orig.items)
+        self.assertEqual(['b', 'a', 'c'], snap.items)
+
+        # Without `copy_item`, mutable items stay shared.
+        orig.set(0, [])
+        orig.snapshot().get_mutable(0).append(1)
+        self.assertEqual([1], orig.items[0])
+
+    def test_get_mutable(self):
+        orig = CowList(copy_item=list.copy)
+        orig.grow(2, None)
+        orig.set(0, [1])
+        orig.set(1, [2])
+        first = orig.items[0]
+        # Before the first snapshot, nothing is copied.
+        self.assertIs(first, orig.get_mutable(0))
+
+        snap = orig.snapshot()
+        snap_first = snap.get_mutable(0)
+        snap_first.append(3)
+        self.assertIsNot(first, snap_first)
+        self.assertIs(snap_first, snap.get_mutable(0))  # Copied only once
+        self.assertEqual([[1], [2]], orig.items)
+        self.assertEqual([[1, 3], [2]], snap.items)
+
+        # The parent must copy, too, since the snapshot may share the item.
+        orig_second = orig.get_mutable(1)
+        orig_second.append(4)
+        self.assertEqual([[1], [2, 4]], orig.items)
+        self.assertEqual([[1, 3], [2]], snap.items)
+
+        # An item given to `set` is not copied again.
+        new = [5]
+        snap.set(1, new)
+        self.assertIs(new, snap.get_mutable(1))
+
+        # Another snapshot makes all the items shared again.
+        snap2 = snap.snapshot()
+        self.assertIsNot(new, snap.get_mutable(1))
+        self.assertIs(new, snap2.items[1])
+
+    def test_cow_dict(self):
+        orig = CowDict(a=1)
+        orig['b'] = 2
+        self.assertEqual({'a': 1, 'b': 2}, orig)
+        self.assertEqual("CowDict({'a': 1, 'b': 2})", repr(orig))
+
+        snap = orig.snapshot()
+        self.assertIs(orig._dict, snap._dict)
+        # Reads, and pops of missing keys, do not un-share the storage.
+        self.assertEqual((1, None, 3), (
+            snap['a'], snap.get('c'), snap.pop('c', 3),
+        ))
+        with self.assertRaises(KeyError):
+            snap.pop('c')
+        self.assertIs(orig._dict, snap._dict)
+
+        # The first write to either dict does.
+        self.assertEqual(1, snap.pop('a'))
+        snap_dict = snap._dict
+        snap['c'] = 3
+        self.assertIs(snap_dict, snap._dict)  # No more copies
+        del orig['b']
+        self.assertEqual({'a': 1}, orig)
+        self.assertEqual({'b': 2, 'c': 3}, snap)
+        self.assertEqual(['b', 'c'], sorted(snap))
+        self.assertIn('c', snap)
+        self.assertEqual(2, len(snap))
+
+        # `clear` does not copy, nor affect other snapshots.
+        snap2 = snap.snapshot()
+        snap.clear()
+        self.assertEqual({}, snap)
+        self.assertEqual({'b': 2, 'c': 3}, snap2)
+        snap['d'] = 4
+        self.assertEqual({'b': 2, 'c': 3}, snap2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+
+from ..crc32c import _crc32c_bytewise, crc32c
+
+
+class Crc32cTestCase(unittest.TestCase):
+
+    def test_check_value(self):
+        # The standard CRC32C check value, after undoing inversions.
+        self.assertEqual(
+            0xe3069283, crc32c(b'123456789', 0xffffffff) ^ 0xffffffff,
+        )
+        self.assertEqual(0, crc32c(b''))
+
+    def test_slice_by_8(self):
+        data = bytes((i * 97 + 13) & 0xff for i in range(1000))
+        # Cover every alignment of the 8-byte words and the tail.
+        for size in range(17):
+            for s in [data[:size], data[size:]]:
+                expected = _crc32c_bytewise(s, 0)
+                self.assertEqual(expected, crc32c(s))
+                self.assertEqual(expected, crc32c(memoryview(s)))
+                self.assertEqual(
+                    expected, crc32c(s[size:], crc32c(s[:size])),
+                )
+
+
+if __name__ == '__main__':
+    unittest.main()
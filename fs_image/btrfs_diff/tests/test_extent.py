@@ -394,6 +394,16 @@ class ExtentTestCase(unittest.TestCase):
             e.truncate(length=11),
         )
 
+    def test_punch_hole(self):
+        e = Extent.empty().write(offset=0, length=5)
+        self.assertEqual('d1h2d2', repr(e.punch_hole(offset=1, length=2)))
+        self.assertEqual('d5h3', repr(e.punch_hole(offset=6, length=2)))
+        holey = e.punch_hole(offset=3, length=4)
+        self.assertEqual('d3h4', repr(holey))
+        # The remaining data is still the original leaf.
+        (_, _, leaf), = e.gen_trimmed_leaves()
+        self.assertIs(leaf, next(holey.gen_trimmed_leaves())[2])
+
     # A cute demonstration that while different orders of operations produce
     # different nestings, `gen_trimmed_leaves` restores commutativity.
     #
@@ -471,6 +481,22 @@ class ExtentTestCase(unittest.TestCase):
         self.assertEqual('', repr(Extent.empty()))
         self.assertEqual([], list(Extent.empty().gen_trimmed_leaves()))
 
+    def test_from_trimmed_leaves(self):
+        source = Extent.empty().write(offset=2, length=4)
+        e = Extent.empty().write(offset=0, length=9).truncate(length=12) \
+            .clone(to_offset=3, from_extent=source, from_offset=1, length=4)
+        leaves = list(e.gen_trimmed_leaves())
+        restored = Extent.from_trimmed_leaves(leaves)
+        self.assertEqual('d3h1d5h3', repr(restored))
+        self.assertEqual(leaves, list(restored.gen_trimmed_leaves()))
+        for a, b in zip(leaves, restored.gen_trimmed_leaves()):
+            self.assertIs(a[2], b[2])
+        self.assertEqual(
+            list(e.gen_trimmed_leaves(offset=3, length=2)),
+            list(restored.gen_trimmed_leaves(offset=3, length=2)),
+        )
+        self.assertEqual(Extent.empty(), Extent.from_trimmed_leaves([]))
+
     def test_copy(self):
         e = Extent.empty().write(offset=5, length=5)
         self.assertIs(e, copy.deepcopy(e))
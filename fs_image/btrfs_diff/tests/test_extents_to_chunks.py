@@ -10,12 +10,15 @@ import re
 import textwrap
 import unittest
 
-from typing import Iterable, Tuple
+from collections import defaultdict
+from typing import Iterable, Sequence, Tuple
 
 from ..extent import Extent
-from ..inode import Chunk
+from ..inode import Chunk, ChunkClone, Clone
 from ..inode_id import InodeID, InodeIDMap
-from ..extents_to_chunks import extents_to_chunks_with_clones
+from ..extents_to_chunks import (
+    extents_to_chunks_with_clones, extents_to_chunks_with_shared_extents,
+)
 
 # `unittest`'s output shortening makes tests much harder to debug.
 unittest.util._MAX_LENGTH = 12345
@@ -50,6 +53,60 @@ def _repr_ids_and_chunks(ids_and_chunks: Iterable[Tuple[InodeID, Chunk]]):
     }
 
 
+def _repr_ids_and_shared_extents(
+    ids_and_chunks: Iterable[Tuple[InodeID, Chunk]],
+):
+    return {
+        repr(id): [
+            (
+                f'{c.kind.name}/{c.length}',
+                [repr(se) for se in c.shared_extents],
+            ) for c in chunks
+        ] for id, chunks in ids_and_chunks
+    }
+
+
+def _shared_extents_to_chunk_clones(
+    ids_and_chunks: Iterable[Tuple[InodeID, Sequence[Chunk]]],
+):
+    '''
+    Expands `SharedExtent`s into the quadratic `ChunkClone` representation
+    by brute force, comparing every pair of references to the same extent.
+    '''
+    nonce_to_refs = defaultdict(list)
+    result = []
+    for ino_id, chunks in ids_and_chunks:
+        new_chunks = []
+        file_offset = 0
+        for c in chunks:
+            assert not c.chunk_clones
+            new_chunks.append(Chunk(
+                kind=c.kind, length=c.length, chunk_clones=set(),
+            ))
+            for se in c.shared_extents:
+                nonce_to_refs[se.extent_nonce].append(
+                    (ino_id, file_offset, se, new_chunks[-1].chunk_clones),
+                )
+            file_offset += c.length
+        result.append((ino_id, new_chunks))
+    for refs in nonce_to_refs.values():
+        for (_, _, a, a_clones), (b_id, b_offset, b, _) in (
+            itertools.permutations(refs, 2)
+        ):
+            start = max(a.extent_offset, b.extent_offset)
+            end = min(a.extent_offset + a.length, b.extent_offset + b.length)
+            if start < end:
+                a_clones.add(ChunkClone(
+                    offset=a.offset + start - a.extent_offset,
+                    clone=Clone(
+                        inode_id=b_id,
+                        offset=b_offset + b.offset + start - b.extent_offset,
+                        length=end - start,
+                    ),
+                ))
+    return result
+
+
 class ExtentsToChunksTestCase(unittest.TestCase):
     '''
     This test has one main focus, plus a few additional checks.
@@ -177,10 +234,29 @@ class ExtentsToChunksTestCase(unittest.TestCase):
                 file_extent,
             )
 
+    def _repr_chunks(self, ids_and_extents):
+        repr_chunks = _repr_ids_and_chunks(
+            extents_to_chunks_with_clones(ids_and_extents),
+        )
+        # `SharedExtent`s must describe exactly the same clones.
+        self.assertEqual(repr_chunks, _repr_ids_and_chunks(
+            _shared_extents_to_chunk_clones(
+                extents_to_chunks_with_shared_extents(ids_and_extents),
+            ),
+        ))
+        return repr_chunks
+
     def _repr_chunks_from_figure(self, s, **kwargs):
-        return _repr_ids_and_chunks(extents_to_chunks_with_clones(list(
+        return self._repr_chunks(list(
             self._gen_ids_and_extents_from_figure(s, **kwargs)
-        )))
+        ))
+
+    def _repr_shared_extents_from_figure(self, s, **kwargs):
+        return _repr_ids_and_shared_extents(
+            extents_to_chunks_with_shared_extents(list(
+                self._gen_ids_and_extents_from_figure(s, **kwargs)
+            )),
+        )
 
     def test_gen_ranges_from_figure(self):
         self.assertEqual(
@@ -462,14 +538,14 @@ class ExtentsToChunksTestCase(unittest.TestCase):
         # files, let's make sure the clone detection does the right thing.
         # Also add an empty file to make sure that corner case works.
 
-        ids_and_chunks = list(extents_to_chunks_with_clones([
+        repr_chunks = self._repr_chunks([
             (self.id_map.add_file(self.id_map.next(), p), e) for p, e in [
                 (b'a', a),
                 (b'b', b),
                 (b'c', c),
                 (b'e', Extent.empty()),
             ]
-        ]))
+        ])
 
         # I iteratively built this up from the "trimmed leaves" data above,
         # and checked against the real output, one file at a time.  So, this
@@ -567,7 +643,54 @@ class ExtentsToChunksTestCase(unittest.TestCase):
                 }),
             ],
             'e': [],
-        }, _repr_ids_and_chunks(ids_and_chunks))
+        }, repr_chunks)
+
+    def test_shared_extents_docblock_example(self):
+        for kwargs in [{}, {'extent_left': 5, 'extent_right': 7}]:
+            self.id_map = InodeIDMap.new()
+            self.assertEqual({
+                'A': [('DATA/6', ['#0:0+3@0', '#0:6+3@3'])],
+                'B': [('DATA/5', ['#0:1+5@0'])],
+                'C': [('DATA/5', ['#0:3+5@0'])],
+            }, self._repr_shared_extents_from_figure('''
+                 BBBBBAAA
+                AAACCCCC
+                0123456789
+            ''', **kwargs))
+
+    def test_shared_extents_skip_unshared_bytes(self):
+        # The `extent_offset`s skip the bytes that no two files share, and
+        # files without clones get no `SharedExtent`s.
+        hole = ('HOLE/3', [])
+        self.assertEqual({
+            'a': [hole, ('DATA/2', ['#0:0+2@0'])],
+            'b': [hole, ('DATA/3', ['#0:3+3@0'])],
+            'c': [hole, ('DATA/2', ['#0:1+2@0'])],
+            'd': [hole, ('DATA/2', ['#0:4+2@0'])],
+            'e': [hole, ('DATA/2', [])],
+        }, self._repr_shared_extents_from_figure('''
+            aa   bbb ee
+             cc   dd
+            0123456789
+        ''', extent_left=4, slice_spacing=3))
+
+    def test_shared_extents_merge_into_chunk(self):
+        # `a` is 3 clones of the same bytes, so its only `Chunk` has 3
+        # `SharedExtent`s with the same extent range at different offsets.
+        e = Extent.empty().write(offset=0, length=2)
+        a = e
+        for _ in range(2):
+            a = a.clone(
+                to_offset=a.length, from_extent=e, from_offset=0, length=2,
+            )
+        self.assertEqual(
+            {'a': [('DATA/6', ['#0:0+2@0', '#0:0+2@2', '#0:0+2@4'])]},
+            _repr_ids_and_shared_extents(
+                extents_to_chunks_with_shared_extents([
+                    (self.id_map.add_file(self.id_map.next(), b'a'), a),
+                ]),
+            ),
+        )
 
 
 if __name__ == '__main__':
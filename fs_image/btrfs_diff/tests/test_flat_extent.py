@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import copy
+import random
+import sys
+import unittest
+
+from ..extent import Extent
+from ..extents_to_chunks import extents_to_chunks_with_clones
+from ..flat_extent import FlatExtent
+from ..freeze import freeze
+from ..inode_id import InodeIDMap
+from ..rendered_tree import emit_all_traversal_ids
+from ..subvolume_set import SubvolumeSet
+
+from .demo_sendstreams import gold_demo_sendstreams
+from .render_subvols import add_sendstream_to_subvol_set
+
+
+def _apply_random_ops(rng: random.Random, num_files: int, num_ops: int):
+    '''
+    Applies the same random sequence of ops to files of both backends.
+    Returns `{backend: [extent of each file]}`.
+    '''
+    backend_to_extents = {
+        cls: [cls.empty() for _ in range(num_files)]
+            for cls in [Extent, FlatExtent]
+    }
+    for _ in range(num_ops):
+        to_idx = rng.randrange(num_files)
+        from_idx = rng.randrange(num_files)
+        from_len = backend_to_extents[Extent][from_idx].length
+        op = rng.choice(['write', 'punch_hole', 'truncate', 'clone'])
+        if op in ('write', 'punch_hole'):
+            kwargs = {
+                'offset': rng.randrange(40), 'length': rng.randrange(1, 15),
+            }
+        elif op == 'truncate':
+            kwargs = {'length': rng.randrange(50)}
+        elif from_len == 0:
+            continue
+        else:
+            from_offset = rng.randrange(from_len)
+            kwargs = {
+                'to_offset': rng.randrange(40),
+                'from_offset': from_offset,
+                'length': rng.randrange(1, from_len - from_offset + 1),
+            }
+        for extents in backend_to_extents.values():
+            if op == 'clone':
+                kwargs['from_extent'] = extents[from_idx]
+            extents[to_idx] = getattr(extents[to_idx], op)(**kwargs)
+    return backend_to_extents
+
+
+class FlatExtentTestCase(unittest.TestCase):
+
+    def test_matches_extent(self):
+        'Both backends must produce the same leaves, and thus clones.'
+        rng = random.Random(7)
+        id_map = InodeIDMap.new()
+        ids = [id_map.add_file(id_map.next(), b'f%d' % i) for i in range(3)]
+        for _ in range(200):
+            results = []
+            for extents in _apply_random_ops(rng, 3, 30).values():
+                results.append((
+                    [repr(e) for e in extents],
+                    [e.length for e in extents],
+                    # Leaf identities differ between the backends.
+                    [
+                        [
+                            (o, l, leaf.content) for o, l, leaf in
+                                e.gen_trimmed_leaves(
+                                    offset=1, length=e.length - 1,
+                                )
+                        ] if e.length > 1 else [] for e in extents
+                    ],
+                    dict(extents_to_chunks_with_clones(list(zip(
+                        ids, extents,
+                    )))),
+                ))
+            self.assertEqual(*results)
+
+    def test_preserves_leaf_identity(self):
+        data = FlatExtent.empty().write(offset=0, length=10)
+        (_, _, leaf), = data.gen_trimmed_leaves()
+        self.assertEqual(Extent(Extent.Kind.DATA, 0, 10), leaf)
+        # The overwrite cuts the leaf, but keeps its identity.
+        e = data.write(offset=3, length=2)
+        self.assertEqual('d10', repr(e))
+        (o1, l1, a), (_, _, new), (o2, l2, b) = e.gen_trimmed_leaves()
+        self.assertEqual([(0, 3), (5, 5)], [(o1, l1), (o2, l2)])
+        self.assertIs(leaf, a)
+        self.assertIs(leaf, b)
+        self.assertIsNot(leaf, new)
+        # Earlier versions are unaffected.
+        self.assertEqual([(0, 10, leaf)], list(data.gen_trimmed_leaves()))
+
+        # Cloning from an `Extent` keeps its leaves, too.
+        source = Extent.empty().write(offset=2, length=4)
+        (_, _, hole), (_, _, source_leaf) = source.gen_trimmed_leaves()
+        e = e.clone(to_offset=12, from_extent=source, from_offset=1, length=4)
+        self.assertEqual('d10h3d3', repr(e))
+        self.assertEqual(
+            [(1, 1, hole), (0, 3, source_leaf)],
+            [
+                t for t in e.gen_trimmed_leaves()
+                    if t[2] is hole or t[2] is source_leaf
+            ],
+        )
+        self.assertEqual(
+            [(1, 1, hole), (0, 2, source_leaf)],
+            list(e.gen_trimmed_leaves(offset=12, length=3)),
+        )
+
+    def test_truncate(self):
+        e = FlatExtent.empty().write(offset=3, length=7)
+        for i in range(1, 10):
+            self.assertEqual(i, e.truncate(length=i).length)
+            self.assertEqual(
+                [l for _, l, _ in e.gen_trimmed_leaves(length=i)],
+                [l for _, l, _ in e.truncate(length=i).gen_trimmed_leaves()],
+            )
+        self.assertEqual('h3d7h1', repr(e.truncate(length=11)))
+        self.assertEqual('', repr(e.truncate(length=0)))
+
+    # `Extent` needed an explicit stack for this, while the treap stays
+    # shallow on its own.
+    def test_many_writes(self):
+        n = 10 * sys.getrecursionlimit()
+        e = FlatExtent.empty()
+        for i in reversed(range(n)):
+            e = e.write(offset=2 * i + 1, length=1)
+        self.assertEqual('h1d1' * n, repr(e))
+
+    def test_subvolume_set(self):
+        'The demo send-streams render the same with either backend.'
+        renders = []
+        for extent_class in [Extent, FlatExtent]:
+            subvols = SubvolumeSet.new(extent_class=extent_class)
+            for d in gold_demo_sendstreams().values():
+                subvol = add_sendstream_to_subvol_set(subvols, d['sendstream'])
+                self.assertIs(extent_class, subvol.extent_class)
+                self.assertEqual({extent_class}, {
+                    type(ino.extent) for ino in subvol.inodes()
+                        if hasattr(ino, 'extent')
+                })
+            renders.append(freeze(subvols).map(
+                lambda sv: emit_all_traversal_ids(sv.render())
+            ))
+        self.assertEqual(*renders)
+
+    def test_from_trimmed_leaves(self):
+        for extents in _apply_random_ops(random.Random(3), 3, 50).values():
+            for e in extents:
+                leaves = list(e.gen_trimmed_leaves())
+                restored = FlatExtent.from_trimmed_leaves(leaves)
+                self.assertEqual(e.length, restored.length)
+                self.assertEqual(repr(e), repr(restored))
+                self.assertEqual(leaves, list(restored.gen_trimmed_leaves()))
+                for a, b in zip(leaves, restored.gen_trimmed_leaves()):
+                    self.assertIs(a[2], b[2])
+
+    def test_empty(self):
+        self.assertEqual('', repr(FlatExtent.empty()))
+        self.assertEqual([], list(FlatExtent.empty().gen_trimmed_leaves()))
+
+    def test_copy(self):
+        e = FlatExtent.empty().write(offset=5, length=5)
+        self.assertIs(e, copy.deepcopy(e))
+        self.assertIs(e, copy.copy(e))
+
+
+if __name__ == '__main__':
+    unittest.main()
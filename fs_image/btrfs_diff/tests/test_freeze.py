@@ -4,12 +4,13 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import enum
 import unittest
 
 from types import MappingProxyType
 from typing import NamedTuple, Sequence
 
-from ..freeze import freeze
+from ..freeze import freeze, register_freezer, register_immutable
 
 
 class FreezeTestCase(unittest.TestCase):
@@ -63,6 +64,77 @@ class FreezeTestCase(unittest.TestCase):
             [type(i) for i in f],
         )
 
+    def test_reuses_immutable(self):
+
+        class Point(NamedTuple):
+            x: int
+            y: Sequence[int]
+
+        class Color(enum.Enum):
+            RED = 1
+
+        p = Point(x=1, y=(2, 3))
+        t = (p, frozenset([5, 'a']), Color.RED, True, 1.5, None)
+        self.assertIs(t, freeze(t))
+        self.assertIs(p, freeze(p))
+        # A mutable item forces a copy of its containers.
+        mutable_p = Point(x=1, y=[2, 3])
+        frozen = freeze((mutable_p, p))
+        self.assertEqual((p, p), frozen)
+        self.assertIsNot(mutable_p, frozen[0])
+        self.assertIs(p, frozen[1])
+
+    def test_register(self):
+
+        class Immutable:
+            pass
+
+        class Custom:
+            def __init__(self, items):
+                self.items = items
+
+        register_immutable(Immutable)
+        register_freezer(
+            Custom,
+            lambda c, *, _memo: ('custom', freeze(c.items, _memo=_memo)),
+        )
+        i = Immutable()
+        self.assertIs(i, freeze(i))
+        # Registered freezers take precedence over the generic `freeze`.
+        memo = {}
+        c = Custom([i, []])
+        self.assertEqual(('custom', (i, ())), freeze(c, _memo=memo))
+        self.assertIn(id(c), memo)
+        self.assertNotIn(id(i), memo)
+        # `register_freezer` is for exact types, not subclasses.
+        with self.assertRaises(NotImplementedError):
+            freeze(type('ImmutableSubclass', (Immutable,), {})())
+
+        with self.assertRaises(AssertionError):
+            freeze(c, chunks=None)
+        # Sets of unchanged items are reused, but not otherwise.
+        fs = frozenset([i])
+        self.assertIs(fs, freeze(fs))
+        fs = frozenset([c])
+        self.assertEqual(frozenset([('custom', (i, ()))]), freeze(fs))
+
+    def test_container_subclasses(self):
+
+        class MyList(list):
+            pass
+
+        class MySet(set):
+            pass
+
+        class MyDict(dict):
+            pass
+
+        f = freeze([MyList([1]), MySet([2]), MyDict(a=3)])
+        self.assertEqual(((1,), {2}, {'a': 3}), f)
+        self.assertEqual(
+            [tuple, frozenset, MappingProxyType], [type(i) for i in f],
+        )
+
     def test_not_implemented(self):
         with self.assertRaises(NotImplementedError):
             freeze(object())
@@ -4,12 +4,19 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import copy
+import pickle
 import stat
 import unittest
 
 from dataclasses import dataclass
 
-from ..inode import InodeOwner, InodeUtimes
+from ..extent import Extent
+from ..freeze import freeze
+from ..inode import (
+    Chunk, ChunkClone, Clone, InodeOwner, InodeUtimes,
+)
+from ..inode_id import InodeIDMap
 from ..incomplete_inode import (
     IncompleteDevice, IncompleteDir, IncompleteFifo, IncompleteFile,
     IncompleteSocket, IncompleteSymlink,
@@ -139,6 +146,41 @@ class IncompleteInodeTestCase(unittest.TestCase):
 
         self.assertEqual('(Symlink o1:2 cat)', repr(ino))
 
+    def test_send_stream_version_2(self):
+        ino = IncompleteFile(item=SSI.mkfile(path=b'a'))
+        ino.apply_item(SSI.encoded_write(
+            path=b'a', offset=3, unencoded_file_len=5, unencoded_len=8,
+            unencoded_offset=3, compression=1, encryption=0,
+            data=b'not really zlib',
+        ))
+        self.assertEqual('(File h3d5)', repr(ino))
+        with self.assertRaisesRegex(RuntimeError, 'past its decoded data'):
+            ino.apply_item(SSI.encoded_write(
+                path=b'a', offset=0, unencoded_file_len=5, unencoded_len=8,
+                unencoded_offset=4, compression=1, encryption=0, data=b'',
+            ))
+
+        for mode, offset, length, expected in [
+            (0x01, 8, 4, '(File h3d5)'),  # KEEP_SIZE, past EOF
+            (0, 8, 2, '(File h3d5h2)'),  # Preallocate past EOF
+            (0, 0, 4, '(File h3d5h2)'),  # Preallocate within the file
+            (0x03, 4, 2, '(File h3d1h2d2h2)'),  # PUNCH_HOLE | KEEP_SIZE
+            (0x03, 12, 2, '(File h3d1h2d2h2)'),  # Nothing to punch past EOF
+            (0x10, 7, 5, '(File h3d1h2d1h5)'),  # ZERO_RANGE, past EOF
+            (0x11, 0, 20, '(File h12)'),  # ZERO_RANGE | KEEP_SIZE
+        ]:
+            ino.apply_item(SSI.fallocate(
+                path=b'a', mode=mode, offset=offset, len=length,
+            ))
+            self.assertEqual(expected, repr(ino), (mode, offset, length))
+        with self.assertRaisesRegex(RuntimeError, 'cannot apply the mode'):
+            ino.apply_item(SSI.fallocate(path=b'a', mode=4, offset=0, len=1))
+
+        for inode in [ino, IncompleteDir(item=SSI.mkdir(path=b'd'))]:
+            before = repr(inode)
+            inode.apply_item(SSI.fileattr(path=b'a', attr=0x10))
+            self.assertEqual(before, repr(inode))
+
     def test_apply_clone(self):
         f1 = IncompleteFile(item=SSI.mkfile(path=b'unused'))
         f1.apply_item(SSI.write(path=b'unused', offset=10, data=b'a' * 10))
@@ -171,6 +213,61 @@ class IncompleteInodeTestCase(unittest.TestCase):
         self.assertEqual('(File h10d10)', repr(f1))
         self.assertEqual('(File d3h7d5)', repr(f2))
 
+    def test_freeze_reuses_unchanged_inode(self):
+        ino = IncompleteFile(item=SSI.mkfile(path=b'f'))
+        ino.apply_item(SSI.set_xattr(path=b'f', name=b'a', data=b'b'))
+        chunks = (Chunk(kind=Extent.Kind.DATA, length=3, chunk_clones=()),)
+        frozen = freeze(ino, chunks=chunks)
+        self.assertIs(frozen, freeze(ino, chunks=chunks))
+        self.assertIsNot(frozen, freeze(ino, chunks=chunks[:0]))
+
+        # Both `apply_item` and direct changes make a new `Inode`.
+        frozen = freeze(ino, chunks=chunks)
+        ino.apply_item(SSI.set_xattr(path=b'f', name=b'a', data=b'c'))
+        self.assertIsNot(frozen, freeze(ino, chunks=chunks))
+        frozen = freeze(ino, chunks=chunks)
+        ino.mode = 0o644
+        self.assertIsNot(frozen, freeze(ino, chunks=chunks))
+        self.assertEqual(0o644, freeze(ino, chunks=chunks).mode)
+
+        # The cache is neither copied, nor pickled.
+        frozen = freeze(ino, chunks=chunks)
+        for ino_copy in [
+            copy.copy(ino), copy.deepcopy(ino),
+            pickle.loads(pickle.dumps(ino)),
+        ]:
+            self.assertIsNone(ino_copy._frozen)
+            self.assertEqual(frozen, freeze(ino_copy, chunks=chunks))
+        self.assertIs(frozen, freeze(ino, chunks=chunks))
+
+        # `InodeID`s of clones are specific to each `freeze`.
+        id_map = InodeIDMap.new()
+        clone_chunks = (Chunk(
+            kind=Extent.Kind.DATA, length=3, chunk_clones=frozenset([
+                ChunkClone(offset=0, clone=Clone(
+                    inode_id=id_map.get_id(b'.'), offset=0, length=3,
+                )),
+            ]),
+        ),)
+        self.assertIsNot(
+            freeze(ino, chunks=clone_chunks),
+            freeze(ino, chunks=clone_chunks),
+        )
+
+        # Device numbers & symlink targets are part of the key, too.
+        dev = IncompleteDevice(item=SSI.mknod(
+            path=b'd', mode=stat.S_IFCHR | 0o644, dev=7,
+        ))
+        frozen = freeze(dev, chunks=None)
+        self.assertIs(frozen, freeze(dev, chunks=None))
+        dev.dev = 8
+        self.assertEqual(8, freeze(dev, chunks=None).dev)
+        sym = IncompleteSymlink(item=SSI.symlink(path=b's', dest=b'a'))
+        frozen = freeze(sym, chunks=None)
+        self.assertIs(frozen, freeze(sym, chunks=None))
+        sym.dest = b'b'
+        self.assertEqual(b'b', freeze(sym, chunks=None).dest)
+
 
 if __name__ == '__main__':
     unittest.main()
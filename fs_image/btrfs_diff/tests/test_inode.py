@@ -11,7 +11,7 @@ from ..extent import Extent
 from ..extents_to_chunks import extents_to_chunks_with_clones
 from ..inode import (
     _time_delta, _repr_time, _repr_time_delta,
-    Chunk, ChunkClone, Clone, Inode, InodeOwner, InodeUtimes,
+    Chunk, ChunkClone, Clone, Inode, InodeOwner, InodeUtimes, SharedExtent,
 )
 from ..inode_id import InodeIDMap
 
@@ -147,6 +147,26 @@ class InodeTestCase(unittest.TestCase):
             ('(DATA/12: a:7+2@3, a:5+6@4)', '(DATA/12: a:5+6@4, a:7+2@3)'),
         )
 
+    def test_shared_extent(self):
+        shared = SharedExtent(
+            offset=3, length=2, extent_nonce=17, extent_offset=5,
+        )
+        self.assertEqual('#17:5+2@3', repr(shared))
+        chunk = Chunk(
+            kind=Extent.Kind.DATA, length=12, chunk_clones=frozenset(),
+            shared_extents=(shared,),
+        )
+        self.assertEqual('(DATA/12 #17:5+2@3)', repr(chunk))
+        ino = Inode(
+            file_type=stat.S_IFREG, mode=0o644, owner=None, utimes=None,
+            xattrs={}, chunks=(chunk,),
+        )
+        self.assertEqual('(File m644 d12[#17:5+2@3])', repr(ino))
+        self.assertEqual(
+            '(File m644 d12[#0:5+2@3])',
+            ino.repr_with_extent_ids(lambda nonce: nonce - 17),
+        )
+
     def test_repr_owner(self):
         self.assertEqual('12:345', repr(InodeOwner(uid=12, gid=345)))
 
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import random
+import unittest
+
+from ..compact_inode_id import CompactInodeIDMap
+from ..freeze import freeze
+from ..incomplete_inode import IncompleteDir, IncompleteFile
+from ..inode_id import InodeIDMap
+from ..parse_dump import SendStreamItems
+from ..rendered_tree import emit_all_traversal_ids
+from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
+
+_PATHS = [b'a', b'b', b'd/a', b'd/c']
+
+
+def _random_items(rng, uuids):
+    'A mix of items that mutate inodes, paths, and clone across subvols.'
+    si = SendStreamItems
+    for _ in range(12):
+        path = rng.choice(_PATHS)
+        yield rng.choice([
+            lambda: si.mkfile(path=path),
+            lambda: si.mkdir(path=b'd'),
+            lambda: si.write(
+                path=path, offset=rng.randrange(4),
+                data=b'x' * rng.randint(1, 4),
+            ),
+            lambda: si.clone(
+                path=path, offset=rng.randrange(4), len=rng.randint(1, 3),
+                from_uuid=rng.choice(uuids), from_transid=0,
+                from_path=rng.choice(_PATHS), clone_offset=rng.randrange(2),
+            ),
+            lambda: si.truncate(path=path, size=rng.randrange(6)),
+            lambda: si.chmod(path=path, mode=rng.randrange(0o1000)),
+            lambda: si.set_xattr(path=path, name=b'n', data=b'v'),
+            lambda: si.unlink(path=path),
+            lambda: si.rename(path=path, dest=rng.choice(_PATHS)),
+        ])()
+
+
+def _render(subvols):
+    return freeze(subvols).map(
+        lambda sv: emit_all_traversal_ids(sv.render())
+    )
+
+
+class InodeTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Print more data to simplify debugging
+        self.maxDiff = 12345
+
+    def test_inode_table(self):
+        subvols = SubvolumeSet.new(id_map_class=CompactInodeIDMap)
+        mutator = SubvolumeSetMutator.new(subvols, SendStreamItems.subvol(
+            path=b'desc', uuid=b'u', transid=0,
+        ))
+        table = mutator.subvolume.id_to_inode
+        id_map = mutator.subvolume.id_map
+        root = id_map.get_id(b'.')
+        self.assertEqual([root], list(table))
+        self.assertEqual(1, len(table))
+
+        # Skip an inode number, leaving a gap in the table.
+        id_map.next()
+        f_id = id_map.add_file(id_map.next(), b'f')
+        f = IncompleteFile(item=SendStreamItems.mkfile(path=b'f'))
+        table[f_id] = f
+        self.assertEqual([root, f_id], list(table))
+        self.assertEqual(2, len(table))
+        self.assertIs(f, table[f_id])
+        self.assertIs(f, table.get_mutable(f_id))
+        gap_id = f_id._replace(id=f_id.id - 1)
+        for missing_id in [
+            'not an InodeID', gap_id, f_id._replace(id=f_id.id + 1),
+            InodeIDMap.new().get_id(b'.'),
+        ]:
+            self.assertNotIn(missing_id, table)
+            with self.assertRaises(KeyError):
+                table.get_mutable(missing_id)
+        with self.assertRaisesRegex(RuntimeError, 'Wrong map for InodeID #'):
+            table[InodeIDMap.new().next()] = f
+
+        # A snapshot copies an inode the first time that it changes it.
+        snap_map = id_map.snapshot(description='snap')
+        snap = table.snapshot(snap_map.inner)
+        snap_f_id = snap_map.get_id(b'f')
+        self.assertEqual(2, len(snap))
+        self.assertIs(f, snap[snap_f_id])
+        self.assertNotIn(f_id, snap)
+        snap_f = snap.get_mutable(snap_f_id)
+        self.assertIsNot(f, snap_f)
+        self.assertIs(snap_f, snap.get_mutable(snap_f_id))
+        snap_f.apply_item(SendStreamItems.chmod(path=b'f', mode=0o644))
+        self.assertIsNone(f.mode)
+
+        # The parent must copy before changing the inode, too.
+        table_f = table.get_mutable(f_id)
+        self.assertIsNot(f, table_f)
+        self.assertIs(table_f, table[f_id])
+
+        del snap[snap_f_id]
+        self.assertEqual([snap_map.get_id(b'.')], list(snap))
+        self.assertEqual(1, len(snap))
+        self.assertEqual([root, f_id], list(table))
+        snap[snap_f_id] = IncompleteDir(item=SendStreamItems.mkdir(path=b'f'))
+        self.assertEqual(2, len(snap))
+        self.assertIsInstance(table[f_id], IncompleteFile)
+
+    def test_snapshot_chain(self):
+        '''
+        Random chains of snapshots render the same with either map, and a
+        frozen `SubvolumeSet` is unaffected by the later changes.
+        '''
+        rng = random.Random(8)
+        for _ in range(30):
+            items = []
+            uuids = [b'0']
+            items.append(SendStreamItems.subvol(
+                path=b'0', uuid=b'0', transid=0,
+            ))
+            items.extend(_random_items(rng, uuids))
+            for i in range(1, 6):
+                uuid = str(i).encode()
+                items.append(SendStreamItems.snapshot(
+                    path=uuid, uuid=uuid, transid=0,
+                    parent_uuid=rng.choice(uuids), parent_transid=0,
+                ))
+                uuids.append(uuid)
+                items.extend(_random_items(rng, uuids))
+
+            results = []
+            for id_map_class in [InodeIDMap, CompactInodeIDMap]:
+                subvols = SubvolumeSet.new(id_map_class=id_map_class)
+                frozens_and_renders = []
+                errors = []
+                for item in items:
+                    if isinstance(item, (
+                        SendStreamItems.subvol, SendStreamItems.snapshot,
+                    )):
+                        frozens_and_renders.append(
+                            (freeze(subvols), _render(subvols)),
+                        )
+                        mutator = SubvolumeSetMutator.new(subvols, item)
+                        continue
+                    try:
+                        mutator.apply_item(item)
+                    except RuntimeError as ex:
+                        errors.append(str(ex))
+                for frozen, render in frozens_and_renders:
+                    self.assertEqual(render, frozen.map(
+                        lambda sv: emit_all_traversal_ids(sv.render())
+                    ))
+                results.append((
+                    [r for _, r in frozens_and_renders],
+                    _render(subvols),
+                    errors,
+                ))
+            self.assertEqual(*results)
+
+
+if __name__ == '__main__':
+    unittest.main()
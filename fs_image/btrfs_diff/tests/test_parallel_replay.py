@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import dataclasses
+import itertools
+import unittest
+
+from io import BytesIO
+
+from ..compact_inode_id import CompactInodeIDMap
+from ..freeze import freeze
+from ..inode_id import InodeIDMap
+from ..parallel_replay import (
+    _components, _replay_component, _unpickle_subvols, replay_sections,
+    split_sections,
+)
+from ..parse_send_stream import parse_send_stream
+from ..rendered_tree import emit_all_traversal_ids
+from ..send_stream import SendStreamItems
+from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
+
+from .demo_sendstreams import gold_demo_sendstreams
+
+si = SendStreamItems
+
+
+def _gold_items(suffix: bytes):
+    'The demo send-streams, with `suffix` added to every UUID.'
+    for d in gold_demo_sendstreams().values():
+        for item in parse_send_stream(BytesIO(d['sendstream'])):
+            for field in ['uuid', 'parent_uuid', 'from_uuid']:
+                if hasattr(item, field):
+                    item = dataclasses.replace(
+                        item, **{field: getattr(item, field) + suffix},
+                    )
+            yield item
+
+
+def _replay_sequentially(subvols, items):
+    for item in items:
+        if isinstance(item, (si.subvol, si.snapshot)):
+            mutator = SubvolumeSetMutator.new(subvols, item)
+        else:
+            mutator.apply_item(item)
+
+
+def _describe(subvols):
+    'Order-sensitive, since the order of `uuid_to_subvolume` matters.'
+    frozen = freeze(subvols)
+    return (
+        list(subvols.uuid_to_subvolume),
+        list(frozen.map(lambda sv: emit_all_traversal_ids(sv.render()))),
+        frozen.map(lambda sv: emit_all_traversal_ids(sv.render())),
+        [repr(ino) for ino in frozen.inodes()],
+        subvols.name_uuid_prefix_counts,
+    )
+
+
+class ParallelReplayTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Print more data to simplify debugging
+        self.maxDiff = 12345
+
+    def test_split_sections(self):
+        self.assertEqual([], list(split_sections([])))
+        a = si.subvol(path=b'a', uuid=b'a', transid=0)
+        b = si.snapshot(
+            path=b'b', uuid=b'b', transid=0, parent_uuid=b'a',
+            parent_transid=0,
+        )
+        mkfile = si.mkfile(path=b'f')
+        self.assertEqual(
+            [[a, mkfile], [b], [a, mkfile, mkfile]],
+            list(split_sections([a, mkfile, b, a, mkfile, mkfile])),
+        )
+        with self.assertRaisesRegex(RuntimeError, 'must specify subvolume'):
+            list(split_sections([mkfile, a]))
+
+    def test_components(self):
+
+        def subvol(uuid):
+            return si.subvol(path=uuid, uuid=uuid, transid=0)
+
+        def snapshot(uuid, parent_uuid):
+            return si.snapshot(
+                path=uuid, uuid=uuid, transid=0, parent_uuid=parent_uuid,
+                parent_transid=0,
+            )
+
+        def clone(from_uuid):
+            return si.clone(
+                path=b'f', offset=0, len=1, from_uuid=from_uuid,
+                from_transid=0, from_path=b'f', clone_offset=0,
+            )
+
+        self.assertEqual([[0, 2], [1, 3, 4], [5]], _components([
+            [subvol(b'a')],
+            [subvol(b'b')],
+            [snapshot(b'c', b'a')],
+            [snapshot(b'd', b'b')],
+            [subvol(b'e'), clone(b'b')],
+            [subvol(b'f'), clone(b'f')],
+        ]))
+        # A clone joins two components that started separately.
+        self.assertEqual([[0, 1, 2, 3]], _components([
+            [subvol(b'a')],
+            [subvol(b'b')],
+            [snapshot(b'c', b'b')],
+            [subvol(b'd'), clone(b'c'), clone(b'a')],
+        ]))
+
+    def test_matches_sequential_replay(self):
+        for id_map_class in [InodeIDMap, CompactInodeIDMap]:
+            # Three stacks of the demo send-streams are independent, so
+            # they are replayed in separate workers.
+            items = list(itertools.chain.from_iterable(
+                _gold_items(s) for s in [b'-1', b'-2', b'-3']
+            ))
+            expected_subvols = SubvolumeSet.new(id_map_class=id_map_class)
+            _replay_sequentially(expected_subvols, items)
+            expected = _describe(expected_subvols)
+            subvols = SubvolumeSet.new(id_map_class=id_map_class)
+            replay_sections(subvols, split_sections(items), max_workers=2)
+            self.assertEqual(expected, _describe(subvols))
+
+            # The merged set remains usable, including for clones across
+            # the subvolumes of different workers.
+            for s in [expected_subvols, subvols]:
+                mutator = SubvolumeSetMutator.new(s, si.snapshot(
+                    path=b'new', uuid=b'new', transid=0,
+                    parent_uuid=b'b5db3896-faf8-b44e-a952-c02f903ab445-1',
+                    parent_transid=0,
+                ))
+                mutator.apply_item(si.clone(
+                    path=b'zeros_hole_zeros', offset=0, len=5,
+                    from_uuid=b'481757f7-6c61-2942-9bea-ee222b120c81-2',
+                    from_transid=0, from_path=b'zeros_hole_zeros',
+                    clone_offset=0,
+                ))
+            self.assertEqual(
+                _describe(expected_subvols), _describe(subvols),
+            )
+
+    def test_existing_subvolumes(self):
+        'Sections depending on subvolumes already in the set run locally.'
+        items_1, items_2 = (list(_gold_items(s)) for s in [b'-1', b'-2'])
+        expected_subvols = SubvolumeSet.new()
+        _replay_sequentially(expected_subvols, items_1 + items_2)
+
+        subvols = SubvolumeSet.new()
+        create_ops_1, mutate_ops_1 = split_sections(items_1)
+        _replay_sequentially(subvols, create_ops_1)
+        # `mutate_ops_1` snapshots an existing subvolume, and `-2` is new.
+        replay_sections(subvols, [mutate_ops_1, *split_sections(items_2)])
+        self.assertEqual(_describe(expected_subvols), _describe(subvols))
+
+        with self.assertRaisesRegex(RuntimeError, ' is already in use: '):
+            replay_sections(subvols, [create_ops_1])
+
+    def test_replay_component(self):
+        'Coverage tools may not see the workers, so run one in-process.'
+        items = list(_gold_items(b''))
+        expected_subvols = SubvolumeSet.new(id_map_class=CompactInodeIDMap)
+        _replay_sequentially(expected_subvols, items)
+        subvols = SubvolumeSet.new(id_map_class=CompactInodeIDMap)
+        for subvol in _unpickle_subvols(subvols, _replay_component(
+            list(split_sections(items)), subvols.extent_class,
+            subvols.id_map_class,
+        )):
+            self.assertIs(
+                subvols.name_uuid_prefix_counts,
+                subvol.id_map.inner.description.name_uuid_prefix_counts,
+            )
+            self.assertIsInstance(subvol.id_map, CompactInodeIDMap)
+            subvols.uuid_to_subvolume[
+                subvol.id_map.inner.description.id.uuid
+            ] = subvol
+            subvols.clone_index.update_subvolume(subvol)
+            subvols.name_uuid_prefix_counts.update(
+                subvol.id_map.inner.description.name_uuid_prefixes()
+            )
+        self.assertEqual(_describe(expected_subvols), _describe(subvols))
+
+    def test_worker_error(self):
+        with self.assertRaisesRegex(RuntimeError, 'Unknown from_uuid for '):
+            replay_sections(SubvolumeSet.new(), [[
+                si.subvol(path=b'a', uuid=b'a', transid=0),
+                si.mkfile(path=b'f'),
+                si.clone(
+                    path=b'f', offset=0, len=1, from_uuid=b'BAD',
+                    from_transid=0, from_path=b'f', clone_offset=0,
+                ),
+            ]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,13 +5,17 @@
 # LICENSE file in the root directory of this source tree.
 
 import io
+import os
+import re
 import sys
 import unittest
 
 from typing import List, Sequence
 
 from ..parse_dump import (
-    NAME_TO_PARSER_TYPE, parse_btrfs_dump, unquote_btrfs_progs_path,
+    _ESCAPED_REGEX, _ESCAPED_TO_UNESCAPED, _normalize_subvolume_path,
+    NAME_TO_ITEM_TYPE, NAME_TO_PARSER_TYPE, parse_btrfs_dump,
+    unquote_btrfs_progs_path,
 )
 from ..send_stream import SendStreamItem, SendStreamItems
 
@@ -26,6 +30,66 @@ def _parse_lines_to_list(s: Sequence[bytes]) -> List[SendStreamItem]:
     return list(parse_btrfs_dump(io.BytesIO(b'\n'.join(s) + b'\n')))
 
 
+def _reference_normalize_subvolume_path(s, *, subvol_name):
+    'The original, `relpath`-only `_normalize_subvolume_path`.'
+    stripped = os.path.relpath(s, subvol_name)
+    if len(stripped) >= len(s) or stripped.startswith(b'..'):
+        raise RuntimeError(f'{s} did not start with {subvol_name}')
+    return stripped
+
+
+def _reference_parse_btrfs_dump(lines: Sequence[bytes]):
+    '''
+    The original `parse_btrfs_dump`, which ran the generic
+    `RegexItemParser.parse_details` for each line.
+    '''
+    reg = re.compile(br'([^ ]+) +((\\ |[^ ])+) *(.*)\n')
+    subvol_name = None
+    for l in io.BytesIO(b'\n'.join(lines) + b'\n'):
+        m = reg.fullmatch(l)
+        if not m:
+            raise RuntimeError(f'line has unexpected format: {repr(l)}')
+        item_name, path, _, details = m.groups()
+        if item_name == b'write':
+            item_name = b'update_extent'
+        item_class = NAME_TO_ITEM_TYPE.get(item_name)
+        if not item_class:
+            raise RuntimeError(f'unknown item type {item_name} in {repr(l)}')
+        item_parser = NAME_TO_PARSER_TYPE[item_name]
+        unnormalized_path = _ESCAPED_REGEX.sub(
+            lambda m: _ESCAPED_TO_UNESCAPED[m.group(0)], path,
+        )
+        if subvol_name is None:
+            if not item_class.sets_subvol_name:
+                raise RuntimeError(
+                    f'First stream item did not set subvolume name: {l}'
+                )
+            path = os.path.normpath(unnormalized_path)
+            subvol_name = path
+            if b'/' in path:
+                raise RuntimeError(f'subvol path {path} contains /')
+        elif item_class.sets_subvol_name:
+            raise RuntimeError(
+                f'Subvolume {subvol_name} created more than once.'
+            )
+        else:
+            path = _reference_normalize_subvolume_path(
+                unnormalized_path, subvol_name=subvol_name,
+            )
+        fields = item_parser.parse_details(subvol_name, details)
+        if fields is None:
+            raise RuntimeError(f'unexpected format in line details: {repr(l)}')
+        fields['path'] = path
+        yield item_class(**fields)
+
+
+def _result(fn):
+    try:
+        return fn()
+    except Exception as ex:
+        return type(ex), str(ex)
+
+
 class ParseBtrfsDumpTestCase(unittest.TestCase):
     def setUp(self):
         self.maxDiff = 12345
@@ -69,9 +133,11 @@ class ParseBtrfsDumpTestCase(unittest.TestCase):
             'utimes',
             # Omitted since `--dump` never prints data: 'write',
         }
+        # The demo makes version 1 send-streams, so we test the operations
+        # of version 2 in `test_send_stream_version_2`.
         self.assertEqual(
             {n.decode() for n in NAME_TO_PARSER_TYPE.keys()},
-            expected_ops,
+            {*expected_ops, 'fallocate', 'fileattr'},
         )
 
         # Now check that `demo_sendstream.py` also exercises those operations.
@@ -172,6 +238,94 @@ class ParseBtrfsDumpTestCase(unittest.TestCase):
             with self.assertRaisesRegex(RuntimeError, 'in line details:'):
                 _parse_lines_to_list(bad_lines)
 
+    def test_send_stream_version_2(self):
+        uuid = b'01234567-0123-0123-0123-012345678901'
+        self.assertEqual([
+            SendStreamItems.subvol(path=b's', uuid=uuid, transid=12),
+            SendStreamItems.fallocate(path=b'f', mode=3, offset=4, len=5),
+            SendStreamItems.fileattr(path=b'f', attr=0xa0),
+            # `encoded_write` becomes `update_extent`, just like `write`.
+            *[SendStreamItems.update_extent(
+                path=b'f', offset=7, len=4096,
+            )] * 2,
+        ], _parse_lines_to_list([
+            b'subvol ./s uuid=' + uuid + b' transid=12',
+            b'fallocate ./s/f mode=3 offset=4 len=5',
+            b'fileattr ./s/f fileattr=0xA0',
+            b'encoded_write ./s/f offset=7 len=33, unencoded_file_len=4096, '
+                b'unencoded_len=8192, unencoded_offset=0, compression=2, '
+                b'encryption=0',
+            b'encoded_write ./s/f offset=7 len=33 unencoded_file_len=4096 '
+                b'unencoded_len=8192 unencoded_offset=0 compression=2 '
+                b'encryption=0',
+        ]))
+
+    def test_normalize_subvolume_path(self):
+        'The fast path must agree with `relpath`, including on errors.'
+        for subvol_name in [b's', b'sub', b'.', b'..']:
+            for path in [
+                b'./s/a', b's/a/b', b'./s/', b'./s', b's/', b's', b'./s/a/',
+                b'./s//a', b'./s/./a', b'./s/a/../b', b'./s/../x', b'./s/.a',
+                b'./sub/a', b'./subx/a', b'././s/a', b'/s/a', b'./x/a',
+                b'./../a', b'../a', b'./s/a b', b'.', b'./', b'./a/.b',
+                b'.../a', b'./..', b'..',
+            ]:
+                self.assertEqual(
+                    _result(lambda: _reference_normalize_subvolume_path(
+                        path, subvol_name=subvol_name,
+                    )),
+                    _result(lambda: _normalize_subvolume_path(
+                        path, subvol_name=subvol_name,
+                    )),
+                    (subvol_name, path),
+                )
+
+    def test_matches_reference_parser(self):
+        'Differential test against the original, per-item regex parser.'
+        uuid = b'01234567-0123-0123-0123-012345678901'
+        subvol_line = b'subvol ./s uuid=' + uuid + b' transid=12'
+        tricky_lines = [
+            b'mkfile ./s/cat\\ and\\ dog',
+            b'mkdir ./s/.hidden/',
+            b'mkfile ./s/a//b',
+            b'rename ./s/a/../b dest=./s/./c',
+            b'rename ./s/a dest=./s/',
+            b'rename ./s/a dest=./x/b',
+            b'clone ./s/f offset=1 len=2 from=./s/g h clone_offset=3',
+            b'clone ./s/f offset=1 len=2 from=./t/g clone_offset=3',
+            b'clone ./s/f offset=x len=2 from=./s/g clone_offset=3',
+            b'link ./s/l dest=a/../b',
+            b'symlink ./s/l dest=/abs/../x',
+            b'utimes ./s/ atime=2019-07-23T11:54:26-0700 '
+                b'mtime=2019-07-23T11:54:27+0000 ctime=2019-07-23T11:54:26Z',
+            b'utimes ./s/ atime=2019-13-23T11:54:26-0700 '
+                b'mtime=2019-07-23T11:54:27+0000 ctime=2019-07-23T11:54:26Z',
+            b'write ./s/f offset=0 len=5',
+            b'mknod ./s/n mode=600 dev=0x1f',
+            b'mkfile ./s/f extra',
+            b'set_xattr ./s/f name=a data=b len=1',
+            b'set_xattr ./s/f name=a data=b len=2',
+            b'chown ./s/f gid=1 uid=2',
+            b'truncate ./s/f size=x',
+            b'bogus ./s/f',
+            b' mkfile ./s/f',
+            b'mkfile ./s',
+            b'mkfile s',
+            subvol_line,
+        ]
+        for lines in [
+            *([subvol_line, l] for l in tricky_lines),
+            [subvol_line.replace(b'./s', b'./s/')],
+            [subvol_line.replace(b'./s', b'./s/t')],
+            [b'mkfile ./s/f'],
+            *(d['dump'] for d in gold_demo_sendstreams().values()),
+        ]:
+            self.assertEqual(
+                _result(lambda: list(_reference_parse_btrfs_dump(lines))),
+                _result(lambda: _parse_lines_to_list(lines)),
+                lines,
+            )
+
     def test_str_uses_unqualified_class_name(self):
         self.assertEqual(
             "mkfile(path='cat and dog')",
@@ -10,18 +10,25 @@ that `test_parse_dump.py` already sanity-checks the gold data.
 '''
 import io
 import struct
+import tempfile
 import unittest
 
-from typing import Iterable
+from typing import Callable, Iterable
 
 from .demo_sendstreams import gold_demo_sendstreams
 from .demo_sendstreams_expected import get_filtered_and_expected_items
 
-from ..send_stream import SendStreamItem
+from ..send_stream import (
+    get_frequency_of_selinux_xattrs, ItemFilterPipeline, ItemFilters,
+    SendStreamItem, SendStreamItems,
+)
 from ..parse_send_stream import (
-    AttributeKind, check_magic, check_version, CommandKind, file_unpack,
-    parse_send_stream, read_attribute, read_command,
+    AttributeKind, BTRFS_SEND_STREAM_MAGIC, check_magic, check_version,
+    CommandKind, file_unpack, get_frequency_of_selinux_xattrs_in_send_stream,
+    parse_send_stream, parse_send_stream_buffer,
+    parse_send_stream_mmap, read_attribute, read_command,
 )
+from ..write_send_stream import write_send_stream
 
 # `unittest`'s output shortening makes tests much harder to debug.
 unittest.util._MAX_LENGTH = 12345
@@ -31,6 +38,34 @@ def _parse_stream_bytes(s: bytes) -> Iterable[SendStreamItem]:
     return parse_send_stream(io.BytesIO(s))
 
 
+def _parse_stream_mmap(s: bytes, **kwargs) -> Iterable[SendStreamItem]:
+    with tempfile.TemporaryFile() as tf:
+        tf.write(s)
+        tf.flush()
+        yield from parse_send_stream_mmap(tf, **kwargs)
+
+
+class _Pipe(io.BytesIO):
+    'Exercises the code paths for input that cannot `seek`.'
+
+    def seekable(self):
+        return False
+
+
+# All the parse modes should produce identical items.
+_PARSERS = {
+    'stream': _parse_stream_bytes,
+    'buffer': parse_send_stream_buffer,
+    'mmap': _parse_stream_mmap,
+}
+_NO_DATA_PARSERS = {
+    'stream': lambda s: parse_send_stream(io.BytesIO(s), no_data=True),
+    'pipe': lambda s: parse_send_stream(_Pipe(s), no_data=True),
+    'buffer': lambda s: parse_send_stream_buffer(s, no_data=True),
+    'mmap': lambda s: _parse_stream_mmap(s, no_data=True),
+}
+
+
 class ParseSendStreamTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -38,10 +73,17 @@ class ParseSendStreamTestCase(unittest.TestCase):
 
     def test_verify_gold_parse(self):
         stream_dict = gold_demo_sendstreams()
+        for name, parse in _PARSERS.items():
+            with self.subTest(parser=name):
+                self._check_gold_parse(stream_dict, parse)
+
+    def _check_gold_parse(
+        self, stream_dict, parse: Callable[[bytes], Iterable[SendStreamItem]],
+    ):
         filtered_items, expected_items = get_filtered_and_expected_items(
             items=[
-                *_parse_stream_bytes(stream_dict['create_ops']['sendstream']),
-                *_parse_stream_bytes(stream_dict['mutate_ops']['sendstream']),
+                *parse(stream_dict['create_ops']['sendstream']),
+                *parse(stream_dict['mutate_ops']['sendstream']),
             ],
             build_start_time=stream_dict['create_ops']['build_start_time'],
             build_end_time=stream_dict['mutate_ops']['build_end_time'],
@@ -49,6 +91,202 @@ class ParseSendStreamTestCase(unittest.TestCase):
         )
         self.assertEqual(filtered_items, expected_items)
 
+    def test_no_data(self):
+        for name, d in gold_demo_sendstreams().items():
+            sendstream = d['sendstream']
+            expected_items = [
+                SendStreamItems.update_extent(
+                    path=i.path, offset=i.offset, len=len(i.data),
+                ) if isinstance(i, SendStreamItems.write) else i
+                    for i in _parse_stream_bytes(sendstream)
+            ]
+            self.assertIn(
+                SendStreamItems.update_extent,
+                {type(i) for i in expected_items},
+            )
+            for parser_name, parse in _NO_DATA_PARSERS.items():
+                with self.subTest(stream=name, parser=parser_name):
+                    self.assertEqual(expected_items, list(parse(sendstream)))
+
+    def test_filter_pipeline(self):
+        si = SendStreamItems
+        gold = gold_demo_sendstreams()['create_ops']
+        start, end = gold['build_start_time'], gold['build_end_time']
+        with tempfile.TemporaryFile() as tf:
+            tf.write(gold['sendstream'])
+            tf.seek(0)
+            selinux_freqs = get_frequency_of_selinux_xattrs_in_send_stream(tf)
+            self.assertEqual(0, tf.tell())
+            max_ctx, _count = max(selinux_freqs.items(), key=lambda p: p[1])
+
+            # A single pass over the streaming parse matches chaining the
+            # one-filter `ItemFilters` over a list of all the items.
+            def discard_fn(_path, ctx):
+                return ctx == max_ctx
+
+            filtered_items = list(ItemFilterPipeline().selinux_xattr(
+                discard_fn,
+            ).normalize_utimes(start, end).filter(parse_send_stream(tf)))
+        items = list(_parse_stream_bytes(gold['sendstream']))
+        self.assertEqual(selinux_freqs, get_frequency_of_selinux_xattrs(items))
+        self.assertEqual(filtered_items, list(ItemFilters.normalize_utimes(
+            ItemFilters.selinux_xattr(items, discard_fn), start, end,
+        )))
+        self.assertLess(len(filtered_items), len(items))
+        self.assertNotIn(max_ctx, {
+            i.data for i in filtered_items if isinstance(i, si.set_xattr)
+        })
+        self.assertIn(si.utimes(
+            path=b'.', atime=start, mtime=start, ctime=start,
+        ), filtered_items)
+
+        # Filters of one type run in order, and stop at a discard.
+        pipeline = ItemFilterPipeline().add(
+            si.chmod, lambda i: si.chmod(path=i.path, mode=i.mode + 1),
+        ).add(si.chmod, lambda i: None if i.mode > 2 else i).add(
+            si.chmod, lambda i: si.chmod(path=i.path + b'!', mode=i.mode),
+        )
+        self.assertEqual(
+            [si.chmod(path=b'a!', mode=2), si.rmdir(path=b'c')],
+            list(pipeline.filter([
+                si.chmod(path=b'a', mode=1),
+                si.chmod(path=b'b', mode=2),
+                si.rmdir(path=b'c'),
+            ])),
+        )
+
+    def test_check_crc(self):
+        sendstream = gold_demo_sendstreams()['create_ops']['sendstream']
+        expected_items = list(_parse_stream_bytes(sendstream))
+        parsers = {
+            'stream': lambda s, **kw: parse_send_stream(io.BytesIO(s), **kw),
+            'buffer': parse_send_stream_buffer,
+            'mmap': _parse_stream_mmap,
+        }
+        # Find a WRITE, and corrupt the last byte of its data.
+        write_pos = len(BTRFS_SEND_STREAM_MAGIC) + 4
+        while True:
+            length, kind = struct.unpack_from('<IH', sendstream, write_pos)
+            if kind == CommandKind.WRITE.value:
+                break
+            write_pos += 10 + length
+        data_end = write_pos + 10 + length
+        bad_data = bytearray(sendstream)
+        bad_data[data_end - 1] ^= 0xff
+        # Corrupting the CRC field itself is also caught.
+        bad_crc = bytearray(sendstream)
+        bad_crc[write_pos + 6] ^= 0xff
+        for name, parse in parsers.items():
+            with self.subTest(parser=name):
+                self.assertEqual(
+                    expected_items, list(parse(sendstream, check_crc=True)),
+                )
+                # Without `check_crc`, the corruption goes unnoticed.
+                self.assertNotEqual(
+                    expected_items, list(parse(bytes(bad_data))),
+                )
+                for bad in [bad_data, bad_crc]:
+                    with self.assertRaisesRegex(
+                        RuntimeError, 'WRITE.* has the wrong CRC32C 0x',
+                    ):
+                        list(parse(bytes(bad), check_crc=True))
+                # We do not read the WRITE payloads with `no_data`, so
+                # those are not checked.
+                self.assertEqual(
+                    list(parse(sendstream, no_data=True)),
+                    list(parse(bytes(bad_data), no_data=True, check_crc=True)),
+                )
+
+    def test_version_2(self):
+        si = SendStreamItems
+        items = [
+            si.subvol(
+                path=b'sv', transid=7,
+                uuid=b'c0ffee00-0000-4000-8000-000000000000',
+            ),
+            si.mkfile(path=b'f'),
+            # Version 2 lets DATA exceed 64KiB.
+            si.write(path=b'f', offset=0, data=b'x' * 2 ** 17),
+            si.encoded_write(
+                path=b'f', offset=2 ** 17, unencoded_file_len=4096,
+                unencoded_len=8192, unencoded_offset=4096, compression=2,
+                encryption=0, data=b'compressed',
+            ),
+            # DATA can start with the bytes of the DATA attribute kind.
+            si.encoded_write(
+                path=b'f', offset=0, unencoded_file_len=1, unencoded_len=1,
+                unencoded_offset=0, compression=1, encryption=0,
+                data=struct.pack('<H', AttributeKind.DATA.value),
+            ),
+            si.fallocate(path=b'f', mode=3, offset=5, len=10),
+            si.fileattr(path=b'f', attr=0x10),
+        ]
+        out = io.BytesIO()
+        write_send_stream(out, items, version=2)
+        sendstream = out.getvalue()
+        self.assertEqual(2, check_version(io.BytesIO(
+            sendstream[len(BTRFS_SEND_STREAM_MAGIC):],
+        )))
+        for name, parse in _PARSERS.items():
+            with self.subTest(parser=name):
+                self.assertEqual(items, list(parse(sendstream)))
+        self.assertEqual(
+            items, list(parse_send_stream(
+                io.BytesIO(sendstream), check_crc=True,
+            )),
+        )
+        expected_no_data = [
+            *items[:2],
+            si.update_extent(path=b'f', offset=0, len=2 ** 17),
+            si.update_extent(path=b'f', offset=2 ** 17, len=4096),
+            si.update_extent(path=b'f', offset=0, len=1),
+            *items[-2:],
+        ]
+        for name, parse in _NO_DATA_PARSERS.items():
+            with self.subTest(parser=name):
+                self.assertEqual(expected_no_data, list(parse(sendstream)))
+
+    def test_encoded_write_defaults(self):
+        'COMPRESSION and ENCRYPTION may be omitted when they are 0.'
+        attrs = b''.join([
+            struct.pack('<HH1s', AttributeKind.PATH.value, 1, b'f'),
+            *(
+                struct.pack('<HHQ', kind.value, 8, 3) for kind in [
+                    AttributeKind.FILE_OFFSET,
+                    AttributeKind.UNENCODED_FILE_LEN,
+                    AttributeKind.UNENCODED_LEN,
+                    AttributeKind.UNENCODED_OFFSET,
+                ]
+            ),
+            struct.pack('<H3s', AttributeKind.DATA.value, b'abc'),
+        ])
+        cmd = struct.pack(
+            '<IHI', len(attrs), CommandKind.ENCODED_WRITE.value, 0,
+        ) + attrs
+        self.assertEqual(SendStreamItems.encoded_write(
+            path=b'f', offset=3, unencoded_file_len=3, unencoded_len=3,
+            unencoded_offset=3, compression=0, encryption=0, data=b'abc',
+        ), read_command(io.BytesIO(cmd), version=2))
+
+    def test_buffer_stops_at_end(self):
+        sendstream = gold_demo_sendstreams()['create_ops']['sendstream']
+        self.assertEqual(
+            list(_parse_stream_bytes(sendstream)),
+            list(parse_send_stream_buffer(sendstream + b'trailing junk')),
+        )
+        # Abandoning the parse midway must still release the `mmap`.
+        items = _parse_stream_mmap(sendstream)
+        next(items)
+        items.close()
+
+    def test_read_attribute(self):
+        self.assertEqual(
+            (AttributeKind.PATH, b'a/b'),
+            read_attribute(io.BytesIO(struct.pack(
+                '<HH4s', AttributeKind.PATH.value, 4, b'a//b',
+            ))),
+        )
+
     def test_errors(self):
         with self.assertRaisesRegex(RuntimeError, "Magic b'xxx', not "):
             check_magic(io.BytesIO(b'xxx'))
@@ -87,6 +325,102 @@ class ParseSendStreamTestCase(unittest.TestCase):
                 b'dog',
             )))
 
+    def test_buffer_errors(self):
+        header = BTRFS_SEND_STREAM_MAGIC + struct.pack('<I', 1)
+        with self.assertRaisesRegex(RuntimeError, "Magic b'xxx', not "):
+            list(parse_send_stream_buffer(b'xxx'))
+        with self.assertRaisesRegex(RuntimeError, 'Not enough bytes b.. '):
+            list(parse_send_stream_buffer(BTRFS_SEND_STREAM_MAGIC))
+        with self.assertRaisesRegex(RuntimeError, 'we require version 1'):
+            list(parse_send_stream_buffer(
+                BTRFS_SEND_STREAM_MAGIC + struct.pack('<I', 3),
+            ))
+        with self.assertRaisesRegex(RuntimeError, 'for format <IHI'):
+            list(parse_send_stream_buffer(header))
+        with self.assertRaisesRegex(ValueError, 'is not a valid CommandKind'):
+            list(parse_send_stream_buffer(
+                header + struct.pack('<IHI', 0, 12345, 0),
+            ))
+
+        cmd_header_1_attr = struct.pack(
+            '<IHI', 2 + 2 + 3, CommandKind.MKFILE.value, 0,
+        )
+        with self.assertRaisesRegex(RuntimeError, 'CommandHead.* got 0 bytes'):
+            list(parse_send_stream_buffer(header + cmd_header_1_attr))
+        with self.assertRaisesRegex(RuntimeError, 'for format <HH'):
+            list(parse_send_stream_buffer(
+                header + struct.pack('<IHI', 1, CommandKind.MKFILE.value, 0)
+                    + b'x',
+            ))
+        with self.assertRaisesRegex(
+            ValueError, 'is not a valid AttributeKind',
+        ):
+            list(parse_send_stream_buffer(
+                header + cmd_header_1_attr
+                    + struct.pack('<HH3s', 0, 3, b'cat'),
+            ))
+        truncated_attr = struct.pack(
+            '<HH3s',
+            AttributeKind.PATH.value,
+            5,  # length excluding this header -- error: we write 3 bytes!
+            b'cat',
+        )
+        for name, parse in _PARSERS.items():
+            with self.subTest(parser=name), self.assertRaisesRegex(
+                RuntimeError, 'AttributeH.* got 3 bytes',
+            ):
+                list(parse(header + cmd_header_1_attr + truncated_attr))
+
+    def test_no_data_errors(self):
+        header = BTRFS_SEND_STREAM_MAGIC + struct.pack('<I', 1)
+        v2_header = BTRFS_SEND_STREAM_MAGIC + struct.pack('<I', 2)
+        # The DATA of version 2 must have room for its kind.
+        for name in ['stream', 'pipe']:
+            with self.subTest(parser=name), self.assertRaisesRegex(
+                RuntimeError, 'AttributeH.*DATA.* overflows CommandH',
+            ):
+                list(_NO_DATA_PARSERS[name](v2_header + struct.pack(
+                    '<IHIH', 1, CommandKind.WRITE.value, 0,
+                    AttributeKind.DATA.value,
+                )))
+
+        def write_cmd(length, *attrs):
+            return header + struct.pack(
+                '<IHI', length, CommandKind.WRITE.value, 0,
+            ) + b''.join(
+                struct.pack('<HH', kind.value, attr_len) + data
+                    for kind, attr_len, data in attrs
+            )
+
+        path = (AttributeKind.PATH, 3, b'cat')
+        for name, parse in _NO_DATA_PARSERS.items():
+            with self.subTest(parser=name):
+                # The buffer parsers see the command as truncated first.
+                with self.assertRaisesRegex(
+                    RuntimeError, 'Header.* got [0-9]+ bytes',
+                ):
+                    list(parse(write_cmd(
+                        2 * 4 + 3 + 5, path, (AttributeKind.DATA, 5, b'xyz'),
+                    )))
+                with self.assertRaisesRegex(
+                    RuntimeError, 'Header.* got [0-9]+ bytes',
+                ):
+                    list(parse(write_cmd(
+                        2 * 4 + 2 * 3, path, (AttributeKind.PATH, 3, b'do'),
+                    )))
+                with self.assertRaisesRegex(
+                    RuntimeError, '\\.PATH occurred twice',
+                ):
+                    list(parse(write_cmd(
+                        2 * 4 + 2 * 3, path, (AttributeKind.PATH, 3, b'dog'),
+                    )))
+        # The buffer parser reports the overflow as truncation instead.
+        for name in ['stream', 'pipe']:
+            with self.subTest(parser=name), self.assertRaisesRegex(
+                RuntimeError, 'AttributeH.* overflows CommandH',
+            ):
+                list(_NO_DATA_PARSERS[name](write_cmd(4 + 2, path)))
+
 
 if __name__ == '__main__':
     unittest.main()
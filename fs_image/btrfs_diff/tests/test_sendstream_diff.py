@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import dataclasses
+import os
+import struct
+import tempfile
+import unittest
+
+from io import BytesIO
+from unittest import mock
+
+from ..compact_inode_id import CompactInodeIDMap
+from ..inode_id import InodeIDMap
+from ..parse_send_stream import parse_send_stream
+from ..send_stream import SendStreamItems
+from ..sendstream_diff import diff_sendstreams, diff_subvolumes
+from ..subvolume import Subvolume
+from ..subvolume_cache import CachedSubvolumeSet, SubvolumeSetCache
+from ..write_send_stream import write_send_stream
+
+from .demo_sendstreams import gold_demo_sendstreams
+
+si = SendStreamItems
+
+
+def _sendstream(items) -> BytesIO:
+    out = BytesIO()
+    write_send_stream(out, items)
+    out.seek(0)
+    return out
+
+
+def _subvol(items):
+    subvol = Subvolume.new(id_map=CompactInodeIDMap.new(description='sv'))
+    for item in items:
+        subvol.apply_item(item)
+    return subvol
+
+
+class SendstreamDiffTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Print more data to simplify debugging
+        self.maxDiff = 12345
+
+    def test_gold_incremental(self):
+        gold = gold_demo_sendstreams()
+        for id_map_class in [InodeIDMap, CompactInodeIDMap]:
+            diff = list(diff_sendstreams(
+                BytesIO(gold['create_ops']['sendstream']),
+                BytesIO(gold['mutate_ops']['sendstream']),
+                id_map_class=id_map_class,
+            ))
+            self.assertEqual([
+                ('.', 'modified'),
+                ('dir_to_remove', 'removed'),
+                ('farewell', 'added'),
+                ('goodbye', 'removed'),
+                ('hello', 'removed'),
+                ('hello/world', 'removed'),
+                ('hello_big_hole', 'modified'),
+                ('hello_renamed', 'added'),
+                ('hello_renamed/een', 'added'),
+            ], [(d['path'], d['change']) for d in diff])
+            big_hole = diff[6]
+            self.assertEqual(['utimes', 'extents'], big_hole['changed_fields'])
+            self.assertEqual(2 - 2 ** 30, big_hole['size_delta'])
+            self.assertEqual(2 - 4096, big_hole['data_bytes_delta'])
+            self.assertIn(' d4096h1073737728)', big_hole['old'])
+            self.assertIn(' d2)', big_hole['new'])
+            een = diff[-1]
+            self.assertIsNone(een['old'])
+            self.assertNotIn('changed_fields', een)
+            self.assertEqual((5, 5), (
+                een['size_delta'], een['data_bytes_delta'],
+            ))
+
+    def test_full_sendstreams(self):
+        'Two full send-streams, and the send-streams of an old layer.'
+        gold = gold_demo_sendstreams()
+        create_ops = list(parse_send_stream(
+            BytesIO(gold['create_ops']['sendstream']),
+        ))
+        # The same subvolume, sent again under another UUID.
+        create_ops_copy = [
+            dataclasses.replace(create_ops[0], uuid=b'0' * 32),
+            *create_ops[1:],
+        ]
+        self.assertEqual([], list(diff_sendstreams(
+            _sendstream(create_ops), _sendstream(create_ops_copy),
+        )))
+        self.assertEqual(9, len(list(diff_sendstreams(
+            BytesIO(gold['mutate_ops']['sendstream']),
+            _sendstream(create_ops_copy),
+            parent_infiles=[_sendstream(create_ops)],
+        ))))
+        with self.assertRaisesRegex(RuntimeError, 'must specify subvolume'):
+            list(diff_sendstreams(
+                _sendstream(create_ops[1:]), _sendstream(create_ops_copy),
+            ))
+
+    def test_cache(self):
+        gold = gold_demo_sendstreams()
+        create = BytesIO(gold['create_ops']['sendstream'])
+        mutate = BytesIO(gold['mutate_ops']['sendstream'])
+        expected = list(diff_sendstreams(create, mutate))
+        with tempfile.TemporaryDirectory() as td:
+            cache = SubvolumeSetCache(td, max_bytes=2 ** 30)
+            for infile in [create, mutate]:
+                infile.seek(0)
+            self.assertEqual(
+                expected, list(diff_sendstreams(create, mutate, cache=cache)),
+            )
+            self.assertEqual(1, len(os.listdir(td)))
+            # A cache hit does not parse the send-streams.
+            for infile in [create, mutate]:
+                infile.seek(0)
+            with mock.patch(
+                'fs_image.btrfs_diff.sendstream_diff._replay',
+                side_effect=AssertionError,
+            ):
+                self.assertEqual(expected, list(diff_sendstreams(
+                    create, mutate, cache=cache,
+                )))
+
+            # `get` does not check the records, so a corrupt one makes us
+            # replay the send-streams instead.
+            for infile in [create, mutate]:
+                infile.seek(0)
+            with mock.patch.object(
+                CachedSubvolumeSet, '_decode_subvolume',
+                side_effect=struct.error,
+            ):
+                self.assertEqual(expected, list(diff_sendstreams(
+                    create, mutate, cache=cache,
+                )))
+            self.assertEqual(1, len(os.listdir(td)))
+
+    def test_diff_subvolumes(self):
+        old = _subvol([
+            si.mkdir(path=b'd'),
+            si.mkfile(path=b'd/f'),
+            si.mkfile(path=b'became_dir'),
+            si.mkdir(path=b'gone'),
+            si.mkfile(path=b'gone/f'),
+            si.write(path=b'gone/f', offset=0, data=b'abc'),
+        ])
+        new = _subvol([
+            si.mkdir(path=b'd'),
+            si.mkfile(path=b'd/f'),
+            si.chmod(path=b'd/f', mode=0o600),
+            si.mkdir(path=b'became_dir'),
+            si.mkdir(path=b'became_dir/e'),
+            si.mkfifo(path=b'became_dir/e/fifo'),
+        ])
+        self.assertEqual([], list(diff_subvolumes(old, old)))
+        self.assertEqual([
+            {
+                'path': 'became_dir', 'change': 'removed',
+                'old': '(File)', 'new': None,
+                'size_delta': 0, 'data_bytes_delta': 0,
+            },
+            {
+                'path': 'became_dir', 'change': 'added',
+                'old': None, 'new': '(Dir)',
+                'size_delta': 0, 'data_bytes_delta': 0,
+            },
+            {
+                'path': 'became_dir/e', 'change': 'added',
+                'old': None, 'new': '(Dir)',
+                'size_delta': 0, 'data_bytes_delta': 0,
+            },
+            {
+                'path': 'became_dir/e/fifo', 'change': 'added',
+                'old': None, 'new': '(FIFO)',
+                'size_delta': 0, 'data_bytes_delta': 0,
+            },
+            {
+                'path': 'd/f', 'change': 'modified',
+                'old': '(File)', 'new': '(File m600)',
+                'size_delta': 0, 'data_bytes_delta': 0,
+                'changed_fields': ['mode'],
+            },
+            {
+                'path': 'gone', 'change': 'removed',
+                'old': '(Dir)', 'new': None,
+                'size_delta': 0, 'data_bytes_delta': 0,
+            },
+            {
+                'path': 'gone/f', 'change': 'removed',
+                'old': '(File d3)', 'new': None,
+                'size_delta': -3, 'data_bytes_delta': -3,
+            },
+        ], list(diff_subvolumes(old, new)))
+        self.assertEqual(
+            ['d/f'], [d['path'] for d in diff_subvolumes(old, new, b'd')],
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
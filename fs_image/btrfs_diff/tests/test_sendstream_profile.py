@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+
+from collections import Counter
+from io import BytesIO
+
+from ..inode_id import InodeIDMap
+from ..send_stream import SendStreamItems
+from ..sendstream_profile import (
+    gen_folded_stacks, gen_report_lines, profile_sendstream, stream_bytes,
+    subtree_totals,
+)
+from ..write_send_stream import serialize_item, write_send_stream
+
+from .demo_sendstreams import gold_demo_sendstreams
+
+si = SendStreamItems
+
+
+def _sendstream(items) -> bytes:
+    out = BytesIO()
+    write_send_stream(out, items)
+    return out.getvalue()
+
+
+class SendstreamProfileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Print more data to simplify debugging
+        self.maxDiff = 12345
+
+    def _check_total(self, path_to_counts, sendstream: bytes):
+        self.assertEqual(len(sendstream), sum(
+            stream_bytes(c) for c in path_to_counts.values()
+        ))
+        self.assertEqual(
+            len(sendstream), stream_bytes(subtree_totals(path_to_counts)[b'.'])
+        )
+
+    def test_gold(self):
+        gold = gold_demo_sendstreams()
+        create_ops = gold['create_ops']['sendstream']
+        mutate_ops = gold['mutate_ops']['sendstream']
+        for id_map_class in [InodeIDMap, None]:
+            kwargs = {} if id_map_class is None \
+                else {'id_map_class': id_map_class}
+            create = profile_sendstream(BytesIO(create_ops), **kwargs)
+            self._check_total(create, create_ops)
+            # `goodbye` is hardlinked to `hello/world`.
+            self.assertNotIn(b'hello/world', create)
+            self.assertEqual(
+                57344, create[b'56KB_nuls_clone']['clone_saved'],
+            )
+            self.assertEqual(0, create[b'56KB_nuls_clone']['data'])
+            self.assertEqual(57344, create[b'56KB_nuls']['data'])
+
+            mutate = profile_sendstream(
+                BytesIO(mutate_ops), parent_infiles=[BytesIO(create_ops)],
+                **kwargs,
+            )
+            self._check_total(mutate, mutate_ops)
+            self.assertEqual({
+                b'.', b'dir_to_remove', b'farewell', b'hello_big_hole',
+                b'hello_renamed', b'hello_renamed/een',
+            }, set(mutate))
+
+    def test_categories(self):
+        subvol = si.subvol(path=b'sv', uuid=b'0' * 32, transid=7)
+        hdr_and_subvol = 17 + len(serialize_item(subvol))
+        cmds = [
+            si.mkdir(path=b'o257-7-0'),
+            si.rename(path=b'o257-7-0', dest=b'd'),
+            si.mkfile(path=b'o258-7-0'),
+            si.rename(path=b'o258-7-0', dest=b'd/f'),
+            si.write(path=b'd/f', offset=0, data=b'x' * 100),
+            si.set_xattr(path=b'd/f', name=b'user.a', data=b'b'),
+            si.mkfile(path=b'o259-7-0'),
+            si.rename(path=b'o259-7-0', dest=b'd/c;\n'),
+            si.truncate(path=b'd/c;\n', size=100),
+            si.clone(
+                path=b'd/c;\n', offset=0, len=100, from_uuid=b'0' * 32,
+                from_transid=7, from_path=b'd/f', clone_offset=0,
+            ),
+            si.mkfile(path=b'o260-7-0'),
+            si.write(path=b'o260-7-0', offset=0, data=b'y' * 10),
+            si.unlink(path=b'o260-7-0'),
+        ]
+        sendstream = _sendstream([subvol, *cmds])
+        p = profile_sendstream(BytesIO(sendstream))
+        self._check_total(p, sendstream)
+
+        size = [len(serialize_item(c)) for c in cmds]
+        end = 10
+        self.assertEqual({
+            b'.': Counter(metadata=hdr_and_subvol + end),
+            b'd': Counter(metadata=size[0] + size[1]),
+            b'd/f': Counter(
+                data=100, xattr=size[5],
+                metadata=size[2] + size[3] + size[4] - 100,
+            ),
+            b'd/c;\n': Counter(
+                metadata=sum(size[6:10]), clone_saved=100,
+            ),
+            # Deleted, so it keeps its last path.
+            b'o260-7-0': Counter(
+                data=10, metadata=size[10] + size[11] + size[12] - 10,
+            ),
+        }, p)
+
+        totals = subtree_totals(p)
+        self.assertEqual(
+            stream_bytes(p[b'd']) + stream_bytes(p[b'd/f'])
+                + stream_bytes(p[b'd/c;\n']),
+            stream_bytes(totals[b'd']),
+        )
+        self.assertEqual(100, totals[b'.']['clone_saved'])
+
+        lines = list(gen_report_lines(p))
+        self.assertEqual(
+            'subtree\town\tdata\txattr\tmetadata\tclone_saved\tpath', lines[0],
+        )
+        self.assertEqual([
+            '.', 'd', 'd/f', 'd/c;\n', 'o260-7-0',
+        ], [l.split('\t')[-1] for l in lines[1:]])
+        self.assertEqual([
+            str(len(sendstream)), str(stream_bytes(p[b'.'])), '110', str(
+                size[5]), str(len(sendstream) - 110 - size[5]), '100', '.',
+        ], lines[1].split('\t'))
+        self.assertEqual(lines[:3], list(gen_report_lines(p, top=2)))
+
+        self.assertEqual([
+            f'. {stream_bytes(p[b"."])}',
+            f'.;d {size[0] + size[1]}',
+            f'.;d;c?? {sum(size[6:10])}',
+            f'.;d;f {stream_bytes(p[b"d/f"])}',
+            f'.;o260-7-0 {stream_bytes(p[b"o260-7-0"])}',
+        ], list(gen_folded_stacks(p)))
+        self.assertEqual(
+            ['.;d;f 100', '.;o260-7-0 10'],
+            list(gen_folded_stacks(p, category='data')),
+        )
+        self.assertEqual(
+            ['.;d;c?? 100'],
+            list(gen_folded_stacks(p, category='clone_saved')),
+        )
+
+    def test_subtree_totals_of_deleted_dir(self):
+        self.assertEqual({
+            b'.': Counter(data=3),
+            b'gone': Counter(data=3),
+            b'gone/f': Counter(data=3),
+        }, subtree_totals({b'gone/f': Counter(data=3)}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,8 +5,13 @@
 # LICENSE file in the root directory of this source tree.
 
 import copy
+import io
+import json
+import os
+import random
 import unittest
 
+from ..compact_inode_id import CompactInodeIDMap
 from ..coroutine_utils import while_not_exited
 from ..extent import Extent
 from ..freeze import freeze
@@ -24,6 +29,69 @@ from .subvolume_utils import InodeRepr, expected_subvol_add_traversal_ids
 # `unittest`'s output shortening makes tests much harder to debug.
 unittest.util._MAX_LENGTH = 12345
 
+_PATHS = [b'a', b'b', b'd', b'd/a', b'd/e', b'd/e/a']
+
+
+def _random_item(rng):
+    si = SendStreamItems
+    path = rng.choice(_PATHS)
+    return rng.choice([
+        lambda: si.mkfile(path=path),
+        lambda: si.mkdir(path=path),
+        lambda: si.symlink(path=path, dest=b'x'),
+        lambda: si.write(
+            path=path, offset=rng.randrange(4),
+            data=b'x' * rng.randint(1, 4),
+        ),
+        lambda: si.truncate(path=path, size=rng.randrange(6)),
+        lambda: si.clone(
+            path=path, offset=rng.randrange(4), len=rng.randint(1, 3),
+            from_uuid=b'', from_transid=0, from_path=rng.choice(_PATHS),
+            clone_offset=rng.randrange(2),
+        ),
+        lambda: si.chmod(path=path, mode=rng.randrange(0o1000)),
+        lambda: si.chown(path=path, uid=rng.randrange(2), gid=0),
+        lambda: si.utimes(
+            path=path, atime=(rng.randrange(2), 0), mtime=(0, 0),
+            ctime=(0, 0),
+        ),
+        lambda: si.set_xattr(path=path, name=b'n', data=b'v'),
+        lambda: si.remove_xattr(path=path, name=b'n'),
+        lambda: si.link(path=path, dest=rng.choice(_PATHS)),
+        lambda: si.unlink(path=path),
+        lambda: si.rmdir(path=path),
+        lambda: si.rename(path=path, dest=rng.choice(_PATHS)),
+    ])()
+
+
+def _reference_changed_paths(a: Subvolume, b: Subvolume):
+    'Unlike `changed_paths`, compares every path.'
+
+    def path_to_repr_and_is_dir(subvol):
+        result = {}
+        with while_not_exited(subvol.gather_bottom_up()) as ctx:
+            while True:
+                path, ino, child_results = ctx.send(None)
+                result[path] = (repr(ino), child_results is not None)
+        return result
+
+    a_paths = path_to_repr_and_is_dir(a)
+    b_paths = path_to_repr_and_is_dir(b)
+
+    def has_dir_ancestors(path):
+        while path != b'.':
+            path = os.path.dirname(path) or b'.'
+            if not (a_paths.get(path, ('', False))[1]
+                    and b_paths.get(path, ('', False))[1]):
+                return False
+        return True
+
+    return sorted((
+        path for path in a_paths.keys() | b_paths.keys()
+            if has_dir_ancestors(path)
+                and a_paths.get(path) != b_paths.get(path)
+    ), key=lambda p: () if p == b'.' else tuple(p.split(b'/')))
+
 
 class SubvolumeTestCase(DeepCopyTestCase):
     def setUp(self):
@@ -344,6 +412,232 @@ class SubvolumeTestCase(DeepCopyTestCase):
     def test_subvolume(self):
         self.check_deepcopy_at_each_step(self._check_subvolume)
 
+    def _check_render_json(self, subvol, top_path=b'.', **kwargs):
+        for all_ids, emit_fn in [
+            (False, emit_non_unique_traversal_ids),
+            (True, emit_all_traversal_ids),
+        ]:
+            out = io.StringIO()
+            subvol.render_json(
+                out, top_path, all_traversal_ids=all_ids, **kwargs,
+            )
+            self.assertEqual(
+                json.dumps(emit_fn(subvol.render(top_path))),
+                out.getvalue(),
+            )
+
+    def test_render_json(self):
+        subvol = None
+        with while_not_exited(self._check_subvolume()) as ctx:
+            while True:
+                step, subvol = ctx.send(subvol)
+                with self.subTest(step):
+                    self._check_render_json(subvol)
+                    self._check_render_json(freeze(subvol))
+                    self._check_render_json(
+                        freeze(subvol, shared_extents=True),
+                    )
+                    if step == 'tiger after hardlink':
+                        out = io.StringIO()
+                        subvol.render_json(out)
+                        self.assertEqual(
+                            '["(Dir o123:456)", {'
+                            '"tamaskan": [["(File m700 d3)", 0]], '
+                            '"wolf": [["(File m700 d3)", 0]]}]',
+                            out.getvalue(),
+                        )
+                        self._check_render_json(subvol, b'wolf')
+
+    def test_deep_tree(self):
+        'The traversals use explicit stacks, so depth is not limited.'
+        si = SendStreamItems
+        subvol = Subvolume.new(id_map=CompactInodeIDMap.new())
+        path = b'.'
+        for _ in range(1500):
+            path = os.path.normpath(path + b'/d')
+            subvol.apply_item(si.mkdir(path=path))
+        subvol.apply_item(si.mkfile(path=path + b'/f'))
+        out = io.StringIO()
+        subvol.render_json(out)
+        self.assertEqual(
+            '["(Dir)", {"d": ' * 1500 + '["(Dir)", {"f": ["(File)"]}]'
+                + '}]' * 1500,
+            out.getvalue(),
+        )
+        num_inodes = 0
+        with while_not_exited(subvol.gather_bottom_up()) as ctx:
+            while True:
+                ctx.send(None)
+                num_inodes += 1
+        self.assertEqual(1502, num_inodes)
+        self.assertEqual(subvol.digest(), freeze(subvol).digest())
+
+    def test_digest(self):
+        si = SendStreamItems
+        cat = Subvolume.new(id_map=InodeIDMap.new(description='cat'))
+        for item in [
+            si.mkdir(path=b'd'),
+            si.mkdir(path=b'd/e'),
+            si.mkfile(path=b'd/e/f'),
+            si.write(path=b'd/e/f', offset=0, data=b'abc'),
+            si.mkfile(path=b'g'),
+            si.set_xattr(path=b'g', name=b'x1', data=b'v'),
+            si.set_xattr(path=b'g', name=b'x2', data=b'v'),
+        ]:
+            cat.apply_item(item)
+        dog = Subvolume.new(id_map=CompactInodeIDMap.new(description='dog'))
+        # Same filesystem, different history: xattr order, clones, renames.
+        for item in [
+            si.mkfile(path=b'g'),
+            si.set_xattr(path=b'g', name=b'x2', data=b'v'),
+            si.set_xattr(path=b'g', name=b'x1', data=b'v'),
+            si.mkfile(path=b'tmp'),
+            si.write(path=b'tmp', offset=0, data=b'abc'),
+            si.mkdir(path=b'e'),
+            si.mkdir(path=b'd'),
+            si.rename(path=b'e', dest=b'd/e'),
+        ]:
+            dog.apply_item(item)
+        dog.apply_item(si.mkfile(path=b'd/e/f'))
+        dog.apply_clone(si.clone(
+            path=b'd/e/f', offset=0, len=3, from_uuid=b'', from_transid=0,
+            from_path=b'tmp', clone_offset=0,
+        ), dog)
+        dog.apply_item(si.unlink(path=b'tmp'))
+        self.assertEqual(cat.digest(), dog.digest())
+        self.assertEqual(cat.digest(b'd/e'), dog.digest(b'd/e'))
+        self.assertNotEqual(cat.digest(b'd/e'), cat.digest(b'd'))
+        self.assertEqual(cat.digest(), freeze(cat).digest())
+        self.assertEqual([], list(cat.changed_paths(dog)))
+        self.assertEqual(len(cat.id_to_inode), len(cat.digests))
+
+        # A change drops only the digests of the inode & its ancestors.
+        dog_digests = dict(dog.digests)
+        dog.apply_item(si.chmod(path=b'd/e/f', mode=0o600))
+        self.assertEqual(
+            {
+                dog.id_map.get_id(p).id
+                    for p in [b'.', b'd', b'd/e', b'd/e/f']
+            },
+            dog_digests.keys() - dog.digests.keys(),
+        )
+        self.assertEqual([b'd/e/f'], list(cat.changed_paths(dog)))
+
+        dog.apply_item(si.chmod(path=b'd', mode=0o700))
+        dog.apply_item(si.link(path=b'd/h', dest=b'g'))
+        dog.apply_item(si.mkdir(path=b'g2'))
+        self.assertEqual(
+            [b'd', b'd/e/f', b'd/h', b'g2'], list(cat.changed_paths(dog)),
+        )
+        self.assertEqual([b'd/e/f'], list(cat.changed_paths(dog, b'd/e')))
+        # Changing a hardlinked file changes both of its directories.
+        dog.apply_item(si.chown(path=b'd/h', uid=1, gid=1))
+        self.assertEqual(
+            [b'd', b'd/e/f', b'd/h', b'g', b'g2'],
+            list(cat.changed_paths(dog)),
+        )
+        # A file replaced by a directory is reported without its children.
+        cat.apply_item(si.mkdir(path=b'g2'))
+        cat.apply_item(si.mkfile(path=b'g2/f'))
+        cat.apply_item(si.unlink(path=b'g'))
+        cat.apply_item(si.mkdir(path=b'g'))
+        cat.apply_item(si.mkfile(path=b'g/f'))
+        self.assertEqual(
+            [b'd', b'd/e/f', b'd/h', b'g', b'g2/f'],
+            list(cat.changed_paths(dog)),
+        )
+        self.assertEqual(
+            _reference_changed_paths(cat, dog), list(cat.changed_paths(dog)),
+        )
+        self.assertEqual(
+            cat._replace(digests={}).digest(), freeze(cat).digest(),
+        )
+
+    def test_digests_are_a_shared_cache(self):
+        si = SendStreamItems
+        for id_map_class in [InodeIDMap, CompactInodeIDMap]:
+            cat = Subvolume.new(id_map=id_map_class.new(description='cat'))
+            cat.apply_item(si.mkfile(path=b'f'))
+            cat.digest()
+            # Snapshots share the digests until either one changes.
+            kitten = cat.snapshot(description='kitten')
+            self.assertIs(cat.digests._dict, kitten.digests._dict)
+            self.assertIs(
+                freeze(cat).digests._dict, cat.digests._dict,
+            )
+            kitten.apply_item(si.chmod(path=b'f', mode=0o600))
+            self.assertIsNot(cat.digests._dict, kitten.digests._dict)
+            self.assertEqual(2, len(cat.digests))
+            self.assertEqual(0, len(kitten.digests))
+            # The cache does not affect equality.
+            self.assertEqual(cat, cat._replace(digests={}))
+            self.assertFalse(cat != cat._replace(digests=None))
+            self.assertNotEqual(cat, cat._replace(extent_class=None))
+            self.assertNotEqual(cat, 'cat')
+            # Snapshots keep working without a `CowDict`.
+            self.assertIsNone(cat._replace(digests=None).snapshot(
+                description='no cache',
+            ).digests)
+            self.assertEqual({0: b'x'}, cat._replace(
+                digests={0: b'x'},
+            ).snapshot(description='dict cache').digests)
+
+    def test_random_digests(self):
+        '''
+        Cached digests match fresh ones after random changes & snapshots,
+        and `changed_paths` matches a comparison of every path.
+        '''
+        results = []
+        for id_map_class in [InodeIDMap, CompactInodeIDMap]:
+            rng = random.Random(11)
+            result = []
+            for _ in range(30):
+                subvols = [
+                    Subvolume.new(id_map=id_map_class.new(description='0')),
+                ]
+                for step in range(60):
+                    subvol = subvols[-1]
+                    item = _random_item(rng)
+                    try:
+                        if isinstance(item, SendStreamItems.clone):
+                            subvol.apply_clone(item, rng.choice(subvols))
+                        else:
+                            subvol.apply_item(item)
+                    except (KeyError, RuntimeError):
+                        pass
+                    if rng.random() < 0.3:
+                        self.assertEqual(
+                            subvol._replace(digests={}).digest(),
+                            subvol.digest(),
+                        )
+                    else:  # Cache just some of the digests
+                        try:
+                            subvol.digest(rng.choice(_PATHS))
+                        except (AssertionError, RuntimeError):
+                            pass
+                    if step % 15 == 14:
+                        subvols.append(subvol.snapshot(
+                            description=str(len(subvols)),
+                        ))
+                for subvol in subvols:
+                    frozen = freeze(subvol)
+                    self.assertEqual(
+                        subvol._replace(digests={}).digest(),
+                        subvol.digest(),
+                    )
+                    self.assertEqual(subvol.digest(), frozen.digest())
+                    self.assertEqual(
+                        subvol.digest(), frozen._replace(digests={}).digest(),
+                    )
+                    result.append(subvol.digest())
+                for a, b in zip(subvols, subvols[1:]):
+                    changed = list(a.changed_paths(b))
+                    self.assertEqual(_reference_changed_paths(a, b), changed)
+                    self.assertEqual(changed, list(b.changed_paths(a)))
+                    result.append(changed)
+            results.append(result)
+        self.assertEqual(*results)
+
     def test_rendered_tree(self):
         'Miscellaneous coverage over `rendered_tree.py`.'
         with self.assertRaisesRegex(RuntimeError, 'Unknown type in rendered'):
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import struct
+import tempfile
+import unittest
+
+from io import BytesIO
+
+from ..compact_inode_id import CompactInodeIDMap
+from ..extent import Extent
+from ..flat_extent import FlatExtent
+from ..freeze import freeze
+from ..incomplete_inode import IncompleteFifo
+from ..inode_id import InodeIDMap
+from ..rendered_tree import emit_all_traversal_ids
+from ..send_stream import SendStreamItems
+from ..subvolume import Subvolume
+from ..subvolume_cache import (
+    _EXTENT_CLASSES, _HEADER, _ID_MAP_CLASSES, _INDEX_ENTRY, _LEAF, _SUBVOL,
+    _SUFFIX, _UINT32, _unlink_if_exists, cache_key, CachedSubvolumeSet,
+    SubvolumeSetCache,
+)
+from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
+
+from .demo_sendstreams import gold_demo_sendstreams
+from .render_subvols import add_sendstream_to_subvol_set
+
+si = SendStreamItems
+
+
+def _gold_subvols(**kwargs) -> SubvolumeSet:
+    subvols = SubvolumeSet.new(**kwargs)
+    for d in gold_demo_sendstreams().values():
+        add_sendstream_to_subvol_set(subvols, d['sendstream'])
+    return subvols
+
+
+def _add_subvol(subvols: SubvolumeSet):
+    'Snapshots the last subvolume, with a hardlink and a cross-subvol clone.'
+    first, *_, last = subvols.uuid_to_subvolume.values()
+    mutator = SubvolumeSetMutator.new(subvols, si.snapshot(
+        path=b'cached', uuid=b'cached', transid=7,
+        parent_uuid=last.id_map.inner.description.id.uuid.encode(),
+        parent_transid=3,
+    ))
+    mutator.apply_item(si.mkfile(path=b'new'))
+    mutator.apply_item(si.link(path=b'new_link', dest=b'new'))
+    mutator.apply_item(si.clone(
+        path=b'new', offset=0, len=3,
+        from_uuid=first.id_map.inner.description.id.uuid.encode(),
+        from_transid=1, from_path=b'hello_big_hole', clone_offset=0,
+    ))
+
+
+def _describe(subvols: SubvolumeSet):
+    'Order-sensitive, since the order of `uuid_to_subvolume` matters.'
+    return [
+        list(subvols.uuid_to_subvolume),
+        subvols.name_uuid_prefix_counts,
+        *(
+            (
+                frozen.map(lambda sv: emit_all_traversal_ids(sv.render())),
+                [repr(ino) for ino in frozen.inodes()],
+            ) for frozen in [
+                freeze(subvols), freeze(subvols, shared_extents=True),
+            ]
+        ),
+        [sv.digest() for sv in subvols.uuid_to_subvolume.values()],
+    ]
+
+
+class SubvolumeCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Print more data to simplify debugging
+        self.maxDiff = 12345
+        td = tempfile.TemporaryDirectory()
+        self.addCleanup(td.cleanup)
+        self.cache = SubvolumeSetCache(td.name, max_bytes=2 ** 30)
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache.path, key + _SUFFIX)
+
+    def test_round_trip(self):
+        for id_map_class in [InodeIDMap, CompactInodeIDMap]:
+            for extent_class in [Extent, FlatExtent]:
+                kwargs = {
+                    'id_map_class': id_map_class, 'extent_class': extent_class,
+                }
+                with self.subTest(**kwargs):
+                    subvols = _gold_subvols(**kwargs)
+                    self.cache.put('k', subvols)
+                    with self.cache.get('k') as cached:
+                        self.assertIs(id_map_class, cached.id_map_class)
+                        self.assertIs(extent_class, cached.extent_class)
+                        restored = cached.subvolume_set()
+                    self.assertEqual(_describe(subvols), _describe(restored))
+                    # The restored set keeps working like the original.
+                    for s in [subvols, restored]:
+                        _add_subvol(s)
+                    self.assertEqual(_describe(subvols), _describe(restored))
+                    self.assertIn(
+                        'create_ops@hello_big_hole:0+3@0',
+                        repr(freeze(restored).uuid_to_subvolume[
+                            'cached'
+                        ].inode_at_path(b'new_link')),
+                    )
+                    # Entries are deterministic, even via the cache.
+                    self.cache.put('k2', restored)
+                    with open(self._entry_path('k2'), 'rb') as f2:
+                        self.cache.put('k', subvols)
+                        with open(self._entry_path('k'), 'rb') as f:
+                            self.assertEqual(f.read(), f2.read())
+
+    def test_lazy_subvolume(self):
+        subvols = _gold_subvols(id_map_class=CompactInodeIDMap)
+        _add_subvol(subvols)
+        self.cache.put('k', subvols)
+        with self.cache.get('k') as cached:
+            self.assertEqual(list(subvols.uuid_to_subvolume), cached.uuids)
+            for uuid, subvol in subvols.uuid_to_subvolume.items():
+                loaded = cached.subvolume(uuid)
+                self.assertEqual(
+                    emit_all_traversal_ids(subvol.render()),
+                    emit_all_traversal_ids(loaded.render()),
+                )
+                self.assertEqual(
+                    repr(subvol.id_map.inner.description),
+                    repr(loaded.id_map.inner.description),
+                )
+                self.assertIsNot(loaded, cached.subvolume(uuid))
+            # Subvolumes that are loaded separately share leaf extents.
+            a = cached.subvolume('cached').inode_at_path(b'new')
+            b = cached.subvolume(cached.uuids[0]).inode_at_path(
+                b'hello_big_hole',
+            )
+            (_, _, leaf), = a.extent.gen_trimmed_leaves()
+            self.assertIs(leaf, next(b.extent.gen_trimmed_leaves())[2])
+
+    def test_cache_key(self):
+        gold = gold_demo_sendstreams()
+        create = BytesIO(gold['create_ops']['sendstream'])
+        mutate = BytesIO(gold['mutate_ops']['sendstream'])
+        mutate.read(5)
+        key = cache_key([create, mutate])
+        self.assertEqual((0, 5), (create.tell(), mutate.tell()))
+        mutate.seek(0)
+        self.assertEqual(64, len(key))
+        self.assertNotEqual(key, cache_key([create, mutate]))
+        mutate.seek(5)
+        self.assertEqual(key, cache_key([create, mutate]))
+        self.assertNotEqual(key, cache_key([mutate, create]))
+        self.assertNotEqual(key, cache_key([create]))
+        self.assertNotEqual(
+            key, cache_key([create, mutate], extent_class=FlatExtent),
+        )
+        self.assertNotEqual(
+            key, cache_key([create, mutate], id_map_class=CompactInodeIDMap),
+        )
+
+    def test_lru_eviction(self):
+        subvols = _gold_subvols()
+        for key in 'abc':
+            self.cache.put(key, subvols)
+        size = os.stat(self._entry_path('a')).st_size
+        for mtime, key in enumerate('abc'):
+            os.utime(self._entry_path(key), ns=(mtime, mtime))
+        self.cache.get('a').close()  # Now `b` is the least recently used
+        self.cache.max_bytes = 2 * size
+        self.cache.put('d', subvols)
+        self.assertEqual(
+            ['a', 'd'], sorted(
+                n[:-len(_SUFFIX)] for n in os.listdir(self.cache.path)
+            ),
+        )
+        self.assertIsNone(self.cache.get('b'))
+        # An entry that is too big for the cache is dropped at once.
+        self.cache.max_bytes = 0
+        self.cache.put('e', subvols)
+        self.assertEqual([], os.listdir(self.cache.path))
+
+    def test_bad_entries(self):
+        subvols = _gold_subvols()
+        self.cache.put('k', subvols)
+        with open(self._entry_path('k'), 'rb') as f:
+            good = f.read()
+        header = _HEADER.unpack_from(good)
+        num_leaves = header[4]
+        index_pos = _HEADER.size + num_leaves * _LEAF.size
+        name_pos = index_pos + _INDEX_ENTRY.size
+        name_len, = _UINT32.unpack_from(good, name_pos)
+        uuid_pos = name_pos + _UINT32.size + name_len + _UINT32.size
+
+        def bad_header(field, value):
+            fields = list(header)
+            fields[field] = value
+            return _HEADER.pack(*fields) + good[_HEADER.size:]
+
+        for bad in [
+            b'', good[:-1], good + b'\0', b'x' + good[1:],
+            good[:8] + b'\xff' + good[9:],  # Another FORMAT_VERSION
+            bad_header(2, len(_ID_MAP_CLASSES)),  # Unknown ID map class
+            bad_header(3, len(_EXTENT_CLASSES)),  # Unknown extent class
+            bad_header(5, 2 ** 31),  # The subvolumes cannot fit
+            # The name runs past the end of the entry.
+            good[:name_pos] + _UINT32.pack(2 ** 31) +
+                good[name_pos + _UINT32.size:],
+            # The UUID is not UTF-8.
+            good[:uuid_pos] + b'\xff' + good[uuid_pos + 1:],
+        ]:
+            with open(self._entry_path('bad'), 'wb') as f:
+                f.write(bad)
+            self.assertIsNone(self.cache.get('bad'))
+            self.assertFalse(os.path.exists(self._entry_path('bad')))
+
+        # Bad records are only detected once we load them.
+        offset, size, *rest = _INDEX_ENTRY.unpack_from(good, index_pos)
+        with open(self._entry_path('bad'), 'wb') as f:
+            f.write(good[:index_pos])
+            f.write(_INDEX_ENTRY.pack(offset, size - 1, *rest))
+            f.write(good[index_pos + _INDEX_ENTRY.size:])
+        with self.cache.get('bad') as cached, \
+                self.assertRaisesRegex(RuntimeError, 'is corrupted'):
+            cached.subvolume(cached.uuids[0])
+
+        # So are records that make the decoder read garbage.
+        with self.cache.get('k') as cached:
+            uuid = cached.uuids[0]
+            _, record_pos, _ = cached._uuid_to_record[uuid]
+        next_id, num_inodes, _ = _SUBVOL.unpack_from(good, record_pos)
+        with open(self._entry_path('bad'), 'wb') as f:
+            f.write(good[:record_pos])
+            f.write(_SUBVOL.pack(next_id, num_inodes, 2 ** 31))
+            f.write(good[record_pos + _SUBVOL.size:])
+        with self.cache.get('bad') as cached, \
+                self.assertRaisesRegex(RuntimeError, 'is corrupted') as ctx:
+            cached.subvolume(uuid)
+        self.assertIsInstance(
+            ctx.exception.__cause__, (KeyError, struct.error),
+        )
+        # Concurrent readers may race to delete a bad entry.
+        for _ in range(2):
+            _unlink_if_exists(self._entry_path('bad'))
+        self.assertFalse(os.path.exists(self._entry_path('bad')))
+
+    def test_cannot_cache(self):
+        with self.assertRaisesRegex(RuntimeError, 'frozen SubvolumeSet'):
+            self.cache.put('k', freeze(_gold_subvols()))
+        with self.assertRaisesRegex(RuntimeError, 'that uses'):
+            self.cache.put('k', SubvolumeSet.new(id_map_class=dict))
+        with self.assertRaisesRegex(RuntimeError, 'that uses'):
+            self.cache.put('k', SubvolumeSet.new(extent_class=dict))
+        subvols = SubvolumeSet.new()
+        subvols.uuid_to_subvolume['x'] = Subvolume.new(
+            id_map=InodeIDMap.new(description='x'),
+        )
+        with self.assertRaisesRegex(RuntimeError, 'SubvolumeDescription'):
+            self.cache.put('k', subvols)
+        subvols = _gold_subvols()
+        subvol = next(iter(subvols.uuid_to_subvolume.values()))
+        subvol.id_to_inode[subvol.id_map.get_id(b'.')] = freeze(
+            subvol.inode_at_path(b'.'), chunks=None,
+        )
+        with self.assertRaisesRegex(RuntimeError, 'only cache Incomplete'):
+            self.cache.put('k', subvols)
+        self.assertEqual([], os.listdir(self.cache.path))
+
+    def test_unknown_file_type(self):
+        subvols = SubvolumeSet.new()
+        mutator = SubvolumeSetMutator.new(
+            subvols, si.subvol(path=b's', uuid=b's', transid=0),
+        )
+        mutator.apply_item(si.mkfifo(path=b'f'))
+        fifo = mutator.subvolume.inode_at_path(b'f')
+        self.assertIsInstance(fifo, IncompleteFifo)
+        fifo.file_type = 0
+        self.cache.put('k', subvols)
+        with self.cache.get('k') as cached, \
+                self.assertRaisesRegex(RuntimeError, 'unknown file type 0'):
+            cached.subvolume('s')
+
+    def test_open_closes_on_error(self):
+        self.cache.put('k', _gold_subvols())
+        with open(self._entry_path('k'), 'r+b') as f:
+            f.write(b'x')
+            f.seek(0)
+            with self.assertRaisesRegex(RuntimeError, 'Not a version'):
+                CachedSubvolumeSet(f)
+
+
+if __name__ == '__main__':
+    unittest.main()
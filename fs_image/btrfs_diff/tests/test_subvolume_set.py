@@ -9,7 +9,7 @@ import unittest
 
 from ..freeze import freeze
 from ..parse_dump import SendStreamItems
-from ..rendered_tree import emit_all_traversal_ids
+from ..rendered_tree import emit_all_traversal_ids, TraversalIDMaker
 from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
 
 from .subvolume_utils import expected_subvol_add_traversal_ids
@@ -26,7 +26,10 @@ class SubvolumeSetTestCase(unittest.TestCase):
         self.maxDiff = 12345
         unittest.util._MAX_LENGTH = 12345
 
-    def _check_repr(self, expected, subvol_set: SubvolumeSet):
+    def _check_repr(
+        self, expected, subvol_set: SubvolumeSet,
+        render=lambda subvol: subvol.render(),
+    ):
         self.assertEqual(*[
             {desc: emit_all_traversal_ids(sv) for desc, sv in ser.items()}
                 for ser in (
@@ -35,7 +38,7 @@ class SubvolumeSetTestCase(unittest.TestCase):
                         desc: expected_subvol_add_traversal_ids(ser_subvol)
                             for desc, ser_subvol in expected.items()
                     },
-                    subvol_set.map(lambda subvol: subvol.render()),
+                    subvol_set.map(render),
                 )
         ])
 
@@ -144,6 +147,25 @@ class SubvolumeSetTestCase(unittest.TestCase):
         }, freeze(subvols)))
         self._check_repr(*reprs_and_frozens[-1])
 
+        # Single inodes can be frozen with their clones, without `freeze`.
+        self.assertEqual(
+            {
+                'cat': '(File h5(tiger@to:1+2@2))',
+                'tiger': '(File d1(cat@from:0+1@0/cat@to:0+1@0)'
+                    'h2(cat@hole:2+2@0))',
+            },
+            {
+                desc: repr(subvols.freeze_inode_at_path(sv, path))
+                    for desc, sv, path in [
+                        ('cat', cat, b'hole'), ('tiger', tiger, b'to'),
+                    ]
+            },
+        )
+        self.assertEqual('(Dir)', repr(subvols.freeze_inode_at_path(
+            tiger, b'.',
+        )))
+        self.assertIsNone(subvols.freeze_inode_at_path(tiger, b'hole'))
+
         # Get `repr` to show some disambiguation
         cat2 = SubvolumeSetMutator.new(subvols, si.subvol(
             path=b'cat', uuid=b'app', transid=3,
@@ -189,6 +211,48 @@ class SubvolumeSetTestCase(unittest.TestCase):
         for expected, frozen in reprs_and_frozens:
             self._check_repr(expected, frozen)
 
+    def test_shared_extents(self):
+        si = SendStreamItems
+        subvols = SubvolumeSet.new()
+        cat_mutator = SubvolumeSetMutator.new(subvols, si.subvol(
+            path=b'cat', uuid=b'abe', transid=3,
+        ))
+        cat_mutator.apply_item(si.mkfile(path=b'from'))
+        cat_mutator.apply_item(si.write(path=b'from', offset=0, data='hi'))
+        cat_mutator.apply_item(si.mkfile(path=b'to'))
+        cat_mutator.apply_item(si.mkfile(path=b'hole'))
+        cat_mutator.apply_item(si.truncate(path=b'hole', size=5))
+        cat_mutator.apply_item(si.clone(
+            path=b'to', offset=0, from_uuid=b'abe', from_transid=3,
+            from_path=b'from', clone_offset=0, len=2,
+        ))
+        tiger_mutator = SubvolumeSetMutator.new(subvols, si.snapshot(
+            path=b'tiger', uuid=b'ee', transid=7,
+            parent_uuid=b'abe', parent_transid=3,
+        ))
+        tiger_mutator.apply_item(si.unlink(path=b'from'))
+        tiger_mutator.apply_item(si.unlink(path=b'hole'))
+        tiger_mutator.apply_item(si.clone(
+            path=b'to', offset=1, len=2, from_uuid=b'abe', from_transid=3,
+            from_path=b'hole', clone_offset=2,
+        ))
+        # Each extent is named once, no matter how many times it is cloned.
+        # The names are assigned in traversal order, and are shared across
+        # subvolumes because we pass the same `extent_id_maker`.
+        extent_id_maker = TraversalIDMaker()
+        self._check_repr({
+            'cat': ['(Dir)', {
+                'from': ['(File d2[#0:0+2@0])'],
+                'hole': ['(File h5[#1:0+5@0])'],
+                'to': ['(File d2[#0:0+2@0])'],
+            }],
+            'tiger': ['(Dir)', {
+                'to': ['(File d1[#0:0+1@0]h2[#1:2+2@0])'],
+            }],
+        }, freeze(subvols, shared_extents=True), lambda subvol: subvol.render(
+            extent_id_maker=extent_id_maker,
+        ))
+
     def test_errors(self):
         si = SendStreamItems
         subvols = SubvolumeSet.new()
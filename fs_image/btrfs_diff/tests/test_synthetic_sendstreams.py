@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+
+from collections import Counter
+from io import BytesIO
+
+from ..freeze import freeze
+from ..inode import InodeOwner
+from ..parse_send_stream import parse_send_stream
+from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
+from ..write_send_stream import write_send_stream
+
+from .synthetic_sendstreams import (
+    SyntheticSendStreamSpec, gen_synthetic_sendstream_items,
+)
+
+
+def _replay(spec: SyntheticSendStreamSpec, subvols: SubvolumeSet):
+    out = BytesIO()
+    write_send_stream(out, gen_synthetic_sendstream_items(spec))
+    items = parse_send_stream(BytesIO(out.getvalue()))
+    mutator = SubvolumeSetMutator.new(subvols, next(items))
+    for item in items:
+        mutator.apply_item(item)
+    return mutator.subvolume
+
+
+class SyntheticSendstreamsTestCase(unittest.TestCase):
+
+    def test_shape(self):
+        spec = SyntheticSendStreamSpec(
+            num_inodes=300, fanout=5, hardlink_fraction=0.2,
+            clone_fraction=0.3, writes_per_file=3, write_size=10,
+        )
+        kinds = Counter(
+            type(i).__name__ for i in gen_synthetic_sendstream_items(spec)
+        )
+        self.assertEqual(120, kinds['mkdir'])
+        self.assertEqual(180, kinds['mkfile'])
+        self.assertEqual(300, kinds['rename'])
+        self.assertEqual(301, kinds['utimes'])
+        self.assertEqual(180, kinds['clone'] + kinds['truncate'])
+        self.assertEqual(3 * kinds['truncate'], kinds['write'])
+        self.assertLess(0, kinds['clone'])
+        self.assertLess(0, kinds['link'])
+
+        subvols = SubvolumeSet.new()
+        subvol = _replay(spec, subvols)
+        frozen = freeze(subvols)
+        for ino in frozen.inodes():
+            ino.assert_valid_and_complete()
+            self.assertEqual(InodeOwner(uid=0, gid=0), ino.owner)
+        # No temporary names are left, the tree is shallow, and every
+        # directory has up to `fanout` entries, plus hardlinks.
+        paths = [
+            p for ino_id in subvol.id_to_inode
+                for p in subvol.id_map.get_paths(ino_id) if p != b'.'
+        ]
+        self.assertEqual(300 + kinds['link'], len(paths))
+        self.assertFalse(any(b'/o' in b'/' + p for p in paths))
+        self.assertGreater(9, max(p.count(b'/') for p in paths))
+        # Without fragmentation, files are all data, and clones share it.
+        self.assertEqual({'d30'}, {
+            repr(ino.extent) for ino in subvol.inodes()
+                if hasattr(ino, 'extent')
+        })
+        self.assertTrue(any(
+            c.chunk_clones for ino in frozen.inodes()
+                if ino.chunks for c in ino.chunks
+        ))
+
+    def test_fragmentation(self):
+        spec = SyntheticSendStreamSpec(
+            num_inodes=50, fanout=10, clone_fraction=0, hardlink_fraction=0,
+            writes_per_file=8, write_size=3, fragmentation=1.0, seed=5,
+        )
+        subvol = _replay(spec, SubvolumeSet.new())
+        reprs = [
+            repr(ino.extent) for ino in subvol.inodes()
+                if hasattr(ino, 'extent')
+        ]
+        self.assertEqual(40, len(reprs))
+        self.assertTrue(all('h' in r for r in reprs))
+
+    def test_deterministic(self):
+        spec = SyntheticSendStreamSpec(num_inodes=100, fragmentation=0.5)
+        self.assertEqual(
+            list(gen_synthetic_sendstream_items(spec)),
+            list(gen_synthetic_sendstream_items(spec)),
+        )
+        self.assertNotEqual(
+            list(gen_synthetic_sendstream_items(spec)),
+            list(gen_synthetic_sendstream_items(spec._replace(seed=1))),
+        )
+
+    def test_many_subvols(self):
+        subvols = SubvolumeSet.new()
+        for idx in range(2):
+            _replay(SyntheticSendStreamSpec(
+                num_inodes=10, subvol_idx=idx,
+            ), subvols)
+        self.assertEqual(
+            {'synthetic0', 'synthetic1'},
+            set(freeze(subvols).map(lambda sv: None)),
+        )
+
+    def test_bad_fanout(self):
+        with self.assertRaisesRegex(RuntimeError, 'fanout of at least 3'):
+            next(gen_synthetic_sendstream_items(
+                SyntheticSendStreamSpec(fanout=2),
+            ))
+
+
+if __name__ == '__main__':
+    unittest.main()
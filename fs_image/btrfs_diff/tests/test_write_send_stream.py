@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import io
+import unittest
+
+from ..parse_send_stream import parse_send_stream
+from ..send_stream import SendStreamItems
+from ..write_send_stream import serialize_item, write_send_stream
+
+from .demo_sendstreams import gold_demo_sendstreams
+
+
+def _round_trip(items, **kwargs):
+    out = io.BytesIO()
+    write_send_stream(out, items, **kwargs)
+    return list(parse_send_stream(io.BytesIO(out.getvalue()), check_crc=True))
+
+
+class WriteSendStreamTestCase(unittest.TestCase):
+
+    def test_gold_round_trip(self):
+        for name, d in gold_demo_sendstreams().items():
+            with self.subTest(name):
+                items = list(parse_send_stream(io.BytesIO(d['sendstream'])))
+                self.assertEqual(items, _round_trip(items))
+
+    def test_items_absent_from_gold(self):
+        di = SendStreamItems
+        # The gold `mutate_ops` uses `update_extent` instead of `write`.
+        items = [
+            di.subvol(
+                path=b'sv', transid=7,
+                uuid=b'c0ffee00-0000-4000-8000-000000000000',
+            ),
+            di.mkfile(path=b'f'),
+            di.write(path=b'f', offset=3, data=b'data'),
+        ]
+        self.assertEqual(items, _round_trip(items))
+
+    def test_version_2(self):
+        'Also see `test_parse_send_stream.py`.'
+        di = SendStreamItems
+        items = [
+            di.subvol(
+                path=b'sv', transid=7,
+                uuid=b'c0ffee00-0000-4000-8000-000000000000',
+            ),
+            di.mkfile(path=b'f'),
+            di.write(path=b'f', offset=0, data=b'x' * 2 ** 16),
+            di.encoded_write(
+                path=b'f', offset=0, unencoded_file_len=5, unencoded_len=5,
+                unencoded_offset=0, compression=1, encryption=0,
+                data=b'zlib?',
+            ),
+            di.fallocate(path=b'f', mode=0, offset=0, len=7),
+            di.fileattr(path=b'f', attr=0x80),
+        ]
+        self.assertEqual(items, _round_trip(items, version=2))
+        with self.assertRaisesRegex(RuntimeError, 'DATA is too long'):
+            _round_trip(items[:3])
+
+    def test_without_crc(self):
+        sendstream = gold_demo_sendstreams()['create_ops']['sendstream']
+        items = list(parse_send_stream(io.BytesIO(sendstream)))
+        out = io.BytesIO()
+        write_send_stream(out, items, with_crc=False)
+        self.assertEqual(
+            items, list(parse_send_stream(io.BytesIO(out.getvalue()))),
+        )
+        with self.assertRaisesRegex(RuntimeError, 'has the wrong CRC32C'):
+            list(parse_send_stream(
+                io.BytesIO(out.getvalue()), check_crc=True,
+            ))
+
+    def test_errors(self):
+        with self.assertRaisesRegex(RuntimeError, 'PATH is too long: 65536'):
+            serialize_item(SendStreamItems.mkfile(path=b'x' * 2 ** 16))
+        with self.assertRaises(KeyError):
+            serialize_item(SendStreamItems)
+        with self.assertRaisesRegex(RuntimeError, 'requires send-stream ver'):
+            serialize_item(SendStreamItems.fileattr(path=b'f', attr=0))
+        with self.assertRaisesRegex(RuntimeError, 'send-stream version 3'):
+            write_send_stream(io.BytesIO(), [], version=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
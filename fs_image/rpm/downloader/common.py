@@ -7,25 +7,30 @@
 import requests
 import time
 import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from contextlib import contextmanager
 from io import BytesIO
 from typing import (
+    Any,
+    Callable,
     ContextManager,
     Dict,
     FrozenSet,
     Iterable,
     Iterator,
+    List,
     Mapping,
     NamedTuple,
     Optional,
+    Tuple,
     Union,
 )
 
 from fs_image.common import get_file_logger
 from fs_image.rpm.common import DecorateContextEntry, RpmShard, retryable
 from fs_image.rpm.db_connection import DBConnectionContext
-from fs_image.rpm.open_url import open_url
-from fs_image.rpm.repo_db import RepoDBContext, RepodataTable
+from fs_image.rpm.open_url import HTTPSessionPool, http_session_pool, open_url
+from fs_image.rpm.repo_db import RepoDBContext, StorageTable
 from fs_image.rpm.repo_objects import Checksum, Repodata, RepoMetadata, Rpm
 from fs_image.rpm.repo_snapshot import FileIntegrityError, HTTPError, MaybeStorageID
 from fs_image.rpm.storage import Storage
@@ -38,7 +43,14 @@ from fs_image.rpm.yum_dnf_conf import YumDnfConfRepo
 # complexity bug that makes it slow for large INPUT_CHUNK/OUTPUT_CHUNK.
 BUFFER_BYTES = 2 ** 19
 DB_MAX_RETRY_S = [2 ** i for i in range(8)]  # 255 sec == 4m15s
+# `RepoDBWriteBatcher` holds a storage ID for at most this long, so that a
+# partial batch does not delay the work that waits for it, e.g. scheduling
+# the RPMs of a primary repodata.
+DB_WRITE_MAX_DELAY_S = 1.0
 log = get_file_logger(__file__)
+# Gets the objects of one `RepoDBWriteBatcher.add` callback, with the storage
+# IDs from the DB.
+OnStoredFn = Callable[[List[Tuple[Union[Repodata, Rpm], str]]], None]
 
 
 def _is_retryable_mysql_err(e: Exception) -> bool:  # pragma: no cover
@@ -71,6 +83,8 @@ class DownloadConfig(NamedTuple):
     storage_cfg: Dict[str, str]
     rpm_shard: RpmShard
     threads: int
+    # How many storage IDs `RepoDBWriteBatcher` writes per transaction.
+    db_write_batch_size: int = 1000
 
     def new_db_conn(self, *, readonly: bool) -> DBConnectionContext:
         assert "readonly" not in self.db_cfg, "readonly is picked by the caller"
@@ -82,6 +96,11 @@ class DownloadConfig(NamedTuple):
     def new_storage(self):
         return Storage.from_json(self.storage_cfg)
 
+    def http_session_pool(self) -> HTTPSessionPool:
+        # Each of the `threads` workers may hold one keep-alive connection
+        # per host, so the downloads never wait on the pool.
+        return http_session_pool(self.threads)
+
 
 # Gets incrementally populated throughout repo downloading; used to carry info
 # through the concurrent downloads until the final repo snapshot is built
@@ -95,28 +114,187 @@ class DownloadResult(NamedTuple):
     rpms: Optional[FrozenSet[Rpm]] = None
 
 
+class RepoDBWriteBatcher:
+    """
+    Write-behind storage of storage IDs in the repo DB, which replaces a
+    `maybe_store` and a `commit` per downloaded object.  `add` queues an
+    object with its storage ID, and `flush` stores the queue via
+    `maybe_store_many`, `batch_size` objects per transaction.  Then, it
+    passes each `on_stored` callback the objects that were `add`ed with it,
+    together with their storage IDs from the DB, which differ from ours if
+    a racing writer stored the same object first.
+
+    `DownloadPipeline` calls `flush` from its driver thread, since SQLite
+    can run into locking issues with many concurrent writers.
+    """
+
+    def __init__(self, db_conn: DBConnectionContext, batch_size: int):
+        assert batch_size > 0, batch_size
+        self._db_conn = db_conn
+        self._batch_size = batch_size
+        self._queue: List[
+            Tuple[StorageTable, Union[Repodata, Rpm], str, OnStoredFn]
+        ] = []
+        self._first_add_time = None  # When the queue became non-empty
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def add(
+        self,
+        table: StorageTable,
+        obj: Union[Repodata, Rpm],
+        storage_id: str,
+        on_stored: OnStoredFn,
+    ) -> None:
+        if not self._queue:
+            self._first_add_time = time.monotonic()
+        self._queue.append((table, obj, storage_id, on_stored))
+
+    def seconds_until_flush(self) -> Optional[float]:
+        "None if the queue is empty, 0 if it is due for a `flush`."
+        if not self._queue:
+            return None
+        if len(self._queue) >= self._batch_size:
+            return 0
+        return max(0, self._first_add_time + DB_WRITE_MAX_DELAY_S - time.monotonic())
+
+    def flush(self, *, run_callbacks: bool = True) -> None:
+        # Callbacks may `add` more objects, which we store as well.
+        while self._queue:
+            batch = self._queue[: self._batch_size]
+            del self._queue[: self._batch_size]
+            self._first_add_time = time.monotonic()
+            self._store_batch(batch, run_callbacks)
+
+    def _store_batch(self, batch, run_callbacks: bool) -> None:
+        # Each group is stored with one `executemany`, and has one callback.
+        group_to_objs_and_ids = {}
+        for table, obj, storage_id, on_stored in batch:
+            group_to_objs_and_ids.setdefault((table, on_stored), []).append(
+                (obj, storage_id)
+            )
+        group_to_db_ids = {}
+        with timeit(f"Writing {len(batch)} storage IDs", threshold_s=10):
+            with retryable_db_ctx(self._db_conn) as repo_db_ctx:
+                for group, objs_and_ids in group_to_objs_and_ids.items():
+                    table, _on_stored = group
+                    group_to_db_ids[group] = repo_db_ctx.maybe_store_many(
+                        table, objs_and_ids
+                    )
+                repo_db_ctx.commit()
+        for group, objs_and_ids in group_to_objs_and_ids.items():
+            objs_and_db_ids = []
+            for (obj, storage_id), db_storage_id in zip(
+                objs_and_ids, group_to_db_ids[group]
+            ):
+                _log_if_storage_ids_differ(obj, storage_id, db_storage_id)
+                objs_and_db_ids.append((obj, db_storage_id))
+            if run_callbacks:
+                _table, on_stored = group
+                on_stored(objs_and_db_ids)
+
+
+class DownloadPipeline:
+    """
+    Runs the downloads of all repos on one shared pool of `threads` workers,
+    so that e.g. RPM downloads for one repo can start as soon as its primary
+    repodata is parsed, while another repo's repodata is still in flight.
+
+    `submit` schedules a function on the pool, together with a callback,
+    which gets its result.  All callbacks run on the driver thread, i.e.
+    the caller of `run`, so this is where all DB writes happen, avoiding
+    SQLite locking issues.  Callbacks may `submit` further work -- `run`
+    returns once nothing is pending.  If a function or a callback raises,
+    `run` cancels the work that has not started yet, and re-raises.
+
+    Callbacks record storage IDs via `db_writer`, which `run` flushes once
+    a batch is full, once the oldest queued ID has waited for
+    `DB_WRITE_MAX_DELAY_S`, or once the pool is idle.  If `run` raises, it
+    still writes the queued IDs, since their objects are already stored --
+    see the `repo_downloader.py` docblock.
+    """
+
+    def __init__(self, cfg: DownloadConfig):
+        self._executor = ThreadPoolExecutor(max_workers=cfg.threads)
+        self._future_to_callback: Dict[Future, Callable[[Any], None]] = {}
+        self.db_writer = RepoDBWriteBatcher(
+            cfg.new_db_conn(readonly=False), cfg.db_write_batch_size
+        )
+
+    def submit(
+        self, callback: Callable[[Any], None], fn: Callable[..., Any], *args, **kwargs
+    ) -> None:
+        future = self._executor.submit(fn, *args, **kwargs)
+        self._future_to_callback[future] = callback
+
+    def run(self) -> None:
+        with self._executor:
+            try:
+                while self._future_to_callback or self.db_writer:
+                    timeout = self.db_writer.seconds_until_flush()
+                    if timeout == 0 or not self._future_to_callback:
+                        self.db_writer.flush()
+                        continue
+                    done, _ = wait(
+                        self._future_to_callback,
+                        timeout=timeout,
+                        return_when=FIRST_COMPLETED,
+                    )
+                    for future in done:
+                        self._future_to_callback.pop(future)(future.result())
+            finally:
+                for future in self._future_to_callback:
+                    future.cancel()
+                # No-op unless we are raising.
+                self.db_writer.flush(run_callbacks=False)
+
+
+class ChunkStreamVerifier:
+    """
+    Checks the size & checksums of a file that is fed to `update` in
+    chunks.  Unlike `verify_chunk_stream`, the chunks may come from several
+    streams, e.g. when a download is resumed after an error.
+    """
+
+    def __init__(self, checksums: Iterable[Checksum], size: int, location: str):
+        self._checksums = list(checksums)
+        self._hashers = [ck.hasher() for ck in self._checksums]
+        self._size = size
+        self._location = location
+        self.actual_size = 0
+
+    def update(self, chunk: bytes) -> None:
+        self.actual_size += len(chunk)
+        for hasher in self._hashers:
+            hasher.update(chunk)
+
+    def verify(self) -> None:
+        if self.actual_size != self._size:
+            raise FileIntegrityError(
+                location=self._location,
+                failed_check="size",
+                expected=self._size,
+                actual=self.actual_size,
+            )
+        for hash, ck in zip(self._hashers, self._checksums):
+            if hash.hexdigest() != ck.hexdigest:
+                raise FileIntegrityError(
+                    location=self._location,
+                    failed_check=ck.algorithm,
+                    expected=ck.hexdigest,
+                    actual=hash.hexdigest(),
+                )
+
+
 def verify_chunk_stream(
     chunks: Iterable[bytes], checksums: Iterable[Checksum], size: int, location: str
 ):
-    actual_size = 0
-    hashers = [ck.hasher() for ck in checksums]
+    verifier = ChunkStreamVerifier(checksums, size, location)
     for chunk in chunks:
-        actual_size += len(chunk)
-        for hasher in hashers:
-            hasher.update(chunk)
+        verifier.update(chunk)
         yield chunk
-    if actual_size != size:
-        raise FileIntegrityError(
-            location=location, failed_check="size", expected=size, actual=actual_size
-        )
-    for hash, ck in zip(hashers, checksums):
-        if hash.hexdigest() != ck.hexdigest:
-            raise FileIntegrityError(
-                location=location,
-                failed_check=ck.algorithm,
-                expected=ck.hexdigest,
-                actual=hash.hexdigest(),
-            )
+    verifier.verify()
 
 
 def _log_if_storage_ids_differ(obj, storage_id, db_storage_id):
@@ -140,14 +318,16 @@ def timeit(operation_msg: str, threshold_s: int):
 
 
 @contextmanager
-def download_resource(repo_url: str, relative_url: str) -> Iterator[BytesIO]:
+def download_resource(
+    repo_url: str, relative_url: str, *, session_pool: HTTPSessionPool, offset: int = 0
+) -> Iterator[BytesIO]:
     if not repo_url.endswith("/"):
         repo_url += "/"  # `urljoin` needs a trailing / to work right
     assert not relative_url.startswith("/")
     try:
         full_url = urllib.parse.urljoin(repo_url, relative_url)
         with timeit(f"Downloading resource {full_url}", threshold_s=60 * 10), open_url(
-            full_url
+            full_url, session_pool=session_pool, offset=offset
         ) as input:
             yield input
     except requests.exceptions.HTTPError as ex:
@@ -159,23 +339,3 @@ def download_resource(repo_url: str, relative_url: str) -> Iterator[BytesIO]:
         # waiting for the next snapshot, but the complexity is
         # not worth it for now.
         raise HTTPError(location=relative_url, http_status=ex.response.status_code)
-
-
-# Note that we use this function serially from the master thread after
-# performing the downloads. This is because it's possible for SQLite to run
-# into locking issues with many concurrent writers. Additionally, these writes
-# are a minor portion of our overall execution time and thus we see negligible
-# perf gains by parallelizing them.
-def maybe_write_id(
-    repo_obj: Union[Repodata, Rpm],
-    storage_id: str,
-    table: RepodataTable,
-    db_conn: DBConnectionContext,
-):
-    """Used to write a storage_id to repo_db after a download."""
-    with timeit(f"Writing storage ID {storage_id}", threshold_s=10):
-        with retryable_db_ctx(db_conn) as repo_db_ctx:
-            db_storage_id = repo_db_ctx.maybe_store(table, repo_obj, storage_id)
-            repo_db_ctx.commit()
-    _log_if_storage_ids_differ(repo_obj, storage_id, db_storage_id)
-    return db_storage_id
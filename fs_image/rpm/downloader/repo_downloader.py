@@ -14,11 +14,28 @@ Specifically, the user calls `download_repos(...)`, which, for each repo:
   - Downloads the repodatas referenced there. Parses a primary repodata.
   - Downloads the RPMs referenced in the primary repodata.
 
-To increase performance, each of the above steps is performed concurrently,
-with `download_repos` being the driver that aggregates the thread results and
+To increase performance, the above steps are performed concurrently, with
+`download_repos` being the driver that aggregates the thread results and
 returns the final list of snapshots. Additionally, the single driver thread
 performs all writes to mitigate potential concurrency issues with SQLite.
 
+The repomds of all repos are downloaded first, since we check that they are
+consistent with each other (see `gen_repomds_from_repos`). After that, the
+repodata and RPM downloads of all repos share one `DownloadPipeline` of
+`cfg.threads` workers. Each repo proceeds at its own pace: its RPMs are
+scheduled as soon as its primary repodata is parsed, so a slow repodata in
+one repo neither stalls the RPM downloads of the other repos, nor leaves
+the pool idle while there is other work to do. Two repos may thus race to
+store the same RPM, which `maybe_store_many` already handles.
+
+The driver records the storage IDs of the downloaded objects in the repo DB
+in batches, see `RepoDBWriteBatcher`, and checks each batch of RPMs for
+mutable RPMs with one query.
+
+All HTTP downloads share `cfg.http_session_pool()`, which keeps up to one
+connection per thread & host alive, so most requests skip the TCP and TLS
+handshakes.  `download_repos` logs how often connections got reused.
+
 `download_repos` returns a list of `RepoSnapshot`s containing descriptions of
 the stored objects. The dictionary keys are either "storage IDs" from the
 supplied `Storage` class, or `ReportableError` instances for those that were
@@ -34,7 +51,9 @@ essentially just be taking up extra space in storage without causing any
 integrity issues. Additionally, if this leaking becomes substantial, it's
 possible to simply have a periodic clean-up job run which garbage collects any
 unreferenced blobs - which is a much simpler approach compared to ensuring we
-always clean up unfinished work.
+always clean up unfinished work.  Conversely, a failing snapshot still writes
+the storage IDs that are waiting in a batch, so that the next run can reuse
+the objects that this one stored.
 
 [1] The snapshot is only atomic (i.e. representative of a single point in time,
 as opposed to a sheared mix of the repo at various points in time) if:
@@ -45,13 +64,19 @@ as opposed to a sheared mix of the repo at various points in time) if:
   - `repomd.xml` is replaced atomically (i.e.  via `rename`) after making
     available all the new RPMs & repodatas.
 """
-from typing import Iterable, Iterator, Tuple
+from typing import FrozenSet, Iterable, Iterator, List, Tuple
 
 from fs_image.common import get_file_logger
-from fs_image.rpm.downloader.common import DownloadConfig, DownloadResult, timeit
+from fs_image.rpm.downloader.common import (
+    DownloadConfig,
+    DownloadPipeline,
+    DownloadResult,
+    timeit,
+)
 from fs_image.rpm.downloader.repomd_downloader import gen_repomds_from_repos
-from fs_image.rpm.downloader.repodata_downloader import gen_repodatas_from_repomds
-from fs_image.rpm.downloader.rpm_downloader import gen_rpms_from_repodatas
+from fs_image.rpm.downloader.repodata_downloader import submit_repodata_downloads
+from fs_image.rpm.downloader.rpm_downloader import submit_rpm_downloads
+from fs_image.rpm.open_url import HTTPPoolStats
 from fs_image.rpm.repo_snapshot import RepoSnapshot
 from fs_image.rpm.yum_dnf_conf import YumDnfConfRepo
 
@@ -80,6 +105,40 @@ def visit_results(
                 visitor.visit_rpm(rpm)
 
 
+def _download_repodatas_and_rpms(
+    repomd_results: List[DownloadResult],
+    cfg: DownloadConfig,
+    all_snapshot_universes: FrozenSet[str],
+) -> List[DownloadResult]:
+    "Returns the results in the order of `repomd_results`."
+    pipeline = DownloadPipeline(cfg)
+    rpm_results = [None] * len(repomd_results)
+
+    def submit_rpms(idx: int, res: DownloadResult) -> None:
+        def store_result(res: DownloadResult) -> None:
+            rpm_results[idx] = res
+
+        submit_rpm_downloads(pipeline, res, cfg, all_snapshot_universes, store_result)
+
+    for idx, res in enumerate(repomd_results):
+        submit_repodata_downloads(
+            pipeline, res, cfg, lambda res, idx=idx: submit_rpms(idx, res)
+        )
+    pipeline.run()
+    assert all(res is not None for res in rpm_results), rpm_results
+    return rpm_results
+
+
+def _log_http_stats(before: HTTPPoolStats, after: HTTPPoolStats) -> None:
+    # The pool is process-wide, so only count this snapshot's requests.
+    stats = HTTPPoolStats(*(a - b for a, b in zip(after, before)))
+    log.info(
+        f"Sent {stats.requests} HTTP requests over {stats.new_connections} "
+        f"new connections, reused keep-alive connections "
+        f"{stats.reused_connections} times"
+    )
+
+
 def download_repos(
     repos_and_universes: Iterable[Tuple[YumDnfConfRepo, str]],
     *,
@@ -91,13 +150,14 @@ def download_repos(
         rw_repo_db.ensure_tables_exist()
         rw_repo_db.commit()
 
-    # Concurrently download repomds, repodatas and RPMs. Materialize the
-    # generators to aggregate the results between each successive step.
+    # Concurrently download repomds, and then stream the repodatas and RPMs
+    # of all repos through one pipeline, see the top docblock.
+    http_stats_before = cfg.http_session_pool().stats()
     repomd_results = list(gen_repomds_from_repos(repos_and_universes, cfg))
-    repodata_results = list(gen_repodatas_from_repomds(repomd_results, cfg))
-    rpm_results = list(
-        gen_rpms_from_repodatas(repodata_results, cfg, all_snapshot_universes)
+    rpm_results = _download_repodatas_and_rpms(
+        repomd_results, cfg, all_snapshot_universes
     )
+    _log_http_stats(http_stats_before, cfg.http_session_pool().stats())
 
     # All downloads have completed - we now want to atomically persist repomds.
     with timeit("Storing all repomds", threshold_s=60 * 10), cfg.new_db_ctx(
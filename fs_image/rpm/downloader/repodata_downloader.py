@@ -5,26 +5,24 @@
 # LICENSE file in the root directory of this source tree.
 
 from contextlib import ExitStack
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from types import MappingProxyType
-from typing import Tuple, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Set
+from typing import Callable, List, NamedTuple, Optional, Tuple
 
 from fs_image.common import get_file_logger, set_new_key, shuffled
 from fs_image.rpm.common import read_chunks, retryable
 from fs_image.rpm.downloader.common import (
     BUFFER_BYTES,
     DownloadConfig,
+    DownloadPipeline,
     DownloadResult,
     download_resource,
     log_size,
-    maybe_write_id,
     verify_chunk_stream,
 )
 from fs_image.rpm.parse_repodata import get_rpm_parser, pick_primary_repodata
 from fs_image.rpm.repo_db import RepodataTable
-from fs_image.rpm.repo_objects import RepoMetadata, Repodata, Rpm
+from fs_image.rpm.repo_objects import Repodata, Rpm
 from fs_image.rpm.repo_snapshot import ReportableError
-from fs_image.rpm.yum_dnf_conf import YumDnfConfRepo
 
 
 REPODATA_MAX_RETRY_S = [2 ** i for i in range(10)]  # 1024sec == 17m4s
@@ -90,7 +88,11 @@ def _download_repodata(
             outfile = None
         else:
             # Nothing stored, must download - can fail due to repo updates
-            infile = cm.enter_context(download_resource(repo_url, repodata.location))
+            infile = cm.enter_context(
+                download_resource(
+                    repo_url, repodata.location, session_pool=cfg.http_session_pool()
+                )
+            )
             # Want to persist the downloaded repodata into storage so that
             # future runs don't need to redownload it
             outfile = cm.enter_context(storage.writer())
@@ -117,82 +119,87 @@ def _download_repodata(
     return DownloadRepodataReturnType(repodata, False, storage_id, rpms)
 
 
-def _download_repodatas(
-    repo: YumDnfConfRepo, repomd: RepoMetadata, cfg: DownloadConfig
-) -> Tuple[Set[Rpm], Mapping[str, Repodata]]:
+def submit_repodata_downloads(
+    pipeline: DownloadPipeline,
+    res: DownloadResult,
+    cfg: DownloadConfig,
+    on_done: Callable[[DownloadResult], None],
+) -> None:
+    """
+    Schedules the download of the repodatas of `res.repomd` on `pipeline`.
+    Once all are stored, calls `on_done` with `res`, updated with the RPMs
+    from the primary repodata, and with `storage_id_to_repodata`.
+
+    We explicitly omit any complex clean-up logic here, and store repodatas
+    regardless of whether they end up actually being used (i.e. their
+    referencing repomd gets committed).
+
+    The main reason for this is that the cost we pay to store these dangling
+    repodatas is fairly negligible when compared to the size of the overall
+    repos, and if we ever run into issues of these extra objects taking up
+    too much space, we can easily add a periodic job to scan the db and
+    remove any unused references. We are also able to avoid implementing a
+    lot of complex cleanup logic this way.
+    """
+    repo, repomd = res.repo, res.repomd
     rpms = None  # We'll extract these from the primary repodata
     storage_id_to_repodata = {}  # Newly stored **and** pre-existing
     repodata_table = RepodataTable()
     primary_repodata = pick_primary_repodata(repomd.repodatas)
     log_size(f"`{repo.name}` repodata weighs", sum(rd.size for rd in repomd.repodatas))
-    rw_db_conn = cfg.new_db_conn(readonly=False)
-    with ThreadPoolExecutor(max_workers=cfg.threads) as executor:
-        futures = [
-            executor.submit(
-                _download_repodata,
-                repodata,
-                repo_url=repo.base_url,
-                repodata_table=repodata_table,
-                cfg=cfg,
-                is_primary=repodata is primary_repodata,
+
+    def handle_repodata(dl_res: DownloadRepodataReturnType) -> None:
+        nonlocal rpms
+        if dl_res.maybe_rpms is not None:
+            # RPMs will only have been returned by the primary, thus we
+            # should only enter this block once
+            assert rpms is None
+            # Convert to a set to work around buggy repodatas, which
+            # list the same RPM object twice.
+            rpms = frozenset(dl_res.maybe_rpms)
+        if dl_res.newly_stored:
+            # Don't want to store errors into the repo db -- this should
+            # never be the case as `newly_stored` is only True when we
+            # successfully commit a new repodata to storage
+            assert not isinstance(dl_res.storage_id, ReportableError)
+            # This repodata was newly downloaded and stored in storage, so
+            # we store its storage_id to repo_db regardless of whether we
+            # encounter fatal errors later on in the execution and don't
+            # finish the snapshot - see top-level docblock for reasoning
+            pipeline.db_writer.add(
+                repodata_table, dl_res.repodata, dl_res.storage_id, handle_stored
             )
-            for repodata in shuffled(repomd.repodatas)
-        ]
-
-        for future in as_completed(futures):
-            res = future.result()
-            if res.newly_stored:
-                # Don't want to store errors into the repo db -- this should
-                # never be the case as `newly_stored` is only True when we
-                # successfully commit a new repodata to storage
-                assert not isinstance(res.storage_id, ReportableError)
-                # This repodata was newly downloaded and stored in storage, so
-                # we store its storage_id to repo_db regardless of whether we
-                # encounter fatal errors later on in the execution and don't
-                # finish the snapshot - see top-level docblock for reasoning
-                storage_id = maybe_write_id(
-                    res.repodata, res.storage_id, repodata_table, rw_db_conn
-                )
-            else:
-                storage_id = res.storage_id
-            if res.maybe_rpms is not None:
-                # RPMs will only have been returned by the primary, thus we
-                # should only enter this block once
-                assert rpms is None
-                # Convert to a set to work around buggy repodatas, which
-                # list the same RPM object twice.
-                rpms = frozenset(res.maybe_rpms)
-            set_new_key(storage_id_to_repodata, storage_id, res.repodata)
-    # It's possible that for non-primary repodatas we received errors when
-    # downloading - in that case we store the error in the sqlite db, thus the
-    # dict should contain an entry for every single repodata
-    assert len(storage_id_to_repodata) == len(repomd.repodatas)
-    if not rpms:
-        log.warning(f"Repo {repo} has no RPMs")
-    return rpms, storage_id_to_repodata
-
-
-def gen_repodatas_from_repomds(
-    repomd_results: Iterable[DownloadResult], cfg: DownloadConfig
-) -> Iterator[DownloadResult]:
-    # For each downloaded repomd, concurrently download the contained
-    # repodatas. This driver runs serially, but each repomd's repodatas are
-    # downloaded in parallel. We could run this driver concurrently as well,
-    # but we're likely already saturating the network with the downloads for a
-    # single repomd and won't see a perf increase from further parallelization.
-    for res in repomd_results:
-        # We explicitly omit any complex clean-up logic here, and store
-        # repodatas regardless of whether they end up actually being used (i.e.
-        # their referencing repomd gets committed).
-        #
-        # The main reason for this is that the cost we pay to store these
-        # dangling repodatas is fairly negligible when compared to the size of
-        # the overall repos, and if we ever run into issues of these extra
-        # objects taking up too much space, we can easily add a periodic job to
-        # scan the db and remove any unused references. We are also able to
-        # avoid implementing a lot of complex cleanup logic this way.
-        rpm_set, storage_id_to_repodata = _download_repodatas(res.repo, res.repomd, cfg)
-        yield res._replace(
-            storage_id_to_repodata=MappingProxyType(storage_id_to_repodata),
-            rpms=rpm_set,
+        else:
+            record_repodata(dl_res.repodata, dl_res.storage_id)
+
+    def handle_stored(repodatas_and_storage_ids: List[Tuple[Repodata, str]]) -> None:
+        for repodata, storage_id in repodatas_and_storage_ids:
+            record_repodata(repodata, storage_id)
+
+    def record_repodata(repodata: Repodata, storage_id: str) -> None:
+        set_new_key(storage_id_to_repodata, storage_id, repodata)
+        if len(storage_id_to_repodata) < len(repomd.repodatas):
+            return
+        # It's possible that for non-primary repodatas we received errors
+        # when downloading - in that case we store the error in the sqlite
+        # db, thus the dict should contain an entry for every single repodata
+        assert len(storage_id_to_repodata) == len(repomd.repodatas)
+        if not rpms:
+            log.warning(f"Repo {repo} has no RPMs")
+        on_done(
+            res._replace(
+                storage_id_to_repodata=MappingProxyType(storage_id_to_repodata),
+                rpms=rpms,
+            )
+        )
+
+    for repodata in shuffled(repomd.repodatas):
+        pipeline.submit(
+            handle_repodata,
+            _download_repodata,
+            repodata,
+            repo_url=repo.base_url,
+            repodata_table=repodata_table,
+            cfg=cfg,
+            is_primary=repodata is primary_repodata,
         )
@@ -26,9 +26,11 @@ log = get_file_logger(__file__)
 # This should realistically only fail on HTTP errors
 @retryable("Download failed: {repo.name} from {repo.base_url}", REPOMD_MAX_RETRY_S)
 def _download_repomd(
-    repo: YumDnfConfRepo, repo_universe: str
+    repo: YumDnfConfRepo, repo_universe: str, cfg: DownloadConfig
 ) -> Tuple[YumDnfConfRepo, str, RepoMetadata]:
-    with download_resource(repo.base_url, "repodata/repomd.xml") as repomd_stream:
+    with download_resource(
+        repo.base_url, "repodata/repomd.xml", session_pool=cfg.http_session_pool()
+    ) as repomd_stream:
         repomd = RepoMetadata.new(xml=repomd_stream.read())
     return repo, repo_universe, repomd
 
@@ -40,7 +42,7 @@ def _download_repomds(
     log.info("Downloading repomds for all repos")
     with ThreadPoolExecutor(max_workers=cfg.threads) as executor:
         futures = [
-            executor.submit(_download_repomd, repo, repo_universe)
+            executor.submit(_download_repomd, repo, repo_universe, cfg)
             for repo, repo_universe in repos_and_universes
         ]
         for future in as_completed(futures):
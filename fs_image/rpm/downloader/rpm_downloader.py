@@ -5,24 +5,27 @@
 # LICENSE file in the root directory of this source tree.
 
 import hashlib
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import AbstractContextManager, ExitStack
 from types import MappingProxyType
-from typing import FrozenSet, Iterable, Iterator, Set, Tuple
+from typing import Callable, FrozenSet, List, Set, Tuple
+
+from urllib3.exceptions import ProtocolError
 
 from fs_image.common import get_file_logger, set_new_key, shuffled
 from fs_image.rpm.common import read_chunks, retryable
 from fs_image.rpm.db_connection import DBConnectionContext
 from fs_image.rpm.downloader.common import (
     BUFFER_BYTES,
+    ChunkStreamVerifier,
     DownloadConfig,
+    DownloadPipeline,
     DownloadResult,
     download_resource,
     log_size,
-    maybe_write_id,
     retryable_db_ctx,
-    verify_chunk_stream,
 )
 from fs_image.rpm.downloader.deleted_mutable_rpms import deleted_mutable_rpms
+from fs_image.rpm.open_url import RangeIgnoredError
 from fs_image.rpm.repo_db import RpmTable
 from fs_image.rpm.repo_objects import CANONICAL_HASH, Checksum, Rpm
 from fs_image.rpm.repo_snapshot import (
@@ -31,7 +34,7 @@ from fs_image.rpm.repo_snapshot import (
     MutableRpmError,
     ReportableError,
 )
-from fs_image.rpm.yum_dnf_conf import YumDnfConfRepo
+from fs_image.rpm.storage import Storage
 
 
 RPM_MAX_RETRY_S = [2 ** i for i in range(9)]  # 512 sec ==  8m32s
@@ -39,6 +42,10 @@ log = get_file_logger(__file__)
 
 
 def _is_retryable_http_err(e: Exception) -> bool:
+    # The connection broke mid-download.  We retry, since `_download_rpm`
+    # resumes from the last byte that it received.
+    if isinstance(e, ProtocolError):
+        return True
     if not isinstance(e, HTTPError):
         return False
     # 408 is 'Request Timeout' and, as with 5xx, can reasonably be presumed
@@ -48,19 +55,27 @@ def _is_retryable_http_err(e: Exception) -> bool:
 
 
 def _detect_mutable_rpms(
-    rpm: Rpm,
+    rpms_and_storage_ids: List[Tuple[Rpm, str]],
     rpm_table: RpmTable,
-    storage_id: str,
     all_snapshot_universes: Set[str],
     db_conn: DBConnectionContext,
-) -> MaybeStorageID:
+) -> List[Tuple[Rpm, MaybeStorageID]]:
+    "Looks up the NEVRAs of a batch of just-stored RPMs in one query."
     with retryable_db_ctx(db_conn) as repo_db_ctx:
-        all_canonical_checksums = set(
-            repo_db_ctx.get_rpm_canonical_checksums(
-                rpm_table, rpm, all_snapshot_universes
-            )
+        rpm_to_canonical_checksums = repo_db_ctx.get_rpms_canonical_checksums(
+            rpm_table, [rpm for rpm, _ in rpms_and_storage_ids], all_snapshot_universes
         )
+    return [
+        (rpm, _check_canonical_checksums(rpm, sid, rpm_to_canonical_checksums[rpm]))
+        for rpm, sid in rpms_and_storage_ids
+    ]
+
+
+def _check_canonical_checksums(
+    rpm: Rpm, storage_id: str, all_canonical_checksums: Set[Checksum]
+) -> MaybeStorageID:
     assert all_canonical_checksums, (rpm, storage_id)
+    all_canonical_checksums = set(all_canonical_checksums)
     assert all(
         c.algorithm == CANONICAL_HASH for c in all_canonical_checksums
     ), all_canonical_checksums
@@ -84,42 +99,100 @@ def _detect_mutable_rpms(
     return storage_id
 
 
-# May raise `ReportableError`s to be caught by `_download_rpms`.
+class _PartialRpm(AbstractContextManager):
+    """
+    The part of an RPM that was downloaded so far: the not-yet-committed
+    `storage.writer()`, and the state of the hashers.  This lets a retry of
+    `_download_rpm` resume with an HTTP `Range` request, instead of having
+    to download a large RPM again from byte 0.
+    """
+
+    def __init__(self, rpm: Rpm, storage: Storage):
+        self.rpm = rpm
+        self._storage = storage
+        self._writer_stack = ExitStack()
+        self.restart()
+
+    def __exit__(self, *exc_info):
+        return self._writer_stack.__exit__(*exc_info)
+
+    def restart(self) -> None:
+        # The uncommitted writer, if any, removes its partial blob.
+        self._writer_stack.close()
+        self.output = self._writer_stack.enter_context(self._storage.writer())
+        self.verifier = ChunkStreamVerifier(
+            [self.rpm.checksum], self.rpm.size, self.rpm.location
+        )
+        # Before committing to the DB, let's standardize on one hash
+        # algorithm.  Otherwise, it might happen that two repos may
+        # store the same RPM hashed with different algorithms, and thus
+        # trigger our "different hashes" detector for a sane RPM.
+        self.canonical_hash = hashlib.new(CANONICAL_HASH)
+
+    def write(self, chunk: bytes) -> None:
+        self.verifier.update(chunk)
+        self.canonical_hash.update(chunk)
+        self.output.write(chunk)
+
+
+def _download_rest_of_rpm(
+    partial: _PartialRpm, repo_url: str, cfg: DownloadConfig
+) -> None:
+    offset = partial.verifier.actual_size
+    if offset:
+        log.info(f"Resuming the download of {partial.rpm} at byte {offset}")
+    with download_resource(
+        repo_url,
+        partial.rpm.location,
+        session_pool=cfg.http_session_pool(),
+        offset=offset,
+    ) as input_:
+        for chunk in read_chunks(input_, BUFFER_BYTES):
+            partial.write(chunk)
+
+
 # May raise an `HTTPError` if the download fails, which won't trigger a
 # retry if they're not 5xx/408 errors.
 @retryable(
-    "Download failed: {rpm}",
+    "Download failed: {partial.rpm}",
     RPM_MAX_RETRY_S,
     is_exception_retryable=_is_retryable_http_err,
 )
+def _resume_rpm_download(
+    partial: _PartialRpm, repo_url: str, cfg: DownloadConfig
+) -> None:
+    if partial.verifier.actual_size >= partial.rpm.size:
+        # A prior attempt got the whole RPM, or more, and still failed.
+        # There is nothing to resume, so start from scratch.
+        partial.restart()
+    try:
+        _download_rest_of_rpm(partial, repo_url, cfg)
+    except RangeIgnoredError:
+        log.warning(f"Cannot resume, downloading {partial.rpm} from byte 0")
+        partial.restart()
+        _download_rest_of_rpm(partial, repo_url, cfg)
+
+
+# May raise `ReportableError`s to be caught by `_download_rpms`.
 def _download_rpm(
     rpm: Rpm, repo_url: str, rpm_table: RpmTable, cfg: DownloadConfig
 ) -> Tuple[Rpm, str]:
     "Returns a storage_id and a copy of `rpm` with a canonical checksum."
     log.info(f"Downloading {rpm}")
-    storage = cfg.new_storage()
-    with download_resource(
-        repo_url, rpm.location
-    ) as input_, storage.writer() as output:
-        # Before committing to the DB, let's standardize on one hash
-        # algorithm.  Otherwise, it might happen that two repos may
-        # store the same RPM hashed with different algorithms, and thus
-        # trigger our "different hashes" detector for a sane RPM.
-        canonical_hash = hashlib.new(CANONICAL_HASH)
-        for chunk in verify_chunk_stream(
-            read_chunks(input_, BUFFER_BYTES), [rpm.checksum], rpm.size, rpm.location
-        ):  # May raise a ReportableError
-            canonical_hash.update(chunk)
-            output.write(chunk)
+    with _PartialRpm(rpm, cfg.new_storage()) as partial:
+        _resume_rpm_download(partial, repo_url, cfg)
+        # Resumed or not, we check the size & checksum of the whole RPM.
+        partial.verifier.verify()  # May raise a ReportableError
         # NB: We can also query the RPM as we download it above, via
         # something like P123285392.  However, at present, all necessary
         # metadata can be retrieved via `parse_metadata.py`.
         rpm = rpm._replace(
             canonical_checksum=Checksum(
-                algorithm=CANONICAL_HASH, hexdigest=canonical_hash.hexdigest()
+                algorithm=CANONICAL_HASH,
+                hexdigest=partial.canonical_hash.hexdigest(),
             )
         )
-        storage_id = output.commit()
+        storage_id = partial.output.commit()
     assert storage_id is not None
     return rpm, storage_id
 
@@ -131,34 +204,7 @@ def _handle_rpm(
     all_snapshot_universes: Set[str],
     cfg: DownloadConfig,
 ) -> Tuple[Rpm, MaybeStorageID]:
-    with cfg.new_db_ctx(readonly=True) as ro_repo_db:
-        # If we get no `storage_id` back, there are 3 possibilities:
-        #  - `rpm.nevra()` was never seen before.
-        #  - `rpm.nevra()` was seen before, but it was hashed with
-        #     different algorithm(s), so we MUST download and
-        #     compute the canonical checksum to know if its contents
-        #     are the same.
-        #  - `rpm.nevra()` was seen before, **AND** one of the
-        #    prior checksums used `rpm.checksum.algorithms`, but
-        #    produced a different hash value.  In other words, this
-        #    is a `MutableRpmError`, because the same NEVRA must
-        #    have had two different contents.  We COULD explicitly
-        #    detect this error here, and avoid the download.
-        #    However, this severe error should be infrequent, and we
-        #    actually get valuable information from the download --
-        #    this lets us know whether the file is wrong or the
-        #    repodata is wrong.
-        storage_id, canonical_chk = ro_repo_db.get_rpm_storage_id_and_checksum(
-            rpm_table, rpm
-        )
-    # If the RPM is already stored with a matching checksum, just update its
-    # `.canonical_checksum`.
-    if storage_id:
-        rpm = rpm._replace(canonical_checksum=canonical_chk)
-        # This is a very common case and thus noisy log, so we write to debug
-        log.debug(f"Already stored under {storage_id}: {rpm}")
-        return rpm, storage_id
-    # We have to download the RPM.
+    "Downloads an RPM that `submit_rpm_downloads` did not find in the DB."
     try:
         return _download_rpm(rpm, repo_url, rpm_table, cfg)
     # RPM checksum validation errors, HTTP errors, etc
@@ -169,52 +215,94 @@ def _handle_rpm(
         return rpm, ex
 
 
-def _download_rpms(
-    repo: YumDnfConfRepo,
-    rpm_table: RpmTable,
-    rpms: Iterable[Rpm],
-    all_snapshot_universes: Set[str],
+def submit_rpm_downloads(
+    pipeline: DownloadPipeline,
+    res: DownloadResult,
     cfg: DownloadConfig,
-):
+    all_snapshot_universes: FrozenSet[str],
+    on_done: Callable[[DownloadResult], None],
+) -> None:
+    """
+    Schedules the download of the RPMs in `res.rpms` that belong to the
+    current shard on `pipeline`.  Once all are stored, calls `on_done` with
+    `res`, updated with `storage_id_to_rpm`.  The RPMs that are already in
+    the DB are looked up in bulk, and are not submitted.
+    """
+    repo, rpms = res.repo, res.rpms
+    rpm_table = RpmTable(res.repo_universe)
     log_size(f"`{repo.name}` has {len(rpms)} RPMs weighing", sum(r.size for r in rpms))
+    # Download in random order to reduce collisions from racing writers.
+    shard_rpms = [rpm for rpm in shuffled(rpms) if cfg.rpm_shard.in_shard(rpm)]
     storage_id_to_rpm = {}
-    rw_db_conn = cfg.new_db_conn(readonly=False)
     ro_db_conn = cfg.new_db_conn(readonly=True)
-    with ThreadPoolExecutor(max_workers=cfg.threads) as executor:
-        futures = [
-            executor.submit(
-                _handle_rpm, rpm, repo.base_url, rpm_table, all_snapshot_universes, cfg
-            )
-            # Download in random order to reduce collisions from racing writers.
-            for rpm in shuffled(rpms)
-            if cfg.rpm_shard.in_shard(rpm)
-        ]
-        for future in as_completed(futures):
-            rpm, res_storage_id = future.result()
-            if not isinstance(res_storage_id, ReportableError):
-                # If it's valid, we store this storage_id to repo_db regardless of
-                # whether we encounter fatal errors later on in the execution and
-                # don't finish the snapshot - see top-level docblock for reasoning
-                res_storage_id = maybe_write_id(
-                    rpm, res_storage_id, rpm_table, rw_db_conn
-                )
-                # Detect if this RPM NEVRA occurs with different contents.
-                res_storage_id = _detect_mutable_rpms(
-                    rpm, rpm_table, res_storage_id, all_snapshot_universes, ro_db_conn
-                )
-            set_new_key(storage_id_to_rpm, res_storage_id, rpm)
-
-    assert len(storage_id_to_rpm) == sum(cfg.rpm_shard.in_shard(r) for r in rpms)
-    return storage_id_to_rpm
-
-
-def gen_rpms_from_repodatas(
-    repodata_results: Iterable[DownloadResult],
-    cfg: DownloadConfig,
-    all_snapshot_universes: FrozenSet[str],
-) -> Iterator[DownloadResult]:
-    for res in repodata_results:
-        storage_id_to_rpm = _download_rpms(
-            res.repo, RpmTable(res.repo_universe), res.rpms, all_snapshot_universes, cfg
+
+    def done() -> None:
+        on_done(res._replace(storage_id_to_rpm=MappingProxyType(storage_id_to_rpm)))
+
+    def handle_rpm(rpm_and_storage_id: Tuple[Rpm, MaybeStorageID]) -> None:
+        rpm, res_storage_id = rpm_and_storage_id
+        if isinstance(res_storage_id, ReportableError):
+            record_rpm(rpm, res_storage_id)
+        else:
+            # If it's valid, we store this storage_id to repo_db regardless of
+            # whether we encounter fatal errors later on in the execution and
+            # don't finish the snapshot - see top-level docblock for reasoning
+            pipeline.db_writer.add(rpm_table, rpm, res_storage_id, handle_stored)
+
+    def handle_stored(rpms_and_storage_ids: List[Tuple[Rpm, str]]) -> None:
+        # Detect if these RPM NEVRAs occur with different contents.
+        for rpm, res_storage_id in _detect_mutable_rpms(
+            rpms_and_storage_ids, rpm_table, all_snapshot_universes, ro_db_conn
+        ):
+            record_rpm(rpm, res_storage_id)
+
+    def record_rpm(rpm: Rpm, res_storage_id: MaybeStorageID) -> None:
+        set_new_key(storage_id_to_rpm, res_storage_id, rpm)
+        if len(storage_id_to_rpm) == len(shard_rpms):
+            done()
+
+    if not shard_rpms:
+        done()
+    # Most RPMs of a repo are usually stored already, so rather than have
+    # each worker make a point query, look them all up in a few batched
+    # queries.  If we get no `storage_id` back, there are 3 possibilities:
+    #  - `rpm.nevra()` was never seen before.
+    #  - `rpm.nevra()` was seen before, but it was hashed with different
+    #     algorithm(s), so we MUST download and compute the canonical
+    #     checksum to know if its contents are the same.
+    #  - `rpm.nevra()` was seen before, **AND** one of the prior checksums
+    #    used `rpm.checksum.algorithms`, but produced a different hash
+    #    value.  In other words, this is a `MutableRpmError`, because the
+    #    same NEVRA must have had two different contents.  We COULD
+    #    explicitly detect this error here, and avoid the download.
+    #    However, this severe error should be infrequent, and we actually
+    #    get valuable information from the download -- this lets us know
+    #    whether the file is wrong or the repodata is wrong.
+    # An RPM that a racing writer stores after this lookup just gets
+    # downloaded again, and `maybe_store_many` resolves the race.
+    with cfg.new_db_ctx(readonly=True) as ro_repo_db:
+        rpm_to_stored = ro_repo_db.get_rpm_storage_ids_and_checksums(
+            rpm_table, shard_rpms
+        )
+    rpms_to_download = []
+    for rpm in shard_rpms:
+        storage_id, canonical_chk = rpm_to_stored.get(rpm, (None, None))
+        if storage_id is None:
+            rpms_to_download.append(rpm)
+            continue
+        # The RPM is already stored with a matching checksum, so just
+        # update its `.canonical_checksum`.
+        rpm = rpm._replace(canonical_checksum=canonical_chk)
+        # This is a very common case and thus noisy log, so we write to debug
+        log.debug(f"Already stored under {storage_id}: {rpm}")
+        handle_rpm((rpm, storage_id))
+    for rpm in rpms_to_download:
+        pipeline.submit(
+            handle_rpm,
+            _handle_rpm,
+            rpm,
+            repo.base_url,
+            rpm_table,
+            all_snapshot_universes,
+            cfg,
         )
-        yield res._replace(storage_id_to_rpm=MappingProxyType(storage_id_to_rpm))
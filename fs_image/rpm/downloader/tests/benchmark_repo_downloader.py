@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compares the wall-clock time of downloading the repodatas & RPMs of several
+repos in one `DownloadPipeline`, as `download_repos` does, against the
+staged order it replaced -- all repos' repodatas one repo at a time, and
+only then all repos' RPMs, one repo at a time:
+
+  buck run fs_image/rpm/downloader:benchmark-repo-downloader -- --repos 8
+
+The repos are stand-ins with random "RPM" contents, served over HTTP from
+a local server that adds `--latency-ms` to every request, and delays the
+primary repodata of the first repo by `--slow-primary-s`.
+"""
+import argparse
+import gzip
+import hashlib
+import http.server
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from typing import Iterator, List
+
+from fs_image.rpm.common import RpmShard
+from fs_image.rpm.downloader.common import (
+    DownloadConfig,
+    DownloadPipeline,
+    DownloadResult,
+)
+from fs_image.rpm.downloader.repo_downloader import _download_repodatas_and_rpms
+from fs_image.rpm.downloader.repodata_downloader import submit_repodata_downloads
+from fs_image.rpm.downloader.repomd_downloader import gen_repomds_from_repos
+from fs_image.rpm.downloader.rpm_downloader import submit_rpm_downloads
+from fs_image.rpm.yum_dnf_conf import YumDnfConfRepo
+
+_PACKAGE_XML = """<package type="rpm">
+  <name>{name}</name>
+  <arch>x86_64</arch>
+  <version epoch="0" ver="1" rel="{idx}"/>
+  <checksum type="sha256" pkgid="YES">{sha256}</checksum>
+  <time file="1" build="1"/>
+  <size package="{size}" installed="{size}" archive="{size}"/>
+  <location href="{location}"/>
+  <format><rpm:sourcerpm>{name}-1-{idx}.src.rpm</rpm:sourcerpm></format>
+</package>
+"""
+_REPODATA_XML = """<data type="{kind}">
+  <checksum type="sha256">{sha256}</checksum>
+  <location href="{location}"/>
+  <timestamp>1</timestamp>
+  <size>{size}</size>
+</data>
+"""
+
+
+def _write_repodata(repo_dir: Path, kind: str, xml: str) -> str:
+    data = gzip.compress(xml.encode())
+    sha256 = hashlib.sha256(data).hexdigest()
+    location = f"repodata/{sha256}-{kind}.xml.gz"
+    (repo_dir / location).write_bytes(data)
+    return _REPODATA_XML.format(
+        kind=kind, sha256=sha256, location=location, size=len(data)
+    )
+
+
+def _make_repo(repo_dir: Path, num_rpms: int, rpm_size: int, seed: int) -> None:
+    rng = random.Random(seed)
+    (repo_dir / "repodata").mkdir(parents=True)
+    (repo_dir / "pkgs").mkdir()
+    packages = []
+    for idx in range(num_rpms):
+        name = f"{repo_dir.name}-rpm{idx}"
+        location = f"pkgs/{name}-1-{idx}.x86_64.rpm"
+        data = bytes(rng.getrandbits(8) for _ in range(rpm_size))
+        (repo_dir / location).write_bytes(data)
+        packages.append(
+            _PACKAGE_XML.format(
+                name=name,
+                idx=idx,
+                sha256=hashlib.sha256(data).hexdigest(),
+                size=len(data),
+                location=location,
+            )
+        )
+    repodatas = [
+        _write_repodata(
+            repo_dir,
+            "primary",
+            '<metadata xmlns="http://linux.duke.edu/metadata/common" '
+            'xmlns:rpm="http://linux.duke.edu/metadata/rpm" '
+            f'packages="{num_rpms}">\n' + "".join(packages) + "</metadata>\n",
+        ),
+        _write_repodata(repo_dir, "other", f'<otherdata repo="{repo_dir.name}"/>\n'),
+    ]
+    (repo_dir / "repodata/repomd.xml").write_text(
+        '<repomd xmlns="http://linux.duke.edu/metadata/repo">\n'
+        + "".join(repodatas)
+        + "</repomd>\n"
+    )
+
+
+class _SlowHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like real mirrors
+    latency_s = 0.0
+    slow_path_prefix = None
+    slow_s = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency_s)
+        if self.path.startswith(self.slow_path_prefix) and self.path.endswith(
+            "-primary.xml.gz"
+        ):
+            time.sleep(self.slow_s)
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def _serve(
+    root: Path, latency_s: float, slow_path_prefix: str, slow_s: float
+) -> Iterator[str]:
+    handler = type(
+        "Handler",
+        (_SlowHandler,),
+        {
+            "latency_s": latency_s,
+            "slow_path_prefix": slow_path_prefix,
+            "slow_s": slow_s,
+        },
+    )
+    with http.server.ThreadingHTTPServer(
+        ("localhost", 0), partial(handler, directory=str(root))
+    ) as httpd:
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        try:
+            yield "http://{}:{}/".format(*httpd.socket.getsockname())
+        finally:
+            httpd.shutdown()
+            thread.join()
+
+
+def _download_staged(
+    repomd_results: List[DownloadResult], cfg: DownloadConfig
+) -> List[DownloadResult]:
+    "Each stage of each repo runs to completion before the next one starts."
+    results = []
+    for stage_fn in [
+        submit_repodata_downloads,
+        partial(submit_rpm_downloads, all_snapshot_universes=frozenset(["bench"])),
+    ]:
+        stage_results = []
+        for res in repomd_results:
+            pipeline = DownloadPipeline(cfg)
+            stage_fn(pipeline, res, cfg, on_done=stage_results.append)
+            pipeline.run()
+        results = repomd_results = stage_results
+    return results
+
+
+def _download_pipelined(
+    repomd_results: List[DownloadResult], cfg: DownloadConfig
+) -> List[DownloadResult]:
+    return _download_repodatas_and_rpms(repomd_results, cfg, frozenset(["bench"]))
+
+
+def _measure(name: str, download_fn, repos, threads: int) -> None:
+    with tempfile.TemporaryDirectory() as td:
+        cfg = DownloadConfig(
+            db_cfg={"kind": "sqlite", "db_path": os.path.join(td, "db")},
+            storage_cfg={"key": "bench", "kind": "filesystem", "base_dir": td},
+            rpm_shard=RpmShard(shard=0, modulo=1),
+            threads=threads,
+        )
+        with cfg.new_db_ctx(readonly=False) as rw_repo_db:
+            rw_repo_db.ensure_tables_exist()
+            rw_repo_db.commit()
+        repomd_results = list(
+            gen_repomds_from_repos([(repo, "bench") for repo in repos], cfg)
+        )
+        start = time.perf_counter()
+        results = download_fn(repomd_results, cfg)
+        elapsed = time.perf_counter() - start
+    num_rpms = sum(len(res.storage_id_to_rpm) for res in results)
+    print(f"  {name:<10} {elapsed:9.3f}s {num_rpms / elapsed:9.1f} RPMs/s")
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    p.add_argument("--repos", type=int, default=4, help="Default: %(default)s")
+    p.add_argument("--rpms-per-repo", type=int, default=40, help="Default: %(default)s")
+    p.add_argument("--rpm-size", type=int, default=2 ** 14, help="Default: %(default)s")
+    p.add_argument("--threads", type=int, default=8, help="Default: %(default)s")
+    p.add_argument(
+        "--latency-ms",
+        type=float,
+        default=20,
+        help="Added to each HTTP request. Default: %(default)s",
+    )
+    p.add_argument(
+        "--slow-primary-s",
+        type=float,
+        default=2,
+        help="Added to the primary repodata of the first repo. Default: %(default)s",
+    )
+    args = p.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as td:
+        root = Path(td)
+        for idx in range(args.repos):
+            _make_repo(root / f"repo{idx}", args.rpms_per_repo, args.rpm_size, idx)
+        with _serve(
+            root, args.latency_ms / 1000, "/repo0/", args.slow_primary_s
+        ) as base_url:
+            repos = [
+                YumDnfConfRepo(
+                    name=f"repo{idx}",
+                    base_url=f"{base_url}repo{idx}/",
+                    gpg_key_urls=("not_used",),
+                )
+                for idx in range(args.repos)
+            ]
+            print(
+                f"{args.repos} repos of {args.rpms_per_repo} RPMs, "
+                f"{args.threads} threads:"
+            )
+            _measure("staged", _download_staged, repos, args.threads)
+            _measure("pipelined", _download_pipelined, repos, args.threads)
+
+
+if __name__ == "__main__":
+    main()
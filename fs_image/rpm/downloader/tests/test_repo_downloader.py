@@ -15,6 +15,7 @@ Future work:
 import os
 import re
 import requests
+import threading
 import unittest
 import tempfile
 
@@ -24,21 +25,25 @@ from io import BytesIO
 from typing import List, Tuple
 from unittest import mock
 
+from urllib3.exceptions import ProtocolError
+
 from fs_image.common import set_new_key
 from fs_image.fs_utils import temp_dir
 
 
 from fs_image.rpm.downloader import repo_downloader
-from fs_image.rpm.downloader.common import open_url
+from fs_image.rpm.downloader.common import RepoDBWriteBatcher, open_url
 from fs_image.rpm.downloader.repomd_downloader import REPOMD_MAX_RETRY_S
 from fs_image.rpm.downloader.repodata_downloader import (
     RepodataParseError,
     _download_repodata,
 )
-from fs_image.rpm.downloader.rpm_downloader import RPM_MAX_RETRY_S
+from fs_image.rpm.downloader.rpm_downloader import RPM_MAX_RETRY_S, _handle_rpm
 from fs_image.rpm.common import RpmShard
 from fs_image.rpm.db_connection import DBConnectionContext
-from fs_image.rpm.repo_db import RepodataTable, RepoDBContext
+from fs_image.rpm.open_url import RangeIgnoredError
+from fs_image.rpm.repo_db import RepodataTable, RepoDBContext, RpmTable
+from fs_image.rpm.repo_objects import Rpm
 from fs_image.rpm.repo_snapshot import (
     FileIntegrityError,
     HTTPError,
@@ -58,6 +63,16 @@ def raise_fake_http_error(_contents):
     raise requests.exceptions.HTTPError(response=response)
 
 
+class _BrokenConnectionStream(BytesIO):
+    "Raises like a broken HTTP connection, after returning all its bytes."
+
+    def read(self, size=-1):
+        chunk = super().read(size)
+        if not chunk:
+            raise ProtocolError("Connection broken: IncompleteRead")
+        return chunk
+
+
 def _location_basename(rpm):
     return rpm._replace(location=os.path.basename(rpm.location))
 
@@ -104,6 +119,31 @@ _BAD_DOG = temp_repos.Repo(
 _EMPTY_EEL = temp_repos.Repo([])
 
 
+def _fake_already_stored(location_regex, on_fake):
+    """
+    Makes a mock `maybe_store_many`, which pretends that another writer
+    already stored the objects whose location matches `location_regex`.
+    """
+    original_maybe_store_many = RepoDBContext.maybe_store_many
+
+    def my_maybe_store_many(self, table, objs_and_storage_ids):
+        obj_to_fake_id = {}
+        real_objs_and_ids = []
+        for obj, storage_id in objs_and_storage_ids:
+            if re.match(location_regex, obj.location):
+                on_fake(obj)
+                obj_to_fake_id[obj] = f"fake_already_stored_{obj.location}"
+            else:
+                real_objs_and_ids.append((obj, storage_id))
+        real_ids = iter(original_maybe_store_many(self, table, real_objs_and_ids))
+        return [
+            obj_to_fake_id[obj] if obj in obj_to_fake_id else next(real_ids)
+            for obj, _ in objs_and_storage_ids
+        ]
+
+    return my_maybe_store_many
+
+
 class DownloadReposTestCase(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -214,11 +254,11 @@ class DownloadReposTestCase(unittest.TestCase):
     def _break_open_url(self, url_regex, corrupt_file_fn):
         original_open_url = open_url
 
-        def my_open_url(url):
+        def my_open_url(url, **kwargs):
             if re.match(url_regex, url):
-                with original_open_url(url) as f:
+                with original_open_url(url, **kwargs) as f:
                     return BytesIO(corrupt_file_fn(f.read()))
-            return original_open_url(url)
+            return original_open_url(url, **kwargs)
 
         with mock.patch(SUT + "common.open_url") as mock_fn:
             mock_fn.side_effect = my_open_url
@@ -322,6 +362,46 @@ class DownloadReposTestCase(unittest.TestCase):
             self.assertEqual(500, error_dict["http_status"])
             self.assertEqual(len(RPM_MAX_RETRY_S), len(mock_sleep.call_args_list))
 
+    def _download_with_broken_mice_connection(self, *, ignore_ranges):
+        original_open_url = open_url
+        offsets = []
+
+        def my_open_url(url, *, offset, **kwargs):
+            if not re.match(MICE_01_RPM_REGEX, url):
+                return original_open_url(url, offset=offset, **kwargs)
+            offsets.append(offset)
+            if offset and ignore_ranges:
+                raise RangeIgnoredError(url)
+            with original_open_url(url, offset=offset, **kwargs) as f:
+                data = f.read()
+            if len(offsets) == 1:  # Break the first connection halfway
+                return _BrokenConnectionStream(data[: len(data) // 2])
+            return BytesIO(data)
+
+        with self._make_downloader("0/good_dog") as downloader, mock.patch(
+            SUT + "common.open_url"
+        ) as mock_fn:
+            mock_fn.side_effect = my_open_url
+            res, = list(downloader())
+        # Whether resumed or restarted, we get the correct RPM.
+        repo, snapshot = res
+        self._check_snapshot(snapshot, _GOOD_DOG_LOCATIONS)
+        return offsets
+
+    @mock.patch("time.sleep", mock.Mock())
+    def test_rpm_download_resumes(self):
+        offsets = self._download_with_broken_mice_connection(ignore_ranges=False)
+        self.assertEqual(2, len(offsets), offsets)
+        self.assertEqual(0, offsets[0])
+        self.assertLess(0, offsets[1])
+
+    @mock.patch("time.sleep", mock.Mock())
+    def test_rpm_download_restarts_if_server_ignores_ranges(self):
+        offsets = self._download_with_broken_mice_connection(ignore_ranges=True)
+        self.assertEqual(3, len(offsets), offsets)
+        self.assertEqual([0, 0], offsets[::2])
+        self.assertLess(0, offsets[1])
+
     @mock.patch("time.sleep", mock.Mock())
     def test_repodata_download_errors(self):
         with self._make_downloader("0/good_dog") as downloader:
@@ -513,17 +593,15 @@ class DownloadReposTestCase(unittest.TestCase):
         "We downloaded & stored a repodata, but in the meantime some other "
         "writer committed the same repodata."
 
-        original_maybe_store = RepoDBContext.maybe_store
         faked_objs = []
 
-        def my_maybe_store(self, table, obj, storage_id):
-            if re.match(FILELISTS_REPODATA_REGEX, obj.location):
-                faked_objs.append(obj)
-                return f"fake_already_stored_{obj.location}"
-            return original_maybe_store(self, table, obj, storage_id)
+        def on_fake(obj):
+            faked_objs.append(obj)
 
         with mock.patch.object(
-            RepoDBContext, "maybe_store", new=my_maybe_store
+            RepoDBContext,
+            "maybe_store_many",
+            new=_fake_already_stored(FILELISTS_REPODATA_REGEX, on_fake),
         ), self._make_downloader("0/good_dog") as downloader:
             res, = list(downloader())
             _, snapshot = res
@@ -539,9 +617,9 @@ class DownloadReposTestCase(unittest.TestCase):
     def test_lose_rpm_commit_race(self):
         "We downloaded & stored an RPM, but in the meantime some other "
         "writer committed the same RPM."
-        original_get_canonical = RepoDBContext.get_rpm_canonical_checksums
+        original_get_canonical = RepoDBContext.get_rpms_canonical_checksums
 
-        # When we download the RPM, the mock `my_maybe_store` writes a
+        # When we download the RPM, the mock `maybe_store_many` writes a
         # single `Checksum` here, the canonical one for the `mice` RPM.
         # Then, during mutable RPM detection, the mock `my_get_canonical`
         # grabs this checksum (since it's not actually in the DB).
@@ -549,25 +627,26 @@ class DownloadReposTestCase(unittest.TestCase):
         # The mice object which was "previously stored" via the mocks
         mice_rpms = []
 
-        def my_get_canonical(self, table, rpm, all_snapshot_universes):
-            if rpm.nevra() == "rpm-test-mice-0:0.1-a.x86_64":
-                return {mice_canonical_checksums[0]}
-            return original_get_canonical(self, table, rpm, all_snapshot_universes)
-
-        original_maybe_store = RepoDBContext.maybe_store
+        def my_get_canonical(self, table, rpms, all_snapshot_universes):
+            rpm_to_checksums = original_get_canonical(
+                self, table, rpms, all_snapshot_universes
+            )
+            for rpm in rpm_to_checksums:
+                if rpm.nevra() == "rpm-test-mice-0:0.1-a.x86_64":
+                    rpm_to_checksums[rpm] = {mice_canonical_checksums[0]}
+            return rpm_to_checksums
 
-        def my_maybe_store(self, table, obj, storage_id):
-            if re.match(MICE_01_RPM_REGEX, obj.location):
-                mice_rpms.append(obj)
-                assert not mice_canonical_checksums, mice_canonical_checksums
-                mice_canonical_checksums.append(obj.canonical_checksum)
-                return f"fake_already_stored_{obj.location}"
-            return original_maybe_store(self, table, obj, storage_id)
+        def on_fake(obj):
+            mice_rpms.append(obj)
+            assert not mice_canonical_checksums, mice_canonical_checksums
+            mice_canonical_checksums.append(obj.canonical_checksum)
 
         with mock.patch.object(
-            RepoDBContext, "get_rpm_canonical_checksums", new=my_get_canonical
+            RepoDBContext, "get_rpms_canonical_checksums", new=my_get_canonical
         ), mock.patch.object(
-            RepoDBContext, "maybe_store", new=my_maybe_store
+            RepoDBContext,
+            "maybe_store_many",
+            new=_fake_already_stored(MICE_01_RPM_REGEX, on_fake),
         ), self._make_downloader(
             "0/good_dog"
         ) as downloader:
@@ -580,6 +659,51 @@ class DownloadReposTestCase(unittest.TestCase):
                 snapshot.storage_id_to_rpm[f"fake_already_stored_{mice_rpm.location}"],
             )
 
+    def test_failed_snapshot_writes_queued_storage_ids(self):
+        "The storage IDs that wait in a batch get written even on failure."
+        orig_add = RepoDBWriteBatcher.add
+        orig_handle_rpm = _handle_rpm
+        queued_rpms = []
+        other_rpms_queued = threading.Event()
+
+        def my_add(self, table, obj, storage_id, on_stored):
+            if isinstance(obj, Rpm):
+                queued_rpms.append(obj)
+                if len(queued_rpms) == len(_GOOD_DOG_LOCATIONS) - 1:
+                    other_rpms_queued.set()
+            return orig_add(self, table, obj, storage_id, on_stored)
+
+        def my_handle_rpm(rpm, *args):
+            if re.match(MICE_01_RPM_REGEX, rpm.location):
+                assert other_rpms_queued.wait(timeout=60)
+                raise RuntimeError("mice")
+            return orig_handle_rpm(rpm, *args)
+
+        with mock.patch.object(
+            RepoDBWriteBatcher, "add", new=my_add
+        ), mock.patch(
+            SUT + "rpm_downloader._handle_rpm", side_effect=my_handle_rpm
+        ), mock.patch(
+            # Nothing gets written before the failure.
+            SUT + "common.DB_WRITE_MAX_DELAY_S",
+            3600,
+        ), tempfile.NamedTemporaryFile() as tmp_db, temp_dir() as storage_dir:
+            with self.assertRaisesRegex(RuntimeError, "^mice$"):
+                self._make_downloader_from_ctx("0/good_dog", tmp_db, storage_dir)()
+            db_conn = DBConnectionContext.from_json(
+                {"kind": "sqlite", "db_path": tmp_db.name, "readonly": True}
+            )
+            with RepoDBContext(db_conn, db_conn.SQL_DIALECT) as repo_db_ctx:
+                rpm_to_stored = repo_db_ctx.get_rpm_storage_ids_and_checksums(
+                    RpmTable("fakeverse"),
+                    [rpm._replace(canonical_checksum=None) for rpm in queued_rpms],
+                )
+        self.assertEqual(len(_GOOD_DOG_LOCATIONS) - 1, len(queued_rpms))
+        self.assertEqual(
+            {(rpm.location, rpm.canonical_checksum) for rpm in queued_rpms},
+            {(rpm.location, chk) for rpm, (_sid, chk) in rpm_to_stored.items()},
+        )
+
     # Test case of having dangling repodata refs without a repomd
     def test_dangling_repodatas(self):
         orig_rd = _download_repodata
@@ -729,17 +853,80 @@ class DownloadReposTestCase(unittest.TestCase):
             # reused for duplicate RPMs
             self.assertEqual(unique_fake_rpms, len(unique_storage_ids))
 
+    def test_pipelined_repos(self):
+        "RPMs of one repo download while another repo's primary is in flight."
+        orig_rd = _download_repodata
+        orig_handle_rpm = _handle_rpm
+        good_dog_rpm_done = threading.Event()
+        waited_for_good_dog_rpm = []
+
+        def my_download_repodata(repodata, *, repo_url, is_primary, **kwargs):
+            if is_primary and "chaos_cat" in repo_url:
+                waited_for_good_dog_rpm.append(good_dog_rpm_done.wait(timeout=60))
+            return orig_rd(repodata, repo_url=repo_url, is_primary=is_primary, **kwargs)
+
+        def my_handle_rpm(rpm, repo_url, *args):
+            res = orig_handle_rpm(rpm, repo_url, *args)
+            if "good_dog" in repo_url:
+                good_dog_rpm_done.set()
+            return res
+
+        with mock.patch(
+            SUT + "repodata_downloader._download_repodata",
+            side_effect=my_download_repodata,
+        ), mock.patch(
+            SUT + "rpm_downloader._handle_rpm", side_effect=my_handle_rpm
+        ), tempfile.NamedTemporaryFile() as tmp_db, temp_dir() as storage_dir:
+            repo_snapshots = list(
+                repo_downloader.download_repos(
+                    repos_and_universes=[
+                        (
+                            YumDnfConfRepo(
+                                name=repo,
+                                base_url=(self.repos_root / "0" / repo).file_url(),
+                                gpg_key_urls=("not_used",),
+                            ),
+                            "fakeverse",
+                        )
+                        for repo in ["good_dog", "chaos_cat"]
+                    ],
+                    cfg=repo_downloader.DownloadConfig(
+                        db_cfg={"kind": "sqlite", "db_path": tmp_db.name},
+                        storage_cfg={
+                            "key": "test",
+                            "kind": "filesystem",
+                            "base_dir": storage_dir,
+                        },
+                        rpm_shard=RpmShard(shard=0, modulo=1),
+                        threads=_THREADS,
+                    ),
+                )
+            )
+        self.assertEqual([True], waited_for_good_dog_rpm)
+        self.assertEqual(
+            {
+                "good_dog": sorted(_GOOD_DOG_LOCATIONS),
+                "chaos_cat": sorted(_CHAOS_CAT.locations("chaos_cat")),
+            },
+            {
+                r.name: sorted(rpm.location for rpm in s.storage_id_to_rpm.values())
+                for r, s in repo_snapshots
+            },
+        )
+
     def test_download_changing_repomds(self):
         original_open_url = open_url
         i = 0
 
-        def my_open_url(url):
+        def my_open_url(url, **kwargs):
             nonlocal i
             postfix = "repodata/repomd.xml"
             if postfix in url:
                 i += 1
-                return original_open_url(re.sub(rf"/(\d)/", rf"/{i % 2}/", url))
-            return original_open_url(url)
+                return original_open_url(
+                    re.sub(rf"/(\d)/", rf"/{i % 2}/", url), **kwargs
+                )
+            return original_open_url(url, **kwargs)
 
         with mock.patch(SUT + "common.open_url") as mock_fn:
             mock_fn.side_effect = my_open_url
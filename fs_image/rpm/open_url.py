@@ -4,25 +4,155 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+'''
+`open_url` reads `file://`, `http://`, and `https://` URLs.
+
+A snapshot downloads tens of thousands of RPMs, mostly from a few mirrors.
+Pass an `HTTPSessionPool` to `open_url` to keep its connections alive
+between requests, instead of paying for a TCP & TLS handshake per file.
+
+Pass an `offset` to resume an interrupted download.  HTTP servers need not
+support byte ranges, so if one sends the whole file instead, `open_url`
+raises `RangeIgnoredError`, and the caller must start over from byte 0.
+'''
 import requests
+import threading
 
 from contextlib import contextmanager
 from io import BytesIO
-from typing import Iterator
+from typing import Dict, Iterator, NamedTuple, Optional
+
+
+class RangeIgnoredError(Exception):
+    'The server sent the whole file, instead of the requested byte range.'
+
+
+class HTTPPoolStats(NamedTuple):
+    requests: int
+    new_connections: int
+
+    @property
+    def reused_connections(self) -> int:
+        return self.requests - self.new_connections
+
+
+class _CountingHTTPAdapter(requests.adapters.HTTPAdapter):
+    '''
+    Counts the requests that it sends, and the connections that its
+    `urllib3` pools open.  The difference is the number of keep-alive
+    connections that got reused.
+    '''
+
+    def __init__(self, **kwargs):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        adapter = self
+
+        # Count `connect` rather than the pool's `_new_conn`, since a pooled
+        # connection that the server closed reconnects without the latter.
+        def counting_pool_class(pool_class):
+            class CountingConnection(pool_class.ConnectionCls):
+                def connect(self):
+                    with adapter._lock:
+                        adapter.new_connections += 1
+                    return super().connect()
+
+            class CountingPool(pool_class):
+                ConnectionCls = CountingConnection
+            return CountingPool
+
+        pool_classes = self.poolmanager.pool_classes_by_scheme
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: counting_pool_class(cls)
+                for scheme, cls in pool_classes.items()
+        }
+
+    def send(self, *args, **kwargs):
+        with self._lock:
+            self.requests += 1
+        return super().send(*args, **kwargs)
+
+
+class HTTPSessionPool:
+    '''
+    Keep-alive HTTP(S) connections, which are safe to share between
+    threads.  For each host, up to `maxsize` idle connections are kept for
+    reuse, so `maxsize` should match the number of downloading threads.
+
+    The connection pools belong to one `requests` adapter, which is
+    thread-safe.  A `requests.Session` is not documented to be, so each
+    thread gets its own, which sends its requests via the shared adapter.
+    '''
+
+    def __init__(self, maxsize: int):
+        self._adapter = _CountingHTTPAdapter(pool_maxsize=maxsize)
+        self._local = threading.local()
+
+    def session(self) -> requests.Session:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            self._local.session = session
+        return session
+
+    def stats(self) -> HTTPPoolStats:
+        with self._adapter._lock:
+            return HTTPPoolStats(
+                requests=self._adapter.requests,
+                new_connections=self._adapter.new_connections,
+            )
+
+
+_MAXSIZE_TO_SESSION_POOL: Dict[int, HTTPSessionPool] = {}
+_SESSION_POOLS_LOCK = threading.Lock()
+
+
+def http_session_pool(maxsize: int) -> HTTPSessionPool:
+    'Returns the process-wide `HTTPSessionPool` of this size.'
+    with _SESSION_POOLS_LOCK:
+        pool = _MAXSIZE_TO_SESSION_POOL.get(maxsize)
+        if pool is None:
+            pool = _MAXSIZE_TO_SESSION_POOL[maxsize] = HTTPSessionPool(maxsize)
+        return pool
 
 
 @contextmanager
-def open_url(url: str) -> Iterator[BytesIO]:
+def open_url(
+    url: str, *, session_pool: Optional[HTTPSessionPool] = None,
+    offset: int = 0,
+) -> Iterator[BytesIO]:
+    'Yields a stream of the bytes of `url`, starting at `offset`.'
     parsed_url = requests.utils.urlparse(url)
     if parsed_url.scheme == 'file':
         assert parsed_url.netloc == '', f'Bad file URL: {url}'
         with open(requests.utils.unquote(parsed_url.path), 'rb') as infile:
+            infile.seek(offset)
             yield infile
     elif parsed_url.scheme in ['http', 'https']:
+        # Without a pool, `requests` makes a new connection per call.
+        get = session_pool.session().get if session_pool else requests.get
         # verify=True is the default, but I want to be explicit about HTTPS,
         # since this function receives GPG key material.
-        with requests.get(url, stream=True, verify=True) as r:
+        with get(
+            url, stream=True, verify=True,
+            headers={'Range': f'bytes={offset}-'} if offset else None,
+        ) as r:
             r.raise_for_status()
+            if offset:
+                if r.status_code != 206:  # "Partial Content"
+                    raise RangeIgnoredError(url)
+                # The format is `bytes <first>-<last>/<size>`
+                content_range = r.headers['content-range']
+                assert content_range.startswith(f'bytes {offset}-'), (
+                    offset, content_range,
+                )
             yield r.raw  # A file-like `io`-style object for the HTTP stream
             if r.raw.isclosed():   # Proxy for "all data was consumed"
                 # Sadly, requests 2.x does not verify content-length :/
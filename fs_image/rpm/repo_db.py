@@ -100,10 +100,14 @@ A database adds value in two key ways:
         snapshot_repos 0 mod 1  # produce a complete snapshot
 '''
 import enum
+import itertools
 import re
 
 from contextlib import AbstractContextManager, contextmanager
-from typing import ContextManager, Iterator, Optional, Set, Tuple, Union
+from typing import (
+    ContextManager, Dict, Iterable, Iterator, List, Optional, Sequence, Set,
+    Tuple, Union,
+)
 
 from fs_image.common import byteme
 
@@ -124,6 +128,13 @@ def validate_universe_name(u):
     return u
 
 
+_NEVRA_COLUMNS = ('name', 'epoch', 'version', 'release', 'arch')
+
+
+def _nevra(rpm: Rpm) -> tuple:
+    return tuple(getattr(rpm, c) for c in _NEVRA_COLUMNS)
+
+
 class StorageTable:
     '''
     A base class for correct `SELECT` / `INSERT` queries against all colums.
@@ -223,6 +234,56 @@ class SQLDialect(enum.Enum):
     MYSQL = 'mysql'
 
 
+def _check_db_values(
+    table: StorageTable, obj: Union[Rpm, Repodata], db_values: tuple,
+) -> None:
+    'Checks that the DB columns we got back agree with `obj`.'
+    for col_name, db_val, val in zip(
+        table.column_names(), db_values[:-1], table.column_values(obj),
+    ):
+        # This `if` is explained in the `Repodata.build_timestamp`
+        # doc.  In essence, we could have seen the same repodata
+        # from a `repomd.xml` that was built either earlier or later
+        # than the one already in the DB.
+        if not (
+            col_name == 'build_timestamp' and type(obj) is Repodata
+        ):
+            assert db_val == val, (db_val, val, obj)
+
+
+def _storage_id_and_checksum_from_rows(
+    tbl: RpmTable, rpm: Rpm, rows: List[tuple],
+) -> Tuple[str, Checksum]:
+    '''
+    `rows` has the `tbl.column_names()` and `storage_id` of each DB row for
+    the NEVRA of `rpm`, whose `checksum` or `canonical_checksum` matches
+    `rpm.checksum`.
+    '''
+    # We can get multiple results:
+    #  - at most 1 match on the `checksum` column
+    #  - many matches on the `canonical_checksum` column
+    # However, they should all have the same size, canonical
+    # checksum, and storage ID, so let's assert that.
+    canonical_checksums = set()
+    other_checksums = set()
+    storage_ids = set()
+    for db_values in rows:
+        storage_ids.add(db_values[-1])
+        for col_name, db_val, val in zip(
+            tbl.column_names(), db_values[:-1], tbl.column_values(rpm),
+        ):
+            if col_name == 'checksum':
+                other_checksums.add(Checksum.from_string(db_val))
+            elif col_name == 'canonical_checksum':
+                canonical_checksums.add(Checksum.from_string(db_val))
+            else:
+                assert db_val == val, f'{col_name} {db_val} {val}'
+    assert len(storage_ids) == 1, storage_ids
+    assert len(canonical_checksums) == 1, canonical_checksums
+    assert rpm.checksum in (other_checksums | canonical_checksums)
+    return (storage_ids.pop(), canonical_checksums.pop())
+
+
 class RepoDBContext(AbstractContextManager):
     '''
     A class to perform read & write queries against our DB of all historical
@@ -247,6 +308,14 @@ class RepoDBContext(AbstractContextManager):
     '''
 
     _DIALECT_TO_PLACEHOLDER = {SQLDialect.SQLITE3: '?', SQLDialect.MYSQL: '%s'}
+    # The most placeholders we put in one query.  SQLite builds before 3.32
+    # refuse more than 999.  `MySQLdb` interpolates the parameters on the
+    # client, so there, the limit is just the size of the query, which has
+    # to fit in `max_allowed_packet` (4MB by default in MySQL 5.7).
+    _DIALECT_TO_MAX_PLACEHOLDERS = {
+        SQLDialect.SQLITE3: 999,
+        SQLDialect.MYSQL: 30000,
+    }
     _DIALECT_TO_COLUMN_TYPE = {
         SQLDialect.SQLITE3: {
             'checksum': 'TEXT',
@@ -402,9 +471,49 @@ class RepoDBContext(AbstractContextManager):
     def _or_ignore(self) -> str:
         return f"{'' if self._dialect == SQLDialect.MYSQL else 'OR'} IGNORE"
 
+    def _insert_or_ignore(self, table: StorageTable) -> str:
+        col_names = table.column_names()
+        return f'''
+            INSERT {self._or_ignore()} INTO `{table.NAME}`
+            ({self._identifiers(col_names)}, `storage_id`)
+            VALUES ({
+                ', '.join([self._placeholder()] * (len(col_names) + 1))
+            })
+        '''
+
     def _identifiers(self, identifiers):
         return ', '.join(f'`{i}`' for i in identifiers)
 
+    def _select_where_in(
+        self, table_name: str, col_names: Iterable[str],
+        key_cols: Sequence[str], keys: Sequence[tuple],
+        and_where: str = '', and_where_params: tuple = (),
+    ) -> Iterator[tuple]:
+        '''
+        Yields the `col_names` of the rows whose `key_cols` equal one of
+        `keys`, and which satisfy the optional `and_where` clause.  Rather
+        than one query per key, each query looks up as many keys as it has
+        room for, via a multi-row `IN`, which works in SQLite & MySQL.
+        '''
+        p = self._placeholder()
+        key_ps = f"({', '.join([p] * len(key_cols))})"
+        batch_size = (
+            self._DIALECT_TO_MAX_PLACEHOLDERS[self._dialect] -
+                len(and_where_params)
+        ) // len(key_cols)
+        for batch_start in range(0, len(keys), batch_size):
+            batch = keys[batch_start:batch_start + batch_size]
+            with self._cursor() as cursor:
+                cursor.execute(f'''
+                    SELECT {self._identifiers(col_names)} FROM `{table_name}`
+                    WHERE ({self._identifiers(key_cols)})
+                        IN ({', '.join([key_ps] * len(batch))}) {and_where}
+                ''', (
+                    *itertools.chain.from_iterable(batch), *and_where_params,
+                ))
+                results = cursor.fetchall()
+            yield from results
+
     def ensure_tables_exist(self, _ensure_line_is_covered=lambda: None):
         # Future: it would be better if this function checked that the table
         # schemas in the DB are exactly as we would create them, and that
@@ -505,30 +614,54 @@ class RepoDBContext(AbstractContextManager):
             results = cursor.fetchall()
         if not results:
             return None, None
+        return _storage_id_and_checksum_from_rows(tbl, rpm, results)
 
-        # We can get multiple results:
-        #  - at most 1 match on the `checksum` column
-        #  - many matches on the `canonical_checksum` column
-        # However, they should all have the same size, canonical
-        # checksum, and storage ID, so let's assert that.
-        canonical_checksums = set()
-        other_checksums = set()
-        storage_ids = set()
-        for db_values in results:
-            storage_ids.add(db_values[-1])
-            for col_name, db_val, val in zip(
-                tbl.column_names(), db_values[:-1], tbl.column_values(rpm),
-            ):
-                if col_name == 'checksum':
-                    other_checksums.add(Checksum.from_string(db_val))
-                elif col_name == 'canonical_checksum':
-                    canonical_checksums.add(Checksum.from_string(db_val))
-                else:
-                    assert db_val == val, f'{col_name} {db_val} {val}'
-        assert len(storage_ids) == 1, storage_ids
-        assert len(canonical_checksums) == 1, canonical_checksums
-        assert rpm.checksum in (other_checksums | canonical_checksums)
-        return (storage_ids.pop(), canonical_checksums.pop())
+    def get_rpm_storage_ids_and_checksums(
+        self, tbl: RpmTable, rpms: Iterable[Rpm],
+    ) -> Dict[Rpm, Tuple[str, Checksum]]:
+        '''
+        The batch version of `get_rpm_storage_id_and_checksum`, for the
+        snapshotter to find which of a repo's RPMs are already stored
+        without one query per RPM.  The RPMs that are not stored are
+        omitted from the result.
+
+        Each query looks up thousands of NEVRAs via a multi-row `IN` on
+        (<NEVRA>, `universe`).  This is a prefix of the primary key, so
+        just like the point query, it only visits the rows of those NEVRAs.
+        '''
+        key_cols = (*_NEVRA_COLUMNS, 'universe')
+        key_to_rpms = {}
+        for rpm in rpms:
+            assert rpm.canonical_checksum is None
+            key_to_rpms.setdefault(
+                (*_nevra(rpm), tbl._universe), [],
+            ).append(rpm)
+        col_names = tbl.column_names()
+        key_idxs = [col_names.index(c) for c in key_cols]
+        checksum_idxs = [
+            col_names.index(c) for c in ('checksum', 'canonical_checksum')
+        ]
+        key_to_rows = {}
+        for db_values in self._select_where_in(
+            tbl.NAME, (*col_names, 'storage_id'), key_cols, list(key_to_rpms),
+        ):
+            key_to_rows.setdefault(
+                tuple(db_values[i] for i in key_idxs), [],
+            ).append(db_values)
+        rpm_to_result = {}
+        for key, rows in key_to_rows.items():
+            for rpm in key_to_rpms.get(key, ()):
+                # Like the `WHERE` clause of the point query.
+                checksum = str(rpm.checksum)
+                rpm_rows = [
+                    r for r in rows
+                        if any(r[i] == checksum for i in checksum_idxs)
+                ]
+                if rpm_rows:
+                    rpm_to_result[rpm] = _storage_id_and_checksum_from_rows(
+                        tbl, rpm, rpm_rows,
+                    )
+        return rpm_to_result
 
     def get_rpm_canonical_checksums(
         self, table: RpmTable, rpm: Rpm, all_snapshot_universes: Set[str],
@@ -542,25 +675,35 @@ class RepoDBContext(AbstractContextManager):
         -- one design principle of universes that unrelated ones can
         legitimately use the same NEVRA to refer to different contents.
         '''
+        yield from self.get_rpms_canonical_checksums(
+            table, [rpm], all_snapshot_universes,
+        )[rpm]
+
+    def get_rpms_canonical_checksums(
+        self, table: RpmTable, rpms: Iterable[Rpm],
+        all_snapshot_universes: Set[str],
+    ) -> Dict[Rpm, Set[Checksum]]:
+        '''
+        The batch version of `get_rpm_canonical_checksums`, which looks up
+        the NEVRAs of many RPMs at once.  Maps each RPM to the canonical
+        checksums of its NEVRA, which may be an empty set.
+        '''
         p = self._placeholder()
         assert table._universe in all_snapshot_universes
         all_snapshot_universe_ps = ', '.join([p] * len(all_snapshot_universes))
-        with self._cursor() as cursor:
-            # Like in `get_rpm_storage_id_and_checksums`, the primary
-            # key helps make this query efficient.
-            cursor.execute(f'''
-                SELECT `canonical_checksum` FROM `{table.NAME}`
-                WHERE (
-                    `name` = {p} AND `epoch` = {p} AND `version` = {p} AND
-                    `release` = {p} AND `arch` = {p} AND
-                    `universe` IN ({all_snapshot_universe_ps})
-                )
-            ''', (
-                rpm.name, rpm.epoch, rpm.version, rpm.release, rpm.arch,
-                *all_snapshot_universes,
-            ))
-            for (canonical_checksum,) in cursor.fetchall():
-                yield Checksum.from_string(canonical_checksum)
+        nevra_to_checksums = {_nevra(rpm): set() for rpm in rpms}
+        # Like in `get_rpm_storage_id_and_checksum`, the primary key helps
+        # make this query efficient.
+        for *nevra, canonical_checksum in self._select_where_in(
+            table.NAME, (*_NEVRA_COLUMNS, 'canonical_checksum'),
+            _NEVRA_COLUMNS, list(nevra_to_checksums),
+            and_where=f'AND `universe` IN ({all_snapshot_universe_ps})',
+            and_where_params=tuple(all_snapshot_universes),
+        ):
+            checksums = nevra_to_checksums.get(tuple(nevra))
+            if checksums is not None:
+                checksums.add(Checksum.from_string(canonical_checksum))
+        return {rpm: nevra_to_checksums[_nevra(rpm)] for rpm in rpms}
 
     def get_storage_id(
         self, table: StorageTable, obj: Union['Rpm', Repodata],
@@ -580,20 +723,35 @@ class RepoDBContext(AbstractContextManager):
             if not results:
                 return None
             db_values, = results
-            # Check that the DB columns we got back agree with `obj`.
-            for col_name, db_val, val in zip(
-                table.column_names(), db_values[:-1], table.column_values(obj),
-            ):
-                # This `if` is explained in the `Repodata.build_timestamp`
-                # doc.  In essence, we could have seen the same repodata
-                # from a `repomd.xml` that was built either earlier or later
-                # than the one already in the DB.
-                if not (
-                    col_name == 'build_timestamp' and type(obj) is Repodata
-                ):
-                    assert db_val == val, (db_val, val, obj)
+            _check_db_values(table, obj, db_values)
             return db_values[-1]  # We put `storage_id` last
 
+    def get_storage_ids(
+        self, table: StorageTable, objs: Sequence[Union['Rpm', Repodata]],
+    ) -> List[Optional[str]]:
+        '''
+        The batch version of `get_storage_id`, whose result has the storage
+        ID of each of `objs`, or `None` if it is not stored.
+        '''
+        col_names = table.column_names()
+        key_idxs = [col_names.index(c) for c in table.KEY_COLUMNS]
+        key_to_db_values = {}
+        for db_values in self._select_where_in(
+            table.NAME, (*col_names, 'storage_id'), table.KEY_COLUMNS,
+            list({table.key(obj): None for obj in objs}),
+        ):
+            key_to_db_values[tuple(db_values[i] for i in key_idxs)] = \
+                db_values
+        storage_ids = []
+        for obj in objs:
+            db_values = key_to_db_values.get(table.key(obj))
+            if db_values is None:
+                storage_ids.append(None)
+            else:
+                _check_db_values(table, obj, db_values)
+                storage_ids.append(db_values[-1])  # We put `storage_id` last
+        return storage_ids
+
     def maybe_store(self, table: StorageTable, obj, storage_id: str) -> str:
         '''
         Records `obj` with `storage_id` in the DB, or if `obj` had already
@@ -606,18 +764,43 @@ class RepoDBContext(AbstractContextManager):
         # a consistency check asserting that all its RPMs are in the DB, but
         # this would make the transaction slow, and thus isn't worth it.
         with self._cursor() as cursor:
-            col_names = table.column_names()
-            cursor.execute(f'''
-                INSERT {self._or_ignore()} INTO `{table.NAME}`
-                ({self._identifiers(col_names)}, `storage_id`)
-                VALUES ({
-                    ', '.join([self._placeholder()] * (len(col_names) + 1))
-                })
-            ''', (*table.column_values(obj), storage_id))
+            cursor.execute(
+                self._insert_or_ignore(table),
+                (*table.column_values(obj), storage_id),
+            )
             if cursor.rowcount:
                 return storage_id  # We won the race to insert our storage_id
             # Our storage_id will not be used, find the already-stored one.
             return self.get_storage_id(table, obj)
 
+    def maybe_store_many(
+        self, table: StorageTable, objs_and_storage_ids: Sequence[Tuple[
+            Union['Rpm', Repodata], str,
+        ]],
+    ) -> List[str]:
+        '''
+        The batch version of `maybe_store`: records all the objects with one
+        `executemany`, and returns the storage ID of each in the DB.  This
+        is the pre-existing one for any object that was already stored.
+        '''
+        if not objs_and_storage_ids:
+            return []
+        # See `maybe_store`.
+        assert all(sid is not None for _, sid in objs_and_storage_ids)
+        with self._cursor() as cursor:
+            cursor.executemany(self._insert_or_ignore(table), [
+                (*table.column_values(obj), storage_id)
+                    for obj, storage_id in objs_and_storage_ids
+            ])
+            # Both SQLite and MySQL sum up the rows inserted by all the
+            # `VALUES`, and the ignored ones do not count.
+            if cursor.rowcount == len(objs_and_storage_ids):
+                # We won all the races to insert our storage IDs
+                return [storage_id for _, storage_id in objs_and_storage_ids]
+        # Some of our storage IDs will not be used, find the stored ones.
+        return self.get_storage_ids(
+            table, [obj for obj, _ in objs_and_storage_ids],
+        )
+
     def commit(self):
         self._conn.commit()
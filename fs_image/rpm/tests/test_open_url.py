@@ -4,12 +4,62 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import http.server
+import re
 import subprocess
 import sys
+import threading
 import unittest
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
 from fs_image.fs_utils import temp_dir
-from ..open_url import open_url
+from ..open_url import (
+    HTTPPoolStats, HTTPSessionPool, RangeIgnoredError, http_session_pool,
+    open_url,
+)
+
+
+class _KeepAliveHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Unlike 1.0, keeps connections alive
+
+    def log_message(self, *args):
+        pass
+
+
+class _RangeHandler(_KeepAliveHandler):
+    'Also serves `Range: bytes=<first>-` requests.'
+
+    def do_GET(self):
+        m = re.fullmatch(r'bytes=([0-9]+)-', self.headers.get('Range', ''))
+        if not m:
+            return super().do_GET()
+        with open(self.translate_path(self.path), 'rb') as in_f:
+            data = in_f.read()
+        first = int(m.group(1))
+        self.send_response(206)
+        self.send_header(
+            'Content-Range', f'bytes {first}-{len(data) - 1}/{len(data)}',
+        )
+        self.send_header('Content-Length', str(len(data) - first))
+        self.end_headers()
+        self.wfile.write(data[first:])
+
+
+@contextmanager
+def _serve_keep_alive(server_dir, handler_class=_KeepAliveHandler):
+    with http.server.ThreadingHTTPServer(
+        ('localhost', 0), partial(handler_class, directory=server_dir),
+    ) as httpd:
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        try:
+            yield 'http://{}:{}/'.format(*httpd.socket.getsockname())
+        finally:
+            httpd.shutdown()
+            thread.join()
 
 
 class OpenUrlTestCase(unittest.TestCase):
@@ -40,3 +90,83 @@ with hs.HTTPServer(('localhost', 0), hs.SimpleHTTPRequestHandler) as httpd:
                         self.assertEqual(b'world', in_f.read())
                 finally:
                     proc.kill()
+
+    def test_session_pool_reuses_connections(self):
+        with temp_dir() as server_dir, _serve_keep_alive(
+            server_dir.decode(),
+        ) as base_url:
+            for i in range(20):
+                with open(server_dir / f'f{i}', 'w') as out_f:
+                    out_f.write('x' * i)
+
+            def read(pool, i):
+                with open_url(base_url + f'f{i}', session_pool=pool) as in_f:
+                    return in_f.read()
+
+            pool = HTTPSessionPool(maxsize=3)
+            self.assertEqual(HTTPPoolStats(0, 0), pool.stats())
+            # Sequential requests use one connection.
+            for i in range(5):
+                self.assertEqual(b'x' * i, read(pool, i))
+            self.assertEqual(HTTPPoolStats(5, 1), pool.stats())
+            self.assertEqual(4, pool.stats().reused_connections)
+
+            # Concurrent requests use up to one connection per thread.
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                self.assertEqual(
+                    [b'x' * i for i in range(20)],
+                    list(executor.map(partial(read, pool), range(20))),
+                )
+                sessions = set(executor.map(
+                    lambda _: pool.session(), range(20),
+                ))
+            self.assertEqual(25, pool.stats().requests)
+            self.assertLessEqual(pool.stats().new_connections, 3)
+            self.assertNotIn(pool.session(), sessions)
+            self.assertIs(pool.session(), pool.session())
+
+    def test_session_pool_counts_closed_connections(self):
+
+        class CloseHandler(_KeepAliveHandler):
+            protocol_version = 'HTTP/1.0'  # Closes after each response
+
+        with temp_dir() as server_dir, _serve_keep_alive(
+            server_dir.decode(), CloseHandler,
+        ) as base_url:
+            with open(server_dir / 'f', 'w') as out_f:
+                out_f.write('abc')
+            pool = HTTPSessionPool(maxsize=1)
+            for _ in range(3):
+                with open_url(base_url + 'f', session_pool=pool) as in_f:
+                    self.assertEqual(b'abc', in_f.read())
+            self.assertEqual(HTTPPoolStats(3, 3), pool.stats())
+            self.assertEqual(0, pool.stats().reused_connections)
+
+    def test_offset(self):
+        with temp_dir() as server_dir:
+            with open(server_dir / 'f', 'w') as out_f:
+                out_f.write('0123456789')
+            with open_url((server_dir / 'f').file_url(), offset=4) as in_f:
+                self.assertEqual(b'456789', in_f.read())
+
+            with _serve_keep_alive(
+                server_dir.decode(), _RangeHandler,
+            ) as base_url:
+                pool = HTTPSessionPool(maxsize=1)
+                for offset in [4, 0, 9]:
+                    with open_url(
+                        base_url + 'f', session_pool=pool, offset=offset,
+                    ) as in_f:
+                        self.assertEqual(b'0123456789'[offset:], in_f.read())
+                self.assertEqual(HTTPPoolStats(3, 1), pool.stats())
+
+            # This server ignores the `Range` header.
+            with _serve_keep_alive(server_dir.decode()) as base_url:
+                with self.assertRaises(RangeIgnoredError), open_url(
+                    base_url + 'f', offset=4,
+                ):
+                    pass  # pragma: no cover
+
+    def test_http_session_pool(self):
+        self.assertIs(http_session_pool(7), http_session_pool(7))
+        self.assertIsNot(http_session_pool(7), http_session_pool(8))
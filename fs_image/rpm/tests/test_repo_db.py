@@ -184,6 +184,30 @@ class RepoDBTestCase(unittest.TestCase):
                     table, obj._replace(build_timestamp=obj.build_timestamp + 1),
                 ))
 
+            # The batch versions behave the same way.
+            obj2 = obj._replace(checksum=Checksum('fake', 'fake2'))
+            obj3 = obj._replace(checksum=Checksum('fake', 'fake3'))
+            self.assertEqual(
+                [None, 'fake1'], db_ctx.get_storage_ids(table, [obj2, obj]),
+            )
+            self.assertEqual([], db_ctx.maybe_store_many(table, []))
+            # We win all the races.
+            self.assertEqual(['fake2'], db_ctx.maybe_store_many(
+                table, [(obj2, 'fake2')],
+            ))
+            # We lose some races, including one against ourselves.
+            self.assertEqual(
+                ['fake3', 'fake1', 'fake2', 'fake3'],
+                db_ctx.maybe_store_many(table, [
+                    (obj3, 'fake3'), (obj, 'fake4'), (obj2, 'fake5'),
+                    (obj3, 'fake6'),
+                ]),
+            )
+            self.assertEqual(
+                ['fake1', 'fake2', 'fake3'],
+                db_ctx.get_storage_ids(table, [obj, obj2, obj3]),
+            )
+
     def test_repodata_maybe_store_and_get_storage_id(self):
         self._check_maybe_store_and_get_storage_id(
             RepodataTable(),
@@ -241,6 +265,65 @@ class RepoDBTestCase(unittest.TestCase):
                         db_ctx.get_rpm_storage_id_and_checksum(table, rpm),
                     )
 
+    def test_get_rpm_storage_ids_and_checksums(self):
+        table = RpmTable('fakeverse')
+        canonical = Checksum('can', 'onical')
+        stored = [
+            _FAKE_RPM._replace(
+                release=f'{idx}b', checksum=Checksum('fa', f'ke{idx}'),
+            ) for idx in range(7)
+        ]
+        # The same NEVRA, stored under a second checksum ...
+        stored.append(stored[0]._replace(checksum=Checksum('fa', 'ke0b')))
+        rpms = [
+            *stored,
+            # ... or looked up via its canonical checksum.
+            stored[0]._replace(checksum=canonical),
+            # Not stored: a known NEVRA with an unknown checksum, a new
+            # NEVRA, and a NEVRA that is only stored in another universe.
+            stored[1]._replace(checksum=Checksum('fa', 'ke1b')),
+            _FAKE_RPM._replace(release='9b', checksum=Checksum('fa', 'ke9')),
+            _FAKE_RPM._replace(release='8b', checksum=Checksum('fa', 'ke8')),
+        ]
+        with self._make_db_ctx() as db_ctx:
+            self.assertEqual(
+                {}, db_ctx.get_rpm_storage_ids_and_checksums(table, rpms),
+            )
+            # Both checksums of the first NEVRA share its storage ID.
+            for idx, rpm in enumerate(stored):
+                db_ctx.maybe_store(
+                    table,
+                    rpm._replace(canonical_checksum=canonical),
+                    f'sid{idx % 7}',
+                )
+            db_ctx.maybe_store(
+                RpmTable('otherverse'),
+                rpms[-1]._replace(canonical_checksum=canonical),
+                'sid_other',
+            )
+            expected = {}
+            for rpm in rpms:
+                sid_and_chk = db_ctx.get_rpm_storage_id_and_checksum(
+                    table, rpm,
+                )
+                if sid_and_chk != (None, None):
+                    expected[rpm] = sid_and_chk
+            self.assertEqual(len(stored) + 1, len(expected))
+            self.assertEqual(
+                ('sid0', canonical),
+                expected[stored[0]._replace(checksum=canonical)],
+            )
+            # Exercise splitting the lookup into several queries.
+            for max_placeholders in [999, 12, 6]:
+                with mock.patch.dict(
+                    RepoDBContext._DIALECT_TO_MAX_PLACEHOLDERS,
+                    {SQLDialect.SQLITE3: max_placeholders},
+                ):
+                    self.assertEqual(
+                        expected,
+                        db_ctx.get_rpm_storage_ids_and_checksums(table, rpms),
+                    )
+
     def test_get_rpm_canonical_checksums(self):
         table = RpmTable('fakeverse')
         canonical1 = Checksum('can', 'onical1')
@@ -282,6 +365,31 @@ class RepoDBTestCase(unittest.TestCase):
                 )),
             )
 
+            # Look up several NEVRAs at once, in several queries.
+            other_rpm = _FAKE_RPM._replace(release='4b')
+            db_ctx.maybe_store(RpmTable('otherverse'), other_rpm._replace(
+                checksum=canonical2, canonical_checksum=canonical2,
+            ), 'sid_other')
+            rpms = [_FAKE_RPM, other_rpm, _FAKE_RPM._replace(release='5b')]
+            for universes, expected in [
+                ({'fakeverse'}, [{canonical1, canonical2}, set(), set()]),
+                (
+                    {'fakeverse', 'otherverse'},
+                    [{canonical1, canonical2}, {canonical2}, set()],
+                ),
+            ]:
+                for max_placeholders in [999, 7]:
+                    with mock.patch.dict(
+                        RepoDBContext._DIALECT_TO_MAX_PLACEHOLDERS,
+                        {SQLDialect.SQLITE3: max_placeholders},
+                    ):
+                        self.assertEqual(
+                            dict(zip(rpms, expected)),
+                            db_ctx.get_rpms_canonical_checksums(
+                                table, rpms, universes,
+                            ),
+                        )
+
     def test_universe_charset(self):
         # Until convinced otherwise, we hate underscores since they look
         # like spaces and needlessly exacerbate our RSI.